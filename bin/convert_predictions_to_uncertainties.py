@@ -1,4 +1,5 @@
 import os
+import sys
 import copy
 import h5py
 from lazyflow.utility import PathComponents
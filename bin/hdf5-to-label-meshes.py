@@ -0,0 +1,65 @@
+"""
+hdf5-to-label-meshes.py
+
+Usage: python hdf5-to-label-meshes.py [--label=<N> ...] [--format=obj|ply] <input-file.h5>[/dataset] [<output-dir>]
+
+Exports a mesh for each object (label) in the given hdf5 label volume, in .obj (or .ply) format.
+Unlike hdf5-to-mesh.py, this needs neither Qt nor VTK, and the volume doesn't have to fit into memory:
+The bounding boxes of all objects are found in one pass over the volume, and each object is meshed
+(with marching cubes) within its bounding box.
+See ilastik.utility.labelMeshes
+"""
+import os
+import sys
+import argparse
+
+import h5py
+from lazyflow.utility import PathComponents
+
+from ilastik.utility.labelMeshes import label_meshes, MESH_WRITERS
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--label", type=int, action='append',
+                        help="Only export the mesh of this label (can be given several times). Default: all labels")
+    parser.add_argument("--format", choices=MESH_WRITERS.keys(), default='obj')
+    parser.add_argument("--spacing", type=float, nargs=3, help="The size of a voxel along each axis of the volume")
+    parser.add_argument("--decimation", type=float,
+                        help="Simplify the meshes, by merging the vertices within cells of this size (in voxels)")
+    parser.add_argument("--block-size", type=int, help="The size of the blocks to read when searching the objects")
+    parser.add_argument("input_hdf5_path", help="The label volume, e.g. /tmp/myfile.h5/labels")
+    parser.add_argument("output_dir", nargs='?', help="Default: next to the input file, named like it")
+    parsed_args = parser.parse_args()
+
+    path_comp = PathComponents(parsed_args.input_hdf5_path)
+    output_dir = parsed_args.output_dir or os.path.splitext(path_comp.externalPath)[0] + "_meshes"
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    with h5py.File(path_comp.externalPath, 'r') as f_input:
+        if path_comp.internalPath:
+            dataset = f_input[path_comp.internalPath]
+        else:
+            dataset_names = []
+            f_input.visit( lambda name: dataset_names.append(name) if isinstance(f_input[name], h5py.Dataset) else None )
+            if len(dataset_names) != 1:
+                sys.stderr.write("Input HDF5 file should have exactly 1 dataset, or the dataset name must be given.\n")
+                sys.exit(1)
+            dataset = f_input[dataset_names[0]]
+
+        block_shape = None
+        if parsed_args.block_size:
+            block_shape = (parsed_args.block_size,) * len(dataset.shape)
+
+        write_mesh = MESH_WRITERS[parsed_args.format]
+        mesh_count = 0
+        for label, vertices, faces in label_meshes( dataset, parsed_args.label, parsed_args.spacing,
+                                                    parsed_args.decimation, block_shape ):
+            write_mesh( os.path.join(output_dir, "label_{}.{}".format(label, parsed_args.format)), vertices, faces )
+            mesh_count += 1
+
+    print "Saved {} meshes to {}".format( mesh_count, output_dir )
+    print "DONE."
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""
+Compute the voxel count, bounding box and centroid of every object in an hdf5 label volume
+(and the sum and mean of its intensities in a raw image), and write them to a csv file or hdf5 dataset.
+
+Unlike labelcounts.py (which counts the labels of a project file), this reads any label volume,
+block by block and in parallel, so it doesn't have to fit into memory.
+See ilastik.utility.labelStatistics
+"""
+
+from ilastik.utility.labelStatistics import label_statistics, write_csv, write_hdf5
+
+if __name__ == "__main__":
+    import h5py
+    import argparse
+    from lazyflow.utility import PathComponents
+    from lazyflow.request import Request
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('h5_volume_path', help='A path to the hdf5 label volume, with internal dataset name, e.g. /tmp/myfile.h5/myvolume')
+    parser.add_argument('output_path', help='A csv file, or an hdf5 dataset, e.g. /tmp/stats.h5/statistics')
+    parser.add_argument('--raw', help='A path to an hdf5 raw volume of the same shape, for the intensity statistics')
+    parser.add_argument('--include-background', action='store_true', help='Also list label 0')
+    parser.add_argument('--block-size', type=int,
+                        help='The size of the blocks to read (default: the hdf5 chunks, at least 128 voxels)')
+    parser.add_argument('--thread-count', type=int, help='The threadpool size (default: one thread per core)')
+
+    parsed_args = parser.parse_args()
+    if parsed_args.thread_count is not None:
+        Request.reset_thread_pool(parsed_args.thread_count)
+
+    label_path_comp = PathComponents(parsed_args.h5_volume_path)
+    with h5py.File(label_path_comp.externalPath, 'r') as label_file:
+        labels = label_file[label_path_comp.internalPath]
+        block_shape = None
+        if parsed_args.block_size is not None:
+            block_shape = (parsed_args.block_size,) * len(labels.shape)
+
+        raw_file = None
+        raw = None
+        if parsed_args.raw:
+            raw_path_comp = PathComponents(parsed_args.raw)
+            raw_file = h5py.File(raw_path_comp.externalPath, 'r')
+            raw = raw_file[raw_path_comp.internalPath]
+        try:
+            table = label_statistics(labels, raw, block_shape, include_background=parsed_args.include_background)
+        finally:
+            if raw_file is not None:
+                raw_file.close()
+
+    output_path_comp = PathComponents(parsed_args.output_path)
+    if output_path_comp.extension in PathComponents.HDF5_EXTS:
+        with h5py.File(output_path_comp.externalPath, 'a') as f:
+            write_hdf5(table, f, output_path_comp.internalPath or 'label_statistics')
+    else:
+        write_csv(table, parsed_args.output_path)
+
+    print "Wrote the statistics of {} labels to {}".format( len(table), parsed_args.output_path )
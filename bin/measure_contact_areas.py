@@ -0,0 +1,60 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+"""
+Measure the contact areas of all pairs of touching objects in a label volume
+and write them to a csv file (columns: label_1, label_2, contact_area).
+
+The volume is read block by block, so it doesn't have to fit into memory.
+See ilastik.utility.contactSurfaces for the definition of the contact area.
+"""
+import csv
+
+from ilastik.utility.contactSurfaces import contact_area_table
+
+if __name__ == "__main__":
+    import h5py
+    import argparse
+    from lazyflow.utility import PathComponents
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('h5_volume_path', help='A path to the hdf5 volume, with internal dataset name, e.g. /tmp/myfile.h5/myvolume')
+    parser.add_argument('output_csv', help='The csv file to write the contact areas to')
+    parser.add_argument('--contact-distance', type=int, default=1,
+                        help='Count the voxels of object 2 at this distance to object 1 (default: 1, i.e. sharing a face)')
+    parser.add_argument('--block-size', type=int,
+                        help='The size of the blocks to read (default: the hdf5 chunks, at least 64 voxels)')
+
+    parsed_args = parser.parse_args()
+    h5_path_comp = PathComponents(parsed_args.h5_volume_path)
+
+    with h5py.File(h5_path_comp.externalPath, 'r') as f:
+        dataset = f[h5_path_comp.internalPath]
+        block_shape = None
+        if parsed_args.block_size is not None:
+            block_shape = (parsed_args.block_size,) * len(dataset.shape)
+        table = contact_area_table(dataset, parsed_args.contact_distance, block_shape)
+
+    with open(parsed_args.output_csv, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(table.dtype.names)
+        writer.writerows(table.tolist())
+
+    print "Wrote the contact areas of {} object pairs to {}".format( len(table), parsed_args.output_csv )
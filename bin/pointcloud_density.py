@@ -0,0 +1,355 @@
+import sys
+import os
+import shutil
+import tempfile
+
+import numpy
+import h5py
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Streaming version of downsample_pointcloud.py (for .h5 output):
+# The csv file is parsed in chunks and the points are sorted into one temporary file per block of the volume.
+# Then the density of each block is accumulated from its file and written to a chunked hdf5 dataset once,
+# so neither the pointcloud nor the volume have to fit into memory.
+
+DEFAULT_CSV_FORMAT = { 'delimiter' : '\t', 'lineterminator' : '\n' }
+
+# Bytes of csv text that are parsed at once (whole lines)
+DEFAULT_CSV_CHUNK_BYTES = 64 * 2**20
+
+# Blocks of the density volume that are accumulated/smoothed at once, and the chunks of the hdf5 datasets.
+DEFAULT_BLOCK_SHAPE_ZYX = (64, 256, 256)
+DEFAULT_CHUNK_SHAPE_ZYX = (32, 64, 64)
+
+# The points of a block are stored in a temporary file as their index within the block (and their weight, for 'by_size').
+_SPILL_RECORD_DTYPE = numpy.dtype([('index', numpy.int64), ('weight', numpy.float64)])
+
+def pointcloud_density_hdf5( pointcloud_csv_filepath,
+                             output_filepath,
+                             dset_name='downsampled_density',
+                             scale_xyz=None,
+                             offset_xyz=None,
+                             volume_shape_xyz=None,
+                             method='by_count',
+                             smoothing_sigma_xyz=None,
+                             normalize_with_max=None,
+                             output_dtype=None,
+                             csv_format=DEFAULT_CSV_FORMAT,
+                             block_shape_zyx=DEFAULT_BLOCK_SHAPE_ZYX,
+                             csv_chunk_bytes=DEFAULT_CSV_CHUNK_BYTES ):
+    """
+    Generate an intensity volume from the given pointcloud file, like downsample_pointcloud() does,
+    and write it to a chunked hdf5 dataset.
+
+    The csv file is read once more than downsample_pointcloud() does if the
+    offset or the volume shape is not given (to find the bounding box of the points).
+    The smoothing is done block by block (with a halo), see smooth_blockwise().
+
+    block_shape_zyx: The blocks to accumulate and smooth at a time.
+    csv_chunk_bytes: The amount of csv text to parse at a time.
+    other parameters: See downsample_pointcloud.py
+    """
+    if method not in ('binary', 'by_count', 'by_size'):
+        raise ValueError("Unknown method: {}".format( method ))
+    columns = ['x_px', 'y_px', 'z_px']
+    if method == 'by_size':
+        columns.append('size_px')
+
+    # Determine offset and volume shape from the bounding box if not provided.
+    if not offset_xyz or not volume_shape_xyz:
+        min_xyz, max_xyz = pointcloud_bounds( pointcloud_csv_filepath, csv_format, csv_chunk_bytes )
+        if not offset_xyz:
+            offset_xyz = min_xyz
+        if not volume_shape_xyz:
+            volume_shape_xyz = 1 + max_xyz - offset_xyz
+    offset_xyz = numpy.array(offset_xyz, dtype=numpy.int64)
+    volume_shape_xyz = numpy.array(volume_shape_xyz, dtype=numpy.int64)
+    logger.debug("Subtracting offset: {}".format( offset_xyz ))
+    logger.debug("Assuming original volume shape: {}".format( volume_shape_xyz ))
+
+    if not scale_xyz:
+        logger.debug("No scale provided. Rendering at full scale.")
+        scale_xyz = (1, 1, 1)
+    scale_xyz = numpy.ones(3) * scale_xyz
+    scaled_volume_shape_xyz = ((volume_shape_xyz + scale_xyz - 1) // scale_xyz).astype(numpy.int64)
+    scaled_volume_shape_zyx = tuple(scaled_volume_shape_xyz[::-1])
+
+    if method == 'binary':
+        density_dtype = numpy.uint8
+    else:
+        density_dtype = numpy.float32
+
+    postprocess = smoothing_sigma_xyz or normalize_with_max or output_dtype
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        with h5py.File(output_filepath, 'w') as f_out:
+            if not postprocess:
+                density_file = f_out
+                density_dset_name = dset_name
+            else:
+                density_file = h5py.File( os.path.join(tmp_dir, 'density.h5'), 'w' )
+                density_dset_name = 'density'
+
+            logger.debug("Initializing volume of zyx shape: {}".format( scaled_volume_shape_zyx ))
+            density_dset = _create_volume_dataset( density_file, density_dset_name, scaled_volume_shape_zyx, density_dtype )
+
+            logger.debug("Sorting points into blocks...")
+            spill_dir = os.path.join(tmp_dir, 'blocks')
+            os.mkdir(spill_dir)
+            for rows in iter_csv_chunks( pointcloud_csv_filepath, columns, csv_format, csv_chunk_bytes ):
+                coordinates_xyz = (rows[:, :3].astype(numpy.int64) - offset_xyz) // scale_xyz
+                coordinates_zyx = coordinates_xyz[:, ::-1].astype(numpy.int64)
+                if method == 'by_size':
+                    weights = rows[:, 3]
+                else:
+                    weights = None
+                spill_points( spill_dir, scaled_volume_shape_zyx, coordinates_zyx, weights, block_shape_zyx )
+
+            logger.debug("Accumulating densities...")
+            accumulate_spilled_points( spill_dir, density_dset, method, block_shape_zyx )
+
+            if postprocess:
+                source_dset = density_dset
+                if smoothing_sigma_xyz:
+                    logger.debug("Smoothing with sigma: {}".format( smoothing_sigma_xyz ))
+                    smoothing_sigma_zyx = (numpy.ones(3) * smoothing_sigma_xyz)[::-1]
+                    source_dset = _create_volume_dataset( density_file, 'smoothed', scaled_volume_shape_zyx, numpy.float32 )
+                    smooth_blockwise( density_dset, source_dset, smoothing_sigma_zyx, block_shape_zyx )
+
+                factor = None
+                if normalize_with_max:
+                    logger.debug("Normalizing with max: {}".format( normalize_with_max ))
+                    max_px = dataset_max( source_dset, block_shape_zyx )
+                    if max_px > 0:
+                        factor = normalize_with_max / max_px
+
+                output_dset = _create_volume_dataset( f_out, dset_name, scaled_volume_shape_zyx,
+                                                      output_dtype or source_dset.dtype )
+                for block_slicing in _block_slicings( scaled_volume_shape_zyx, block_shape_zyx ):
+                    block = source_dset[block_slicing]
+                    if factor is not None:
+                        block = (block * factor).astype(block.dtype)
+                    output_dset[block_slicing] = numpy.asarray( block, dtype=output_dset.dtype )
+                density_file.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+    logger.debug("FINISHED downsampling pointcloud.")
+
+def iter_csv_chunks( pointcloud_csv_filepath, columns, csv_format=DEFAULT_CSV_FORMAT, chunk_bytes=DEFAULT_CSV_CHUNK_BYTES ):
+    """
+    Parse the (numeric) csv file in chunks of lines.
+    The csv file must include a header row.
+
+    columns: The names of the columns to return.
+    Yields: float64 arrays of shape (N, len(columns)), in the order of the given columns.
+    """
+    delimiter = csv_format['delimiter']
+    with open(pointcloud_csv_filepath, 'r') as f_in:
+        column_names = f_in.readline().rstrip('\r\n').split(delimiter)
+        missing_columns = set(columns) - set(column_names)
+        assert not missing_columns, \
+            "Your pointcloud data file does not contain all expected columns.\n"\
+            "Expected columns: {},\n"\
+            "Your file's columns: {}"\
+            .format( columns, column_names )
+        column_indexes = [column_names.index(column) for column in columns]
+
+        while True:
+            lines = f_in.readlines(chunk_bytes)
+            if not lines:
+                break
+            text = ''.join(lines)
+            if not delimiter.isspace():
+                text = text.replace(delimiter, ' ')
+            # (fromstring's whitespace separator matches tabs and newlines, too)
+            data = numpy.fromstring(text, dtype=numpy.float64, sep=' ')
+            num_rows = sum(1 for line in lines if line.strip())
+            if data.size != num_rows * len(column_names):
+                raise ValueError("Couldn't parse the pointcloud data in lines {}".format( lines[:3] ))
+            yield data.reshape( (num_rows, len(column_names)) )[:, column_indexes]
+
+def pointcloud_bounds( pointcloud_csv_filepath, csv_format=DEFAULT_CSV_FORMAT, chunk_bytes=DEFAULT_CSV_CHUNK_BYTES ):
+    """
+    Returns the min and max x,y,z coordinates of the points (as int64 arrays).
+    """
+    min_xyz = None
+    max_xyz = None
+    for rows in iter_csv_chunks( pointcloud_csv_filepath, ['x_px', 'y_px', 'z_px'], csv_format, chunk_bytes ):
+        if len(rows) == 0:
+            continue
+        chunk_min = rows.min(axis=0).astype(numpy.int64)
+        chunk_max = rows.max(axis=0).astype(numpy.int64)
+        if min_xyz is None:
+            min_xyz, max_xyz = chunk_min, chunk_max
+        else:
+            min_xyz = numpy.minimum(min_xyz, chunk_min)
+            max_xyz = numpy.maximum(max_xyz, chunk_max)
+    assert min_xyz is not None, "The pointcloud file is empty: {}".format( pointcloud_csv_filepath )
+    return min_xyz, max_xyz
+
+def spill_points( spill_dir, shape_zyx, coordinates_zyx, weights, block_shape_zyx ):
+    """
+    Append the points to the temporary files of the blocks they fall into
+    (one file per block of the volume, see accumulate_spilled_points()).
+
+    coordinates_zyx: int array of shape (N, 3)
+    weights: The weight of each point, or None (count each point once).
+    """
+    if len(coordinates_zyx) == 0:
+        return
+    shape = numpy.array(shape_zyx)
+    assert ((coordinates_zyx >= 0) & (coordinates_zyx < shape)).all(), \
+        "Some points lie outside the volume of shape (zyx) {}".format( tuple(shape) )
+    block_shape = numpy.minimum(block_shape_zyx, shape)
+
+    # Sort the points by block
+    block_coords = coordinates_zyx // block_shape
+    blocks_per_axis = (shape + block_shape - 1) // block_shape
+    block_ids = numpy.ravel_multi_index( block_coords.T, blocks_per_axis )
+    order = numpy.argsort( block_ids, kind='mergesort' )
+    block_ids = block_ids[order]
+    coordinates_zyx = coordinates_zyx[order]
+    bounds = numpy.flatnonzero( numpy.concatenate( ([True], block_ids[1:] != block_ids[:-1], [True]) ) )
+
+    # Store the index of each point within its block (and its weight)
+    start = block_coords[order] * block_shape
+    stop = numpy.minimum(start + block_shape, shape)
+    local_indexes = numpy.zeros( len(coordinates_zyx), dtype=numpy.int64 )
+    for axis in range(3):
+        local_indexes = local_indexes * (stop[:, axis] - start[:, axis]) + (coordinates_zyx[:, axis] - start[:, axis])
+    if weights is None:
+        records = local_indexes
+    else:
+        records = numpy.empty( len(local_indexes), dtype=_SPILL_RECORD_DTYPE )
+        records['index'] = local_indexes
+        records['weight'] = weights[order]
+
+    for first, last in zip(bounds[:-1], bounds[1:]):
+        with open( os.path.join(spill_dir, str(block_ids[first])), 'ab' ) as f:
+            records[first:last].tofile(f)
+
+def accumulate_spilled_points( spill_dir, density_dset, method, block_shape_zyx ):
+    """
+    Compute the density of each block that contains points from its temporary file
+    (see spill_points()), and write it to the density volume (each block only once).
+    Blocks without points are not written.
+
+    method: 'binary' (set to 1) or 'by_count'/'by_size' (accumulate the weights).
+    """
+    shape = numpy.array(density_dset.shape)
+    block_shape = numpy.minimum(block_shape_zyx, shape)
+    blocks_per_axis = (shape + block_shape - 1) // block_shape
+    for block_id in sorted( int(name) for name in os.listdir(spill_dir) ):
+        start = numpy.array( numpy.unravel_index( block_id, blocks_per_axis ) ) * block_shape
+        stop = numpy.minimum(start + block_shape, shape)
+        block_size = numpy.prod(stop - start)
+
+        records = numpy.fromfile( os.path.join(spill_dir, str(block_id)),
+                                  dtype=_SPILL_RECORD_DTYPE if method == 'by_size' else numpy.int64 )
+        if method == 'binary':
+            block = numpy.zeros( block_size, dtype=density_dset.dtype )
+            block[records] = 1
+        elif method == 'by_count':
+            block = numpy.bincount( records, minlength=block_size )
+        else:
+            block = numpy.bincount( records['index'], records['weight'], minlength=block_size )
+        slicing = tuple( slice(a, b) for a, b in zip(start, stop) )
+        density_dset[slicing] = block.reshape(stop - start).astype(density_dset.dtype)
+
+def smooth_blockwise( input_dset, output_dset, sigma_zyx, block_shape_zyx ):
+    """
+    Gaussian smoothing (vigra.filters.gaussianSmoothing), one block at a time.
+    Each block is smoothed with a halo of the filter's radius (clipped at the volume border,
+    where vigra reflects the volume as it does for the whole volume).
+    """
+    import vigra
+    shape = numpy.array(input_dset.shape)
+    halo = numpy.ceil( 3.0 * numpy.array(sigma_zyx) ).astype(int) + 1
+    for block_slicing in _block_slicings( shape, block_shape_zyx ):
+        start = numpy.array([s.start for s in block_slicing])
+        stop = numpy.array([s.stop for s in block_slicing])
+        halo_start = numpy.maximum(start - halo, 0)
+        halo_stop = numpy.minimum(stop + halo, shape)
+        block = input_dset[tuple( slice(a, b) for a, b in zip(halo_start, halo_stop) )]
+        block = vigra.taggedView( numpy.asarray(block, numpy.float32), 'zyx' )
+        smoothed = vigra.filters.gaussianSmoothing( block, tuple(sigma_zyx) )
+        output_dset[block_slicing] = smoothed[tuple( slice(a, b) for a, b in zip(start - halo_start, stop - halo_start) )]
+
+def dataset_max( dset, block_shape_zyx ):
+    return max( dset[block_slicing].max() for block_slicing in _block_slicings( dset.shape, block_shape_zyx ) )
+
+def _block_slicings( shape, block_shape ):
+    block_shape = numpy.minimum(block_shape, shape)
+    for block_index in numpy.ndindex( *((numpy.array(shape) + block_shape - 1) // block_shape) ):
+        start = numpy.array(block_index) * block_shape
+        stop = numpy.minimum(start + block_shape, shape)
+        yield tuple( slice(a, b) for a, b in zip(start, stop) )
+
+def _create_volume_dataset( h5_file, dset_name, shape_zyx, dtype ):
+    chunks = tuple( numpy.minimum(DEFAULT_CHUNK_SHAPE_ZYX, shape_zyx) )
+    dset = h5_file.create_dataset( dset_name, shape_zyx, dtype, chunks=chunks )
+
+    # Try to provide axistags on the volume if possible.
+    try:
+        import vigra
+        dset.attrs["axistags"] = vigra.defaultAxistags( "zyx" ).toJSON()
+    except ImportError:
+        pass
+    return dset
+
+if __name__ == "__main__":
+    # When executing from cmdline, print all logging output
+    logger.addHandler( logging.StreamHandler(sys.stdout) )
+    logger.setLevel(logging.DEBUG)
+
+    # Define cmd-line API (same as downsample_pointcloud.py, but only for hdf5 output)
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--method", choices=['binary', 'by_count', 'by_size'], default='by_count',
+                        help="The method by which points will be accumulated into the downsampled volume.")
+    parser.add_argument("--smooth_with_sigma_xyz", required=False)
+    parser.add_argument("--normalize_with_max", required=False)
+    parser.add_argument("--output_dtype", required=False)
+    parser.add_argument("--dset_name", default='downsampled_density')
+    parser.add_argument("pointcloud_csv_filepath")
+    parser.add_argument("output_filepath", help="Path to .h5 file to (over)write.")
+    parser.add_argument("scale_xyz", nargs='?', default=None,
+                        help="Scale to divide all coordinates by (after offset), e.g. 1000.0 or [100, 100, 1.1]")
+
+    # These parameters aren't usually needed...
+    parser.add_argument("offset_xyz", nargs='?', default=None,
+                        help="Offset to remove from all point coordinates before processing, e.g. 10.0 or [7.1, 8, 0]")
+    parser.add_argument("volume_shape_xyz", nargs='?', default=None,
+                        help="Full shape of the original volume. If not provided, use bounding box of the pointcloud.")
+
+    parsed_args = parser.parse_args()
+
+    # Evaluate tuple args if provided
+    volume_shape_xyz = parsed_args.volume_shape_xyz and eval(parsed_args.volume_shape_xyz)
+    offset_xyz = parsed_args.offset_xyz and eval(parsed_args.offset_xyz)
+    scale_xyz = parsed_args.scale_xyz and eval(parsed_args.scale_xyz)
+    smoothing_sigma_xyz = parsed_args.smooth_with_sigma_xyz and eval(parsed_args.smooth_with_sigma_xyz)
+
+    # Evaluate other optional args
+    output_dtype = None
+    if parsed_args.output_dtype:
+        assert parsed_args.output_dtype in \
+            [ 'uint8', 'int8', 'uint16', 'int16', 'uint32', 'int32', 'uint64', 'int64', 'float32', 'float64' ], \
+            "Unknown dtype: {}".format( parsed_args.output_dtype )
+        output_dtype = eval( "numpy." + parsed_args.output_dtype )
+
+    normalize_with_max = parsed_args.normalize_with_max and eval(parsed_args.normalize_with_max)
+
+    # Main func.
+    sys.exit( pointcloud_density_hdf5( parsed_args.pointcloud_csv_filepath,
+                                       parsed_args.output_filepath,
+                                       parsed_args.dset_name,
+                                       scale_xyz,
+                                       offset_xyz,
+                                       volume_shape_xyz,
+                                       parsed_args.method,
+                                       smoothing_sigma_xyz,
+                                       normalize_with_max,
+                                       output_dtype ) )
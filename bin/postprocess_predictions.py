@@ -0,0 +1,290 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2016, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+"""
+Compute the segmentation, uncertainties, entropy and/or thresholded segmentation
+of exported pixel predictions (hdf5, channel axis last), all in a single pass.
+
+Replaces convert_predictions_to_segmentation.py and convert_predictions_to_uncertainties.py
+for large volumes and many files:
+
+- The predictions are read in blocks that are aligned with the dataset's chunks,
+  and the blocks are processed in parallel, a few blocks ahead of the one being written.
+- All requested outputs are computed from the same block, and written to the same output file.
+- Several files are processed at the same time, as many as fit into the memory budget.
+
+Example:
+
+    python postprocess_predictions.py --outputs segmentation uncertainties /path/to/*_Probabilities.h5
+
+writes /path/to/*_Probabilities_Postprocessed.h5, with the datasets 'segmentation' and 'uncertainties'.
+"""
+import os
+import json
+import collections
+from functools import partial
+
+import numpy
+import h5py
+
+from lazyflow.utility import PathComponents
+from lazyflow.request import Request
+from ilastik.utility import MemoryBoundedScheduler
+from ilastik.utility.blocking import block_rois
+
+import logging
+logger = logging.getLogger(__name__)
+
+DEFAULT_BLOCK_BYTES = 64 * 2**20
+
+# Number of blocks (of each file) being processed while the current block is written
+DEFAULT_PREFETCH = 4
+
+DEFAULT_THRESHOLD = 0.5
+
+def segmentation(pmap, threshold):
+    """
+    The index of the channel with the highest value, 1-based (like OpArgmaxChannel).
+    """
+    result = numpy.argmax(pmap, axis=-1).astype(numpy.uint8)
+    result += 1
+    return result
+
+def uncertainties(pmap, threshold):
+    """
+    1 minus the margin between the highest two probabilities (like OpEnsembleMargin).
+    """
+    if pmap.shape[-1] <= 1:
+        return numpy.zeros(pmap.shape[:-1], dtype=pmap.dtype)
+    # Only the two highest channels are needed, no full sort.
+    top_two = numpy.partition(pmap, pmap.shape[-1] - 2, axis=-1)[..., -2:]
+    return 1 - (top_two[..., 1] - top_two[..., 0])
+
+def entropy(pmap, threshold):
+    """
+    The entropy of the (normalized) probabilities, divided by its maximum (log of the channel count),
+    so it ranges from 0 (certain) to 1 (uniform).
+    """
+    if pmap.shape[-1] <= 1:
+        return numpy.zeros(pmap.shape[:-1], dtype=numpy.float32)
+    p = pmap.astype(numpy.float32)
+    p /= numpy.maximum(p.sum(axis=-1), numpy.finfo(numpy.float32).tiny)[..., None]
+    plogp = p * numpy.log(numpy.maximum(p, numpy.finfo(numpy.float32).tiny))
+    return -plogp.sum(axis=-1) / numpy.float32(numpy.log(pmap.shape[-1]))
+
+def thresholded(pmap, threshold):
+    """
+    The segmentation, but 0 where the highest probability is below the threshold.
+    """
+    result = segmentation(pmap, threshold)
+    result[pmap.max(axis=-1) < threshold] = 0
+    return result
+
+# Output name -> (function, dtype or None for the input dtype)
+OUTPUTS = collections.OrderedDict([ ('segmentation', (segmentation, numpy.uint8)),
+                                    ('uncertainties', (uncertainties, None)),
+                                    ('entropy', (entropy, numpy.float32)),
+                                    ('thresholded', (thresholded, numpy.uint8)) ])
+
+def block_shape_for(shape, chunks, itemsize, block_bytes=DEFAULT_BLOCK_BYTES):
+    """
+    A block shape with all channels, whose other axes are multiples of the chunk shape
+    (unless the block covers the whole axis).
+    The longest axes are halved until the block is small enough.
+    """
+    if chunks is None:
+        chunks = (1,) * len(shape)
+    block = list(shape)
+    spatial = range(len(shape) - 1)
+    while numpy.prod(block) * itemsize > block_bytes and any(block[i] > chunks[i] for i in spatial):
+        i = max((i for i in spatial if block[i] > chunks[i]), key=lambda i: block[i] // chunks[i])
+        block[i] = max((block[i] // 2) // chunks[i], 1) * chunks[i]
+    return tuple(int(b) for b in block)
+
+def block_slicings(shape, block_shape):
+    """
+    The slicings of all blocks (without the channel axis), in C order.
+    """
+    for start, stop in block_rois(shape[:-1], block_shape[:-1]):
+        yield tuple( slice(a, b) for a, b in zip(start, stop) )
+
+def estimated_memory(shape, dtype, output_names, block_bytes=DEFAULT_BLOCK_BYTES, prefetch=DEFAULT_PREFETCH):
+    """
+    A rough estimate of the memory needed to process a predictions dataset:
+    each block in flight, a temporary copy of it, and its outputs.
+    """
+    voxels = numpy.prod(shape[:-1])
+    block_voxels = min(voxels, max(block_bytes // (numpy.dtype(dtype).itemsize * shape[-1]), 1))
+    block_nbytes = block_voxels * shape[-1] * numpy.dtype(dtype).itemsize
+    output_nbytes = block_voxels * 8 * len(output_names)
+    return int( (prefetch + 1) * (2 * block_nbytes + output_nbytes) )
+
+def postprocess_predictions( input_path, output_path, output_names=('segmentation',), threshold=DEFAULT_THRESHOLD,
+                             block_bytes=DEFAULT_BLOCK_BYTES, prefetch=DEFAULT_PREFETCH ):
+    """
+    Compute the given outputs of one predictions dataset, blockwise.
+
+    input_path: The path to the predictions, including the internal dataset name, e.g. /path/to/file.h5/exported_data
+                The channel axis must be last.
+    output_path: The hdf5 file to write. Each output is stored in a dataset of the same name.
+    output_names: Any of OUTPUTS
+    threshold: The threshold for the 'thresholded' output
+    block_bytes: The (approximate) size of the predictions blocks that are processed at once
+    prefetch: Number of blocks that are processed ahead of the block being written
+    """
+    assert all(name in OUTPUTS for name in output_names), "Unknown output in {}".format(output_names)
+    input_pathcomp = PathComponents(input_path)
+    with h5py.File(input_pathcomp.externalPath, 'r') as input_file, \
+         h5py.File(output_path, 'w') as output_file:
+        predictions = input_file[input_pathcomp.internalPath]
+        shape = predictions.shape
+        axistags = predictions.attrs.get('axistags', None)
+        if axistags is not None:
+            axiskeys = [axis['key'] for axis in json.loads(axistags)['axes']]
+            assert axiskeys[-1] == 'c', "The channel axis must be last, not: {}".format(axiskeys)
+        assert shape[-1] <= 255, "Too many channels for a uint8 segmentation"
+
+        block_shape = block_shape_for(shape, predictions.chunks, predictions.dtype.itemsize, block_bytes)
+        output_chunks = None
+        if predictions.chunks is not None:
+            output_chunks = predictions.chunks[:-1] + (1,)
+
+        datasets = []
+        for name in output_names:
+            fn, dtype = OUTPUTS[name]
+            dataset = output_file.create_dataset( name,
+                                                  shape=shape[:-1] + (1,),
+                                                  dtype=dtype or predictions.dtype,
+                                                  chunks=output_chunks )
+            if axistags is not None:
+                dataset.attrs['axistags'] = axistags
+            datasets.append( (fn, dataset) )
+
+        def process_block(slicing):
+            pmap = predictions[slicing]
+            return [fn(pmap, threshold) for fn, _ in datasets]
+
+        # Blocks are processed in parallel, and written (in order) by this thread.
+        slicings = block_slicings(shape, block_shape)
+        pending = collections.deque()
+        while True:
+            while len(pending) <= prefetch:
+                slicing = next(slicings, None)
+                if slicing is None:
+                    break
+                req = Request( partial(process_block, slicing) )
+                req.submit()
+                pending.append( (slicing, req) )
+            if not pending:
+                break
+
+            slicing, req = pending.popleft()
+            results = req.wait()
+            req.clean()
+            for (_, dataset), result in zip(datasets, results):
+                dataset[slicing] = result[..., None]
+            del results
+
+def postprocess_all_predictions( input_paths, output_paths, output_names=('segmentation',), threshold=DEFAULT_THRESHOLD,
+                                 block_bytes=DEFAULT_BLOCK_BYTES, prefetch=DEFAULT_PREFETCH, memory_budget=None ):
+    """
+    Run postprocess_predictions() for several files,
+    as many at the same time as fit into the memory budget (see MemoryBoundedScheduler).
+    """
+    assert len(input_paths) == len(output_paths)
+    def postprocess(input_path, output_path):
+        postprocess_predictions(input_path, output_path, output_names, threshold, block_bytes, prefetch)
+        print "Wrote {}".format( output_path )
+
+    jobs = []
+    for input_path, output_path in zip(input_paths, output_paths):
+        input_pathcomp = PathComponents(input_path)
+        with h5py.File(input_pathcomp.externalPath, 'r') as f:
+            dataset = f[input_pathcomp.internalPath]
+            nbytes = estimated_memory(dataset.shape, dataset.dtype, output_names, block_bytes, prefetch)
+        jobs.append( (nbytes, partial(postprocess, input_path, output_path)) )
+    MemoryBoundedScheduler(memory_budget).run(jobs)
+
+def all_dataset_internal_paths(f):
+    """
+    Return a list of all the internal datasets in an hdf5 file.
+    """
+    allkeys = []
+    f.visit(allkeys.append)
+    dataset_keys = filter(lambda key: isinstance(f[key], h5py.Dataset),
+                          allkeys)
+    return dataset_keys
+
+if __name__ == "__main__":
+    import sys
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Compute segmentations and uncertainties of exported predictions")
+    parser.add_argument("--outputs", nargs='+', choices=OUTPUTS.keys(), default=['segmentation'],
+                        help="The outputs to compute. Each is written to a dataset of the same name.")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="The probability below which the 'thresholded' output is 0")
+    parser.add_argument("--output_suffix", default="_Postprocessed",
+                        help="Appended to the input file names, to name the output files")
+    parser.add_argument("--block_mb", type=float, default=DEFAULT_BLOCK_BYTES / 2.0**20,
+                        help="The (approximate) size of the predictions blocks that are processed at once")
+    parser.add_argument("--prefetch", type=int, default=DEFAULT_PREFETCH,
+                        help="Number of blocks (per file) that are processed ahead of the block being written")
+    parser.add_argument("--memory_mb", type=float,
+                        help="The memory that may be used by all files together. "
+                             "By default: the RAM that lazyflow may use (see LAZYFLOW_TOTAL_RAM_MB)")
+    parser.add_argument("prediction_image_paths", nargs='+', help="Path(s) to your exported predictions (hdf5).")
+    parsed_args = parser.parse_args()
+
+    # As a convenience, auto-determine the internal dataset path if possible.
+    input_paths = []
+    output_paths = []
+    for input_path in parsed_args.prediction_image_paths:
+        path_comp = PathComponents(input_path, os.getcwd())
+        if path_comp.extension not in PathComponents.HDF5_EXTS:
+            sys.stderr.write("Not an hdf5 file:\n"
+                             "{}\n".format(input_path))
+            sys.exit(1)
+        if path_comp.internalDatasetName == "":
+            with h5py.File(path_comp.externalPath, 'r') as f:
+                all_internal_paths = all_dataset_internal_paths(f)
+
+            if len(all_internal_paths) == 1:
+                path_comp.internalPath = all_internal_paths[0]
+            elif len(all_internal_paths) == 0:
+                sys.stderr.write("Could not find any datasets in your input file:\n"
+                                 "{}\n".format(input_path))
+                sys.exit(1)
+            else:
+                sys.stderr.write("Found more than one dataset in your input file:\n"
+                                 "{}\n".format(input_path) +
+                                 "Please specify the dataset name, e.g. /path/to/myfile.h5/internal/dataset_name\n")
+                sys.exit(1)
+        input_paths.append( path_comp.totalPath() )
+        output_paths.append( os.path.join( path_comp.externalDirectory,
+                                           path_comp.filenameBase + parsed_args.output_suffix + path_comp.extension ) )
+
+    memory_budget = None
+    if parsed_args.memory_mb is not None:
+        memory_budget = int(parsed_args.memory_mb * 2**20)
+
+    postprocess_all_predictions( input_paths, output_paths, parsed_args.outputs, parsed_args.threshold,
+                                 int(parsed_args.block_mb * 2**20), parsed_args.prefetch, memory_budget )
+    print "DONE."
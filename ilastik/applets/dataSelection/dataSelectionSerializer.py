@@ -20,6 +20,7 @@
 #		   http://ilastik.org/license.html
 ###############################################################################
 from opDataSelection import OpDataSelection, DatasetInfo
+from stackImporter import StackImporter
 from lazyflow.operators.ioOperators import OpStackLoader, OpH5WriterBigDataset
 from lazyflow.operators.ioOperators.opTiffReader import OpTiffReader
 from lazyflow.operators.ioOperators.opTiffSequenceReader import OpTiffSequenceReader
@@ -182,7 +183,7 @@ class DataSelectionSerializer( AppletSerializer ):
 
         self._dirty = False
 
-    def importStackAsLocalDataset(self, info, sequence_axis='t'):
+    def importStackAsLocalDataset(self, info, sequence_axis='t', compression='lzf', compression_opts=None):
         """
         Add the given stack data to the project file as a local dataset.
         Does not update the topLevelOperator.
@@ -190,6 +191,10 @@ class DataSelectionSerializer( AppletSerializer ):
         :param info: A DatasetInfo object.
                      Note: info.filePath must be a str which lists the stack files, delimited with os.path.pathsep
                      Note: info will be MODIFIED by this function.  Use the modified info when assigning it to a dataset.
+        :param compression: Compression of the dataset in the project: 'gzip', 'lzf' or None
+        :param compression_opts: For gzip: the compression level (0-9)
+        :return: True if the stack was imported.
+                 If reading the stack fails, the exception is raised and no dataset is added to the project.
         """
         self.progressSignal.emit(0)
         
@@ -220,25 +225,16 @@ class DataSelectionSerializer( AppletSerializer ):
             data_slot = opLoader.stack
 
         try:
-            opWriter = OpH5WriterBigDataset(parent=self.topLevelOperator.parent)
-            opWriter.hdf5File.setValue(projectFileHdf5)
-            opWriter.hdf5Path.setValue(self.topGroupName + '/local_data/' + info.datasetId)
-            opWriter.CompressionEnabled.setValue(False)
-            # We assume that the main bottleneck is the hard disk, 
-            #  so adding lots of threads to access it at once seems like a bad idea.
-            opWriter.BatchSize.setValue(1)
-            opWriter.Image.connect( data_slot )
-                
-            # Forward progress from the writer directly to our applet                
-            opWriter.progressSignal.subscribe( self.progressSignal.emit )
-
-            success = opWriter.WriteImage.value
+            localDataGroup = getOrCreateGroup( getOrCreateGroup(projectFileHdf5, self.topGroupName), 'local_data' )
+            # The stack files are read in parallel (a few slabs ahead), and written as compressed chunks.
+            importer = StackImporter(compression, compression_opts)
+            importer.run( data_slot, localDataGroup, info.datasetId, sequence_axis,
+                          progress_fn=self.progressSignal.emit )
         finally:
-            opWriter.cleanUp()
             opLoader.cleanUp()
             self.progressSignal.emit(100)
 
-        return success
+        return True
 
     def initWithoutTopGroup(self, hdf5File, projectFilePath):
         """
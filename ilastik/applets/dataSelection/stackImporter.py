@@ -0,0 +1,153 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2016, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import collections
+
+import numpy
+
+import logging
+logger = logging.getLogger(__name__)
+
+# hdf5 keeps chunks of up to 1 MB in its chunk cache (per dataset, by default),
+# so larger chunks would be decompressed again for every access.
+DEFAULT_CHUNK_BYTES = 2**20
+
+# Size of the slabs (one chunk deep along the sequence axis) that are read ahead.
+# A slab can be a single slice (e.g. for time series), so the number of slabs
+# in flight depends on their size.
+DEFAULT_PREFETCH_BYTES = 256 * 2**20
+
+def stack_chunk_shape(shape, axiskeys, itemsize, target_bytes=DEFAULT_CHUNK_BYTES):
+    """
+    Chunk shape for an image stack: one time step and all channels per chunk,
+    the spatial axes are halved (the longest first) until the chunk is small enough.
+    This gives roughly cubic chunks for volumes, and square tiles for 2D stacks.
+    """
+    chunks = list(shape)
+    for i, key in enumerate(axiskeys):
+        if key == 't':
+            chunks[i] = 1
+    spatial = [i for i, key in enumerate(axiskeys) if key in 'xyz']
+    while numpy.prod(chunks) * itemsize > target_bytes and any(chunks[i] > 1 for i in spatial):
+        i = max(spatial, key=lambda i: chunks[i])
+        chunks[i] = (chunks[i] + 1) // 2
+    return tuple(int(c) for c in chunks)
+
+class StackImporter(object):
+    """
+    Copy an image stack (e.g. the output of OpStackLoader or OpTiffSequenceReader) into an hdf5 dataset.
+
+    The slices (files) of the stack are read in parallel, a few slabs ahead of the slab that is
+    currently written, so reading and compressing overlap. The dataset is chunked and compressed.
+    """
+    def __init__(self, compression='lzf', compression_opts=None, prefetch_bytes=DEFAULT_PREFETCH_BYTES):
+        """
+        compression: 'gzip', 'lzf' or None
+        compression_opts: For gzip: the compression level (0-9)
+        prefetch_bytes: Size of the slabs that are read ahead (at least one). Bounds the memory needed for the import.
+        """
+        assert compression in ('gzip', 'lzf', None), "Unknown compression: {}".format(compression)
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.prefetch_bytes = prefetch_bytes
+
+    def run(self, data_slot, h5group, dataset_name, sequence_axis, progress_fn=None):
+        """
+        data_slot: The slot that provides the stack
+        h5group: The group to create the dataset in (an existing dataset of the same name is replaced)
+        sequence_axis: The axis key (e.g. 'z') along which the stack files are concatenated
+        progress_fn: Called with the progress in percent
+
+        Returns: The new dataset.
+                 If reading the stack fails, the pending requests are cancelled,
+                 the incomplete dataset is removed and the exception is re-raised.
+        """
+        meta = data_slot.meta
+        shape = meta.shape
+        axiskeys = meta.getAxisKeys()
+        sequence_index = axiskeys.index(sequence_axis)
+        chunks = stack_chunk_shape(shape, axiskeys, meta.getDtypeBytes())
+
+        if dataset_name in h5group:
+            del h5group[dataset_name]
+        dataset = h5group.create_dataset( dataset_name,
+                                          shape=shape,
+                                          dtype=meta.dtype,
+                                          chunks=chunks,
+                                          compression=self.compression,
+                                          compression_opts=self.compression_opts )
+        logger.debug("Importing stack of shape {} with chunks {} and compression {}"
+                     .format(shape, chunks, self.compression))
+
+        # Slabs are one chunk deep, so each chunk is written (and compressed) only once.
+        depth = chunks[sequence_index]
+        slab_starts = range(0, shape[sequence_index], depth)
+        slab_bytes = numpy.prod(shape) // shape[sequence_index] * depth * meta.getDtypeBytes()
+        prefetch = max(1, self.prefetch_bytes // slab_bytes)
+        pending = collections.deque()
+        try:
+            self._copy_slabs(data_slot, dataset, sequence_index, depth, slab_starts, prefetch, pending, progress_fn)
+        except:
+            for _, _, requests in pending:
+                for req in requests:
+                    req.cancel()
+            del h5group[dataset_name]
+            raise
+
+        # Add axistags and drange attributes, like OpH5WriterBigDataset
+        dataset.attrs['axistags'] = meta.axistags.toJSON()
+        if meta.drange is not None:
+            dataset.attrs['drange'] = meta.drange
+        return dataset
+
+    def _copy_slabs(self, data_slot, dataset, sequence_index, depth, slab_starts, prefetch, pending, progress_fn):
+        shape = dataset.shape
+        next_slab = 0
+        written = 0
+        while written < len(slab_starts):
+            # Read ahead: one request per slice
+            while next_slab < len(slab_starts) and len(pending) < prefetch:
+                slab_start = slab_starts[next_slab]
+                slab_stop = min(slab_start + depth, shape[sequence_index])
+                requests = []
+                for i in range(slab_start, slab_stop):
+                    start = [0] * len(shape)
+                    stop = list(shape)
+                    start[sequence_index] = i
+                    stop[sequence_index] = i + 1
+                    req = data_slot(start, stop)
+                    req.submit()
+                    requests.append(req)
+                pending.append( (slab_start, slab_stop, requests) )
+                next_slab += 1
+
+            slab_start, slab_stop, requests = pending[0]
+            slab = numpy.concatenate( [req.wait() for req in requests], axis=sequence_index )
+            pending.popleft()
+            for req in requests:
+                req.clean()
+            slicing = [slice(None)] * len(shape)
+            slicing[sequence_index] = slice(slab_start, slab_stop)
+            dataset[tuple(slicing)] = slab
+            del slab
+
+            written += 1
+            if progress_fn is not None:
+                progress_fn( 100 * written // len(slab_starts) )
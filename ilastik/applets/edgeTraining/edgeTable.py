@@ -0,0 +1,71 @@
+from itertools import chain
+
+import numpy as np
+
+def edge_keys(edge_ids):
+    """
+    Combine (sp1, sp2) edge ids into single uint64 keys (sp1 << 32 | sp2),
+    which sort in the same order as the edge ids.
+    """
+    edge_ids = np.asarray(edge_ids, dtype=np.uint64).reshape(-1, 2)
+    return (edge_ids[:,0] << np.uint64(32)) | edge_ids[:,1]
+
+def edge_labels_to_arrays(edge_labels_dict):
+    """
+    Convert a dict of {(sp1, sp2): label} into aligned arrays of edge_ids (N,2) and labels (N,).
+    """
+    if not edge_labels_dict:
+        return np.zeros((0,2), dtype=np.uint32), np.zeros((0,), dtype=np.uint32)
+    count = len(edge_labels_dict)
+    edge_ids = np.fromiter(chain.from_iterable(edge_labels_dict.iterkeys()), dtype=np.uint32, count=2*count)
+    edge_ids = edge_ids.reshape(-1, 2)
+    labels = np.fromiter(edge_labels_dict.itervalues(), dtype=np.uint32, count=count)
+    return edge_ids, labels
+
+class EdgeTable(object):
+    """
+    Index over the rows of a per-edge table (e.g. the edge features of one lane),
+    for vectorized lookups of many edges at once.
+    """
+    def __init__(self, edge_ids):
+        keys = edge_keys(edge_ids)
+        if len(keys) > 1 and (keys[1:] < keys[:-1]).any():
+            self._order = np.argsort(keys, kind='mergesort')
+            self._keys = keys[self._order]
+        else:
+            # Rag.edge_ids are already sorted
+            self._order = None
+            self._keys = keys
+
+    def __len__(self):
+        return len(self._keys)
+
+    def lookup(self, edge_ids):
+        """
+        The row of each of the given edges, or -1 for edges that are not in the table.
+        """
+        query = edge_keys(edge_ids)
+        rows = -np.ones((len(query),), dtype=np.int64)
+        if len(self._keys) == 0:
+            return rows
+        pos = np.searchsorted(self._keys, query)
+        pos = np.minimum(pos, len(self._keys) - 1)
+        found = (self._keys[pos] == query)
+        if self._order is not None:
+            pos = self._order[pos]
+        rows[found] = pos[found]
+        return rows
+
+    def labeled_rows(self, edge_labels_dict):
+        """
+        For the edges with a nonzero label in edge_labels_dict,
+        return (rows, labels), sorted by row.
+        Labels for edges that are not in the table are ignored.
+        """
+        edge_ids, labels = edge_labels_to_arrays(edge_labels_dict)
+        rows = self.lookup(edge_ids)
+        keep = (rows != -1) & (labels != 0)
+        rows = rows[keep]
+        labels = labels[keep]
+        order = np.argsort(rows, kind='mergesort')
+        return rows[order], labels[order]
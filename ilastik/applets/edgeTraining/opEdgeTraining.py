@@ -15,7 +15,9 @@ from lazyflow.classifiers import ParallelVigraRfLazyflowClassifierFactory
 
 from ilastik.applets.base.applet import DatasetConstraintError
 from ilastik.utility.operatorSubView import OperatorSubView
-from ilastik.utility import OpMultiLaneWrapper
+from ilastik.utility import OpMultiLaneWrapper, MemoryBoundedScheduler
+
+from edgeTable import EdgeTable
 
 import logging
 logger = logging.getLogger(__name__)
@@ -218,17 +220,27 @@ class OpComputeEdgeFeatures(Operator):
     VoxelData = InputSlot()
     Rag = InputSlot()
     EdgeFeaturesDataFrame = OutputSlot() # Includes columns 'sp1' and 'sp2'
+
+    # Rough estimate of the peak memory needed to compute the features of one channel,
+    # in multiples of the channel's size as float32 (voxel data + per-edge-pixel values).
+    CHANNEL_MEMORY_FACTOR = 3
      
     def setupOutputs(self):
         assert self.VoxelData.meta.getAxisKeys()[-1] == 'c'
         self.EdgeFeaturesDataFrame.meta.shape = (1,)
         self.EdgeFeaturesDataFrame.meta.dtype = object
+
+    def _channel_bytes(self):
+        """
+        The estimated peak memory for computing the features of one channel.
+        """
+        return np.prod(self.VoxelData.meta.shape[:-1]) * 4 * self.CHANNEL_MEMORY_FACTOR
          
     def execute(self, slot, subindex, roi, result):
         rag = self.Rag.value
         channel_feature_names = self.FeatureNames.value
 
-        edge_feature_dfs =[]
+        channels = []
         for c in range( self.VoxelData.meta.shape[-1] ):
             channel_name = self.VoxelData.meta.channel_names[c]
             if channel_name not in channel_feature_names:
@@ -237,11 +249,14 @@ class OpComputeEdgeFeatures(Operator):
             if not feature_names:
                 # No features selected for this channel
                 continue
+            channels.append( (c, channel_name, feature_names) )
 
+        def compute_channel_features(i, c, channel_name, feature_names):
             voxel_data = self.VoxelData[...,c:c+1].wait()
             voxel_data = vigra.taggedView(voxel_data, self.VoxelData.meta.axistags)
             voxel_data = voxel_data[...,0] # drop channel
             edge_features_df = rag.compute_features(voxel_data, feature_names)
+            del voxel_data
 
             #if np.isnan(edge_features_df.values).any():
             #    raise RuntimeError("Whoa, why are there NaN values in the feature matrix?")
@@ -252,7 +267,14 @@ class OpComputeEdgeFeatures(Operator):
             # (Generally a nice feature, but also required for serialization.)
             edge_features_df.columns = map( lambda feature_name: channel_name + ' ' + feature_name,
                                             edge_features_df.columns.values )
-            edge_feature_dfs.append(edge_features_df)
+            edge_feature_dfs[i] = edge_features_df
+
+        # Channels are computed in parallel, as many at a time as fit into the RAM that lazyflow may use.
+        # The results are stored by channel index, so the column order doesn't depend on the scheduling.
+        edge_feature_dfs = [None] * len(channels)
+        channel_bytes = self._channel_bytes()
+        jobs = [ (channel_bytes, partial(compute_channel_features, i, *channels[i])) for i in range(len(channels)) ]
+        MemoryBoundedScheduler().run(jobs)
 
         # Could use join() or merge() here, but we know the rows are already in the right order, and concat() should be faster.
         all_edge_features_df = pd.DataFrame( rag.edge_ids, columns=['sp1', 'sp2'] )
@@ -274,7 +296,9 @@ class OpTrainEdgeClassifier(Operator):
         self.EdgeClassifier.meta.dtype = object
         
     def execute(self, slot, subindex, roi, result):
-        all_features_and_labels_df = None
+        feature_matrices = []
+        all_labels = []
+        feature_names = None
 
         for lane_index, (labels_dict_slot, features_slot) in \
                 enumerate( zip(self.EdgeLabelsDict, self.EdgeFeaturesDataFrame) ):
@@ -284,40 +308,33 @@ class OpTrainEdgeClassifier(Operator):
             if not labels_dict:
                 continue
 
-            sp_columns = np.array(labels_dict.keys())
             edge_features_df = features_slot.value
             assert list(edge_features_df.columns[0:2]) == ['sp1', 'sp2']
-
-            labels_df = pd.DataFrame(sp_columns, columns=['sp1', 'sp2'])
-            labels_df['label'] = labels_dict.values()
-
-            # Drop zero labels
-            labels_df = labels_df[labels_df['label'] != 0]
-            
-            # Merge in features
-            features_and_labels_df = pd.merge(edge_features_df, labels_df, how='right', on=['sp1', 'sp2'])
-            if all_features_and_labels_df is not None:
-                all_features_and_labels_df = all_features_and_labels_df.append(features_and_labels_df)
-            else:
-                all_features_and_labels_df = features_and_labels_df
-
-        if all_features_and_labels_df is None:
+            if feature_names is None:
+                feature_names = edge_features_df.columns[2:].values
+            assert list(edge_features_df.columns[2:]) == list(feature_names), \
+                "All lanes must have the same edge features"
+
+            # Look up the labeled edges and copy only their rows (zero labels are dropped)
+            edge_table = EdgeTable( edge_features_df[['sp1', 'sp2']].values )
+            rows, labels = edge_table.labeled_rows( labels_dict )
+            feature_matrices.append( edge_features_df.iloc[rows, 2:].values )
+            all_labels.append( labels )
+
+        if feature_names is None:
             # No labels yet.
             result[0] = None
             return
 
-        assert list(all_features_and_labels_df.columns[0:2]) == ['sp1', 'sp2']
-        assert all_features_and_labels_df.columns[-1] == 'label'
-
-        feature_matrix = all_features_and_labels_df.iloc[:, 2:-1].values # Omit 'sp1', 'sp2', and 'label'
-        labels = all_features_and_labels_df.iloc[:, -1].values
+        feature_matrix = np.concatenate(feature_matrices)
+        labels = np.concatenate(all_labels)
 
         logger.info("Training classifier with {} labels...".format( len(labels) ))
         # TODO: Allow factory to be configured via an input slot
         classifier_factory = ParallelVigraRfLazyflowClassifierFactory()
         classifier = classifier_factory.create_and_train( feature_matrix,
                                                           labels,
-                                                          feature_names=all_features_and_labels_df.columns[2:-1].values )
+                                                          feature_names=feature_names )
         assert set(classifier.known_classes).issubset(set([1,2]))
         result[0] = classifier
 
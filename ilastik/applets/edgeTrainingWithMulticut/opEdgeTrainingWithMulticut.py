@@ -14,6 +14,7 @@ class OpEdgeTrainingWithMulticut(Operator):
     Beta = InputSlot(value=0.5)
     SolverName = InputSlot(value=DEFAULT_SOLVER_NAME) # See opMulticut.py for list of solvers
     FreezeCache = InputSlot(value=True)
+    MulticutBlockShape = InputSlot(optional=True) # If given, solve hierarchically (see OpMulticut.BlockShape)
   
     # Lane-wise input slots
     RawData = InputSlot(level=1, optional=True) # Used by the GUI for display only
@@ -57,6 +58,7 @@ class OpEdgeTrainingWithMulticut(Operator):
         opMulticut.Beta.connect( self.Beta )
         opMulticut.SolverName.connect( self.SolverName )
         opMulticut.FreezeCache.connect( self.FreezeCache )        
+        opMulticut.BlockShape.connect( self.MulticutBlockShape )
         opMulticut.RawData.connect( self.RawData )
         opMulticut.Superpixels.connect( opEdgeTraining.Superpixels )
         opMulticut.Rag.connect( opEdgeTraining.Rag )
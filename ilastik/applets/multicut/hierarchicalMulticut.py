@@ -0,0 +1,185 @@
+from functools import partial
+
+import numpy as np
+
+from lazyflow.request import Request, RequestPool
+
+import logging
+logger = logging.getLogger(__name__)
+
+def superpixel_blocks(label_img, block_shape, node_count):
+    """
+    Assign every superpixel to the block (of the given block_shape) that contains its center.
+    Returns an array of block ids, indexed by superpixel id (-1 for ids that don't occur).
+    """
+    assert len(block_shape) == label_img.ndim
+    labels = np.asarray(label_img).reshape(-1)
+    sizes = np.bincount(labels, minlength=node_count).astype(np.float64)
+
+    blocks_per_axis = [ (s + b - 1) // b for s, b in zip(label_img.shape, block_shape) ]
+    node_blocks = np.zeros((node_count,), dtype=np.int64)
+    for axis, (extent, block_size) in enumerate(zip(label_img.shape, block_shape)):
+        coords = np.arange(extent).reshape( [-1 if a == axis else 1 for a in range(label_img.ndim)] )
+        coords = np.broadcast_to(coords, label_img.shape).reshape(-1)
+        with np.errstate(invalid='ignore'):
+            centers = np.bincount(labels, weights=coords, minlength=node_count) / sizes
+        block_index = (np.nan_to_num(centers) // block_size).astype(np.int64)
+        node_blocks = node_blocks * blocks_per_axis[axis] + block_index
+
+    node_blocks[sizes == 0] = -1
+    return node_blocks
+
+def connected_components(edge_ids, node_count):
+    """
+    Connected components of the graph with the given edges.
+    Returns (component of each node, number of components), components are numbered consecutively.
+    """
+    labels = np.arange(node_count, dtype=np.int64)
+    u = edge_ids[:,0].astype(np.int64)
+    v = edge_ids[:,1].astype(np.int64)
+    while True:
+        # Hook the larger root onto the smaller one, then compress the paths
+        lu = labels[u]
+        lv = labels[v]
+        if (lu == lv).all():
+            break
+        smaller = np.minimum(lu, lv)
+        np.minimum.at(labels, lu, smaller)
+        np.minimum.at(labels, lv, smaller)
+        while True:
+            jumped = labels[labels]
+            if (jumped == labels).all():
+                break
+            labels = jumped
+    _, components = np.unique(labels, return_inverse=True)
+    return components, components.max() + 1 if node_count > 0 else 0
+
+def contract_graph(edge_ids, edge_weights, components):
+    """
+    Merge the nodes of each component into one node.
+    Parallel edges are combined by summing their weights, edges within a component are dropped.
+
+    Returns (reduced_edge_ids, reduced_edge_weights).
+    """
+    cu = components[edge_ids[:,0]]
+    cv = components[edge_ids[:,1]]
+    between = (cu != cv)
+    cu, cv = np.minimum(cu[between], cv[between]), np.maximum(cu[between], cv[between])
+    keys = (cu.astype(np.uint64) << np.uint64(32)) | cv.astype(np.uint64)
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    reduced_weights = np.bincount(inverse, weights=edge_weights[between], minlength=len(unique_keys))
+
+    reduced_edge_ids = np.empty((len(unique_keys), 2), dtype=np.uint32)
+    reduced_edge_ids[:,0] = unique_keys >> np.uint64(32)
+    reduced_edge_ids[:,1] = unique_keys & np.uint64(0xFFFFFFFF)
+    return reduced_edge_ids, reduced_weights
+
+def consecutive_labels(labels):
+    """
+    Renumber the labels to 0..N-1 (in the order of the old labels).
+    The solvers expect the labels of a starting point to be smaller than the node count.
+    """
+    _, labels = np.unique(labels, return_inverse=True)
+    return labels.astype(np.uint32)
+
+def multicut_energy(edge_ids, edge_weights, node_labels):
+    """
+    The multicut objective: the sum of the weights of all cut edges.
+    """
+    cut = node_labels[edge_ids[:,0]] != node_labels[edge_ids[:,1]]
+    return edge_weights[cut].sum()
+
+class HierarchicalMulticut(object):
+    """
+    Approximate multicut solver for large graphs:
+
+    1. The sub-graphs within spatial blocks are solved independently (in parallel).
+    2. The nodes that were merged in a block are contracted.
+    3. The much smaller contracted graph is solved globally.
+
+    A solver instance keeps its block solutions between calls to solve(),
+    so changing a few edge weights only re-solves the blocks with changed edges,
+    and the previous result is used as initial solution for the global problem.
+    """
+    def __init__(self, edge_ids, node_blocks, solve_fn):
+        """
+        edge_ids: The list of edges in the graph. shape=(N, 2)
+
+        node_blocks: The spatial block of each node (see superpixel_blocks()).
+
+        solve_fn: Callable solve_fn(edge_ids, edge_weights, node_count, initial_labels)
+                  that solves a multicut problem and returns the label of each node.
+                  initial_labels may be None.
+        """
+        self.edge_ids = np.asarray(edge_ids)
+        self.node_count = len(node_blocks)
+        self.solve_fn = solve_fn
+
+        # Group the edges within a block by block
+        blocks_u = node_blocks[self.edge_ids[:,0]]
+        blocks_v = node_blocks[self.edge_ids[:,1]]
+        inner_edges = np.flatnonzero( (blocks_u == blocks_v) & (blocks_u != -1) )
+        order = np.argsort(blocks_u[inner_edges], kind='mergesort')
+        inner_edges = inner_edges[order]
+        inner_blocks = blocks_u[inner_edges]
+        boundaries = np.flatnonzero(inner_blocks[1:] != inner_blocks[:-1]) + 1
+        self._block_edges = np.split(inner_edges, boundaries) if len(inner_edges) else []
+
+        self._block_weights = [None] * len(self._block_edges)
+        self._block_merges = [None] * len(self._block_edges)
+        self._previous_labels = None
+
+    def _solve_block(self, block_index, edge_weights):
+        edges = self._block_edges[block_index]
+        weights = edge_weights[edges]
+        if self._block_weights[block_index] is not None \
+           and np.array_equal(self._block_weights[block_index], weights):
+            # Nothing changed in this block
+            return
+
+        # Renumber the nodes of this block consecutively
+        nodes, local_edge_ids = np.unique(self.edge_ids[edges], return_inverse=True)
+        local_edge_ids = local_edge_ids.reshape(-1, 2).astype(np.uint32)
+
+        initial_labels = None
+        if self._previous_labels is not None:
+            initial_labels = consecutive_labels(self._previous_labels[nodes])
+
+        labels = self.solve_fn(local_edge_ids, weights, len(nodes), initial_labels)
+        self._block_merges[block_index] = (labels[local_edge_ids[:,0]] == labels[local_edge_ids[:,1]])
+        self._block_weights[block_index] = weights
+
+    def solve(self, edge_weights):
+        """
+        Returns: The segment id of each node, shape=(node_count,)
+        """
+        edge_weights = np.asarray(edge_weights, dtype=np.float64)
+        assert edge_weights.shape == (len(self.edge_ids),)
+
+        pool = RequestPool()
+        for block_index in range(len(self._block_edges)):
+            pool.add( Request( partial(self._solve_block, block_index, edge_weights) ) )
+        pool.wait()
+
+        # Contract all edges that were merged within their block
+        if self._block_edges:
+            merged_edges = np.concatenate( [edges[merges] for edges, merges
+                                            in zip(self._block_edges, self._block_merges)] )
+        else:
+            merged_edges = np.zeros((0,), dtype=np.int64)
+        components, num_components = connected_components(self.edge_ids[merged_edges], self.node_count)
+        reduced_edge_ids, reduced_weights = contract_graph(self.edge_ids, edge_weights, components)
+        logger.info("Hierarchical multicut: {} blocks, contracted {} nodes to {}"
+                    .format(len(self._block_edges), self.node_count, num_components))
+
+        initial_labels = None
+        if self._previous_labels is not None:
+            # Label each component like (one of) its nodes in the previous solution
+            initial_labels = np.zeros((num_components,), dtype=np.uint32)
+            initial_labels[components] = self._previous_labels
+            initial_labels = consecutive_labels(initial_labels)
+
+        reduced_labels = self.solve_fn(reduced_edge_ids, reduced_weights, num_components, initial_labels)
+        node_labels = np.asarray(reduced_labels, dtype=np.uint32)[components]
+        self._previous_labels = node_labels
+        return node_labels
@@ -1,4 +1,6 @@
 import warnings
+from functools import partial
+
 import numpy as np
 
 from lazyflow.graph import Operator, InputSlot, OutputSlot
@@ -6,6 +8,8 @@ from lazyflow.roi import roiToSlice
 from lazyflow.operators import OpBlockedArrayCache, OpValueCache
 from lazyflow.utility import Timer
 
+from hierarchicalMulticut import HierarchicalMulticut, superpixel_blocks
+
 import logging
 logger = logging.getLogger(__name__)
 
@@ -77,6 +81,7 @@ class OpMulticut(Operator):
     EdgeProbabilities = InputSlot()
     EdgeProbabilitiesDict = InputSlot() # A dict of id_pair -> probabilities (used by the GUI)
     RawData = InputSlot(optional=True) # Used by the GUI for display only
+    BlockShape = InputSlot(optional=True) # If given, solve hierarchically with blocks of this shape (spatial axes only)
 
     Output = OutputSlot() # Pixelwise output (not RAG, etc.)
 
@@ -89,6 +94,7 @@ class OpMulticut(Operator):
         self.opMulticutAgglomerator.SolverName.connect( self.SolverName )
         self.opMulticutAgglomerator.Rag.connect( self.Rag )
         self.opMulticutAgglomerator.EdgeProbabilities.connect( self.EdgeProbabilities )
+        self.opMulticutAgglomerator.BlockShape.connect( self.BlockShape )
 
         self.opSegmentationCache = OpBlockedArrayCache(parent=self)
         self.opSegmentationCache.fixAtCurrent.connect( self.FreezeCache )
@@ -111,8 +117,14 @@ class OpMulticutAgglomerator(Operator):
     Rag = InputSlot()
     Superpixels = InputSlot() # Just needed for slot metadata
     EdgeProbabilities = InputSlot()
+    BlockShape = InputSlot(optional=True)
     Output = OutputSlot()
 
+    def __init__(self, *args, **kwargs):
+        super( OpMulticutAgglomerator, self ).__init__(*args, **kwargs)
+        # Kept between executions, to warm-start when only the edge weights change.
+        self._hierarchical_multicut = None
+
     def setupOutputs(self):
         self.Output.meta.assignFrom(self.Superpixels.meta)
         self.Output.meta.display_mode = 'random-colortable'
@@ -123,8 +135,15 @@ class OpMulticutAgglomerator(Operator):
         beta = self.Beta.value
         solver_name = self.SolverName.value
 
+        hierarchical_multicut = None
+        if self.BlockShape.ready():
+            hierarchical_multicut = self._hierarchical_multicut
+            if hierarchical_multicut is None:
+                hierarchical_multicut = self.create_hierarchical_multicut(rag, tuple(self.BlockShape.value), solver_name)
+                self._hierarchical_multicut = hierarchical_multicut
+
         with Timer() as timer:
-            agglomerated_labels = self.agglomerate_with_multicut(rag, edge_probabilities, beta, solver_name)
+            agglomerated_labels = self.agglomerate_with_multicut(rag, edge_probabilities, beta, solver_name, hierarchical_multicut)
         logger.info("'{}' Multicut took {} seconds".format( solver_name, timer.seconds() ))
 
         result[:] = agglomerated_labels[...,None]
@@ -133,10 +152,22 @@ class OpMulticutAgglomerator(Operator):
         #result[:] += 1 # RAG labels are 0-based, but we want 1-based
 
     def propagateDirty(self, slot, subindex, roi):
+        if slot is not self.Beta and slot is not self.EdgeProbabilities:
+            # The block problems can't be reused.
+            self._hierarchical_multicut = None
         self.Output.setDirty()
 
     @classmethod
-    def agglomerate_with_multicut(cls, rag, edge_probabilities, beta, solver_name):
+    def create_hierarchical_multicut(cls, rag, block_shape, solver_name):
+        """
+        Create a HierarchicalMulticut for the given rag, which solves
+        the block and contracted problems with the given solver.
+        """
+        node_blocks = superpixel_blocks(rag.label_img, block_shape, rag.max_sp+1)
+        return HierarchicalMulticut(rag.edge_ids, node_blocks, partial(solve_multicut, solver_name=solver_name))
+
+    @classmethod
+    def agglomerate_with_multicut(cls, rag, edge_probabilities, beta, solver_name, hierarchical_multicut=None):
         """
         rag: ilastikrag.Rag
 
@@ -147,6 +178,9 @@ class OpMulticutAgglomerator(Operator):
 
         solver_name: The multicut solver used. Format: library_solver (e.g. opengm_Exact, nifty_Exact)
 
+        hierarchical_multicut: Optional. A HierarchicalMulticut for this rag (see create_hierarchical_multicut()),
+                               to solve the problem blockwise instead of all at once.
+
         Returns: A label image of the same shape as rag.label_img, type uint32
         """
         #
@@ -169,13 +203,10 @@ class OpMulticutAgglomerator(Operator):
         edge_weights = compute_edge_weights(rag.edge_ids, edge_probabilities, beta)
         assert edge_weights.shape == (rag.num_edges,)
 
-        solver_library, solver_method = solver_name.split('_')
-        if solver_library == 'Nifty':
-            mapping_index_array = solve_with_nifty(rag.edge_ids, edge_weights, node_count, solver_method)
-        elif solver_library == 'Opengm':
-            mapping_index_array = solve_with_opengm(rag.edge_ids, edge_weights, node_count, solver_method)
+        if hierarchical_multicut is not None:
+            mapping_index_array = hierarchical_multicut.solve(edge_weights)
         else:
-            raise RuntimeError("Unknown solver library: '{}'".format(solver_library))
+            mapping_index_array = solve_multicut(rag.edge_ids, edge_weights, node_count, solver_name=solver_name)
 
         #
         # Project solution onto supervoxels, return segmentation image
@@ -216,7 +247,22 @@ def compute_edge_weights( edge_ids, edge_probabilities, beta ):
     return edge_weights
 
 
-def solve_with_nifty(edge_ids, edge_weights, node_count, solver_method):
+def solve_multicut(edge_ids, edge_weights, node_count, initial_labels=None, solver_name=DEFAULT_SOLVER_NAME):
+    """
+    Solve the given multicut problem with the given solver (e.g. 'Nifty_FmGreedy')
+    and return an index array that maps node IDs to segment IDs.
+
+    initial_labels: Optional. A previous solution, used as starting point by solvers that support it.
+    """
+    solver_library, solver_method = solver_name.split('_')
+    if solver_library == 'Nifty':
+        return solve_with_nifty(edge_ids, edge_weights, node_count, solver_method, initial_labels)
+    elif solver_library == 'Opengm':
+        return solve_with_opengm(edge_ids, edge_weights, node_count, solver_method)
+    else:
+        raise RuntimeError("Unknown solver library: '{}'".format(solver_library))
+
+def solve_with_nifty(edge_ids, edge_weights, node_count, solver_method, initial_labels=None):
     """
     Solve the given multicut problem with the 'Nifty' library and return an
     index array that maps node IDs to segment IDs.
@@ -230,6 +276,9 @@ def solve_with_nifty(edge_ids, edge_weights, node_count, solver_method):
                       If your superpixel IDs are not consecutive, node_count should be max_sp_id+1
 
     solver_method: One of 'ExactCplex', 'FmGreedy', etc.
+
+    initial_labels: Optional. Starting point for the fusion move solvers
+                    (instead of the greedy additive solution).
     """
     # TODO: I don't know if this handles non-consecutive sp-ids properly
     g = nifty.graph.UndirectedGraph( int(node_count) )
@@ -254,6 +303,12 @@ def solve_with_nifty(edge_ids, edge_weights, node_count, solver_method):
             fuseN=2
         )
 
+    def initial_solution():
+        if initial_labels is not None:
+            return np.asarray(initial_labels, dtype=np.uint64)
+        greedy=obj.greedyAdditiveFactory().create(obj)
+        return greedy.optimize()
+
      # TODO finetune parameters
     ret = None
     if solver_method == 'ExactCplex':
@@ -263,18 +318,15 @@ def solve_with_nifty(edge_ids, edge_weights, node_count, solver_method):
         inf = getIlpFac('gurobi').create(obj)
 
     elif solver_method == 'FmCplex':
-        greedy=obj.greedyAdditiveFactory().create(obj)
-        ret = greedy.optimize()
+        ret = initial_solution()
         inf = getFmFac(getIlpFac('cplex')).create(obj)
 
     elif solver_method == 'FmGurobi':
-        greedy=obj.greedyAdditiveFactory().create(obj)
-        ret = greedy.optimize()
+        ret = initial_solution()
         inf = getFmFac(getIlpFac('gurobi')).create(obj)
 
     elif solver_method == 'FmGreedy':
-        greedy=obj.greedyAdditiveFactory().create(obj)
-        ret = greedy.optimize()
+        ret = initial_solution()
         inf = getFmFac(obj.greedyAdditiveFactory()).create(obj)
 
     else:
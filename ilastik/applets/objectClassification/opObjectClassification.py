@@ -808,11 +808,13 @@ class OpObjectClassification(Operator, ExportingOperator, MultiLaneOperatorABC):
                                 {"selection": selected_features})
 
         if settings["file type"] == "h5":
-            export_file.add_rois(Default.LabelRoiPath, label_image, "table", settings["margin"], "labeling")
+            export_file.add_rois(Default.LabelRoiPath, label_image, "table", settings["margin"], "labeling",
+                                 compression=settings["compression"])
             if settings["include raw"]:
                 export_file.add_image(Default.RawPath, self.RawImages[lane_index])
             else:
-                export_file.add_rois(Default.RawRoiPath, self.RawImages[lane_index], "table", settings["margin"])
+                export_file.add_rois(Default.RawRoiPath, self.RawImages[lane_index], "table", settings["margin"],
+                                     compression=settings["compression"])
         export_file.write_all(settings["file type"], settings["compression"])
 
         export_file.ExportProgress.unsubscribe(progress_slot)
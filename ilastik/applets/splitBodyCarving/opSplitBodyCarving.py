@@ -19,17 +19,20 @@
 #		   http://ilastik.org/license.html
 ###############################################################################
 import copy
+from functools import partial
 import numpy
 import vigra
 from lazyflow.graph import Operator, InputSlot, OutputSlot
-from lazyflow.roi import roiFromShape, roiToSlice, getIntersectingBlocks, getBlockBounds
+from lazyflow.roi import roiToSlice, getIntersectingBlocks, getBlockBounds
 from lazyflow.operators import OpCrosshairMarkers, OpSelectLabel
 from lazyflow.operators.operators import OpArrayCache
+from lazyflow.request import Request, RequestPool
 
 from ilastik.workflows.carving.opCarving import OpCarving
 from opParseAnnotations import OpParseAnnotations
 
 from ilastik.utility import bind
+from ilastik.utility.labelBoundingBoxes import LabelBoundingBoxes
 
 import logging
 logger = logging.getLogger(__name__)
@@ -57,9 +60,11 @@ class OpSplitBodyCarving( OpCarving ):
     
     BLOCK_SIZE = 520
     SEED_MARGIN = 10
+    SEED_BATCH_SIZE = 8 # Number of blocks that are seeded in parallel (and then written)
 
     def __init__(self, *args, **kwargs):
         super( OpSplitBodyCarving, self ).__init__( *args, **kwargs )
+        self._ravelerBoundingBoxes = None
 
         self._opParseAnnotations = OpParseAnnotations( parent=self )
         self._opParseAnnotations.AnnotationFilepath.connect( self.AnnotationFilepath )
@@ -94,48 +99,70 @@ class OpSplitBodyCarving( OpCarving ):
     @classmethod
     def autoSeedBackground(cls, laneView, foreground_label):
         # Seed the entire image with background labels, except for the individual label in question
-        # To save memory, we'll do this in blocks instead of all at once
+        # To save memory, we'll do this in blocks instead of all at once.
+        # Only the blocks that intersect the bounding box of the label can contain seeds.
 
         volume_shape = laneView.RavelerLabels.meta.shape
-        volume_roi = roiFromShape( volume_shape )
         block_shape = (OpSplitBodyCarving.BLOCK_SIZE,) * len( volume_shape ) 
         block_shape = numpy.minimum( block_shape, volume_shape )
-        block_starts = getIntersectingBlocks( block_shape, volume_roi )
-
-        logger.debug("Auto-seeding {} blocks for label".format( len(block_starts), foreground_label ))
-        for block_index, block_start in enumerate(block_starts):
-            block_roi = getBlockBounds( volume_shape, block_shape, block_start )
-            label_block = laneView.RavelerLabels(*block_roi).wait()
-            background_block = numpy.where( label_block == foreground_label, 0, 1 )
-            background_block = numpy.asarray( background_block, numpy.float32 ) # Distance transform requires float
-            if (background_block == 0.0).any():
-                # We need to leave a small border between the background seeds and the object membranes
-                background_block_view = background_block.view( vigra.VigraArray )
-                background_block_view.axistags = copy.copy( laneView.RavelerLabels.meta.axistags )
-                
-                background_block_view_4d = background_block_view.bindAxis('t', 0)
-                background_block_view_3d = background_block_view_4d.bindAxis('c', 0)
-                
-                distance_transformed_block = vigra.filters.distanceTransform(background_block_view_3d, background=False)
-                distance_transformed_block = distance_transformed_block.astype( numpy.uint8 )
-                
-                # Create a 'hull' surrounding the foreground, but leave some space.
-                background_seed_block = (distance_transformed_block == OpSplitBodyCarving.SEED_MARGIN)
-                background_seed_block = background_seed_block.astype(numpy.uint8) * 1 # (In carving, background is label 1)
-
-#                # Make the hull VERY sparse to avoid over-biasing graph cut toward the background class
-#                # FIXME: Don't regenerate this random block on every loop iteration
-#                rand_bytes = numpy.random.randint(0, 1000, background_seed_block.shape)
-#                background_seed_block = numpy.where( rand_bytes < 1, background_seed_block, 0 )
-#                background_seed_block = background_seed_block.view(vigra.VigraArray)
-#                background_seed_block.axistags = background_block_view_3d.axistags
-                
-                axisorder = laneView.RavelerLabels.meta.getTaggedShape().keys()
-                
-                logger.debug("Writing backgound seeds: {}/{}".format( block_index, len(block_starts) ))
-                laneView.WriteSeeds[ roiToSlice( *block_roi ) ] = background_seed_block.withAxes(*axisorder)
-            else:
-                logger.debug("Skipping all-background block: {}/{}".format( block_index, len(block_starts) ))
+
+        bounding_box = laneView.getRavelerBoundingBoxes().bounding_box( foreground_label )
+        if bounding_box is None:
+            logger.debug("Label {} doesn't occur, nothing to seed".format( foreground_label ))
+            return
+        block_starts = getIntersectingBlocks( block_shape, bounding_box )
+
+        logger.debug("Auto-seeding {} blocks for label {}".format( len(block_starts), foreground_label ))
+        axisorder = laneView.RavelerLabels.meta.getTaggedShape().keys()
+        for batch_start in range(0, len(block_starts), cls.SEED_BATCH_SIZE):
+            batch = block_starts[batch_start:batch_start+cls.SEED_BATCH_SIZE]
+            block_rois = [ getBlockBounds( volume_shape, block_shape, block_start ) for block_start in batch ]
+            seed_blocks = [None] * len(batch)
+
+            pool = RequestPool()
+            for index, block_roi in enumerate(block_rois):
+                pool.add( Request( partial( cls._computeBackgroundSeeds, laneView, foreground_label,
+                                            block_roi, seed_blocks, index ) ) )
+            pool.wait()
+
+            # The seeds are written from this thread only
+            for index, (block_roi, seed_block) in enumerate(zip(block_rois, seed_blocks)):
+                if seed_block is None:
+                    logger.debug("Skipping all-background block: {}/{}".format( batch_start + index, len(block_starts) ))
+                else:
+                    logger.debug("Writing backgound seeds: {}/{}".format( batch_start + index, len(block_starts) ))
+                    laneView.WriteSeeds[ roiToSlice( *block_roi ) ] = seed_block.withAxes(*axisorder)
+
+    @classmethod
+    def _computeBackgroundSeeds(cls, laneView, foreground_label, block_roi, seed_blocks, index):
+        label_block = laneView.RavelerLabels(*block_roi).wait()
+        if not (label_block == foreground_label).any():
+            return
+        background_block = numpy.where( label_block == foreground_label, 0, 1 )
+        background_block = numpy.asarray( background_block, numpy.float32 ) # Distance transform requires float
+
+        # We need to leave a small border between the background seeds and the object membranes
+        background_block_view = background_block.view( vigra.VigraArray )
+        background_block_view.axistags = copy.copy( laneView.RavelerLabels.meta.axistags )
+
+        background_block_view_4d = background_block_view.bindAxis('t', 0)
+        background_block_view_3d = background_block_view_4d.bindAxis('c', 0)
+
+        distance_transformed_block = vigra.filters.distanceTransform(background_block_view_3d, background=False)
+        distance_transformed_block = distance_transformed_block.astype( numpy.uint8 )
+
+        # Create a 'hull' surrounding the foreground, but leave some space.
+        background_seed_block = (distance_transformed_block == OpSplitBodyCarving.SEED_MARGIN)
+        background_seed_block = background_seed_block.astype(numpy.uint8) * 1 # (In carving, background is label 1)
+        seed_blocks[index] = background_seed_block
+
+    def getRavelerBoundingBoxes(self):
+        """
+        The bounding box of each raveler label (computed on first use).
+        """
+        if self._ravelerBoundingBoxes is None:
+            self._ravelerBoundingBoxes = LabelBoundingBoxes.from_slot( self.RavelerLabels )
+        return self._ravelerBoundingBoxes
 
     def setupOutputs(self):
         self._opFragmentSetLutCache.Input.connect( self._opFragmentSetLut.Lut )
@@ -224,6 +251,7 @@ class OpSplitBodyCarving( OpCarving ):
     
     def propagateDirty(self, slot, subindex, roi):
         if slot == self.RavelerLabels:
+            self._ravelerBoundingBoxes = None
             self.MaskedSegmentation.setDirty( roi.start, roi.stop )
         elif slot == self.CurrentRavelerLabel:
             self.MaskedSegmentation.setDirty( slice(None) )
@@ -24,9 +24,9 @@ import numpy
 import vigra
 import h5py
 from lazyflow.graph import Operator, InputSlot, OutputSlot, OperatorWrapper
-from lazyflow.roi import roiToSlice
+from lazyflow.roi import roiToSlice, roiFromShape, getIntersectingBlocks, getBlockBounds, getIntersection
 
-from lazyflow.request import Request
+from lazyflow.request import Request, RequestPool, RequestLock
 from lazyflow.operators import OpFilterLabels, OpCompressedCache, OpVigraLabelVolume, OpMaskedWatershed, OpSelectLabel
 from lazyflow.operators.ioOperators import OpH5WriterBigDataset
 from lazyflow.operators.opReorderAxes import OpReorderAxes
@@ -151,7 +151,7 @@ class OpSplitBodyPostprocessing(Operator):
         self._opMaskedWatershedCaches.Input.connect( self._opMaskedWatersheds.Output )
         self.WatershedFilledBodies.connect( self._opMaskedWatershedCaches.Output )
 
-        self._opAccumulateFinalImage = OpAccumulateFragmentSegmentations( parent=self )
+        self._opAccumulateFinalImage = OpBlockwiseAccumulateFragmentSegmentations( parent=self )
         self._opAccumulateFinalImage.RavelerLabels.connect( self.RavelerLabels )
         self._opAccumulateFinalImage.FragmentSegmentations.connect( self.WatershedFilledBodies )
         
@@ -339,6 +339,116 @@ class OpAccumulateFragmentSegmentations( Operator ):
     def propagateDirty(self, slot, subindex, roi):
         self.Output.setDirty()
 
+class OpBlockwiseAccumulateFragmentSegmentations( Operator ):
+    """
+    Same output (and Mapping) as OpAccumulateFragmentSegmentations, but computed block by block.
+
+    The label offset of each body's fragments only depends on the max label of the
+    raveler labels and of the preceding fragment segmentations, so the offsets are
+    determined first (from the blockwise max of each image). Then each block of the
+    output is composed independently (and in parallel), and any roi can be requested.
+    """
+    RavelerLabels = InputSlot()
+    FragmentSegmentations = InputSlot(level=1)
+    BlockShape = InputSlot(optional=True) # Default: up to DEFAULT_BLOCK_SIZE along each axis
+
+    Output = OutputSlot()
+    Mapping = OutputSlot()
+
+    DEFAULT_BLOCK_SIZE = 256
+
+    def __init__(self, *args, **kwargs):
+        super( OpBlockwiseAccumulateFragmentSegmentations, self ).__init__( *args, **kwargs )
+        self._lock = RequestLock()
+        self._offsets = None
+        self._mapping = None
+
+    def setupOutputs(self):
+        self.Output.meta.assignFrom( self.RavelerLabels.meta )
+        self.Mapping.meta.dtype = object
+        self.Mapping.meta.shape = (1,)
+        with self._lock:
+            self._offsets = None
+            self._mapping = None
+
+    def _getBlockShape(self):
+        shape = self.RavelerLabels.meta.shape
+        if self.BlockShape.ready():
+            return numpy.minimum( self.BlockShape.value, shape )
+        return numpy.minimum( (self.DEFAULT_BLOCK_SIZE,) * len(shape), shape )
+
+    def _blockwiseMax(self, slot):
+        shape = slot.meta.shape
+        block_starts = getIntersectingBlocks( self._getBlockShape(), roiFromShape(shape) )
+        block_maxes = [0] * len(block_starts)
+        def computeMax(index):
+            block_roi = getBlockBounds( shape, self._getBlockShape(), block_starts[index] )
+            block_maxes[index] = int( slot(*block_roi).wait().max() )
+
+        pool = RequestPool()
+        for index in range(len(block_starts)):
+            pool.add( Request( partial(computeMax, index) ) )
+        pool.wait()
+        return max( block_maxes )
+
+    def _getOffsets(self):
+        """
+        Returns the label offset for each body's fragments.
+        (Also prepares the mapping.)
+        """
+        with self._lock:
+            if self._offsets is None:
+                max_label = self._blockwiseMax( self.RavelerLabels )
+                mapping = collections.OrderedDict()
+                mapping[(0,max_label+1)] = -1 # Special body-id: -1 means "identity"
+
+                offsets = []
+                for slot in self.FragmentSegmentations:
+                    offsets.append( max_label )
+                    old_max = max_label + 1
+                    max_label += self._blockwiseMax( slot )
+                    mapping[(old_max,max_label+1)] = slot.meta.selected_label
+
+                self._offsets = offsets
+                self._mapping = mapping
+            return self._offsets
+
+    def execute(self, slot, subindex, roi, result):
+        if slot == self.Mapping:
+            self._getOffsets()
+            result[0] = self._mapping
+            return result
+        elif slot == self.Output:
+            offsets = self._getOffsets()
+            block_starts = getIntersectingBlocks( self._getBlockShape(), (roi.start, roi.stop) )
+
+            def composeBlock(block_start):
+                block_roi = getBlockBounds( self.Output.meta.shape, self._getBlockShape(), block_start )
+                block_roi = getIntersection( block_roi, (roi.start, roi.stop) )
+                result_block = result[ roiToSlice( *numpy.subtract(block_roi, roi.start) ) ]
+
+                # Start with the raveler labels, then paint the fragments of each body on top (in order)
+                self.RavelerLabels(*block_roi).writeInto( result_block ).wait()
+                for fragment_slot, offset in zip(self.FragmentSegmentations, offsets):
+                    fragments = fragment_slot(*block_roi).wait()
+                    fragment_pixels = (fragments != 0)
+                    result_block[fragment_pixels] = fragments[fragment_pixels].astype(numpy.int64) + offset
+
+            pool = RequestPool()
+            for block_start in block_starts:
+                pool.add( Request( partial(composeBlock, block_start) ) )
+            pool.wait()
+            return result
+        else:
+            assert False, "Unknown output slot: {}".format( slot.name )
+
+    def propagateDirty(self, slot, subindex, roi):
+        with self._lock:
+            self._offsets = None
+            self._mapping = None
+        self.Output.setDirty()
+        self.Mapping.setDirty()
+
 
 
 
@@ -29,11 +29,30 @@ from lazyflow.operators.opReorderAxes import OpReorderAxes
 
 from lazyflow.utility import PathComponents
 from ilastik.utility import bind, log_exception
-from ilastik.applets.splitBodyPostprocessing.opSplitBodyPostprocessing import OpAccumulateFragmentSegmentations, OpMaskedWatershed
+from ilastik.applets.splitBodyPostprocessing.opSplitBodyPostprocessing import OpBlockwiseAccumulateFragmentSegmentations, OpMaskedWatershed
 
 import logging
 logger = logging.getLogger(__name__)
 
+def supervoxel_transform_table(mapping):
+    """
+    The 'transforms' table of the supervoxel export: (supervoxel_label, body_id) for each supervoxel label.
+
+    mapping: OrderedDict of { (start, stop) : body_id } for consecutive label ranges
+             (see OpAccumulateFragmentSegmentations).
+             A body_id of -1 means "identity transform" for these supervoxels
+             (which are really untouched raveler bodies).
+    """
+    num_labels = mapping.keys()[-1][1]
+    transform = numpy.zeros( shape=(num_labels, 2), dtype=numpy.uint32 )
+    for (start, stop), body_id in mapping.items():
+        transform[start:stop, 0] = numpy.arange( start, stop )
+        if body_id == -1:
+            transform[start:stop, 1] = transform[start:stop, 0]
+        else:
+            transform[start:stop, 1] = body_id
+    return transform
+
 class OpSplitBodySupervoxelExport(Operator):
 
     DatasetInfos = InputSlot(level=1) # Used to extract the other datasets from the segmentation file.
@@ -117,7 +136,7 @@ class OpSplitBodySupervoxelExport(Operator):
         self._opRelabeledMergedSupervoxelCaches.Input.connect( self._opRelabelMergedSupervoxels.Output )
         self.RelabeledSupervoxels.connect( self._opRelabeledMergedSupervoxelCaches.Output )
 
-        self._opAccumulateFinalImage = OpAccumulateFragmentSegmentations( parent=self )
+        self._opAccumulateFinalImage = OpBlockwiseAccumulateFragmentSegmentations( parent=self )
         self._opAccumulateFinalImage.RavelerLabels.connect( self.RavelerLabels )
         self._opAccumulateFinalImage.FragmentSegmentations.connect( self._opRelabeledMergedSupervoxelCaches.Output )
         
@@ -178,20 +197,10 @@ class OpSplitBodySupervoxelExport(Operator):
         def handleFinished( result ):
             # Generate the mapping transforms dataset
             mapping = self._opAccumulateFinalImage.Mapping.value
-            num_labels = mapping.keys()[-1][1]
-            transform = numpy.zeros( shape=(num_labels, 2), dtype=numpy.uint32 )
-            for (start, stop), body_id in mapping.items():
-                for supervoxel_label in range(start, stop):
-                    transform[supervoxel_label][0] = supervoxel_label
-                    if body_id == -1:
-                        # Special case: -1 means "identity transform" for this supervoxel
-                        # (Which is really an untouched raveler body)
-                        transform[supervoxel_label][1] = supervoxel_label
-                    else:
-                        transform[supervoxel_label][1] = body_id
+            transform = supervoxel_transform_table( mapping )
 
             # Save the transform before closing the file
-            f.create_dataset('transforms', data=transform)
+            f.create_dataset('transforms', data=transform, chunks=True, compression='gzip')
 
             # Copy all other datasets from the original segmentation file.
             ravelerSegmentationInfo = self.DatasetInfos[2].value
@@ -22,6 +22,7 @@
 
 # basic python modules
 import functools
+import itertools
 import logging
 logger = logging.getLogger(__name__)
 from threading import Lock as ThreadLock
@@ -43,8 +44,21 @@ from lazyflow.operators.opLabelVolume import OpLabelVolume
 from lazyflow.operators.opCompressedCache import OpCompressedCache
 from lazyflow.operators.opReorderAxes import OpReorderAxes
 
+from ilastik.utility import MemoryBoundedScheduler
+
 from _OpGraphCut import segmentGC, OpGraphCut
 
+# Memory needed by segmentGC() per voxel, only used to schedule the graph cuts.
+# This is an estimate, not a measurement: the opengm model (one unary and three
+# pairwise factors per voxel), the max-flow graph and the temporary index arrays,
+# rounded up generously.
+GRAPHCUT_BYTES_PER_VOXEL = 500
+
+# Larger boxes are split into overlapping sub-boxes.  The split does not depend on
+# the available memory, so the segmentation is the same on every machine; jobs that
+# exceed the memory budget are run alone by the MemoryBoundedScheduler.
+MAXBOXSIZE = 10000000
+
 
 ## segment predictions with pre-thresholding
 #
@@ -158,7 +172,8 @@ class OpObjectsSegment(OpGraphCut):
 
         margin = self.Margin.value
         beta = self.Beta.value
-        MAXBOXSIZE = 10000000  # FIXME justification??
+
+        maxBoxSize = MAXBOXSIZE
 
         ## request the bounding box coordinates ##
         # the trailing index brackets give us the dictionary (instead of an
@@ -185,8 +200,7 @@ class OpObjectsSegment(OpGraphCut):
         resultXYZ = vigra.taggedView(np.zeros(cc.shape, dtype=np.uint8),
                                      axistags='xyz')
 
-        def processSingleObject(i):
-            logger.debug("processing object {}".format(i))
+        def getBox(i):
             # maxs are inclusive, so we need to add 1
             xmin = max(mins[i][0]-margin[0], 0)
             ymin = max(mins[i][1]-margin[1], 0)
@@ -194,18 +208,26 @@ class OpObjectsSegment(OpGraphCut):
             xmax = min(maxs[i][0]+margin[0]+1, cc.shape[0])
             ymax = min(maxs[i][1]+margin[1]+1, cc.shape[1])
             zmax = min(maxs[i][2]+margin[2]+1, cc.shape[2])
-            ccbox = cc[xmin:xmax, ymin:ymax, zmin:zmax]
-            resbox = resultXYZ[xmin:xmax, ymin:ymax, zmin:zmax]
+            return np.s_[xmin:xmax, ymin:ymax, zmin:zmax]
 
-            nVoxels = ccbox.size
-            if nVoxels > MAXBOXSIZE:
-                #problem too large to run graph cut, assign to seed
-                logger.warn("Object {} too large for graph cut.".format(i))
-                resbox[ccbox == i] = 1
-                return
-
-            probbox = pred[xmin:xmax, ymin:ymax, zmin:zmax]
-            gcsegm = segmentGC(probbox, beta)
+        def processSingleObject(i):
+            logger.debug("processing object {}".format(i))
+            box = getBox(i)
+            ccbox = cc[box]
+            resbox = resultXYZ[box]
+            probbox = pred[box]
+
+            if ccbox.size > maxBoxSize:
+                # problem too large to run graph cut at once, split it up
+                logger.debug("Splitting object {} for graph cut.".format(i))
+                gcsegm = np.zeros(ccbox.shape, dtype=np.uint8)
+                for core, subbox in splitBox(ccbox.shape, maxBoxSize, margin):
+                    subsegm = segmentGC(probbox[subbox], beta)
+                    local = tuple(slice(c.start - s.start, c.stop - s.start)
+                                  for c, s in zip(core, subbox))
+                    gcsegm[core] = subsegm[local]
+            else:
+                gcsegm = segmentGC(probbox, beta)
             gcsegm = vigra.taggedView(gcsegm, axistags='xyz')
             ccsegm = vigra.analysis.labelVolumeWithBackground(
                 gcsegm.astype(np.uint8))
@@ -222,7 +244,7 @@ class OpObjectsSegment(OpGraphCut):
             assert len(passed.shape) == 1
             if passed.size > 2:
                 logger.warn("ambiguous label assignment for region {}".format(
-                    (xmin, xmax, ymin, ymax, zmin, zmax)))
+                    box))
                 resbox[ccbox == i] = 1
             elif passed.size <= 1:
                 logger.warn(
@@ -232,16 +254,16 @@ class OpObjectsSegment(OpGraphCut):
                 label = passed[1]  # 0 is background
                 resbox[ccsegm == label] = 1
 
-        pool = RequestPool()
-        #FIXME make sure that the parallel computations fit into memory
+        # Large boxes are started first, and only as many at once as fit into memory.
+        jobs = []
         for i in range(1, nobj):
-            req = Request(functools.partial(processSingleObject, i))
-            pool.add(req)
+            nVoxels = cc[getBox(i)].size
+            estimate = min(nVoxels, maxBoxSize) * GRAPHCUT_BYTES_PER_VOXEL
+            jobs.append((estimate, functools.partial(processSingleObject, i)))
 
         logger.info("Processing {} objects ...".format(nobj-1))
 
-        pool.wait()
-        pool.clean()
+        MemoryBoundedScheduler().run(jobs)
 
         logger.info("object loop done")
 
@@ -272,3 +294,59 @@ class OpObjectsSegment(OpGraphCut):
         elif slot == self.Margin:
             # margin affects the whole volume
             self.Output.setDirty(slice(None))
+
+
+def splitBox(shape, maxVoxels, overlap):
+    '''
+       Split a box of the given shape into sub-boxes of at most maxVoxels
+       voxels (as far as the overlap allows), that overlap by the given margin
+       on each side. Boxes that can't be split usefully are returned as a
+       single sub-box.
+       Returns a list of (core, subbox) pairs of slicings (relative to the box):
+       the cores partition the box, each subbox is its core plus the overlap.
+    '''
+    ndim = len(shape)
+    counts = [1]*ndim
+
+    def subSize(axis, count=None):
+        core = -(-shape[axis] // (count or counts[axis]))  # ceil
+        return min(core + 2*overlap[axis], shape[axis])
+
+    def nextCount(axis):
+        # the next number of pieces along this axis that makes the sub-boxes smaller
+        # (the overlap may be so large that only a few more pieces help),
+        # but without making the cores smaller than the overlap (which would
+        # mostly multiply the work)
+        for count in range(counts[axis] + 1, shape[axis] + 1):
+            if -(-shape[axis] // count) < overlap[axis]:
+                break
+            if subSize(axis, count) < subSize(axis):
+                return count
+        return None
+
+    while np.prod([subSize(a) for a in range(ndim)]) > maxVoxels:
+        candidates = [(subSize(a) - subSize(a, c), a, c)
+                      for a, c in ((a, nextCount(a)) for a in range(ndim))
+                      if c is not None]
+        if not candidates:
+            break
+        _, axis, count = max(candidates)
+        counts[axis] = count
+
+    ranges = []
+    for axis in range(ndim):
+        size = -(-shape[axis] // counts[axis])
+        axisRanges = []
+        for start in range(0, shape[axis], size):
+            stop = min(start + size, shape[axis])
+            axisRanges.append((slice(start, stop),
+                               slice(max(start - overlap[axis], 0),
+                                     min(stop + overlap[axis], shape[axis]))))
+        ranges.append(axisRanges)
+
+    boxes = []
+    for combination in itertools.product(*ranges):
+        core = tuple(c for c, _ in combination)
+        subbox = tuple(s for _, s in combination)
+        boxes.append((core, subbox))
+    return boxes
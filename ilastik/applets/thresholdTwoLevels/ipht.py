@@ -1,9 +1,19 @@
+import itertools
+from functools import partial
+
 import numpy
 import vigra
+import scipy.sparse
+import scipy.sparse.csgraph
 import logging
 logger = logging.getLogger(__name__)
 
 from lazyflow.utility import vigra_bincount
+from lazyflow.request import Request, RequestPool
+from ilastik.utility.blocking import block_rois
+
+DEFAULT_BLOCK_SHAPE = 256
+DEFAULT_HALO = 32
 
 def identity_preserving_hysteresis_thresholding( img,
                                                  high_threshold, low_threshold,
@@ -63,6 +73,187 @@ def identity_preserving_hysteresis_thresholding( img,
     logger.debug("Complete")
     return watershed_labels
 
+def blockwise_identity_preserving_hysteresis_thresholding( img,
+                                                           high_threshold, low_threshold,
+                                                           min_size, max_size=None, out=None,
+                                                           block_shape=None, halo=DEFAULT_HALO ):
+    """
+    Same as identity_preserving_hysteresis_thresholding(), but computed tile by tile (in parallel),
+    so that the temporary images are only as large as a tile (plus halo), not as the whole image.
+
+    Each tile is thresholded with a halo, and its core is labeled with the (local) seeds.
+    The object identities are then reconciled with a global union-find over the seed pixels
+    that each tile sees in its halo, i.e. in the core of its neighbors.
+    The size filter uses the global object sizes.
+
+    The result is the same as the one of the reference implementation (up to label numbering),
+    as long as no object grows further than 'halo' pixels beyond its seed.
+
+    block_shape: Tile shape without halo (default: DEFAULT_BLOCK_SHAPE along every axis)
+    halo: At least 1. Tiles smaller than the halo are enlarged to the halo (or the image shape).
+    """
+    shape = img.shape
+    if halo < 1:
+        raise ValueError("The halo must be at least 1 pixel, got {}".format( halo ))
+    if block_shape is None:
+        block_shape = (DEFAULT_BLOCK_SHAPE,) * len(shape)
+    enlarged_block_shape = tuple(min(max(b, halo), s) for b, s in zip(block_shape, shape))
+    if enlarged_block_shape != tuple(min(b, s) for b, s in zip(block_shape, shape)):
+        logger.info("Enlarged the tiles {} to {} for a halo of {}".format( tuple(block_shape), enlarged_block_shape, halo ))
+    block_shape = enlarged_block_shape
+    if out is None:
+        out = vigra.VigraArray(shape, dtype=numpy.uint32, axistags=img.axistags)
+    labels = out.view(numpy.ndarray)
+
+    grid_shape = tuple( (s + b - 1) // b for s, b in zip(shape, block_shape) )
+    blocks = []
+    for start, stop in block_rois(shape, block_shape):
+        halo_start = tuple(max(a - halo, 0) for a in start)
+        halo_stop = tuple(min(b + halo, s) for b, s in zip(stop, shape))
+        blocks.append( (start, stop, halo_start, halo_stop) )
+
+    def run_parallel(fn):
+        pool = RequestPool()
+        for i in range(len(blocks)):
+            pool.add( Request( partial(fn, i) ) )
+        pool.wait()
+
+    def slicing(start, stop, offset=None):
+        offset = offset or (0,) * len(start)
+        return tuple(slice(a - o, b - o) for a, b, o in zip(start, stop, offset))
+
+    logger.debug("Thresholding {} tiles".format( len(blocks) ))
+    tile_results = [None] * len(blocks)
+    def threshold_tile(i):
+        start, stop, halo_start, halo_stop = blocks[i]
+        tile = img[slicing(halo_start, halo_stop)]
+        tile_labels = _hysteresis_tile(tile, high_threshold, low_threshold)
+        core_slicing = slicing(start, stop, halo_start)
+        core = tile_labels[core_slicing]
+        labels[slicing(start, stop)] = core
+
+        # Remember the seeds in the halo, they belong to the neighboring tiles.
+        halo_seeds = (tile.view(numpy.ndarray) >= high_threshold)
+        halo_seeds[core_slicing] = False
+        seed_coords = numpy.nonzero(halo_seeds)
+        seed_labels = tile_labels[seed_coords]
+        seed_coords = tuple(c + o for c, o in zip(seed_coords, halo_start))
+        seed_indexes = numpy.ravel_multi_index(seed_coords, shape)
+
+        num_labels = int(tile_labels.max())
+        sizes = numpy.bincount(core.reshape(-1), minlength=num_labels+1)
+        tile_results[i] = (num_labels, sizes, seed_indexes, seed_labels)
+    run_parallel(threshold_tile)
+
+    counts = numpy.array([r[0] for r in tile_results], dtype=numpy.int64)
+    offsets = numpy.concatenate(([0], numpy.cumsum(counts)[:-1]))
+    num_labels = int(counts.sum())
+
+    logger.debug("Merging objects across tiles")
+    label_sizes = numpy.zeros((num_labels+1,), dtype=numpy.int64)
+    merges = []
+    for i, (count, sizes, seed_indexes, seed_labels) in enumerate(tile_results):
+        label_sizes[offsets[i]+1:offsets[i]+count+1] = sizes[1:]
+
+        # The same seed pixel in the core of the neighbor
+        seed_coords = numpy.unravel_index(seed_indexes, shape)
+        neighbor_labels = labels[seed_coords]
+        neighbors = numpy.ravel_multi_index( tuple(c // b for c, b in zip(seed_coords, block_shape)), grid_shape )
+        merges.append( numpy.array([seed_labels + offsets[i], neighbor_labels + offsets[neighbors]]).T )
+    del tile_results[:]
+
+    merges = numpy.concatenate(merges)
+    graph = scipy.sparse.coo_matrix( (numpy.ones(len(merges)), (merges[:,0], merges[:,1])),
+                                     shape=(num_labels+1, num_labels+1) )
+    # Components are numbered consecutively in order of their first node, so 0 stays 0.
+    _, mapping = scipy.sparse.csgraph.connected_components(graph, directed=False)
+    mapping = mapping.astype(numpy.uint32)
+
+    logger.debug("Filtering labels")
+    object_sizes = numpy.bincount(mapping, weights=label_sizes)
+    if not (min_size == 0 and (max_size is None or max_size > numpy.prod(shape))):
+        bad_sizes = object_sizes < min_size
+        if max_size is not None:
+            numpy.logical_or( bad_sizes, object_sizes > max_size, out=bad_sizes )
+        bad_sizes[0] = False
+        mapping[bad_sizes[mapping]] = 0
+
+    removed = numpy.zeros(grid_shape, dtype=bool)
+    def relabel_tile(i):
+        start, stop, _, _ = blocks[i]
+        core = labels[slicing(start, stop)]
+        objects = (core > 0)
+        core[objects] = mapping[core[objects] + offsets[i]]
+        removed.flat[i] = (objects & (core == 0)).any()
+    run_parallel(relabel_tile)
+
+    if not removed.any() or mapping.max() == 0:
+        # Nothing to fill up, or everything got filtered out.
+        return out
+
+    # Run watershed a second time (in the tiles next to removed objects)
+    #  to make sure the larger labels eat up the tiny stuff we removed, if it was adjacent.
+    logger.debug("Second watershed")
+    dirty = numpy.zeros(grid_shape, dtype=bool)
+    for shift in itertools.product(*[(-1, 0, 1)] * len(grid_shape)):
+        src = tuple(slice(max(-d, 0), g - max(d, 0)) for d, g in zip(shift, grid_shape))
+        dst = tuple(slice(max(d, 0), g - max(-d, 0)) for d, g in zip(shift, grid_shape))
+        dirty[dst] |= removed[src]
+
+    grown = [None] * len(blocks)
+    def grow_tile(i):
+        if not dirty.flat[i]:
+            return
+        start, stop, halo_start, halo_stop = blocks[i]
+        tile = img[slicing(halo_start, halo_stop)]
+        seeds = labels[slicing(halo_start, halo_stop)].copy()
+        grown[i] = _grow_tile(tile, seeds, low_threshold)[slicing(start, stop, halo_start)]
+    run_parallel(grow_tile)
+
+    for i, tile_labels in enumerate(grown):
+        if tile_labels is not None:
+            start, stop, _, _ = blocks[i]
+            labels[slicing(start, stop)] = tile_labels
+    logger.debug("Complete")
+    return out
+
+def _hysteresis_tile(tile, high_threshold, low_threshold):
+    """
+    The first steps of identity_preserving_hysteresis_thresholding() for a single tile:
+    label the seeds and grow them into the low-threshold regions.
+    Returns a plain uint32 array of the same shape as the tile.
+    """
+    binary_seeds = (tile >= high_threshold).view(numpy.uint8)
+    seed_labels = label_with_background(binary_seeds)
+
+    tile_max = tile.max()
+    inverted_tile = (-tile + tile_max).withAxes(seed_labels.axistags.keys())
+    inverted_low_threshold = -1*tile.dtype.type(low_threshold) + tile_max
+
+    tile_labels, _ = vigra.analysis.watershedsNew( inverted_tile,
+                                                   seeds=seed_labels,
+                                                   terminate=vigra.analysis.SRGType.StopAtThreshold,
+                                                   max_cost=inverted_low_threshold )
+    return tile_labels.view(numpy.ndarray).reshape(tile.shape)
+
+def _grow_tile(tile, seeds, low_threshold):
+    """
+    The second watershed of identity_preserving_hysteresis_thresholding() for a single tile.
+    Returns a plain uint32 array of the same shape as the tile.
+    """
+    seeds = vigra.taggedView(seeds, tile.axistags).squeeze()
+
+    tile_max = tile.max()
+    inverted_tile = (-tile + tile_max).withAxes(seeds.axistags.keys())
+    inverted_low_threshold = -1*tile.dtype.type(low_threshold) + tile_max
+
+    vigra.analysis.watershedsNew( inverted_tile,
+                                  seeds=seeds,
+                                  terminate=vigra.analysis.SRGType.StopAtThreshold,
+                                  max_cost=inverted_low_threshold,
+                                  out=seeds )
+    return seeds.view(numpy.ndarray).reshape(tile.shape)
+
 def label_with_background(img):
     img = img.squeeze()
     if img.ndim == 2:
@@ -31,7 +31,7 @@ import vigra
 # ilastik
 from ilastik.applets.base.applet import DatasetConstraintError
 import ilastik.config
-from ipht import identity_preserving_hysteresis_thresholding
+from ipht import identity_preserving_hysteresis_thresholding, blockwise_identity_preserving_hysteresis_thresholding
 
 # Lazyflow
 from lazyflow.graph import Operator, InputSlot, OutputSlot
@@ -39,14 +39,14 @@ from lazyflow.operators import OpPixelOperator, OpLabelVolume,\
     OpCompressedCache, OpColorizeLabels,\
     OpSingleChannelSelector, OperatorWrapper,\
     OpMultiArrayStacker, OpMultiArraySlicer,\
-    OpReorderAxes, OpFilterLabels
+    OpReorderAxes
 from lazyflow.rtype import SubRegion
 from lazyflow.request import Request, RequestPool
 
 # local
 from thresholdingTools import OpAnisotropicGaussianSmoothing5d
 
-from thresholdingTools import OpSelectLabels
+from thresholdingTools import OpSelectLabels, OpLabelSizeFilter, threshold_two_levels
 
 from opGraphcutSegment import haveGraphCut
 
@@ -82,6 +82,10 @@ class OpThresholdTwoLevels(Operator):
     Channel = InputSlot(value=0)
     CurOperator = InputSlot(stype='int', value=0)
 
+    # Compute the two-level threshold in a single pass (and without debug outputs).
+    # Headless only, see _OpThresholdTwoLevelsFused.
+    FusedTwoLevels = InputSlot(stype='bool', value=False)
+
     ## Graph-Cut options ##
 
     SingleThresholdGC = InputSlot(stype='float', value=0.5)
@@ -150,6 +154,15 @@ class OpThresholdTwoLevels(Operator):
         self.opThreshold2.LowThreshold.connect(self.LowThreshold)
         self.opThreshold2.HighThreshold.connect(self.HighThreshold)
 
+        # fused double threshold operator (smooths by itself)
+        self.opThreshold2Fused = _OpThresholdTwoLevelsFused(parent=self)
+        self.opThreshold2Fused.MinSize.connect(self.MinSize)
+        self.opThreshold2Fused.MaxSize.connect(self.MaxSize)
+        self.opThreshold2Fused.LowThreshold.connect(self.LowThreshold)
+        self.opThreshold2Fused.HighThreshold.connect(self.HighThreshold)
+        self.opThreshold2Fused.Sigmas.connect(self.SmootherSigma)
+        self.opThreshold2Fused.InputImage.connect(self._opChannelSelector.Output)
+
         # Identity-preserving hysteresis thresholding
         self.opIpht = OpIpht(parent=self)
         self.opIpht.MinSize.connect(self.MinSize)
@@ -208,6 +221,8 @@ class OpThresholdTwoLevels(Operator):
 
         if curIndex == 0:
             outputSlot = self._connectForSingleThreshold(self.opThreshold1)
+        elif curIndex == 1 and self.FusedTwoLevels.value:
+            outputSlot = self.opThreshold2Fused.Output
         elif curIndex == 1:
             outputSlot = self._connectForTwoLevelThreshold()
         elif curIndex == 2:
@@ -320,7 +335,7 @@ class _OpThresholdOneLevel(Operator):
 
         self.BeforeSizeFilter.connect( self._opLabeler.Output )
 
-        self._opFilter = OpFilterLabels( parent=self )
+        self._opFilter = OpLabelSizeFilter( parent=self )
         self._opFilter.Input.connect(self._opLabeler.Output )
         self._opFilter.MinLabelSize.connect( self.MinSize )
         self._opFilter.MaxLabelSize.connect( self.MaxSize )
@@ -419,7 +434,7 @@ class _OpThresholdTwoLevels(Operator):
         self._opHighLabeler.Method.setValue(_labeling_impl)
         self._opHighLabeler.Input.connect(self._opHighThresholder.Output)
 
-        self._opHighLabelSizeFilter = OpFilterLabels(parent=self)
+        self._opHighLabelSizeFilter = OpLabelSizeFilter(parent=self)
         self._opHighLabelSizeFilter.Input.connect(self._opHighLabeler.Output)
         self._opHighLabelSizeFilter.MinLabelSize.connect(self.MinSize)
         self._opHighLabelSizeFilter.MaxLabelSize.connect(self.MaxSize)
@@ -434,7 +449,7 @@ class _OpThresholdTwoLevels(Operator):
         # they might still be present in case a big object
         # was split into many small ones for the higher threshold
         # and they got reconnected again at lower threshold
-        self._opFinalLabelSizeFilter = OpFilterLabels( parent=self )
+        self._opFinalLabelSizeFilter = OpLabelSizeFilter( parent=self )
         self._opFinalLabelSizeFilter.Input.connect(self._opSelectLabels.Output )
         self._opFinalLabelSizeFilter.MinLabelSize.connect( self.MinSize )
         self._opFinalLabelSizeFilter.MaxLabelSize.connect( self.MaxSize )
@@ -523,6 +538,63 @@ class _OpThresholdTwoLevels(Operator):
         #  so all calls to __setitem__ are forwarded automatically
 
 
+## internal operator for two level thresholding, fused into a single pass
+#
+# Same result as _OpThresholdTwoLevels (after smoothing with the given Sigmas),
+# but each t/c volume is smoothed, thresholded, labeled and filtered in one go
+# (see threshold_two_levels()). No debug outputs and no cache of its own
+# (OpThresholdTwoLevels caches the final labels).
+#
+# Only the final labels are kept, so every change of the MinSize/MaxSize
+# recomputes the smoothing and labeling, too. That's fine for headless runs,
+# where the parameters are set once, but too slow for tuning them in the GUI,
+# which therefore always uses the chained operators.
+class _OpThresholdTwoLevelsFused(Operator):
+    name = "_OpThresholdTwoLevelsFused"
+
+    InputImage = InputSlot() # Not smoothed
+    Sigmas = InputSlot(value={'x': 1.0, 'y': 1.0, 'z': 1.0})
+    MinSize = InputSlot(stype='int', value=0)
+    MaxSize = InputSlot(stype='int', value=1000000)
+    HighThreshold = InputSlot(stype='float', value=0.5)
+    LowThreshold = InputSlot(stype='float', value=0.2)
+
+    Output = OutputSlot()
+
+    def setupOutputs(self):
+        assert self.InputImage.meta.getAxisKeys() == list('txyzc')
+        assert set(self.Sigmas.value.keys()) == set('xyz'), "Sigmas slot expects three key-value pairs for x,y,z"
+        self.Output.meta.assignFrom(self.InputImage.meta)
+        self.Output.meta.dtype = numpy.uint32
+
+    def execute(self, slot, subindex, roi, result):
+        high = self.HighThreshold.value
+        low = self.LowThreshold.value
+        drange = self.InputImage.meta.drange
+        if drange is not None:
+            assert drange[0] == 0,\
+                "Don't know how to threshold data with this drange."
+            high *= drange[1]
+            low *= drange[1]
+
+        # The thresholding is global: always process whole t/c volumes
+        # (and keep only the requested part)
+        shape = self.InputImage.meta.shape
+        spatial_slicing = tuple( slice(a, b) for a, b in zip(roi.start[1:4], roi.stop[1:4]) )
+        for i, t in enumerate(xrange(roi.start[0], roi.stop[0])):
+            for j, c in enumerate(xrange(roi.start[4], roi.stop[4])):
+                image = self.InputImage((t,0,0,0,c), (t+1,)+shape[1:4]+(c+1,)).wait()
+                labels = threshold_two_levels( image[0,...,0], high, low,
+                                               self.MinSize.value, self.MaxSize.value,
+                                               sigmas=self.Sigmas.value )
+                del image
+                result[i,...,j] = labels[spatial_slicing]
+        return result
+
+    def propagateDirty(self, slot, subindex, roi):
+        self.Output.setDirty()
+
+
 class OpIpht(Operator):
     """
     Identity-preserving Hysteresis Thresholding.
@@ -533,6 +605,7 @@ class OpIpht(Operator):
     MaxSize = InputSlot(stype='int', value=1000000)
     HighThreshold = InputSlot(stype='float', value=0.5)
     LowThreshold = InputSlot(stype='float', value=0.2)
+    BlockShape = InputSlot(optional=True) # xyz. If given, the thresholding is computed tile by tile.
 
     Output = OutputSlot()
     CachedOutput = OutputSlot()  # For the GUI (blockwise-access)
@@ -555,6 +628,7 @@ class OpIpht(Operator):
         self._opIpht.MaxSize.connect( self.MaxSize )
         self._opIpht.HighThreshold.connect( self.HighThreshold )
         self._opIpht.LowThreshold.connect( self.LowThreshold )
+        self._opIpht.BlockShape.connect( self.BlockShape )
         self.Output.connect( self._opIpht.Output )
         
         self._opCache = OpCompressedCache(parent=self)
@@ -582,6 +656,7 @@ class OpIphtNoCache(Operator):
     MaxSize = InputSlot(stype='int', value=1000000)
     HighThreshold = InputSlot(stype='float', value=0.5)
     LowThreshold = InputSlot(stype='float', value=0.2)
+    BlockShape = InputSlot(optional=True) # xyz. If given, the thresholding is computed tile by tile.
 
     Output = OutputSlot()
     
@@ -600,12 +675,21 @@ class OpIphtNoCache(Operator):
             roi_t[:,0] = (t, t+1)
             image = self.InputImage(*roi_t).wait()
             image = vigra.taggedView(image, 'txyzc')
-            identity_preserving_hysteresis_thresholding( image[0,...,0],
-                                                         self.HighThreshold.value,
-                                                         self.LowThreshold.value,
-                                                         self.MinSize.value,
-                                                         self.MaxSize.value,
-                                                         out=result[t-t_start,...,0] )
+            if self.BlockShape.ready():
+                blockwise_identity_preserving_hysteresis_thresholding( image[0,...,0],
+                                                                       self.HighThreshold.value,
+                                                                       self.LowThreshold.value,
+                                                                       self.MinSize.value,
+                                                                       self.MaxSize.value,
+                                                                       out=result[t-t_start,...,0],
+                                                                       block_shape=tuple(self.BlockShape.value) )
+            else:
+                identity_preserving_hysteresis_thresholding( image[0,...,0],
+                                                             self.HighThreshold.value,
+                                                             self.LowThreshold.value,
+                                                             self.MinSize.value,
+                                                             self.MaxSize.value,
+                                                             out=result[t-t_start,...,0] )
 
     def propagateDirty(self, slot, subindex, roi):
         self.Output.setDirty()
@@ -31,6 +31,7 @@ import psutil
 # Lazyflow
 from lazyflow.graph import Operator, InputSlot, OutputSlot
 from lazyflow.roi import enlargeRoiForHalo, TinyVector
+from lazyflow.request import RequestLock
 
 # ilastik
 from lazyflow.utility import Timer, vigra_bincount
@@ -392,3 +393,157 @@ class OpSelectLabels(Operator):
             self.Output.setDirty(slice(None))
         else:
             assert False, "Unknown input slot: {}".format(slot.name)
+
+
+## Remove the objects that are too small or too large from a label image
+#
+# Same as lazyflow's OpFilterLabels, but the object sizes are counted once
+# per t/c volume and kept until the labels change. Changing MinLabelSize or
+# MaxLabelSize only remaps the labels with a lookup table.
+#
+# The input must have 5 dimensions (txyzc). The sizes are always counted over
+# the whole spatial volume, even if only a part of it is requested.
+class OpLabelSizeFilter(Operator):
+    name = "OpLabelSizeFilter"
+
+    Input = InputSlot()
+    MinLabelSize = InputSlot(stype='int')
+    MaxLabelSize = InputSlot(optional=True, stype='int')
+    BinaryOut = InputSlot(optional=True, value=False, stype='bool')
+
+    Output = OutputSlot()
+
+    def __init__(self, *args, **kwargs):
+        super(OpLabelSizeFilter, self).__init__(*args, **kwargs)
+        self._lock = RequestLock()  # protects the dicts below
+        self._sizes = {}  # (t, c) -> size of each label
+        self._sizeLocks = {}  # (t, c) -> lock held while counting the sizes
+        self._generation = 0  # incremented whenever the sizes are discarded
+
+    def setupOutputs(self):
+        assert len(self.Input.meta.shape) == 5, "Input must be 5d (txyzc)"
+        self.Output.meta.assignFrom(self.Input.meta)
+        with self._lock:
+            self._sizes = {}
+            self._generation += 1
+
+    def execute(self, slot, subindex, roi, result):
+        minSize = self.MinLabelSize.value
+        maxSize = None
+        if self.MaxLabelSize.ready():
+            maxSize = self.MaxLabelSize.value
+        binary = self.BinaryOut.value
+
+        for i, t in enumerate(xrange(roi.start[0], roi.stop[0])):
+            for j, c in enumerate(xrange(roi.start[4], roi.stop[4])):
+                sizes = self._getSizes(t, c)
+
+                # lookup table: the label itself, or 0 for the wrong sizes
+                remove = sizes < minSize
+                if maxSize is not None:
+                    remove |= sizes > maxSize
+                lut = numpy.arange(len(sizes), dtype=self.Output.meta.dtype)
+                lut[remove] = 0
+                if binary:
+                    lut = (lut != 0).astype(self.Output.meta.dtype)
+
+                start = (t,) + tuple(roi.start[1:4]) + (c,)
+                stop = (t+1,) + tuple(roi.stop[1:4]) + (c+1,)
+                labels = self.Input(start, stop).wait()
+                result[i:i+1, ..., j:j+1] = lut[labels]
+        return result
+
+    def _getSizes(self, t, c):
+        # The sizes are counted under a lock of their own (per t/c volume),
+        # so requests for other volumes (and dirty notifications) don't have
+        # to wait for the upstream request.
+        with self._lock:
+            if (t, c) in self._sizes:
+                return self._sizes[(t, c)]
+            sizeLock = self._sizeLocks.setdefault((t, c), RequestLock())
+
+        with sizeLock:
+            with self._lock:
+                if (t, c) in self._sizes:
+                    return self._sizes[(t, c)]
+                generation = self._generation
+            shape = self.Input.meta.shape
+            labels = self.Input((t, 0, 0, 0, c), (t+1,) + tuple(shape[1:4]) + (c+1,)).wait()
+            sizes = vigra_bincount(labels)
+            with self._lock:
+                # Don't keep sizes of labels that were discarded in the meantime
+                if generation == self._generation:
+                    self._sizes[(t, c)] = sizes
+            return sizes
+
+    def propagateDirty(self, slot, subindex, roi):
+        if slot == self.Input:
+            with self._lock:
+                for t, c in self._sizes.keys():
+                    if roi.start[0] <= t < roi.stop[0] and roi.start[4] <= c < roi.stop[4]:
+                        del self._sizes[(t, c)]
+                self._generation += 1
+            # The objects that changed can reach beyond the dirty roi
+            shape = self.Input.meta.shape
+            self.Output.setDirty((roi.start[0], 0, 0, 0, roi.start[4]),
+                                 (roi.stop[0],) + tuple(shape[1:4]) + (roi.stop[4],))
+        else:
+            # Only the lookup table changes
+            self.Output.setDirty(slice(None))
+
+
+def threshold_two_levels(data, high_threshold, low_threshold, min_size, max_size, sigmas=None):
+    """
+    Two-level (hysteresis) thresholding of a single 3d volume in one pass,
+    with the same result as the chain of operators in _OpThresholdTwoLevels:
+
+    - smooth (optional, see OpAnisotropicGaussianSmoothing5d)
+    - label the objects above the high and the low threshold
+    - keep the low-threshold objects that contain a high-threshold object
+      of the allowed size, and number them consecutively
+    - remove the remaining objects of the wrong size
+
+    Only the two label volumes are held in memory (besides the input),
+    the filtering steps work on the per-object size tables.
+
+    data: Tagged 'xyz' volume (already scaled to the thresholds, see drange)
+    sigmas: dict of the smoothing sigmas for x, y and z, or None for no smoothing.
+
+    Returns: uint32 labels, same shape as data
+    """
+    # Must be float32 (vigra gaussian only supports float32)
+    data = vigra.taggedView(data, axistags='xyz')
+    if data.dtype != numpy.float32:
+        data = data.astype(numpy.float32)
+
+    tags = [k for k in 'xyz' if data.shape[data.axistags.index(k)] > 1]
+    if sigmas is not None and all(sigmas[k] >= 0.1 for k in tags):
+        data = vigra.filters.gaussianSmoothing(data.withAxes(*tags),
+                                               [sigmas[k] for k in tags], window_size=2.0)
+        data = data.withAxes(*'xyz')
+
+    highLabels = vigra.analysis.labelVolumeWithBackground((data > high_threshold).view(numpy.uint8))
+    lowLabels = vigra.analysis.labelVolumeWithBackground((data > low_threshold).view(numpy.uint8))
+    del data
+
+    # high-threshold objects of the right size
+    highSizes = vigra_bincount(highLabels)
+    goodHigh = (highSizes >= min_size) & (highSizes <= max_size)
+    goodHigh[0] = False
+    goodHigh = goodHigh[highLabels]
+    del highLabels
+
+    # low-threshold objects that contain one of them
+    passed = numpy.zeros((int(lowLabels.max())+1,), dtype=bool)
+    passed[lowLabels[goodHigh]] = True
+    passed[0] = False
+    del goodHigh
+
+    # number the selected objects consecutively (like OpSelectLabels),
+    # then drop the ones that are too small or large (like OpFilterLabels)
+    lowSizes = vigra_bincount(lowLabels)
+    mapping = numpy.zeros(passed.shape, dtype=numpy.uint32)
+    mapping[passed] = numpy.arange(1, passed.sum()+1, dtype=numpy.uint32)
+    mapping[(lowSizes < min_size) | (lowSizes > max_size)] = 0
+
+    return mapping[lowLabels]
@@ -299,11 +299,13 @@ class OpAnnotations(Operator):
             export_file.add_columns("divisions", divs, Mode.List, extra={"names": names})
 
         if settings["file type"] == "h5":
-            export_file.add_rois(Default.LabelRoiPath, self.LabelImage, "table", settings["margin"], "labeling")
+            export_file.add_rois(Default.LabelRoiPath, self.LabelImage, "table", settings["margin"], "labeling",
+                                 compression=settings["compression"])
             if settings["include raw"]:
                 export_file.add_image(Default.RawPath, self.RawImage)
             else:
-                export_file.add_rois(Default.RawRoiPath, self.RawImage, "table", settings["margin"])
+                export_file.add_rois(Default.RawRoiPath, self.RawImage, "table", settings["margin"],
+                                     compression=settings["compression"])
         export_file.write_all(settings["file type"], settings["compression"])
 
         export_file.ExportProgress.unsubscribe(progress_slot)
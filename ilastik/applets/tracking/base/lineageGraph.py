@@ -0,0 +1,173 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2016, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import numpy as np
+
+class LineageGraph(object):
+    """
+    Index over the lineage of a tracking result, built once from the
+    events that OpTrackingBase._setLabel2Color() replays in export mode.
+
+    All lookups are array based:
+
+    - parents[track] is the track that divided into 'track' (0 if none)
+    - children[track] holds the two daughter tracks of 'track' (0 if none)
+    - division_times[track] is the timestep at which 'track' divided (-1 if never)
+
+    Additionally, (t, label) pairs can be mapped to track ids in bulk with track_ids_at().
+    """
+    NO_TRACK = 0
+
+    def __init__(self, divisions, track_ids=None):
+        """
+        :param divisions: list of (t, parent_oid, parent_track, child1_oid, child1_track, child2_oid, child2_track),
+                          as produced by _setLabel2Color(export_mode=True)
+        :param track_ids: list (one entry per timestep) of dicts {label: track id}, optional
+        """
+        max_track = 0
+        if len(divisions) > 0:
+            division_array = np.asarray(divisions, dtype=np.int64).reshape(-1, 7)
+            max_track = int(division_array[:, [2, 4, 6]].max())
+        else:
+            division_array = np.zeros((0, 7), dtype=np.int64)
+
+        keys, values = self._flatten_track_ids(track_ids)
+        if len(values) > 0:
+            max_track = max(max_track, int(values.max()))
+
+        self.parents = np.zeros((max_track + 1,), dtype=np.int64)
+        self.children = np.zeros((max_track + 1, 2), dtype=np.int64)
+        self.division_times = np.empty((max_track + 1,), dtype=np.int64)
+        self.division_times[:] = -1
+
+        parent_tracks = division_array[:, 2]
+        self.parents[division_array[:, 4]] = parent_tracks
+        self.parents[division_array[:, 6]] = parent_tracks
+        self.children[parent_tracks, 0] = division_array[:, 4]
+        self.children[parent_tracks, 1] = division_array[:, 6]
+        self.division_times[parent_tracks] = division_array[:, 0]
+
+        self._keys = keys
+        self._values = values
+
+    @staticmethod
+    def _flatten_track_ids(track_ids):
+        """
+        Turn the per-timestep {label: track} dicts into a sorted array of
+        (t, label) keys and an aligned array of track ids.
+        """
+        if not track_ids:
+            return np.zeros((0,), dtype=np.int64), np.zeros((0,), dtype=np.int64)
+
+        times = []
+        labels = []
+        tracks = []
+        for t, mapping in enumerate(track_ids):
+            if not mapping:
+                continue
+            times.append(np.empty((len(mapping),), dtype=np.int64))
+            times[-1][:] = t
+            labels.append(np.fromiter(mapping.iterkeys(), dtype=np.int64, count=len(mapping)))
+            tracks.append(np.fromiter(mapping.itervalues(), dtype=np.int64, count=len(mapping)))
+
+        if not times:
+            return np.zeros((0,), dtype=np.int64), np.zeros((0,), dtype=np.int64)
+
+        keys = LineageGraph._make_keys(np.concatenate(times), np.concatenate(labels))
+        tracks = np.concatenate(tracks)
+        order = np.argsort(keys, kind='mergesort')
+        return keys[order], tracks[order]
+
+    @staticmethod
+    def _make_keys(times, labels):
+        return (np.asarray(times, dtype=np.int64) << 32) | np.asarray(labels, dtype=np.int64)
+
+    @property
+    def num_tracks(self):
+        return len(self.parents) - 1
+
+    def track_ids_at(self, times, labels):
+        """
+        Vectorized lookup of the track ids of the objects (times[i], labels[i]).
+        Objects that are not part of any track get NO_TRACK.
+        """
+        query = self._make_keys(times, labels)
+        result = np.zeros(query.shape, dtype=np.int64)
+        if len(self._keys) == 0:
+            return result
+        pos = np.searchsorted(self._keys, query)
+        pos = np.minimum(pos, len(self._keys) - 1)
+        found = self._keys[pos] == query
+        result[found] = self._values[pos[found]]
+        return result
+
+    def track_id(self, t, label):
+        return int(self.track_ids_at([t], [label])[0])
+
+    def _valid(self, track_id):
+        return 0 < track_id < len(self.parents)
+
+    def descendants(self, track_id):
+        """
+        All tracks that originate from divisions of track_id, ordered as
+        [child1, child2] + descendants(child1) + descendants(child2).
+        """
+        result = []
+        if not self._valid(track_id):
+            return result
+        stack = [track_id]
+        while stack:
+            track = stack.pop()
+            child1, child2 = self.children[track]
+            if child1 == self.NO_TRACK:
+                continue
+            result.extend((int(child1), int(child2)))
+            stack.append(child2)
+            stack.append(child1)
+        return result
+
+    def ancestors(self, track_id):
+        """
+        The chain of parent tracks of track_id, starting with the direct parent.
+        """
+        result = []
+        if not self._valid(track_id):
+            return result
+        track = self.parents[track_id]
+        while track != self.NO_TRACK:
+            result.append(int(track))
+            track = self.parents[track]
+        return result
+
+    def family(self, track_id):
+        return self.descendants(track_id), self.ancestors(track_id)
+
+    def roots(self):
+        """
+        For every track id, the id of the first track of its lineage tree.
+        Computed for all tracks at once by pointer jumping.
+        """
+        roots = np.arange(len(self.parents), dtype=np.int64)
+        roots = np.where(self.parents != self.NO_TRACK, self.parents, roots)
+        while True:
+            next_roots = roots[roots]
+            if np.array_equal(next_roots, roots):
+                return roots
+            roots = next_roots
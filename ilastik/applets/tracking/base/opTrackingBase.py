@@ -19,7 +19,6 @@
 # http://ilastik.org/license.html
 # ##############################################################################
 import os
-from functools import partial
 import logging
 
 import numpy as np
@@ -34,8 +33,8 @@ except:
     import pgmlinkNoIlpSolver as pgmlink
 from ilastik.applets.tracking.base.trackingUtilities import relabel, \
     get_dict_value
-from ilastik.applets.objectExtraction.opObjectExtraction import default_features_key
-from ilastik.applets.objectExtraction import config
+from ilastik.applets.tracking.base.lineageGraph import LineageGraph
+from ilastik.applets.tracking.base.traxelArrays import frame_traxel_arrays
 from ilastik.applets.base.applet import DatasetConstraintError
 from lazyflow.operators.opCompressedCache import OpCompressedCache
 from lazyflow.operators.valueProviders import OpZeroDefault
@@ -45,6 +44,34 @@ from lazyflow.roi import sliceToRoi
 logger = logging.getLogger(__name__)
 
 
+def add_frame_traxels(ts, fs, timestep, object_ids, features, scales):
+    """
+    Add the traxels of one timestep to a pgmlink TraxelStore,
+    with the features as computed by frame_traxel_arrays().
+
+    pgmlink only offers per-value feature setters, so this is one call per value.
+    (The features are lists of python floats, which the setters convert fastest.)
+    """
+    x_scale, y_scale, z_scale = scales
+    feature_columns = features.items()
+    for row, oid in enumerate(object_ids.tolist()):
+        tr = pgmlink.Traxel()
+        tr.set_feature_store(fs)
+        tr.set_x_scale(x_scale)
+        tr.set_y_scale(y_scale)
+        tr.set_z_scale(z_scale)
+        tr.Id = oid
+        tr.Timestep = timestep
+
+        for name, column in feature_columns:
+            values = column[row]
+            tr.add_feature_array(name, len(values))
+            for i, v in enumerate(values):
+                tr.set_feature_value(name, i, v)
+
+        ts.add(fs, tr)
+
+
 class OpTrackingBase(Operator, ExportingOperator):
     name = "Tracking"
     category = "other"
@@ -91,6 +118,7 @@ class OpTrackingBase(Operator, ExportingOperator):
         self.track_id = None
         self.extra_track_ids = None
         self.divisions = None
+        self.lineage_graph = None
 
         self._opCache = OpCompressedCache(parent=self)
         self._opCache.InputHdf5.connect(self.InputHdf5)
@@ -356,6 +384,7 @@ class OpTrackingBase(Operator, ExportingOperator):
             self.track_id = label2color
             self.divisions = divisions
             self.extra_track_ids = extra_track_ids
+            self.lineage_graph = LineageGraph(divisions, label2color)
             return label2color, extra_track_ids, divisions
 
         self.track_id = label2color
@@ -374,24 +403,22 @@ class OpTrackingBase(Operator, ExportingOperator):
     def export_track_ids(self):
         return self._setLabel2Color(export_mode=True)
 
-    def track_children(self, track_id, start=0):
-        if start in self.divisions:
-            for t, _, track, _, child_track1, _, child_track2 in self.divisions[start:]:
-                if track == track_id:
-                    children_of = partial(self.track_children, start=t)
-                    return [child_track1, child_track2] + \
-                           children_of(child_track1) + children_of(child_track2)
-        return []
+    def _get_lineage_graph(self):
+        if self.lineage_graph is None:
+            # _setLabel2Color has not run in export mode yet, so no lineage is known
+            return LineageGraph([])
+        return self.lineage_graph
+
+    def track_children(self, track_id):
+        return self._get_lineage_graph().descendants(track_id)
 
     def track_parent(self, track_id):
-        if not self.divisions == {}:
-            for t, oid, track, _, child_track1, _, child_track2 in self.divisions[:-1]:
-                if track_id in (child_track1, child_track2):
-                    return [track] + self.track_parent(track)
-        return []
+        # Note: This includes the last division (the old linear scan skipped it,
+        # so the daughters of the last division had no parents).
+        return self._get_lineage_graph().ancestors(track_id)
 
     def track_family(self, track_id):
-        return self.track_children(track_id), self.track_parent(track_id)
+        return self._get_lineage_graph().family(track_id)
 
 
     def _generate_traxelstore(self,
@@ -455,111 +482,25 @@ class OpTrackingBase(Operator, ExportingOperator):
         empty_frame = False
 
         for t in feats.keys():
-            rc = feats[t][default_features_key]['RegionCenter']
-            lower = feats[t][default_features_key]['Coord<Minimum>']
-            upper = feats[t][default_features_key]['Coord<Maximum>']
-            if rc.size:
-                rc = rc[1:, ...]
-                lower = lower[1:, ...]
-                upper = upper[1:, ...]
-
-            if with_opt_correction:
-                try:
-                    rc_corr = feats[t][config.features_vigra_name]['RegionCenter_corr']
-                except:
-                    raise Exception, 'Can not consider optical correction since it has not been computed before'
-                if rc_corr.size:
-                    rc_corr = rc_corr[1:, ...]
-
-            ct = feats[t][default_features_key]['Count']
-            if ct.size:
-                ct = ct[1:, ...]
-
-            logger.debug("at timestep {}, {} traxels found".format(t, rc.shape[0]))
-            count = 0
-            filtered_labels_at = []
-            for idx in range(rc.shape[0]):
-                # for 2d data, set z-coordinate to 0:
-                if len(rc[idx]) == 2:
-                    x, y = rc[idx]
-                    z = 0
-                elif len(rc[idx]) == 3:
-                    x, y, z = rc[idx]
-                else:
-                    raise DatasetConstraintError ("Tracking", "The RegionCenter feature must have dimensionality 2 or 3.")
-                size = ct[idx]
-                if (x < x_range[0] or x >= x_range[1] or
-                            y < y_range[0] or y >= y_range[1] or
-                            z < z_range[0] or z >= z_range[1] or
-                            size < size_range[0] or size >= size_range[1]):
-                    filtered_labels_at.append(int(idx + 1))
-                    continue
-                else:
-                    count += 1
-                tr = pgmlink.Traxel()
-                tr.set_feature_store(fs)
-                tr.set_x_scale(x_scale)
-                tr.set_y_scale(y_scale)
-                tr.set_z_scale(z_scale)
-                tr.Id = int(idx + 1)
-                tr.Timestep = int(t)
-
-                # pgmlink expects always 3 coordinates, z=0 for 2d data
-                tr.add_feature_array("com", 3)
-                for i, v in enumerate([x, y, z]):
-                    tr.set_feature_value('com', i, float(v))
-
-                tr.add_feature_array("CoordMinimum", 3)
-                for i, v in enumerate(lower[idx]):
-                    tr.set_feature_value("CoordMinimum", i, float(v))
-                tr.add_feature_array("CoordMaximum", 3)
-                for i, v in enumerate(upper[idx]):
-                    tr.set_feature_value("CoordMaximum", i, float(v))
-
-                if with_opt_correction:
-                    tr.add_feature_array("com_corrected", 3)
-                    for i, v in enumerate(rc_corr[idx]):
-                        tr.set_feature_value("com_corrected", i, float(v))
-                    if len(rc_corr[idx]) == 2:
-                        tr.set_feature_value("com_corrected", 2, 0.)
-
-                if with_div:
-                    tr.add_feature_array("divProb", 1)
-                    # idx+1 because rc and ct start from 1, divProbs starts from 0
-                    tr.set_feature_value("divProb", 0, float(divProbs[t][idx + 1][1]))
-
-                if with_classifier_prior:
-                    tr.add_feature_array("detProb", len(detProbs[t][idx + 1]))
-                    for i, v in enumerate(detProbs[t][idx + 1]):
-                        val = float(v)
-                        if val < 0.0000001:
-                            val = 0.0000001
-                        if val > 0.99999999:
-                            val = 0.99999999
-                        tr.set_feature_value("detProb", i, float(val))
-
-
-                # FIXME: check whether it is 2d or 3d data!
-                if with_local_centers:
-                    tr.add_feature_array("localCentersX", len(localCenters[t][idx + 1]))
-                    tr.add_feature_array("localCentersY", len(localCenters[t][idx + 1]))
-                    tr.add_feature_array("localCentersZ", len(localCenters[t][idx + 1]))
-                    for i, v in enumerate(localCenters[t][idx + 1]):
-                        tr.set_feature_value("localCentersX", i, float(v[0]))
-                        tr.set_feature_value("localCentersY", i, float(v[1]))
-                        tr.set_feature_value("localCentersZ", i, float(v[2]))
-
-                tr.add_feature_array("count", 1)
-                tr.set_feature_value("count", 0, float(size))
-                if median_object_size is not None:
-                    obj_sizes.append(float(size))
-
-                ts.add(fs, tr)
+            object_ids, features, filtered_labels_at = frame_traxel_arrays(
+                feats[t], x_range, y_range, z_range, size_range,
+                with_opt_correction=with_opt_correction,
+                div_probs=divProbs[t] if with_div else None,
+                det_probs=detProbs[t] if with_classifier_prior else None,
+                local_centers=localCenters[t] if with_local_centers else None)
+            num_objects = len(object_ids) + len(filtered_labels_at)
+            count = len(object_ids)
+            logger.debug("at timestep {}, {} traxels found".format(t, num_objects))
+
+            add_frame_traxels(ts, fs, int(t), object_ids, features, (x_scale, y_scale, z_scale))
+
+            if median_object_size is not None:
+                obj_sizes.extend(v[0] for v in features.get('count', []))
 
             if len(filtered_labels_at) > 0:
                 filtered_labels[str(int(t) - time_range[0])] = filtered_labels_at
             logger.debug("at timestep {}, {} traxels passed filter".format(t, count))
-            max_traxel_id_at.append(int(rc.shape[0]))
+            max_traxel_id_at.append(int(num_objects))
             if count == 0:
                 empty_frame = True
 
@@ -573,6 +514,18 @@ class OpTrackingBase(Operator, ExportingOperator):
 
         return fs, ts, empty_frame, max_traxel_id_at
 
+    def _median_object_size(self, time_range, x_range, y_range, z_range, size_range):
+        """
+        The median size of all objects in time_range that pass the range filters,
+        computed frame by frame without building a traxelstore.
+        """
+        obj_sizes = []
+        for t in time_range:
+            feats = self.ObjectFeatures([t]).wait()
+            _, features, _ = frame_traxel_arrays(feats[t], x_range, y_range, z_range, size_range)
+            obj_sizes.extend(v[0] for v in features.get('count', []))
+        return np.median(np.array(obj_sizes), overwrite_input=True)
+
     def save_export_progress_dialog(self, dialog):
         """
         Implements ExportOperator.save_export_progress_dialog
@@ -645,11 +598,13 @@ class OpTrackingBase(Operator, ExportingOperator):
                 logger.debug("No divisions occurred. Division Table will not be exported!")
 
         if settings["file type"] == "h5":
-            export_file.add_rois(Default.LabelRoiPath, label_image_slot, "table", settings["margin"], "labeling")
+            export_file.add_rois(Default.LabelRoiPath, label_image_slot, "table", settings["margin"], "labeling",
+                                 compression=settings["compression"])
             if settings["include raw"]:
                 export_file.add_image(Default.RawPath, self.RawImage)
             else:
-                export_file.add_rois(Default.RawRoiPath, self.RawImage, "table", settings["margin"])
+                export_file.add_rois(Default.RawRoiPath, self.RawImage, "table", settings["margin"],
+                                     compression=settings["compression"])
         export_file.write_all(settings["file type"], settings["compression"])
 
         export_file.ExportProgress.unsubscribe(progress_slot)
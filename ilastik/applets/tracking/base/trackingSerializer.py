@@ -49,6 +49,8 @@ class TrackingSerializer(AppletSerializer):
                           )
 
         if 'CoordinateMap' in mainOperator.outputs:
+            # Holds a pgmlink.TimestepIdCoordinateMap, or a windowedTracking.WindowedCoordinateMap
+            # (one coordinate map per window) after windowed tracking. Both are pickled as they are.
             slots.append(SerialPickleableSlot(mainOperator.CoordinateMap, 1, pgmlink.TimestepIdCoordinateMap()))
 
         super( TrackingSerializer, self ).__init__( projectFileGroupName, slots=slots )
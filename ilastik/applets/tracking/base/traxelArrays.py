@@ -0,0 +1,127 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2016, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import collections
+
+import numpy as np
+
+from ilastik.applets.base.applet import DatasetConstraintError
+from ilastik.applets.objectExtraction.opObjectExtraction import default_features_key
+from ilastik.applets.objectExtraction import config
+
+# Probabilities handed to pgmlink are clipped to this range
+DETECTION_PROB_RANGE = (0.0000001, 0.99999999)
+
+def _as_3d_coordinates(coords):
+    """
+    pgmlink expects always 3 coordinates, pad 2d data with z=0
+    """
+    coords = np.asarray(coords, dtype=np.float64)
+    if coords.shape[1] == 3:
+        return coords
+    padded = np.zeros((coords.shape[0], 3), dtype=np.float64)
+    padded[:, :coords.shape[1]] = coords
+    return padded
+
+def frame_traxel_arrays(frame_feats,
+                        x_range,
+                        y_range,
+                        z_range,
+                        size_range,
+                        with_opt_correction=False,
+                        div_probs=None,
+                        det_probs=None,
+                        local_centers=None):
+    """
+    Compute everything that OpTrackingBase._generate_traxelstore() needs to
+    fill the traxels of one timestep with whole-frame numpy operations.
+
+    :param frame_feats: the object features of one timestep, as computed by the object extraction
+    :param div_probs: division probabilities of this timestep (indexed by object id), or None
+    :param det_probs: detection probabilities of this timestep (indexed by object id), or None
+    :param local_centers: local centers of this timestep (indexed by object id), or None
+    :returns: (object_ids, features, filtered_labels), where object_ids holds the ids of all
+              objects that passed the range filters, features is an OrderedDict
+              {pgmlink feature name: list with one list of floats per object in object_ids}
+              and filtered_labels is the list of ids that were rejected by the filters.
+    """
+    rc = frame_feats[default_features_key]['RegionCenter']
+    lower = frame_feats[default_features_key]['Coord<Minimum>']
+    upper = frame_feats[default_features_key]['Coord<Maximum>']
+    ct = frame_feats[default_features_key]['Count']
+
+    # the first row belongs to the background
+    rc = np.asarray(rc)[1:, ...]
+    lower = np.asarray(lower)[1:, ...]
+    upper = np.asarray(upper)[1:, ...]
+    ct = np.asarray(ct)[1:, ...]
+
+    num_objects = rc.shape[0]
+    features = collections.OrderedDict()
+    if num_objects == 0:
+        return np.zeros((0,), dtype=np.int64), features, []
+
+    if rc.ndim != 2 or rc.shape[1] not in (2, 3):
+        raise DatasetConstraintError("Tracking", "The RegionCenter feature must have dimensionality 2 or 3.")
+
+    if with_opt_correction:
+        try:
+            rc_corr = frame_feats[config.features_vigra_name]['RegionCenter_corr']
+        except:
+            raise Exception, 'Can not consider optical correction since it has not been computed before'
+        rc_corr = np.asarray(rc_corr)[1:, ...]
+
+    com = _as_3d_coordinates(rc)
+    sizes = np.asarray(ct, dtype=np.float64).reshape(num_objects, -1)[:, 0]
+    x, y, z = com[:, 0], com[:, 1], com[:, 2]
+    rejected = ((x < x_range[0]) | (x >= x_range[1]) |
+                (y < y_range[0]) | (y >= y_range[1]) |
+                (z < z_range[0]) | (z >= z_range[1]) |
+                (sizes < size_range[0]) | (sizes >= size_range[1]))
+
+    filtered_labels = (np.flatnonzero(rejected) + 1).tolist()
+    kept = np.flatnonzero(~rejected)
+    object_ids = kept + 1
+
+    features['com'] = com[kept].tolist()
+    features['CoordMinimum'] = _as_3d_coordinates(lower[kept]).tolist()
+    features['CoordMaximum'] = _as_3d_coordinates(upper[kept]).tolist()
+
+    if with_opt_correction:
+        features['com_corrected'] = _as_3d_coordinates(rc_corr[kept]).tolist()
+
+    if div_probs is not None:
+        # object ids start from 1, but div_probs has an entry for the background
+        div_probs = np.asarray(div_probs, dtype=np.float64)
+        features['divProb'] = div_probs[object_ids, 1:2].tolist()
+
+    if det_probs is not None:
+        det_probs = np.asarray(det_probs, dtype=np.float64)
+        features['detProb'] = np.clip(det_probs[object_ids], *DETECTION_PROB_RANGE).tolist()
+
+    # FIXME: check whether it is 2d or 3d data!
+    if local_centers is not None:
+        centers = [np.asarray(local_centers[oid], dtype=np.float64).reshape(-1, 3) for oid in object_ids]
+        for axis, name in enumerate(["localCentersX", "localCentersY", "localCentersZ"]):
+            features[name] = [c[:, axis].tolist() for c in centers]
+
+    features['count'] = sizes[kept, None].tolist()
+
+    return object_ids, features, filtered_labels
@@ -0,0 +1,238 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2016, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+"""
+Helpers for tracking long time series in overlapping temporal windows.
+
+Every window is solved on its own, and each frame of the full time range is
+then owned by exactly one window: the events (and the merger coordinates) of a
+frame are taken from its owning window only.
+
+Consecutive windows are cut at a frame c of their overlap where both solutions
+agree on frame c-1, i.e. both windows track the same set of objects there and
+neither window has a merger in that frame.  The events at c (the transitions
+from c-1 into the second window) then refer to exactly the objects the first
+window ended with, so tracks continue over the junction without being broken
+or duplicated.  Among the frames that qualify, the one closest to the middle of
+the overlap is chosen, so every decision in the result still had temporal
+context on both sides.
+
+If the two solutions disagree on every frame of the overlap, the overlap is cut
+in the middle and the transitions of the second window at the cut are
+reconciled with the first window: moves and divisions whose source is not an
+object of the first window's solution in frame c-1 (or is a merger, whose
+resolved ids differ between the windows) become appearances of their targets.
+
+Since events refer to frame-local object ids, track identities carry over a
+window junction when the stitched events are replayed
+(see OpTrackingBase._setLabel2Color).
+"""
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+def tracking_windows(first, last, window_size, overlap):
+    """
+    Split the frames first..last (inclusive) into windows of window_size frames
+    where consecutive windows share 'overlap' frames.
+
+    :returns: list of (start, stop) tuples, both inclusive
+    """
+    if overlap < 2:
+        raise ValueError("Tracking windows must overlap by at least 2 frames, got {}".format(overlap))
+    if window_size <= overlap:
+        raise ValueError("The tracking window size ({}) must be larger than the overlap ({})".format(window_size, overlap))
+
+    windows = []
+    start = first
+    while True:
+        stop = min(start + window_size - 1, last)
+        windows.append((start, stop))
+        if stop == last:
+            return windows
+        start = stop - overlap + 1
+
+def _middle_cut(windows, i, previous_cut):
+    start = windows[i][0]
+    shared = windows[i - 1][1] - start + 1
+    return max(start + shared // 2, previous_cut + 1)
+
+def _tracked_objects(events_at):
+    """
+    The ids of all objects a solution tracks in a frame (the targets of the
+    appearances, moves and divisions into it), and the ids involved in mergers there.
+    """
+    tracked = set()
+    for key, columns in (('app', (0,)), ('mov', (1,)), ('div', (1, 2))):
+        for row in events_at.get(key, []):
+            tracked.update(int(row[c]) for c in columns)
+
+    mergers = set(int(row[0]) for row in events_at.get('merger', []))
+    for merger_id, resolved in events_at.get('res', {}).items():
+        mergers.add(int(merger_id))
+        # the last entry is the energy
+        mergers.update(int(resolved_id) for resolved_id in resolved[:-1])
+    return tracked, mergers
+
+def window_cuts(windows, window_events):
+    """
+    Choose where consecutive windows are cut, see the module docstring.
+
+    :param window_events: the events of every window, as returned by
+                          trackingUtilities.get_events (keyed by the frame index
+                          relative to the window start)
+    :returns: list with the first owned frame of every window but the first one
+    """
+    assert len(windows) == len(window_events)
+    cuts = []
+    previous_cut = windows[0][0]
+    for i in range(1, len(windows)):
+        (previous_start, previous_stop), (start, _) = windows[i - 1], windows[i]
+        middle = _middle_cut(windows, i, previous_cut)
+
+        # c-1 must not be the first frame of the second window, its objects are not linked to anything there
+        candidates = range(max(start + 2, previous_cut + 1), previous_stop + 2)
+        cut = None
+        for c in sorted(candidates, key=lambda c: abs(c - middle)):
+            tracked_a, mergers_a = _tracked_objects(window_events[i - 1].get(str(c - 1 - previous_start), {}))
+            tracked_b, mergers_b = _tracked_objects(window_events[i].get(str(c - 1 - start), {}))
+            if tracked_a == tracked_b and not mergers_a and not mergers_b:
+                cut = c
+                break
+
+        if cut is None:
+            cut = middle
+            logger.warning("Tracking windows {} and {} disagree on every frame of their overlap, "
+                           "tracks may be interrupted at frame {}".format(windows[i - 1], windows[i], cut))
+        cuts.append(cut)
+        previous_cut = cut
+    return cuts
+
+def owned_frames(windows, cuts=None):
+    """
+    For every window, the (first, last) frames whose events are taken from it.
+
+    :param cuts: the first owned frame of every window but the first one, see window_cuts().
+                 By default, every overlap is cut in the middle.
+    """
+    if cuts is None:
+        cuts = []
+        for i in range(1, len(windows)):
+            cuts.append(_middle_cut(windows, i, cuts[-1] if cuts else windows[0][0]))
+    assert len(cuts) == len(windows) - 1
+
+    own_firsts = [windows[0][0]] + list(cuts)
+    own_lasts = [cut - 1 for cut in cuts] + [windows[-1][1]]
+    return zip(own_firsts, own_lasts)
+
+def _reconcile_transitions(events_at, own_previous_events_at, previous_events_at):
+    """
+    Rewrite the moves and divisions into the first owned frame of a window (events_at)
+    that do not start at an object the previous window tracks in the frame before
+    (previous_events_at) as appearances of their targets.  Merger ids are never
+    matched, the resolved ids of both windows are unrelated.
+    """
+    tracked, mergers = _tracked_objects(previous_events_at)
+    _, own_mergers = _tracked_objects(own_previous_events_at)
+    sources = tracked - mergers - own_mergers
+
+    events_at = dict(events_at)
+    appearances = [tuple(row) for row in events_at.get('app', [])]
+    for key, targets in (('mov', (1,)), ('div', (1, 2))):
+        kept = []
+        for row in events_at.get(key, []):
+            if int(row[0]) in sources:
+                kept.append(tuple(row))
+            else:
+                appearances.extend((row[c], row[-1]) for c in targets)
+        events_at.pop(key, None)
+        if kept:
+            events_at[key] = np.asarray(kept)
+    if appearances:
+        events_at['app'] = np.asarray(appearances)
+    return events_at
+
+def stitch_window_events(windows, window_events, cuts):
+    """
+    Combine the events of all windows (as returned by trackingUtilities.get_events,
+    i.e. keyed by the frame index relative to the window start) into the events
+    of the full time range.
+
+    :param cuts: see window_cuts()
+    """
+    assert len(windows) == len(window_events)
+    first = windows[0][0]
+    events = {}
+    owned = owned_frames(windows, cuts)
+    for i, ((start, _), (own_first, own_last), events_at) in enumerate(zip(windows, owned, window_events)):
+        for t in range(own_first, own_last + 1):
+            events[str(t - first)] = events_at[str(t - start)]
+        if i > 0:
+            previous_start = windows[i - 1][0]
+            events[str(own_first - first)] = _reconcile_transitions(
+                events_at[str(own_first - start)],
+                events_at.get(str(own_first - 1 - start), {}),
+                window_events[i - 1].get(str(own_first - 1 - previous_start), {}))
+    return events
+
+def stitch_window_filtered_labels(windows, window_filtered_labels, cuts):
+    """
+    Same as stitch_window_events(), but for the filtered labels dicts that
+    OpTrackingBase._generate_traxelstore() produces.
+    """
+    assert len(windows) == len(window_filtered_labels)
+    first = windows[0][0]
+    filtered_labels = {}
+    for (start, _), (own_first, own_last), filtered_at in zip(windows, owned_frames(windows, cuts),
+                                                              window_filtered_labels):
+        for t in range(own_first, own_last + 1):
+            key = str(t - start)
+            if key in filtered_at:
+                filtered_labels[str(t - first)] = filtered_at[key]
+    return filtered_labels
+
+class WindowedCoordinateMap(object):
+    """
+    The merger coordinates of a windowed tracking result.
+
+    The coordinate map of each window resolves the merger ids of that window only,
+    so every frame has to be relabeled with the map of the window that owns it.
+    After windowed tracking, the CoordinateMap slot of OpConservationTracking holds
+    one of these instead of a single pgmlink.TimestepIdCoordinateMap, and it is
+    pickled into the project file as such (see TrackingSerializer).
+    """
+    def __init__(self, windows, window_coordinate_maps, cuts):
+        assert len(windows) == len(window_coordinate_maps)
+        self.owned = owned_frames(windows, cuts)
+        self.window_coordinate_maps = list(window_coordinate_maps)
+
+    def at(self, time):
+        """
+        The coordinate map to relabel frame 'time' with, None outside the tracked range.
+        """
+        for (own_first, own_last), coordinate_map in zip(self.owned, self.window_coordinate_maps):
+            if own_first <= time <= own_last:
+                return coordinate_map
+        return None
+
+    def size(self):
+        return sum(coordinate_map.size() for coordinate_map in self.window_coordinate_maps)
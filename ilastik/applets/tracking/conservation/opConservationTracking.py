@@ -1,5 +1,7 @@
+from functools import partial
 import numpy as np
 from lazyflow.graph import InputSlot, OutputSlot
+from lazyflow.request import Request, RequestPool
 from lazyflow.rtype import List
 from lazyflow.stype import Opaque
 try:
@@ -11,6 +13,8 @@ from ilastik.applets.tracking.base.opTrackingBase import OpTrackingBase
 from ilastik.applets.tracking.base.trackingUtilities import relabel, highlightMergers
 from ilastik.applets.objectExtraction.opObjectExtraction import default_features_key, OpRegionFeatures
 from ilastik.applets.tracking.base.trackingUtilities import get_events
+from ilastik.applets.tracking.base.windowedTracking import tracking_windows, window_cuts, stitch_window_events, \
+    stitch_window_filtered_labels, WindowedCoordinateMap
 from lazyflow.operators.opCompressedCache import OpCompressedCache
 from lazyflow.roi import sliceToRoi
 from opRelabeledMergerFeatureExtraction import OpRelabeledMergerFeatureExtraction
@@ -61,6 +65,9 @@ class OpConservationTracking(OpTrackingBase):
     RelabeledCachedOutput = OutputSlot() # For the GUI (blockwise access)
     RelabeledImage = OutputSlot()
 
+    EP_GAP = 0.05
+    TRANSITION_PARAMETER = 5
+
     def __init__(self, parent=None, graph=None):
         super(OpConservationTracking, self).__init__(parent=parent, graph=graph)
 
@@ -177,7 +184,10 @@ class OpConservationTracking(OpTrackingBase):
             force_build_hypotheses_graph = False,
             max_nearest_neighbors = 1,
             withBatchProcessing = False,
-            solverName="ILP"
+            solverName="ILP",
+            windowSize=0,
+            windowOverlap=10,
+            maxParallelWindows=2
             ):
         
         if not self.Parameters.ready():
@@ -208,8 +218,6 @@ class OpConservationTracking(OpTrackingBase):
         parameters['appearanceCost'] = appearance_cost
         parameters['disappearanceCost'] = disappearance_cost
 
-        do_build_hypotheses_graph = True
-
         if cplex_timeout:
             parameters['cplex_timeout'] = cplex_timeout
         else:
@@ -228,27 +236,101 @@ class OpConservationTracking(OpTrackingBase):
                     'Check whether you have (i) the correct number of label names specified in Object Count Classification, and (ii) provided at least ' +\
                     'one training example for each class.')
         
-        median_obj_size = [0]
+        solver_settings = dict(x_range=x_range,
+                               y_range=y_range,
+                               z_range=z_range,
+                               size_range=size_range,
+                               x_scale=x_scale,
+                               y_scale=y_scale,
+                               z_scale=z_scale,
+                               maxDist=maxDist,
+                               maxObj=maxObj,
+                               divThreshold=divThreshold,
+                               withTracklets=withTracklets,
+                               sizeDependent=sizeDependent,
+                               divWeight=divWeight,
+                               transWeight=transWeight,
+                               withDivisions=withDivisions,
+                               withOpticalCorrection=withOpticalCorrection,
+                               withClassifierPrior=withClassifierPrior,
+                               withMergerResolution=withMergerResolution,
+                               ndim=ndim,
+                               cplex_timeout=cplex_timeout,
+                               borderAwareWidth=borderAwareWidth,
+                               appearance_cost=appearance_cost,
+                               disappearance_cost=disappearance_cost,
+                               max_nearest_neighbors=max_nearest_neighbors,
+                               solverType=self.getPgmlinkSolverType(solverName))
+
+        parameters['windowSize'] = windowSize
+        parameters['windowOverlap'] = windowOverlap
+        parameters['maxParallelWindows'] = maxParallelWindows
+
+        if windowSize and windowSize < len(time_range):
+            events = self._track_windowed(time_range, avgSize, windowSize, windowOverlap, maxParallelWindows,
+                                          withMergerResolution, solver_settings)
+            parameters['time_range'] = [min(time_range), max(time_range)]
+        else:
+            fs, ts, max_traxel_id_at, median_obj_size = self._generate_window_traxelstore(time_range, avgSize,
+                                                                                          solver_settings)
+            self.tracker, params, eventsVector = self._solve_window(time_range, ts, median_obj_size, solver_settings)
+
+            # extract the coordinates with the given event vector
+            if withMergerResolution:
+                coordinate_map = pgmlink.TimestepIdCoordinateMap()
+                self.CoordinateMap.setValue(coordinate_map)
+                eventsVector = self._resolve_window_mergers(self.tracker, params, time_range, eventsVector,
+                                                            coordinate_map, max_traxel_id_at, solver_settings)
+
+            if len(eventsVector) == 0:
+                raise Exception, 'Tracking terminated unsuccessfully: Events vector has zero length.'
 
-        fs, ts, empty_frame, max_traxel_id_at = self._generate_traxelstore(time_range, x_range, y_range, z_range,
-                                                                      size_range, x_scale, y_scale, z_scale, 
-                                                                      median_object_size=median_obj_size, 
-                                                                      with_div=withDivisions,
-                                                                      with_opt_correction=withOpticalCorrection,
-                                                                      with_classifier_prior=withClassifierPrior)
+            events = get_events(eventsVector)
+
+        self.Parameters.setValue(parameters, check_changed=False)
+        self.EventsVector.setValue(events, check_changed=False)
+        self.RelabeledImage.setDirty()
         
+        if not withBatchProcessing:
+            merger_layer_idx = self.parent.parent.trackingApplet._gui.currentGui().layerstack.findMatchingIndex(lambda x: x.name == "Merger")
+            tracking_layer_idx = self.parent.parent.trackingApplet._gui.currentGui().layerstack.findMatchingIndex(lambda x: x.name == "Tracking")
+            if 'withMergerResolution' in parameters.keys() and not parameters['withMergerResolution']:
+                self.parent.parent.trackingApplet._gui.currentGui().layerstack[merger_layer_idx].colorTable = \
+                    self.parent.parent.trackingApplet._gui.currentGui().merger_colortable
+            else:
+                self.parent.parent.trackingApplet._gui.currentGui().layerstack[merger_layer_idx].colorTable = \
+                    self.parent.parent.trackingApplet._gui.currentGui().tracking_colortable
+
+    def _generate_window_traxelstore(self, time_range, avgSize, s):
+        median_obj_size = [0]
+
+        fs, ts, empty_frame, max_traxel_id_at = self._generate_traxelstore(time_range, s['x_range'], s['y_range'],
+                                                                      s['z_range'], s['size_range'],
+                                                                      s['x_scale'], s['y_scale'], s['z_scale'],
+                                                                      median_object_size=median_obj_size,
+                                                                      with_div=s['withDivisions'],
+                                                                      with_opt_correction=s['withOpticalCorrection'],
+                                                                      with_classifier_prior=s['withClassifierPrior'])
+
         if empty_frame:
             raise DatasetConstraintError('Tracking', 'Can not track frames with 0 objects, abort.')
-              
-        
+
         if avgSize[0] > 0:
             median_obj_size = avgSize
-        
+
         logger.info( 'median_obj_size = {}'.format( median_obj_size ) )
+        return fs, ts, max_traxel_id_at, median_obj_size
+
+    def _solve_window(self, time_range, ts, median_obj_size, s):
+        """
+        Build the hypotheses graph for the traxels in ts and solve it.
+
+        :returns: (tracker, tracking parameters, events vector)
+        """
+        x_range, y_range, z_range = s['x_range'], s['y_range'], s['z_range']
+        x_scale, y_scale, z_scale = s['x_scale'], s['y_scale'], s['z_scale']
+        ndim = s['ndim']
 
-        ep_gap = 0.05
-        transition_parameter = 5
-        
         fov = pgmlink.FieldOfView(time_range[0] * 1.0,
                                       x_range[0] * x_scale,
                                       y_range[0] * y_scale,
@@ -270,26 +352,20 @@ class OpConservationTracking(OpTrackingBase):
         if ndim == 2:
             assert z_range[0] * z_scale == 0 and (z_range[1]-1) * z_scale == 0, "fov of z must be (0,0) if ndim==2"
 
-        if self.tracker is None:
-            do_build_hypotheses_graph = True
-
-        solverType = self.getPgmlinkSolverType(solverName)
-
-        if do_build_hypotheses_graph:
-            print '\033[94m' +"make new graph"+  '\033[0m'
-            self.tracker = pgmlink.ConsTracking(int(maxObj),
-                                         bool(sizeDependent),   # size_dependent_detection_prob
-                                         float(median_obj_size[0]), # median_object_size
-                                         float(maxDist),
-                                         bool(withDivisions),
-                                         float(divThreshold),
-                                         "none",  # detection_rf_filename
-                                         fov,
-                                         "none", # dump traxelstore,
-                                         solverType,
-                                         ndim
-                                         )
-            g = self.tracker.buildGraph(ts, max_nearest_neighbors)
+        print '\033[94m' +"make new graph"+  '\033[0m'
+        tracker = pgmlink.ConsTracking(int(s['maxObj']),
+                                       bool(s['sizeDependent']),   # size_dependent_detection_prob
+                                       float(median_obj_size[0]), # median_object_size
+                                       float(s['maxDist']),
+                                       bool(s['withDivisions']),
+                                       float(s['divThreshold']),
+                                       "none",  # detection_rf_filename
+                                       fov,
+                                       "none", # dump traxelstore,
+                                       s['solverType'],
+                                       ndim
+                                       )
+        g = tracker.buildGraph(ts, s['max_nearest_neighbors'])
 
         # create dummy uncertainty parameter object with just one iteration, so no perturbations at all (iter=0 -> MAP)
         sigmas = pgmlink.VectorOfDouble()
@@ -297,24 +373,24 @@ class OpConservationTracking(OpTrackingBase):
             sigmas.append(0.0)
         uncertaintyParams = pgmlink.UncertaintyParameter(1, pgmlink.DistrId.PerturbAndMAP, sigmas)
 
-        params = self.tracker.get_conservation_tracking_parameters(
+        params = tracker.get_conservation_tracking_parameters(
             0,       # forbidden_cost
-            float(ep_gap), # ep_gap
-            bool(withTracklets), # with tracklets
+            float(self.EP_GAP), # ep_gap
+            bool(s['withTracklets']), # with tracklets
             float(10.0), # detection weight
-            float(divWeight), # division weight
-            float(transWeight), # transition weight
-            float(disappearance_cost), # disappearance cost
-            float(appearance_cost), # appearance cost
-            bool(withMergerResolution), # with merger resolution
+            float(s['divWeight']), # division weight
+            float(s['transWeight']), # transition weight
+            float(s['disappearance_cost']), # disappearance cost
+            float(s['appearance_cost']), # appearance cost
+            bool(s['withMergerResolution']), # with merger resolution
             int(ndim), # ndim
-            float(transition_parameter), # transition param
-            float(borderAwareWidth), # border width
+            float(self.TRANSITION_PARAMETER), # transition param
+            float(s['borderAwareWidth']), # border width
             True, #with_constraints
             uncertaintyParams, # uncertainty parameters
-            float(cplex_timeout), # cplex timeout
+            float(s['cplex_timeout']), # cplex timeout
             None, # transition classifier
-            solverType,
+            s['solverType'],
             False, # training to hard constraints
             1 # num threads
         )
@@ -324,52 +400,103 @@ class OpConservationTracking(OpTrackingBase):
         #     params.register_motion_model4_func(swirl_motion_func_creator(motionModelWeight), motionModelWeight * 25.0)
 
         try:
-            eventsVector = self.tracker.track(params, False)
+            eventsVector = tracker.track(params, False)
+        except Exception as e:
+            raise Exception, 'Tracking terminated unsuccessfully: ' + str(e)
 
-            eventsVector = eventsVector[0] # we have a vector such that we could get a vector per perturbation
+        eventsVector = eventsVector[0] # we have a vector such that we could get a vector per perturbation
+        return tracker, params, eventsVector
 
-            # extract the coordinates with the given event vector
-            if withMergerResolution:
-                coordinate_map = pgmlink.TimestepIdCoordinateMap()
+    def _resolve_window_mergers(self, tracker, params, time_range, eventsVector, coordinate_map, max_traxel_id_at, s):
+        try:
+            self._get_merger_coordinates(coordinate_map,
+                                         time_range,
+                                         eventsVector)
+
+            eventsVector = tracker.resolve_mergers(
+                eventsVector,
+                params,
+                coordinate_map.get(),
+                float(self.EP_GAP),
+                float(s['transWeight']),
+                bool(s['withTracklets']),
+                s['ndim'],
+                self.TRANSITION_PARAMETER,
+                max_traxel_id_at,
+                True, # with_constraints
+                None) # TransitionClassifier
+        except Exception as e:
+            raise Exception, 'Tracking terminated unsuccessfully: ' + str(e)
+        return eventsVector
 
-                self._get_merger_coordinates(coordinate_map,
-                                             time_range,
-                                             eventsVector)
-                self.CoordinateMap.setValue(coordinate_map)
+    def _track_windowed(self, time_range, avgSize, windowSize, windowOverlap, maxParallelWindows,
+                        withMergerResolution, s):
+        """
+        Track in overlapping temporal windows of windowSize frames and stitch the
+        results, see ilastik.applets.tracking.base.windowedTracking.
+        At most maxParallelWindows traxelstores and hypotheses graphs are alive at any time.
+        """
+        windows = tracking_windows(time_range[0], time_range[-1], windowSize, windowOverlap)
+        logger.info("tracking {} frames in {} windows".format(len(time_range), len(windows)))
 
-                eventsVector = self.tracker.resolve_mergers(
-                    eventsVector,
-                    params,
-                    coordinate_map.get(),
-                    float(ep_gap),
-                    float(transWeight),
-                    bool(withTracklets),
-                    ndim,
-                    transition_parameter,
-                    max_traxel_id_at,
-                    True, # with_constraints
-                    None) # TransitionClassifier
+        # all windows must use the same detection model
+        if avgSize[0] > 0:
+            median_obj_size = avgSize
+        else:
+            median_obj_size = [self._median_object_size(time_range, s['x_range'], s['y_range'], s['z_range'],
+                                                        s['size_range'])]
+
+        window_coordinate_maps = [None] * len(windows)
+        window_events = [None] * len(windows)
+        window_filtered_labels = [None] * len(windows)
+
+        maxParallelWindows = max(1, int(maxParallelWindows))
+        for batch_start in range(0, len(windows), maxParallelWindows):
+            batch = range(batch_start, min(batch_start + maxParallelWindows, len(windows)))
+
+            # _generate_traxelstore writes the Parameters and FilteredLabels slots, so it must not run in parallel
+            stores = {}
+            for i in batch:
+                window_range = range(windows[i][0], windows[i][1] + 1)
+                stores[i] = self._generate_window_traxelstore(window_range, median_obj_size, s)
+                window_filtered_labels[i] = dict(self.FilteredLabels.value)
+
+            solved = {}
+            def solve(i):
+                window_range = range(windows[i][0], windows[i][1] + 1)
+                fs, ts, max_traxel_id_at, window_median_obj_size = stores[i]
+                solved[i] = self._solve_window(window_range, ts, window_median_obj_size, s)
+
+            pool = RequestPool()
+            for i in batch:
+                pool.add(Request(partial(solve, i)))
+            pool.wait()
+            pool.clean()
+
+            # Every window needs its own coordinate map: mergers inside an overlap are resolved by both windows,
+            # and the resolved ids of one window mean nothing in the other.
+            for i in batch:
+                tracker, params, eventsVector = solved[i]
+                if withMergerResolution:
+                    window_range = range(windows[i][0], windows[i][1] + 1)
+                    window_coordinate_maps[i] = pgmlink.TimestepIdCoordinateMap()
+                    eventsVector = self._resolve_window_mergers(tracker, params, window_range, eventsVector,
+                                                                window_coordinate_maps[i], stores[i][2], s)
+                if len(eventsVector) == 0:
+                    raise Exception, 'Tracking terminated unsuccessfully: Events vector has zero length.'
+                window_events[i] = get_events(eventsVector)
+
+            # release the traxelstores and hypotheses graphs of this batch
+            stores.clear()
+            solved.clear()
 
-        except Exception as e:
-            raise Exception, 'Tracking terminated unsuccessfully: ' + str(e)
-        
-        if len(eventsVector) == 0:
-            raise Exception, 'Tracking terminated unsuccessfully: Events vector has zero length.'
-        
-        events = get_events(eventsVector)
-        self.Parameters.setValue(parameters, check_changed=False)
-        self.EventsVector.setValue(events, check_changed=False)
-        self.RelabeledImage.setDirty()
-        
-        if not withBatchProcessing:
-            merger_layer_idx = self.parent.parent.trackingApplet._gui.currentGui().layerstack.findMatchingIndex(lambda x: x.name == "Merger")
-            tracking_layer_idx = self.parent.parent.trackingApplet._gui.currentGui().layerstack.findMatchingIndex(lambda x: x.name == "Tracking")
-            if 'withMergerResolution' in parameters.keys() and not parameters['withMergerResolution']:
-                self.parent.parent.trackingApplet._gui.currentGui().layerstack[merger_layer_idx].colorTable = \
-                    self.parent.parent.trackingApplet._gui.currentGui().merger_colortable
-            else:
-                self.parent.parent.trackingApplet._gui.currentGui().layerstack[merger_layer_idx].colorTable = \
-                    self.parent.parent.trackingApplet._gui.currentGui().tracking_colortable
+        self.tracker = None
+        cuts = window_cuts(windows, window_events)
+        if withMergerResolution:
+            self.CoordinateMap.setValue(WindowedCoordinateMap(windows, window_coordinate_maps, cuts))
+        self.FilteredLabels.setValue(stitch_window_filtered_labels(windows, window_filtered_labels, cuts),
+                                     check_changed=True)
+        return stitch_window_events(windows, window_events, cuts)
 
     @staticmethod
     def getPgmlinkSolverType(solverName):
@@ -412,7 +539,7 @@ class OpConservationTracking(OpTrackingBase):
             lower = feats[t][default_features_key]['Coord<Minimum>']
             upper = feats[t][default_features_key]['Coord<Maximum>']
             size = feats[t][default_features_key]['Count']
-            for event in eventsVector[t]:
+            for event in eventsVector[t - time_range[0]]:
                 # check for merger events
                 if event.type == pgmlink.EventType.Merger:
                     idx = event.traxel_ids[0]
@@ -441,8 +568,19 @@ class OpConservationTracking(OpTrackingBase):
                                                          idx,
                                                          int(size[idx,0]))
 
+    def _coordinateMapAt(self, time):
+        """
+        After windowed tracking, the CoordinateMap slot holds a WindowedCoordinateMap
+        with the coordinate map of every window.
+        """
+        coordinate_map = self.CoordinateMap.value
+        if isinstance(coordinate_map, WindowedCoordinateMap):
+            return coordinate_map.at(time)
+        return coordinate_map
+
     def _relabelMergers(self, volume, time, pixel_offsets=[0, 0, 0], onlyMergers=False, noRelabeling=False):
-        if self.CoordinateMap.value.size() == 0:
+        coordinate_map = self._coordinateMapAt(time)
+        if coordinate_map is None or coordinate_map.size() == 0:
             logger.info("Skipping merger relabeling because coordinate map is empty")
             if onlyMergers:
                 return np.zeros_like(volume)
@@ -454,7 +592,6 @@ class OpConservationTracking(OpTrackingBase):
             else:
                 return volume
 
-        coordinate_map = self.CoordinateMap.value
         valid_ids = []
         for old_id, new_ids in self.resolvedto[time].iteritems():
             for new_id in new_ids:
@@ -1,10 +1,12 @@
 import numpy as np
 import math
 import vigra
+from functools import partial
 
 from lazyflow.graph import Operator, InputSlot, OutputSlot
 from lazyflow.stype import Opaque
 from lazyflow.rtype import SubRegion, List
+from lazyflow.request import Request, RequestPool
 from lazyflow.operators import OpArrayCache
 from lazyflow.roi import roiToSlice
 from ilastik.applets.objectExtraction.opObjectExtraction import OpObjectExtraction    ,\
@@ -13,7 +15,6 @@ from ilastik.applets.trackingFeatureExtraction import config
 from ilastik.applets.trackingFeatureExtraction.trackingFeatures import FeatureManager
 
 import logging
-import collections
 from ilastik.applets.base.applet import DatasetConstraintError
 logger = logging.getLogger(__name__)
 
@@ -55,42 +56,40 @@ class OpDivisionFeatures(Operator):
         assert slot == self.BlockwiseDivisionFeatures
         taggedShape = self.LabelVolume.meta.getTaggedShape()
         timeIndex = taggedShape.keys().index('t')
-        
+        assert timeIndex == 0
+        assert len(roi.start) == 1
+
         import time
         start = time.time()
-        
-        vroi_start = len(self.LabelVolume.meta.shape) * [0,]
-        vroi_stop = list(self.LabelVolume.meta.shape)
-        
-        assert len(roi.start) == 1
-        froi_start = roi.start[0]
-        froi_stop = roi.stop[0]
-        vroi_stop[timeIndex] = roi.stop[0]
-        
-        assert timeIndex == 0
-        vroi_start[timeIndex] = roi.start[0]
-        if roi.stop[0] + 1 < self.LabelVolume.meta.shape[timeIndex]:
-            vroi_stop[timeIndex] = roi.stop[0]+1
-            froi_stop = roi.stop[0]+1
-        vroi = [slice(vroi_start[i],vroi_stop[i]) for i in range(len(vroi_start))]
-        
-        feats = self.RegionFeaturesVigra[slice(froi_start, froi_stop)].wait()
-        labelVolume = self.LabelVolume[vroi].wait()
-        divisionFeatNames = self.DivisionFeatureNames[()].wait()[config.features_division_name] 
-        
-        for t in range(roi.stop[0]-roi.start[0]):
-            result[t] = {}
-            feats_cur = feats[t][config.features_vigra_name]
-            if t+1 < froi_stop-froi_start:                
-                feats_next = feats[t+1][config.features_vigra_name]
-                                
-                img_next = labelVolume[t+1,...]
+
+        num_frames = self.LabelVolume.meta.shape[timeIndex]
+        divisionFeatNames = self.DivisionFeatureNames[()].wait()[config.features_division_name]
+
+        def compute_features_for_frame_pair(res_t_ind, t):
+            # The features of frame t depend on the objects in frames t and t+1
+            if t + 1 < num_frames:
+                feats_req = self.RegionFeaturesVigra[t:t+2]
+                label_req = self.LabelVolume[t+1:t+2, ...]
+                feats_req.submit()
+                label_req.submit()
+                feats = feats_req.wait()
+                feats_next = feats[1][config.features_vigra_name]
+                img_next = label_req.wait()[0]
             else:
+                feats = self.RegionFeaturesVigra[t:t+1].wait()
                 feats_next = None
                 img_next = None
+            feats_cur = feats[0][config.features_vigra_name]
+
             res = self.featureManager.computeFeatures_at(feats_cur, feats_next, img_next, divisionFeatNames)
-            result[t][config.features_division_name] = res 
-        
+            result[res_t_ind] = {config.features_division_name: res}
+
+        # every frame pair is computed (and cached) independently
+        pool = RequestPool()
+        for res_t_ind, t in enumerate(xrange(roi.start[0], roi.stop[0])):
+            pool.add( Request( partial(compute_features_for_frame_pair, res_t_ind, t) ) )
+        pool.wait()
+
         stop = time.time()
         logger.info("TIMING: computing division features took {:.3f}s".format(stop-start))
         return result
@@ -99,25 +98,18 @@ class OpDivisionFeatures(Operator):
     def propagateDirty(self, slot, subindex, roi):
         if slot is self.DivisionFeatureNames:
             self.BlockwiseDivisionFeatures.setDirty(slice(None))
-        elif slot is self.RegionFeaturesVigra:
-            self.BlockwiseDivisionFeatures.setDirty(roi)
+            return
+
+        if slot is self.RegionFeaturesVigra:
+            dirtyStart, dirtyStop = roi.start[0], roi.stop[0]
         else:
             axes = self.LabelVolume.meta.getTaggedShape().keys()
-            dirtyStart = collections.OrderedDict(zip(axes, roi.start))
-            dirtyStop = collections.OrderedDict(zip(axes, roi.stop))
-
-            # Remove the spatial and channel dims (keep t, if present)
-            del dirtyStart['x']
-            del dirtyStart['y']
-            del dirtyStart['z']
-            del dirtyStart['c']
-
-            del dirtyStop['x']
-            del dirtyStop['y']
-            del dirtyStop['z']
-            del dirtyStop['c']
+            timeIndex = axes.index('t')
+            dirtyStart, dirtyStop = roi.start[timeIndex], roi.stop[timeIndex]
 
-            self.BlockwiseDivisionFeatures.setDirty(dirtyStart.values(), dirtyStop.values())
+        # frame t enters the features of the pairs (t-1, t) and (t, t+1)
+        dirtyStart = max(dirtyStart - 1, 0)
+        self.BlockwiseDivisionFeatures.setDirty([dirtyStart], [dirtyStop])
     
     
 class OpTrackingFeatureExtraction(Operator):
@@ -21,7 +21,9 @@
 from __future__ import division
 import numpy as np
 import math
-import vigra
+import itertools
+import scipy.ndimage
+import scipy.spatial
 
 def dotproduct(v1, v2):
     return sum((a*b) for a, b in zip(v1, v2))
@@ -64,6 +66,19 @@ class Feature( object ):
     def compute(self, feats_cur, feats_next, **kwargs):
         raise NotImplementedError('Feature not fully implemented yet.')
 
+    def compute_all(self, feats_cur, feats_next, n_next):
+        '''
+        computes the feature for many objects at once
+
+        feats_cur: array of shape (n_objects, feat_dim)
+        feats_next: array of shape (n_objects, n_best, feat_dim), sorted by distance to the parent
+        n_next: number of valid rows in feats_next for each object
+        '''
+        result = np.ones((feats_cur.shape[0], self.dim())) * self.default_value
+        for i in range(feats_cur.shape[0]):
+            result[i] = self.compute(feats_cur[i], feats_next[i, :n_next[i]])
+        return result
+
     def getName(self):
         return self.name
 
@@ -87,6 +102,17 @@ class ParentChildrenRatio( Feature ):
                 result[i] = self.default_value
         return result
 
+    def compute_all(self, feats_cur, feats_next, n_next):
+        result = np.ones((feats_cur.shape[0], self.dim())) * self.default_value
+        valid = n_next >= 2
+        if feats_next.shape[1] < 2 or not valid.any():
+            return result
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = feats_cur[valid] / (feats_next[valid, 0] + feats_next[valid, 1])
+        ratio[np.isnan(ratio)] = self.default_value
+        result[valid] = ratio
+        return result
+
     def dim(self):
         return self.dimensionality * self.feat_dim
 
@@ -105,6 +131,19 @@ class ChildrenRatio( Feature ):
                 ratio[i] = 1./ratio[i]
         return ratio
 
+    def compute_all(self, feats_cur, feats_next, n_next):
+        result = np.ones((feats_cur.shape[0], self.dim())) * self.default_value
+        valid = n_next >= 2
+        if feats_next.shape[1] < 2 or not valid.any():
+            return result
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = feats_next[valid, 0] / feats_next[valid, 1]
+            ratio[np.isnan(ratio)] = self.default_value
+            inverse = ratio > 1
+            ratio[inverse] = 1. / ratio[inverse]
+        result[valid] = ratio
+        return result
+
     def dim(self):
         return self.dimensionality * self.feat_dim
 
@@ -139,6 +178,40 @@ class ParentChildrenAngle( Feature ):
 
         return max(angles)
 
+    def compute_all(self, feats_cur, feats_next, n_next):
+        n_objects, n_best, n_dim = feats_next.shape
+        scales = self.scales[0:n_dim]
+        vectors = (feats_next - feats_cur[:, None, :]) * scales
+        result = np.ones((n_objects, 1)) * self.default_value
+        best = np.empty((n_objects,))
+        best[:] = -np.inf
+
+        for idx1, idx2 in itertools.combinations(range(n_best), 2):
+            valid = n_next > idx2
+            v1 = vectors[valid, idx1]
+            v2 = vectors[valid, idx2]
+            # accumulate in the same order as dotproduct()
+            dot = v1[:, 0] * v2[:, 0]
+            norm1 = v1[:, 0] * v1[:, 0]
+            norm2 = v2[:, 0] * v2[:, 0]
+            for d in range(1, n_dim):
+                dot = dot + v1[:, d] * v2[:, d]
+                norm1 = norm1 + v1[:, d] * v1[:, d]
+                norm2 = norm2 + v2[:, d] * v2[:, d]
+            lengths = np.sqrt(norm1) * np.sqrt(norm2)
+
+            radians = np.zeros(dot.shape)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                cosine = dot / lengths
+                # angle() falls back to 0 for degenerate vectors and rounding errors outside of [-1, 1]
+                defined = (lengths != 0) & ~(np.abs(cosine) > 1)
+                radians[defined] = np.arccos(cosine[defined])
+            best[valid] = np.maximum(best[valid], (radians * 180) / math.pi)
+
+        has_angle = n_next >= 2
+        result[has_angle, 0] = best[has_angle]
+        return result
+
 
 
 
@@ -172,36 +245,103 @@ class FeatureManager( object ):
         self.size_filter = size_filter
         self.squared_distance_default = squared_distance_default
 
-    def _getBestSquaredDistances(self, com_cur, coms_next, size_filter = None, sizes_next = [], default_value = 9999):
-        ''' returns the squared distances to the objects in the neighborhood of com_curr, optionally with size filter '''
-        squaredDistances = []
-
-        for label_next in coms_next.keys():
-            assert label_next in sizes_next.keys()
-            if size_filter != None and sizes_next[label_next] >= size_filter:
-                dist = np.linalg.norm(coms_next[label_next] - com_cur * self.scales)                
-                squaredDistances.append([label_next,dist])
-
-        squaredDistances = np.array(squaredDistances)
-        # sort the array in the second column in ascending order
-        squaredDistances = np.array(sorted(squaredDistances, key=lambda a_entry: a_entry[1]))        
-        
-        # initialize with label -1 and default value
-        result = np.array([ [-1, default_value] for x in range(self.n_best) ], dtype=np.float32)
-        if squaredDistances.shape[0] != 0:
-            result[0:min(squaredDistances.shape[0],result.shape[0]),:] = squaredDistances[0:min(squaredDistances.shape[0],result.shape[0]),:]
-
-        return result
- 
+    def _getBestSuccessors(self, feats_cur, feats_next, img_next):
+        '''
+        returns (labels, distances) of shape (n_objects, n_best) for all objects in feats_cur:
+        the n_best objects in img_next that are closest to each object and overlap the template
+        around it, sorted by distance (label -1 and the default distance where there are less candidates)
+        '''
+        coms_cur = np.asarray(feats_cur[self.com_name_cur])
+        n_objects = coms_cur.shape[0]
+        labels = -np.ones((n_objects, self.n_best), dtype=np.int64)
+        distances = np.ones((n_objects, self.n_best)) * self.squared_distance_default
+        if feats_next is None or img_next is None or n_objects <= 1 or self.size_filter is None:
+            return labels, distances
+
+        coms_next = np.asarray(feats_next[self.com_name_next])
+        sizes_next = np.asarray(feats_next[self.size_name]).reshape(coms_next.shape[0], -1)[:, 0]
+        n_dim = coms_cur.shape[1]
+
+        # bounding boxes of all objects in the next frame, in one pass over the image
+        img_next = np.asarray(img_next)
+        bounding_boxes = scipy.ndimage.find_objects(img_next.astype(np.int32, copy=False), coms_next.shape[0] - 1)
+        bb_min = np.zeros((coms_next.shape[0], n_dim), dtype=np.int64)
+        bb_max = np.zeros((coms_next.shape[0], n_dim), dtype=np.int64)
+        present = np.zeros((coms_next.shape[0],), dtype=bool)
+        for label, slicing in enumerate(bounding_boxes, start=1):
+            if slicing is not None:
+                present[label] = True
+                bb_min[label] = [sl.start for sl in slicing[:n_dim]]
+                bb_max[label] = [sl.stop for sl in slicing[:n_dim]]
+
+        eligible = present & (sizes_next >= self.size_filter)
+        eligible[0] = False
+        candidate_labels = np.flatnonzero(eligible)
+        if len(candidate_labels) == 0:
+            return labels, distances
+
+        # the template (in pixels) around each object, as cropped by the per-object implementation
+        rounded = np.floor(coms_cur[1:] + 0.5)
+        half = self.template_size // 2
+        shape = np.array(img_next.shape[:n_dim])
+        window_start = np.maximum(rounded - half, 0).astype(np.int64)
+        window_stop = np.minimum(rounded + half, shape).astype(np.int64)
+
+        # A candidate's center lies in its bounding box, which must touch the template.
+        # This bounds the distance up to which the kd-tree has to search.
+        queries = coms_cur[1:] * self.scales
+        extent = (bb_max[candidate_labels] - bb_min[candidate_labels]).max()
+        max_distance = math.sqrt(n_dim) * (half + extent + 1) + np.sqrt(((queries - rounded) ** 2).sum(axis=1)).max()
+
+        tree = scipy.spatial.cKDTree(coms_next[candidate_labels])
+        n_candidates = len(candidate_labels)
+        todo = np.arange(n_objects - 1)
+        k = min(self.n_best + 4, n_candidates)
+        while len(todo) > 0:
+            _, neighbors = tree.query(queries[todo], k=k, distance_upper_bound=max_distance)
+            neighbors = neighbors.reshape(len(todo), k)
+            found = neighbors < n_candidates
+            neighbor_labels = candidate_labels[np.where(found, neighbors, 0)]
+
+            start = window_start[todo][:, None, :]
+            stop = window_stop[todo][:, None, :]
+            nb_min = bb_min[neighbor_labels]
+            nb_max = bb_max[neighbor_labels]
+            intersects = found & ((nb_min < stop) & (nb_max > start)).all(axis=-1)
+            contained = intersects & ((nb_min >= start) & (nb_max <= stop)).all(axis=-1)
+
+            # objects that only partly overlap the template: check if any of their pixels is inside
+            for row, col in zip(*np.nonzero(intersects & ~contained)):
+                label = neighbor_labels[row, col]
+                obj = todo[row]
+                roi = tuple(slice(max(window_start[obj, d], bb_min[label, d]), min(window_stop[obj, d], bb_max[label, d]))
+                            for d in range(n_dim))
+                intersects[row, col] = (img_next[roi] == label).any()
+
+            valid_count = intersects.sum(axis=1)
+            exhausted = (k == n_candidates) | ~found[:, -1]
+            done = (valid_count >= self.n_best) | exhausted
+
+            for row in np.flatnonzero(done):
+                obj = todo[row]
+                candidates = neighbor_labels[row][intersects[row]]
+                dist = np.sqrt(((coms_next[candidates] - coms_cur[obj + 1] * self.scales) ** 2).sum(axis=1))
+                # break ties by label
+                order = np.lexsort((candidates, dist))[:self.n_best]
+                labels[obj + 1, :len(order)] = candidates[order]
+                distances[obj + 1, :len(order)] = dist[order]
+
+            todo = todo[~done]
+            k = min(2 * k, n_candidates)
+
+        # the per-object implementation stored the distances as float32
+        distances = distances.astype(np.float32).astype(np.float64)
+        return labels, distances
 
     def computeFeatures_at(self, feats_cur, feats_next, img_next, feat_names): 
-
-#         n_labels = feats_cur.values()[0].shape[0]
         result = {}
-        
-        vigra_feat_names = set([self.com_name_cur, self.com_name_next, self.size_name])
-
         feat_classes = {}
+        n_objects = feats_cur.values()[0].shape[0]
 
         for name in feat_names:
             name_split = name.split(self.delim)
@@ -213,73 +353,36 @@ class FeatureManager( object ):
             feat_dim = len(feats_cur[name_split[1]][0])
             feat_classes[name] = self.feature_mappings[name_split[0]](name_split[1], delim=self.delim, ndim=self.ndim, feat_dim=feat_dim)
 
-            shape = (feats_cur.values()[0].shape[0],feat_classes[name].dim())
+            shape = (n_objects, feat_classes[name].dim())
             result[name] = np.ones(shape) * feat_classes[name].default_value
 
-            vigra_feat_names.add(name_split[1])
-        
+        labels, distances = self._getBestSuccessors(feats_cur, feats_next, img_next)
 
+        # first add squared distances
         for idx in range(self.n_best):
             name = 'SquaredDistances_' + str(idx)
-            result[name] = np.ones((feats_cur.values()[0].shape[0], 1)) * self.squared_distance_default
-
-        for label_cur, com_cur in enumerate(feats_cur[self.com_name_cur]):
-            if label_cur == 0:
+            result[name] = distances[:, idx:idx+1].copy()
+
+        # add all other features, for all objects (except the background) at once
+        n_next = (labels[1:] != -1).sum(axis=1)
+        for name, feat_class in feat_classes.items():
+            if feat_class.feats_name == 'SquaredDistances':
+                # features of the distances to the two closest successors
+                f_next = distances[1:, 0:2, None]
+                f_cur = np.zeros((n_objects - 1, 1))
+                result[name][1:] = feat_class.compute_all(f_cur, f_next, np.ones((n_objects - 1,), dtype=np.int64) * 2)
                 continue
 
-            feats_next_subset = {}
-            for k in vigra_feat_names:
-                feats_next_subset[k] = {}
-
-            if feats_next is not None and img_next is not None:
-                idx_cur = [round(x) for x in com_cur]
-
-                roi = []
-                for idx,coord in enumerate(idx_cur):
-                    start = max(coord - self.template_size//2, 0)
-                    stop = min(coord + self.template_size//2, img_next.shape[idx])
-                    roi.append(slice(int(start),int(stop)))
-
-
-                # find all coms in the neighborhood of com_cur
-                subimg_next = img_next[roi]
-                labels_next = np.sort(vigra.analysis.unique(subimg_next)).tolist()
-
-                for l in labels_next:
-                    if l != 0:
-                        for n in vigra_feat_names:
-                            feats_next_subset[n][l] = np.array([feats_next[n][l]]).flatten()                            
-
-            sq_dist_label = self._getBestSquaredDistances(com_cur, feats_next_subset[self.com_name_next], 
-                                self.size_filter, feats_next_subset[self.size_name], default_value=self.squared_distance_default)
-
-            feats_next_subset_best = {}
-            for n in vigra_feat_names:
-                feats_next_subset_best[n] = []
-                for idx, row in enumerate(sq_dist_label):
-                    l = row[0]
-                    if l != -1:
-                        feats_next_subset_best[n].append(feats_next_subset[n][l])
-
-            # first add squared distances
-            for idx in range(self.n_best):
-                name = 'SquaredDistances_' + str(idx)                
-                result[name][label_cur] = sq_dist_label[idx][1]
-
-            # add all other features
-            for name, feat_class in feat_classes.items():
-                if feat_class.feats_name == 'SquaredDistances':
-                    f_next = sq_dist_label[0:2,1]
-                    f_cur = None
-                else:   
-                    f_cur = np.array([feats_cur[feat_class.feats_name][label_cur]]).flatten()
-                    f_next = np.array([feats_next_subset_best[feat_class.feats_name]]).reshape((-1,f_cur.shape[0]))
-                result[name][label_cur] = feat_class.compute(f_cur, f_next)
+            f_cur = np.asarray(feats_cur[feat_class.feats_name]).reshape(n_objects, -1)[1:]
+            if feats_next is not None:
+                f_next = np.asarray(feats_next[feat_class.feats_name])
+                f_next = f_next.reshape(f_next.shape[0], -1)[np.maximum(labels[1:], 0)]
+            else:
+                f_next = np.zeros((n_objects - 1, self.n_best, f_cur.shape[1]), dtype=f_cur.dtype)
+            result[name][1:] = feat_class.compute_all(f_cur, f_next, n_next)
 
         return result
 
-
-
 if __name__ == '__main__':
     import vigra
     import numpy as np
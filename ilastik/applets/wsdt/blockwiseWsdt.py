@@ -0,0 +1,194 @@
+from functools import partial
+
+import numpy as np
+import scipy.sparse
+import scipy.sparse.csgraph
+
+from lazyflow.request import Request, RequestPool
+
+from ilastik.utility.blocking import block_rois
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Extra context around each block (in pixels), beyond the smoothing sigmas.
+# The distance transform sees this far past the block border.
+DEFAULT_HALO_MARGIN = 10
+
+def wsdt_halo(sigma_minima, sigma_weights, margin=DEFAULT_HALO_MARGIN):
+    """
+    The halo (in pixels) that is needed around a block to compute
+    a watershed that agrees with the global one near the block border.
+    """
+    return int(np.ceil(3.0 * max(sigma_minima, sigma_weights))) + margin
+
+def _slicing(start, stop, offset=None):
+    if offset is None:
+        offset = (0,) * len(start)
+    return tuple(slice(a - o, b - o) for a, b, o in zip(start, stop, offset))
+
+class BlockwiseWsdt(object):
+    """
+    Compute a watershed segmentation block by block, so that only
+    one block (plus halo) per thread has to be held in memory.
+
+    1. Each block is segmented with its halo, the core is stored with local labels.
+       The labels that the block sees just beyond its upper faces are remembered.
+       (The halo makes sure that the segmentation is still reliable there.)
+    2. Segments of neighboring blocks are merged if they are each other's best match
+       on that face (the segment they overlap most with).  Segments that span several
+       blocks are merged through all of their faces (i.e. a union-find over the matched pairs).
+    3. The merged labels are made consecutive and written back into the output.
+    """
+    def __init__(self, shape, block_shape, halo, wsdt_fn):
+        """
+        shape: Shape of the (single-channel) volume
+
+        block_shape: Shape of the blocks (without halo), same dimensionality as shape.
+
+        halo: Pixels of context on each side of a block (at least 1). See wsdt_halo().
+              Blocks smaller than the halo are enlarged to the halo (or the volume shape).
+
+        wsdt_fn: callable(pmap) -> uint32 labels (0 is not a segment)
+        """
+        assert len(block_shape) == len(shape)
+        self.shape = tuple(shape)
+        if halo < 1:
+            raise ValueError("The halo must be at least 1 pixel, got {}".format( halo ))
+        self.block_shape = tuple(min(max(b, halo), s) for b, s in zip(block_shape, shape))
+        if self.block_shape != tuple(min(b, s) for b, s in zip(block_shape, shape)):
+            logger.info("Blockwise WSDT: enlarged the blocks {} to {} for a halo of {}"
+                        .format(tuple(block_shape), self.block_shape, halo))
+        self.halo = halo
+        self.wsdt_fn = wsdt_fn
+
+    def run(self, read_block, out):
+        """
+        read_block: callable (start, stop) -> probability map of that roi
+
+        out: Array-like of the volume shape, to store the segmentation in (e.g. a numpy array or a chunked h5py dataset).
+
+        Returns: the number of segments.
+        """
+        blocks = list(block_rois(self.shape, self.block_shape))
+        block_indexes = { start : i for i, (start, _) in enumerate(blocks) }
+
+        # 1. Segment all blocks
+        block_results = [None] * len(blocks)
+        def segment_block(i):
+            block_results[i] = self._segment_block(blocks[i], read_block, out)
+        self._run_parallel(segment_block, len(blocks))
+
+        counts = np.array([r[0] for r in block_results], dtype=np.int64)
+        offsets = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        num_labels = counts.sum()
+
+        # 2. Merge the segments across the block faces
+        merges = []
+        for i, (_, face_slabs) in enumerate(block_results):
+            for slab_start, slab_stop, slab_labels in face_slabs:
+                j = block_indexes[ self._block_start(slab_start) ]
+                neighbor_labels = np.asarray(out[_slicing(slab_start, slab_stop)])
+                merges.append( self._overlap_merges(slab_labels, offsets[i], neighbor_labels, offsets[j]) )
+
+        if merges:
+            merges = np.concatenate(merges)
+        else:
+            merges = np.zeros((0, 2), dtype=np.int64)
+        graph = scipy.sparse.coo_matrix( (np.ones(len(merges)), (merges[:,0], merges[:,1])),
+                                         shape=(num_labels + 1, num_labels + 1) )
+        # 3. Relabel: merged segments share a label (the connected components of the matched pairs).
+        #    Components are numbered consecutively in order of their first node, so 0 stays 0.
+        _, mapping = scipy.sparse.csgraph.connected_components(graph, directed=False)
+        mapping = mapping.astype(np.uint32)
+        logger.debug("Blockwise WSDT: {} blocks, {} segments before merging, {} after"
+                     .format(len(blocks), num_labels, mapping.max()))
+
+        def relabel_block(i):
+            start, stop = blocks[i]
+            slicing = _slicing(start, stop)
+            local_labels = np.asarray(out[slicing])
+            out[slicing] = np.where(local_labels > 0, mapping[local_labels + offsets[i]], 0)
+        self._run_parallel(relabel_block, len(blocks))
+
+        return int(mapping.max())
+
+    def _block_start(self, position):
+        return tuple( (p // b) * b for p, b in zip(position, self.block_shape) )
+
+    @classmethod
+    def _run_parallel(cls, fn, count):
+        pool = RequestPool()
+        for i in range(count):
+            pool.add( Request( partial(fn, i) ) )
+        pool.wait()
+
+    def _segment_block(self, block_roi, read_block, out):
+        """
+        Segment one block with halo and write its core (with labels 1..N) to the output.
+        Returns (N, face_slabs), where face_slabs are the (start, stop, labels) of the
+        first layer of each upper neighbor of the block (labels in local numbering, 0 for segments not in the core).
+        """
+        start, stop = block_roi
+        halo_start = tuple(max(a - self.halo, 0) for a in start)
+        halo_stop = tuple(min(b + self.halo, s) for b, s in zip(stop, self.shape))
+        segmentation = self.wsdt_fn( read_block(halo_start, halo_stop) )
+
+        core = segmentation[_slicing(start, stop, halo_start)]
+        ids, local_core = np.unique(core, return_inverse=True)
+        if ids[0] == 0:
+            ids = ids[1:]
+        else:
+            local_core += 1
+        out[_slicing(start, stop)] = local_core.reshape(core.shape).astype(np.uint32)
+
+        face_slabs = []
+        for axis in range(len(self.shape)):
+            if stop[axis] == self.shape[axis]:
+                continue
+            slab_start = list(start)
+            slab_stop = list(stop)
+            slab_start[axis] = stop[axis]
+            slab_stop[axis] = stop[axis] + 1
+            slab = segmentation[_slicing(slab_start, slab_stop, halo_start)]
+
+            # Translate to local labels, forget the segments that are not in the core.
+            pos = np.minimum(np.searchsorted(ids, slab), max(len(ids) - 1, 0))
+            if len(ids):
+                slab_labels = np.where(ids[pos] == slab, pos + 1, 0).astype(np.uint32)
+            else:
+                slab_labels = np.zeros(slab.shape, dtype=np.uint32)
+            face_slabs.append( (tuple(slab_start), tuple(slab_stop), slab_labels) )
+
+        return len(ids), face_slabs
+
+    @classmethod
+    def _overlap_merges(cls, labels, offset, neighbor_labels, neighbor_offset):
+        """
+        Pairs of global labels from two blocks that should be merged:
+        those that are each other's best match on the face, i.e. neither of them
+        overlaps more with any other segment (ties go to the smaller label).
+        Segments are never merged just because they touch, which could chain
+        unrelated segments together.  Segments that are split inside a block
+        are only merged if they are connected within the halo.
+        """
+        labels = labels.reshape(-1).astype(np.int64)
+        neighbor_labels = neighbor_labels.reshape(-1).astype(np.int64)
+
+        valid = (labels > 0) & (neighbor_labels > 0)
+        if not valid.any():
+            return np.zeros((0, 2), dtype=np.int64)
+        a = labels[valid]
+        b = neighbor_labels[valid]
+        base = b.max() + 1
+        keys, overlaps = np.unique(a * base + b, return_counts=True)
+        a, b = keys // base, keys % base
+
+        def best_matches(side, other):
+            # the first pair of each segment, ordered by decreasing overlap
+            order = np.lexsort((other, -overlaps, side))
+            first = np.concatenate(([True], side[order][1:] != side[order][:-1]))
+            return order[first]
+
+        mutual = np.intersect1d(best_matches(a, b), best_matches(b, a))
+        return np.array([a[mutual] + offset, b[mutual] + neighbor_offset]).T
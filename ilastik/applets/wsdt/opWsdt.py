@@ -1,15 +1,43 @@
-
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#           http://ilastik.org/license.html
+###############################################################################
+import os
+import tempfile
 from collections import OrderedDict
 import numpy as np
+import h5py
+import logging
 
 from wsdt import wsDtSegmentation
 
 from lazyflow.utility import OrderedSignal
+from lazyflow.request import RequestLock
 from lazyflow.graph import Operator, InputSlot, OutputSlot
 from lazyflow.roi import roiToSlice, sliceToRoi
 from lazyflow.operators import OpBlockedArrayCache, OpValueCache
 from lazyflow.operators.generic import OpPixelOperator, OpSingleChannelSelector
 
+from blockwiseWsdt import BlockwiseWsdt, wsdt_halo
+
+logger = logging.getLogger(__name__)
+
 class OpWsdt(Operator):
     Input = InputSlot() # Can be multi-channel (but you'll have to choose which channel you want to use)
     ChannelSelection = InputSlot(value=0)
@@ -24,6 +52,11 @@ class OpWsdt(Operator):
     PreserveMembranePmaps = InputSlot(value=False)
 
     EnableDebugOutputs = InputSlot(value=False)
+
+    # If given, the watershed of the whole volume is computed in blocks of this shape
+    # (without the channel axis) and kept in a temporary chunked file on disk,
+    # so that the full volume never needs to be held in memory.
+    BlockShape = InputSlot(optional=True)
     
     Superpixels = OutputSlot()
 
@@ -31,6 +64,8 @@ class OpWsdt(Operator):
         super( OpWsdt, self ).__init__(*args, **kwargs)
         self.debug_results = None
         self.watershed_completed = OrderedSignal()
+        self._blockwise_lock = RequestLock()
+        self._blockwise_file = None
 
     def setupOutputs(self):
         assert self.Input.meta.getAxisKeys()[-1] == 'c', \
@@ -43,6 +78,8 @@ class OpWsdt(Operator):
         self.debug_results = None
         if self.EnableDebugOutputs.value:
             self.debug_results = OrderedDict()
+
+        self._discard_blockwise_result()
     
     def execute(self, slot, subindex, roi, result):
         assert slot is self.Superpixels, "Unknown or unconnected output slot: {}".format( slot )
@@ -52,28 +89,110 @@ class OpWsdt(Operator):
         pmap_roi.start[-1] = channel_index
         pmap_roi.stop[-1] = channel_index+1
 
-        # TODO: We could be sneaky and use the result array as a temporary here...
-        pmap = self.Input(pmap_roi.start, pmap_roi.stop).wait()
+        if self.BlockShape.ready():
+            self._execute_blockwise(roi, result)
+        else:
+            # TODO: We could be sneaky and use the result array as a temporary here...
+            pmap = self.Input(pmap_roi.start, pmap_roi.stop).wait()
 
-        if self.debug_results:
-            self.debug_results.clear()
-        wsDtSegmentation( pmap[...,0],
-                          self.Pmin.value,
-                          self.MinMembraneSize.value,
-                          self.MinSegmentSize.value,
-                          self.SigmaMinima.value,
-                          self.SigmaWeights.value,
-                          self.GroupSeeds.value,
-                          self.PreserveMembranePmaps.value,
-                          out_debug_image_dict=self.debug_results,
-                          out=result[...,0] )
+            if self.debug_results:
+                self.debug_results.clear()
+            wsDtSegmentation( pmap[...,0],
+                              self.Pmin.value,
+                              self.MinMembraneSize.value,
+                              self.MinSegmentSize.value,
+                              self.SigmaMinima.value,
+                              self.SigmaWeights.value,
+                              self.GroupSeeds.value,
+                              self.PreserveMembranePmaps.value,
+                              out_debug_image_dict=self.debug_results,
+                              out=result[...,0] )
         
         self.watershed_completed()
         
+    def _execute_blockwise(self, roi, result):
+        """
+        Copy the roi from the blockwise watershed of the whole volume,
+        which is computed on the first request.
+        """
+        with self._blockwise_lock:
+            if self._blockwise_file is None:
+                self._blockwise_file = self._compute_blockwise()
+            superpixels = self._blockwise_file['superpixels']
+            result[...,0] = superpixels[roiToSlice(roi.start[:-1], roi.stop[:-1])]
+
+    def _compute_blockwise(self):
+        """
+        Compute the watershed of the whole volume block by block
+        into a temporary chunked hdf5 file (see BlockwiseWsdt).
+        Debug outputs are not produced in this mode.
+        """
+        if self.debug_results:
+            logger.warn("Debug outputs are not available for the blockwise watershed.")
+            self.debug_results.clear()
+
+        pmin = self.Pmin.value
+        min_membrane_size = self.MinMembraneSize.value
+        min_segment_size = self.MinSegmentSize.value
+        sigma_minima = self.SigmaMinima.value
+        sigma_weights = self.SigmaWeights.value
+        group_seeds = self.GroupSeeds.value
+        preserve_membrane_pmaps = self.PreserveMembranePmaps.value
+
+        def wsdt(pmap):
+            segmentation = np.zeros(pmap.shape, dtype=np.uint32)
+            wsDtSegmentation( pmap,
+                              pmin,
+                              min_membrane_size,
+                              min_segment_size,
+                              sigma_minima,
+                              sigma_weights,
+                              group_seeds,
+                              preserve_membrane_pmaps,
+                              out=segmentation )
+            return segmentation
+
+        channel_index = self.ChannelSelection.value
+        def read_block(start, stop):
+            return self.Input(start + (channel_index,), stop + (channel_index+1,)).wait()[...,0]
+
+        shape = self.Superpixels.meta.shape[:-1]
+        block_shape = tuple(self.BlockShape.value)
+        assert len(block_shape) == len(shape), \
+            "BlockShape must not include the channel axis: {}".format( block_shape )
+        chunk_shape = tuple(min(b, s) for b, s in zip(block_shape, shape))
+
+        fd, path = tempfile.mkstemp(prefix='ilastik-wsdt-', suffix='.h5')
+        os.close(fd)
+        f = h5py.File(path, 'w')
+        try:
+            superpixels = f.create_dataset('superpixels', shape=shape, dtype=np.uint32,
+                                           chunks=chunk_shape, compression='lzf')
+            halo = wsdt_halo(sigma_minima, sigma_weights)
+            BlockwiseWsdt(shape, block_shape, halo, wsdt).run(read_block, superpixels)
+        except:
+            f.close()
+            os.remove(path)
+            raise
+        return f
+
+    def _discard_blockwise_result(self):
+        with self._blockwise_lock:
+            if self._blockwise_file is not None:
+                path = self._blockwise_file.filename
+                self._blockwise_file.close()
+                os.remove(path)
+                self._blockwise_file = None
+
     def propagateDirty(self, slot, subindex, roi):
         if slot is not self.EnableDebugOutputs:
+            self._discard_blockwise_result()
             self.Superpixels.setDirty()
 
+    def cleanUp(self):
+        self._discard_blockwise_result()
+        super( OpWsdt, self ).cleanUp()
+
 class OpCachedWsdt(Operator):
     RawData = InputSlot(optional=True) # Used by the GUI for display only
     FreezeCache = InputSlot(value=True)
@@ -91,6 +210,7 @@ class OpCachedWsdt(Operator):
     PreserveMembranePmaps = InputSlot(value=False)
 
     EnableDebugOutputs = InputSlot(value=False)
+    BlockShape = InputSlot(optional=True)
     
     Superpixels = OutputSlot()
     
@@ -120,8 +240,10 @@ class OpCachedWsdt(Operator):
         self._opWsdt.GroupSeeds.connect( self.GroupSeeds )
         self._opWsdt.PreserveMembranePmaps.connect( self.PreserveMembranePmaps )
         self._opWsdt.EnableDebugOutputs.connect( self.EnableDebugOutputs )
+        self._opWsdt.BlockShape.connect( self.BlockShape )
         
         self._opCache = OpBlockedArrayCache( parent=self )
+        self._blockwise_cache = False
         self._opCache.fixAtCurrent.connect( self.FreezeCache )
         self._opCache.Input.connect( self._opWsdt.Superpixels )
         self.Superpixels.connect( self._opCache.Output )
@@ -138,6 +260,14 @@ class OpCachedWsdt(Operator):
     def setupOutputs(self):
         self._opThreshold.Function.setValue( lambda a: (a >= self.Pmin.value).astype(np.uint8) )
 
+        # The blockwise watershed is consistent across blocks, so it can be requested (and cached) block by block.
+        if self.BlockShape.ready():
+            self._opCache.outerBlockShape.setValue( tuple(self.BlockShape.value) + (1,) )
+            self._blockwise_cache = True
+        elif self._blockwise_cache:
+            self._opCache.outerBlockShape.setValue( self.Input.meta.shape[:-1] + (1,) )
+            self._blockwise_cache = False
+
     @property
     def debug_results(self):
         return self._opWsdt.debug_results
@@ -45,7 +45,8 @@ class WsdtApplet( StandardApplet ):
                  'SigmaMinima',
                  'SigmaWeights',
                  'GroupSeeds',
-                 'PreserveMembranePmaps' ]
+                 'PreserveMembranePmaps',
+                 'BlockShape' ]
 
     @property
     def singleLaneGuiClass(self):
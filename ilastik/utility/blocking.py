@@ -0,0 +1,64 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2016, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+"""
+Helpers for processing volumes block by block.
+"""
+import itertools
+from functools import partial
+
+from lazyflow.request import Request, RequestPool
+
+def block_rois(shape, block_shape):
+    """
+    Iterate over the (start, stop) rois of a blocking of the given shape.
+    """
+    ranges = [range(0, s, b) for s, b in zip(shape, block_shape)]
+    for start in itertools.product(*ranges):
+        stop = tuple(min(a + b, s) for a, b, s in zip(start, block_shape, shape))
+        yield start, stop
+
+def default_block_shape(volume, block_size):
+    """
+    Blocks of block_size along each axis, rounded up to the chunks of an hdf5 dataset
+    (so each chunk is read only once). Not clipped to the shape of the volume.
+    """
+    block_shape = (block_size,) * len(volume.shape)
+    chunks = getattr(volume, 'chunks', None)
+    if chunks is not None:
+        block_shape = tuple( -(-b // c) * c for b, c in zip(block_shape, chunks) )
+    return block_shape
+
+def map_blocks(process_block, shape, block_shape):
+    """
+    Call process_block(start, stop) for every block of the given blocking, in parallel.
+    Returns the results, in the order of block_rois().
+    """
+    rois = list(block_rois(shape, block_shape))
+    results = [None] * len(rois)
+    def process(index):
+        results[index] = process_block(*rois[index])
+
+    pool = RequestPool()
+    for index in range(len(rois)):
+        pool.add( Request( partial(process, index) ) )
+    pool.wait()
+    pool.clean()
+    return results
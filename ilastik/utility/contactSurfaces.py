@@ -0,0 +1,163 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2016, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+"""
+Contact areas between all pairs of objects in a label volume.
+
+The contact area of object 1 on object 2 is the number of voxels of object 2 that
+lie within a given (euclidean) distance of object 1, see bin/measure_surface_contact.py.
+For a contact distance of 1, that's the voxels of object 2 that share a face with object 1.
+"""
+import numpy
+
+from ilastik.utility.blocking import default_block_shape, map_blocks
+
+import logging
+logger = logging.getLogger(__name__)
+
+DEFAULT_BLOCK_SIZE = 64
+
+TABLE_DTYPE = [('label_1', numpy.uint64), ('label_2', numpy.uint64), ('contact_area', numpy.uint64)]
+
+def contact_area_table(label_volume, contact_distance=1, block_shape=None, distance_range=None):
+    """
+    Measure the contact areas of all pairs of touching objects, block by block.
+
+    label_volume: A numpy array or h5py dataset. Singleton axes are ignored.
+                  Label 0 is background, it has no contacts.
+    contact_distance: Count the voxels of object 2 with contact_distance-1 < distance <= contact_distance
+                      to object 1 (like measure_surface_contact_B, i.e. a dilation 'shell').
+    block_shape: The blocks to read at a time (without the halo of contact_distance around each block).
+                 By default, blocks of DEFAULT_BLOCK_SIZE, rounded up to the chunks of an hdf5 dataset.
+    distance_range: (min, max) Count the voxels of object 2 with min < distance <= max instead.
+
+    Returns: A structured array (label_1, label_2, contact_area), sorted by label.
+             Both (a, b) and (b, a) are listed, the areas are not necessarily equal.
+    """
+    if distance_range is None:
+        distance_range = (contact_distance - 1, contact_distance)
+    min_distance, max_distance = distance_range
+    assert max_distance >= 1, "Objects touch at a distance of 1 voxel or more"
+
+    # Ignore singleton axes
+    axes = [i for i, s in enumerate(label_volume.shape) if s > 1]
+    shape = tuple(label_volume.shape[i] for i in axes)
+
+    if block_shape is None:
+        block_shape = default_block_shape(label_volume, DEFAULT_BLOCK_SIZE)
+    if len(block_shape) == len(label_volume.shape):
+        block_shape = [block_shape[i] for i in axes]
+    assert len(block_shape) == len(shape)
+    block_shape = numpy.minimum(block_shape, shape)
+
+    offsets, distances = contact_offsets(len(shape), max_distance)
+    halo = int(numpy.floor(max_distance))
+
+    def process_block(start, stop):
+        block = _read_with_halo(label_volume, axes, numpy.array(start), numpy.array(stop), halo)
+        return _block_contacts(block, halo, offsets, distances, min_distance, max_distance)
+
+    block_results = map_blocks(process_block, shape, block_shape)
+    logger.debug("Measured the contacts in {} blocks".format( len(block_results) ))
+
+    label_1, label_2, areas = map(numpy.concatenate, zip(*block_results))
+    label_1, label_2, areas = _sum_pairs(label_1, label_2, areas)
+    table = numpy.zeros( (len(areas),), dtype=TABLE_DTYPE )
+    table['label_1'] = label_1
+    table['label_2'] = label_2
+    table['contact_area'] = areas
+    return table
+
+def contact_offsets(ndim, max_distance):
+    """
+    The offsets to all neighbors within max_distance (the center excluded),
+    sorted by distance. Returns (offsets, squared distances).
+    """
+    radius = int(numpy.floor(max_distance))
+    offsets = numpy.indices( (2*radius+1,) * ndim ).reshape(ndim, -1).T - radius
+    distances = (offsets**2).sum(axis=1)
+    keep = (distances > 0) & (distances <= max_distance**2)
+    order = numpy.argsort( distances[keep], kind='mergesort' )
+    return offsets[keep][order], distances[keep][order]
+
+def _read_with_halo(label_volume, axes, start, stop, halo):
+    """
+    Read the block with a halo, padded with background where the halo leaves the volume.
+    """
+    shape = numpy.array([label_volume.shape[i] for i in axes])
+    read_start = numpy.maximum(start - halo, 0)
+    read_stop = numpy.minimum(stop + halo, shape)
+
+    slicing = [0] * len(label_volume.shape)
+    for axis, a, b in zip(axes, read_start, read_stop):
+        slicing[axis] = slice(a, b)
+    block = numpy.asarray(label_volume[tuple(slicing)])
+
+    padding = zip( read_start - (start - halo), (stop + halo) - read_stop )
+    if any(before or after for before, after in padding):
+        block = numpy.pad(block, padding, mode='constant')
+    return block
+
+def _block_contacts(block, halo, offsets, distances, min_distance, max_distance):
+    """
+    The contact areas of the voxels in the center of the block (the block without its halo).
+    Returns (label_1, label_2, area) arrays.
+    """
+    core_shape = tuple(s - 2*halo for s in block.shape)
+    labels = block[tuple(slice(halo, halo + s) for s in core_shape)].reshape(-1)
+
+    # For each offset: the voxels that have a neighboring object there
+    voxels, neighbors, neighbor_distances = [], [], []
+    for offset, distance in zip(offsets, distances):
+        neighbor_labels = block[tuple(slice(halo + o, halo + o + s) for o, s in zip(offset, core_shape))].reshape(-1)
+        touching = numpy.flatnonzero( (neighbor_labels != labels) & (neighbor_labels != 0) & (labels != 0) )
+        voxels.append(touching)
+        neighbors.append(neighbor_labels[touching])
+        neighbor_distances.append(numpy.repeat(distance, len(touching)))
+
+    voxels = numpy.concatenate(voxels)
+    neighbors = numpy.concatenate(neighbors)
+    neighbor_distances = numpy.concatenate(neighbor_distances)
+
+    # The distance of a voxel to a neighboring object is the first (smallest) one found.
+    # (lexsort is stable, the offsets are sorted by distance.)
+    order = numpy.lexsort( (neighbors, voxels) )
+    voxels = voxels[order]
+    neighbors = neighbors[order]
+    neighbor_distances = neighbor_distances[order]
+    first = numpy.ones( len(voxels), dtype=bool )
+    first[1:] = (voxels[1:] != voxels[:-1]) | (neighbors[1:] != neighbors[:-1])
+    in_range = first & (neighbor_distances > min_distance**2) & (neighbor_distances <= max_distance**2)
+
+    label_1 = neighbors[in_range].astype(numpy.uint64)
+    label_2 = labels[voxels[in_range]].astype(numpy.uint64)
+    return _sum_pairs( label_1, label_2, numpy.ones(len(label_1), dtype=numpy.uint64) )
+
+def _sum_pairs(label_1, label_2, areas):
+    """
+    Sum up the areas of equal pairs. Returns (label_1, label_2, area), sorted by label.
+    """
+    if len(label_1) == 0:
+        return label_1, label_2, areas
+    order = numpy.lexsort( (label_2, label_1) )
+    label_1 = label_1[order]
+    label_2 = label_2[order]
+    first = numpy.flatnonzero( numpy.concatenate( ([True], (label_1[1:] != label_1[:-1]) | (label_2[1:] != label_2[:-1])) ) )
+    return label_1[first], label_2[first], numpy.add.reduceat( areas[order], first )
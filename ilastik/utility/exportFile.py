@@ -3,6 +3,7 @@ import numpy as np
 import numpy.lib.recfunctions as nlr
 import h5py
 from vigra import AxisTags
+from lazyflow.roi import roiToSlice
 from lazyflow.utility import OrderedSignal
 from sys import stdout
 from zipfile import ZipFile
@@ -49,27 +50,17 @@ def flatten_tracking_table(table, extra_table, obj_counts, max_tracks, t_range):
     return array
 
 
-def flatten_ilastik_feature_table(table, selection, signal):
-    selection = list(selection)
-    frames = table.meta.shape[0]
-
-    signal(0)
-    if frames > 1:
-        computed_feature = {}
-        for t in xrange(frames):
-            request = table([t])
-            computed_feature.update(request.wait())
-            signal(100 * t / frames)
-    else:
-        computed_feature = table([]).wait()
-    signal(100)
-
+def feature_table_layout(frame_features, selection):
+    """
+    Determines the columns of the flattened feature table from the features of a single frame
+    :returns: the dtype of the table and a dict: column name -> (category, feature name, channel)
+    """
     feature_names = []
     feature_cats = []
     feature_channels = []
     feature_types = []
 
-    for cat_name, category in computed_feature[0].iteritems():
+    for cat_name, category in frame_features.iteritems():
         for feat_name, feat_array in category.iteritems():
             if (cat_name == "Default features" or \
                      feat_name in selection) and \
@@ -79,10 +70,6 @@ def flatten_ilastik_feature_table(table, selection, signal):
                 feature_channels.append((feat_array.shape[1]))
                 feature_types.append(feat_array.dtype)
 
-    obj_count = []
-    for t, cf in computed_feature.iteritems():
-        obj_count.append(cf["Default features"]["Count"].shape[0] - 1)  # no background
-
     dtype_names = []
     dtype_types = []
     dtype_to_key = {}
@@ -98,23 +85,54 @@ def flatten_ilastik_feature_table(table, selection, signal):
             dtype_types.append(feature_types[i].name)
             dtype_to_key[dtype_names[-1]] = (feature_cats[i], name, 0)
 
-    feature_table = np.zeros((sum(obj_count),), dtype=",".join(dtype_types))
-    feature_table.dtype.names = map(str, dtype_names)
-
-    start = 0
-    end = obj_count[0]
-    for t, cf in computed_feature.iteritems():
-        for name in dtype_names:
-            cat, feat_name, index = dtype_to_key[name]
-            data_len = len(cf[cat][feat_name][1:, index])
-            feature_table[name][start:start + data_len] = cf[cat][feat_name][1:, index]
-        start = end
-        try:
-            end += obj_count[int(t) + 1]
-        except IndexError:
-            end = sum(obj_count)
+    dtype = np.dtype([(str(name), type_) for name, type_ in zip(dtype_names, dtype_types)])
+    return dtype, dtype_to_key
 
-    return feature_table
+
+def flatten_frame_features(frame_features, dtype, dtype_to_key):
+    """
+    The rows of the feature table for the objects of one frame (without the background)
+    """
+    obj_count = frame_features["Default features"]["Count"].shape[0] - 1
+    rows = np.zeros((obj_count,), dtype=dtype)
+    for name in dtype.names:
+        cat, feat_name, index = dtype_to_key[name]
+        rows[name] = frame_features[cat][feat_name][1:, index]
+    return rows
+
+
+def iter_ilastik_feature_table(table, selection, signal, prefetch=4):
+    """
+    Flattens the feature table frame by frame, the columns are determined by the first frame.
+    The frames are requested in parallel, at most prefetch at a time.
+    Yields the rows of each frame, in order.
+    """
+    selection = list(selection)
+    frames = table.meta.shape[0]
+
+    signal(0)
+    pending = collections.deque()
+    next_frame = 0
+    layout = None
+    for t in xrange(frames):
+        while next_frame < frames and len(pending) < prefetch:
+            request = table([next_frame] if frames > 1 else [])
+            request.submit()
+            pending.append(request)
+            next_frame += 1
+
+        request = pending.popleft()
+        frame_features = request.wait()[t]
+        request.clean()
+        if layout is None:
+            layout = feature_table_layout(frame_features, selection)
+        yield flatten_frame_features(frame_features, *layout)
+        signal(100 * (t + 1) / frames)
+    signal(100)
+
+
+def flatten_ilastik_feature_table(table, selection, signal):
+    return np.concatenate(list(iter_ilastik_feature_table(table, selection, signal)))
 
 
 def objects_per_frame(label_image_slot):
@@ -235,14 +253,27 @@ class ExportFile(object):
     ExportProgress = OrderedSignal()
     InsertionProgress = OrderedSignal()
 
+    # add_rois: block size for grouping the objects, number of requests in flight
+    ROI_BLOCK_SIZE = 128
+    ROI_QUEUE_SIZE = 4
+
+    # Feature tables: number of frames requested in parallel, rows per hdf5 chunk
+    FEATURE_TABLE_PREFETCH = 4
+    TABLE_CHUNK_ROWS = 1024
+
     def __init__(self, file_name):
         self.file_name = file_name
         self.table_dict = {}
         self.meta_dict = {}
+        self.streamed_dict = {}
+        self._coordinate_tables = {}
+        self._h5_file_created = False
 
     def add_columns(self, table_name, col_data, mode, extra=None):
         """
         Adds new columns to the table ( creates the table if neccessary )
+        The columns of an IlastikFeatureTable are computed and written frame by frame in write_all,
+        after the other columns of the table. They must be added last.
         :param table_name: the table name
         :type table_name: str
         :param col_data: the actual data to be added
@@ -267,16 +298,21 @@ class ExportFile(object):
         elif mode == Mode.IlastikFeatureTable:
             if "selection" not in extra:
                 raise AttributeError("IlastikFeatureTable needs a feature selection (extra 'selection')")
-            columns = flatten_ilastik_feature_table(col_data, extra["selection"], self.InsertionProgress)
+            if table_name in self.streamed_dict:
+                raise AttributeError("Table '{}' has feature columns already".format(table_name))
+            # The features are only computed (frame by frame) when the table is written
+            self.streamed_dict[table_name] = (col_data, extra["selection"])
+            return
         elif mode == Mode.NumpyStructArray:
             columns = col_data
         else:
             raise AttributeError("Invalid Mode")
         self._add_columns(table_name, columns)
 
-    def add_rois(self, table_path, image_slot, feature_table_name, margin, type_="image"):
+    def add_rois(self, table_path, image_slot, feature_table_name, margin, type_="image", compression=None):
         """
         Adds the rois as images to the table
+        The rois are written to the (hdf5) file right away, they are not kept in memory.
         :param table_path: the new name for the table
         :type table_path: str
         :param image_slot: the slot to read the data from
@@ -287,34 +323,86 @@ class ExportFile(object):
         :type margin: int
         :param type_: "image" for normal images, "labeling" for labeling images
         :type type_: str
+        :param compression: the compression settings (see write_all)
+        :type compression: dict
         """
         assert type_ in ("labeling", "image"), "Type must be 'labeling' or 'image'"
+        feature_table = self._coordinate_table(feature_table_name)
         slicings = create_slicing(image_slot.meta.axistags, image_slot.meta.shape,
-                                  margin, self.table_dict[feature_table_name])
+                                  margin, feature_table)
         self.InsertionProgress(0)
 
-        if type_ == "labeling":
-            vec = self._normalize
-        else:
-            vec = lambda _: lambda y: y
-        for i, (slicing, oid) in enumerate(slicings):
-            roi = image_slot(slicing).wait()
-            roi = vec(oid)(roi)
-            roi_path = table_path.format(i)
-            self.meta_dict[roi_path] = {
-                "type": type_,
-                "axistags": actual_axistags(image_slot.meta.axistags, roi.shape).toJSON()
-            }
-            self.table_dict[roi_path] = roi.squeeze()
-            self.InsertionProgress(100 * i / self.table_dict[feature_table_name].shape[0])
+        # Nearby objects are read with a single request,
+        # a few requests are processed in parallel while the rois are written.
+        groups = self._group_rois(image_slot.meta.axistags, image_slot.meta.shape, slicings)
+        roi_count = feature_table.shape[0]
+        with self._open_h5_file() as fout:
+            pending = collections.deque()
+            next_group = 0
+            written = 0
+            while pending or next_group < len(groups):
+                while next_group < len(groups) and len(pending) < self.ROI_QUEUE_SIZE:
+                    start, stop, rois = groups[next_group]
+                    request = image_slot(start, stop)
+                    request.submit()
+                    pending.append((start, request, rois))
+                    next_group += 1
+
+                start, request, rois = pending.popleft()
+                block = request.wait()
+                request.clean()
+                for i, roi_start, roi_stop, oid in rois:
+                    roi = block[roiToSlice(roi_start - start, roi_stop - start)]
+                    if type_ == "labeling":
+                        roi = self._normalize(roi, oid)
+                    meta = {
+                        "type": type_,
+                        "axistags": actual_axistags(image_slot.meta.axistags, roi.shape).toJSON()
+                    }
+                    self._make_h5_dataset(fout, table_path.format(i), roi.squeeze(), meta,
+                                          compression if compression is not None else {})
+                    written += 1
+                del block
+                self.InsertionProgress(100 * written / roi_count)
         self.InsertionProgress(100)
 
-    @staticmethod
-    def _normalize(oid):
-        def f(pixel_value):
-            return 1 if pixel_value == oid else 0
+    @classmethod
+    def _group_rois(cls, axistags, shape, slicings):
+        """
+        Groups the rois of objects that start in the same block (of ROI_BLOCK_SIZE in each spatial
+        dimension) of the same time step. Rois that are larger than a block are not grouped.
+        :returns: a list of (start, stop, [(object index, roi start, roi stop, oid), ...]),
+            start and stop being the bounding box of the group's rois
+        """
+        block_shape = []
+        for tag, size in zip(axistags, shape):
+            if tag.key == "t":
+                block_shape.append(1)
+            elif tag.key == "c":
+                block_shape.append(size)
+            else:
+                block_shape.append(cls.ROI_BLOCK_SIZE)
+        block_shape = np.array(block_shape)
 
-        return np.vectorize(f)
+        groups = collections.OrderedDict()
+        for i, (slicing, oid) in enumerate(slicings):
+            slicing = list(slicing) + [slice(None)] * (len(shape) - len(slicing))
+            bounds = [s.indices(size)[:2] for s, size in zip(slicing, shape)]
+            roi_start = np.array([b[0] for b in bounds])
+            roi_stop = np.array([b[1] for b in bounds])
+            if (roi_stop - roi_start > block_shape).any():
+                key = i
+            else:
+                key = tuple(roi_start // block_shape)
+            groups.setdefault(key, []).append((i, roi_start, roi_stop, oid))
+
+        return [(np.min([roi[1] for roi in rois], axis=0),
+                 np.max([roi[2] for roi in rois], axis=0),
+                 rois) for rois in groups.itervalues()]
+
+    @staticmethod
+    def _normalize(roi, oid):
+        return (roi == oid).astype(np.int_)
 
     def add_image(self, table, image_slot):
         """
@@ -350,14 +438,24 @@ class ExportFile(object):
         :type compression: dict
         """
         count = 0
+        table_names = self.table_dict.keys() + [name for name in self.streamed_dict if name not in self.table_dict]
         self.ExportProgress(0)
         if mode in ("h5", "hd5", "hdf5"):
-            with h5py.File(self.file_name, "w") as fout:
-                for table_name, table in self.table_dict.iteritems():
-                    self._make_h5_dataset(fout, table_name, table, self.meta_dict.get(table_name, {}),
-                                          compression if compression is not None else {})
+            # The file might already contain the rois
+            with self._open_h5_file() as fout:
+                for table_name in table_names:
+                    table = self.table_dict.get(table_name)
+                    meta = self.meta_dict.get(table_name, {})
+                    if table_name in self.streamed_dict:
+                        self._make_h5_dataset_streamed(fout, table_name, self._iter_table(table_name), meta,
+                                                       compression if compression is not None else {})
+                    else:
+                        self._make_h5_dataset(fout, table_name, table, meta,
+                                              compression if compression is not None else {})
                     count += 1
-                    self.ExportProgress(count * 100 / len(self.table_dict))
+                    self.ExportProgress(count * 100 / len(table_names))
+            # The export is complete, writing again starts a new file
+            self._h5_file_created = False
         elif mode == "csv":
             f_name = self.file_name.rsplit(".", 1)
             if len(f_name) == 1:
@@ -365,12 +463,16 @@ class ExportFile(object):
             else:
                 base, ext = f_name
             file_names = []
-            for table_name, table in self.table_dict.iteritems():
+            for table_name in table_names:
                 file_names.append("{name}_{table}.{ext}".format(name=base, table=table_name, ext=ext))
                 with open(file_names[-1], "w") as fout:
-                    self._make_csv_table(fout, table)
+                    if table_name in self.streamed_dict:
+                        for i, rows in enumerate(self._iter_table(table_name)):
+                            self._make_csv_table(fout, rows, header=(i == 0))
+                    else:
+                        self._make_csv_table(fout, self.table_dict[table_name])
                     count += 1
-                    self.ExportProgress(count * 100 / len(self.table_dict))
+                    self.ExportProgress(count * 100 / len(table_names))
             if False:
                 with ZipFile("{name}.zip".format(name=base), "w") as zip_file:
                     for file_name in file_names:
@@ -378,7 +480,58 @@ class ExportFile(object):
         self.ExportProgress(100)
         logger.info("exported %i tables" % count)
 
+    def _open_h5_file(self):
+        """
+        Opens the hdf5 file, to be closed by the caller (use it in a with statement).
+        The first call creates (or truncates) the file, later calls add to it.
+        """
+        mode = "a" if self._h5_file_created else "w"
+        fout = h5py.File(self.file_name, mode)
+        self._h5_file_created = True
+        return fout
+
+    def _iter_table(self, table_name, names=None):
+        """
+        Yields the rows of a table with feature columns, frame by frame
+        :param names: only these feature columns (default: all)
+        """
+        columns = self.table_dict.get(table_name)
+        feature_slot, selection = self.streamed_dict[table_name]
+        start = 0
+        for features in iter_ilastik_feature_table(feature_slot, selection, self.InsertionProgress,
+                                                   self.FEATURE_TABLE_PREFETCH):
+            if names is None:
+                names = features.dtype.names
+            else:
+                names = [name for name in names if name in features.dtype.names]
+            descr = [(name, features.dtype[name]) for name in names]
+            if columns is not None:
+                descr = columns.dtype.descr + descr
+            rows = np.zeros(features.shape, dtype=descr)
+            if columns is not None:
+                for name in columns.dtype.names:
+                    rows[name] = columns[name][start:start + len(rows)]
+            for name in names:
+                rows[name] = features[name]
+            start += len(rows)
+            yield rows
+
+    def _coordinate_table(self, table_name):
+        """
+        The columns of the table that are needed for the object rois (see create_slicing)
+        The feature columns are computed only once, for all add_rois calls of the table.
+        """
+        if table_name not in self.streamed_dict:
+            return self.table_dict[table_name]
+        if table_name not in self._coordinate_tables:
+            names = ["Coord<Minimum>_{}".format(i) for i in xrange(3)] + \
+                    ["Coord<Maximum>_{}".format(i) for i in xrange(3)]
+            self._coordinate_tables[table_name] = np.concatenate(list(self._iter_table(table_name, names)))
+        return self._coordinate_tables[table_name]
+
     def _add_columns(self, table_name, columns):
+        if table_name in self.streamed_dict:
+            raise AttributeError("The feature columns of table '{}' must be added last".format(table_name))
         if table_name in self.table_dict.iterkeys():
             old = self.table_dict[table_name]
             columns = nlr.merge_arrays((old, columns), flatten=True)
@@ -394,11 +547,33 @@ class ExportFile(object):
         for k, v in meta.iteritems():
             dset.attrs[k] = v
 
+    @classmethod
+    def _make_h5_dataset_streamed(cls, fout, table_name, row_chunks, meta, compression):
+        """
+        Appends the rows to a resizable (chunked) dataset as they come in
+        """
+        dset = None
+        for rows in row_chunks:
+            if dset is None:
+                try:
+                    dset = fout.create_dataset(table_name, (0,), dtype=rows.dtype, maxshape=(None,),
+                                               chunks=(cls.TABLE_CHUNK_ROWS,), **compression)
+                except TypeError:
+                    dset = fout.create_dataset(table_name, (0,), dtype=rows.dtype, maxshape=(None,),
+                                               chunks=(cls.TABLE_CHUNK_ROWS,))
+                for k, v in meta.iteritems():
+                    dset.attrs[k] = v
+            if len(rows) > 0:
+                start = dset.shape[0]
+                dset.resize((start + len(rows),))
+                dset[start:] = rows
+
     @staticmethod
-    def _make_csv_table(fout, table):
-        line = ",".join(table.dtype.names)
-        fout.write(line)
-        fout.write("\n")
+    def _make_csv_table(fout, table, header=True):
+        if header:
+            line = ",".join(table.dtype.names)
+            fout.write(line)
+            fout.write("\n")
         for row in table:
             line = ",".join(map(str, row))
             fout.write(line)
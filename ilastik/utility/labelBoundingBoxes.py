@@ -0,0 +1,78 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2016, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import numpy
+
+from lazyflow.roi import roiToSlice
+from ilastik.utility.blocking import default_block_shape
+from ilastik.utility.labelStatistics import blockwise_label_statistics
+
+import logging
+logger = logging.getLogger(__name__)
+
+class LabelBoundingBoxes(object):
+    """
+    The bounding box of every label in a label volume,
+    computed once (blockwise, in parallel, see blockwise_label_statistics) to quickly find where a label is.
+    """
+    BLOCK_SIZE = 128
+
+    def __init__(self, labels, starts, stops):
+        """
+        labels: sorted label values, shape=(N,)
+        starts, stops: the bounding box of each label, shape=(N, ndim)
+        """
+        self.labels = labels
+        self.starts = starts
+        self.stops = stops
+
+    @classmethod
+    def from_slot(cls, slot, block_shape=None):
+        """
+        Compute the bounding boxes of all labels provided by the given slot.
+        The blocks are small by default, since the index is built from a full sort of each block.
+        """
+        if block_shape is None:
+            block_shape = (cls.BLOCK_SIZE,) * len(slot.meta.shape)
+        return cls._from_blocks( slot.meta.shape, lambda start, stop: slot( start, stop ).wait(), block_shape )
+
+    @classmethod
+    def from_array(cls, array, block_shape=None):
+        """
+        Compute the bounding boxes of all labels in the given array (a numpy array or h5py dataset).
+        By default, the blocks are rounded up to the chunks of an hdf5 dataset.
+        """
+        if block_shape is None:
+            block_shape = default_block_shape( array, cls.BLOCK_SIZE )
+        return cls._from_blocks( array.shape, lambda start, stop: array[roiToSlice( start, stop )], block_shape )
+
+    @classmethod
+    def _from_blocks(cls, shape, read_block, block_shape):
+        labels, _, starts, stops, _, _ = blockwise_label_statistics( shape, read_block, block_shape )
+        return LabelBoundingBoxes( labels, starts, stops )
+
+    def bounding_box(self, label):
+        """
+        Returns the (start, stop) of the given label, or None if the label doesn't occur.
+        """
+        index = numpy.searchsorted( self.labels, label )
+        if index == len(self.labels) or self.labels[index] != label:
+            return None
+        return tuple(self.starts[index]), tuple(self.stops[index])
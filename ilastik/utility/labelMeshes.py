@@ -0,0 +1,180 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2016, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+"""
+Surface meshes of the objects in a label volume, with marching cubes (skimage),
+without VTK or Qt (see volumina.view3d for the meshes shown in the GUI).
+
+Each object is meshed within its bounding box, so the volume doesn't have to fit into memory.
+Vertex coordinates are given in the order of the volume's (non-singleton) axes.
+"""
+import collections
+from functools import partial
+
+import numpy
+
+try:
+    from skimage.measure import marching_cubes_lewiner as _marching_cubes
+except ImportError:
+    # Older versions of skimage only have the classic algorithm (and newer ones renamed lewiner's)
+    from skimage.measure import marching_cubes as _marching_cubes
+
+from lazyflow.request import Request
+from ilastik.utility.labelBoundingBoxes import LabelBoundingBoxes
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Number of objects being meshed while the meshes of the previous objects are handed out
+DEFAULT_PREFETCH = 16
+
+def label_meshes(label_volume, labels=None, spacing=None, decimation=None, block_shape=None, prefetch=DEFAULT_PREFETCH):
+    """
+    Generate the surface mesh of each object in a label volume.
+
+    label_volume: A numpy array or h5py dataset with 3 non-singleton axes. Label 0 is background.
+    labels: The labels to mesh. By default: all labels in the volume.
+    spacing: The size of a voxel along each (non-singleton) axis.
+    decimation: If given, simplify the meshes by merging the vertices within cells of this size (in voxels),
+                see decimate_mesh().
+    block_shape: The blocks to read at a time when finding the bounding boxes of the objects.
+    prefetch: Number of objects that are meshed in parallel, ahead of the one that is returned.
+
+    Yields: (label, vertices, faces) for each label, in order.
+            vertices: float32, shape=(N, 3); faces: vertex indexes, shape=(M, 3)
+            Labels that don't occur in the volume are skipped.
+    """
+    # Ignore singleton axes
+    axes = [i for i, s in enumerate(label_volume.shape) if s > 1]
+    assert len(axes) == 3, "Need a 3D volume, not shape {}".format( label_volume.shape )
+    if spacing is None:
+        spacing = (1.0, 1.0, 1.0)
+    spacing = numpy.asarray(spacing, dtype=numpy.float32)
+
+    # Find all objects in one pass over the volume
+    boxes = LabelBoundingBoxes.from_array(label_volume, block_shape)
+    if labels is None:
+        labels = boxes.labels[boxes.labels != 0]
+
+    def mesh_label(label, start, stop):
+        # Read the bounding box with a margin of 1 voxel, so the mesh is closed.
+        # Outside of the volume, the margin is padded with background.
+        read_start = numpy.maximum(numpy.array(start) - 1, 0)
+        read_stop = numpy.minimum(numpy.array(stop) + 1, label_volume.shape)
+        block = label_volume[tuple( slice(a, b) for a, b in zip(read_start, read_stop) )]
+        mask = (block == label).reshape( [block.shape[i] for i in axes] ).view(numpy.uint8)
+        padding = [ (int(a - b + 1), int(d - c + 1)) for a, b, c, d in zip(read_start, start, read_stop, stop) ]
+        mask = numpy.pad( mask, [padding[i] for i in axes], 'constant' ).astype(numpy.float32)
+
+        vertices, faces = _marching_cubes(mask, 0.5, spacing=tuple(spacing))[:2]
+        vertices += (numpy.array(start)[axes] - 1) * spacing
+        if decimation:
+            vertices, faces = decimate_mesh(vertices, faces, decimation * spacing)
+        return vertices.astype(numpy.float32), faces
+
+    pending = collections.deque()
+    labels = iter(labels)
+    while True:
+        while len(pending) <= prefetch:
+            label = next(labels, None)
+            if label is None:
+                break
+            box = boxes.bounding_box(label)
+            if box is None or label == 0:
+                continue
+            req = Request( partial(mesh_label, label, *box) )
+            req.submit()
+            pending.append( (label, req) )
+        if not pending:
+            break
+
+        label, req = pending.popleft()
+        vertices, faces = req.wait()
+        req.clean()
+        yield label, vertices, faces
+
+def decimate_mesh(vertices, faces, cell_size):
+    """
+    Simplify a mesh by vertex clustering: all vertices within the same cell of a regular grid are
+    merged into one (their mean), and the faces that collapse are removed.
+    This is fast, but doesn't preserve the topology of the mesh for cells larger than the object's features.
+
+    cell_size: The size of the grid cells (scalar or per axis).
+    """
+    cells = numpy.floor( vertices / cell_size ).astype(numpy.int64)
+    cells -= cells.min(axis=0)
+    cell_index = numpy.ravel_multi_index( tuple(cells.T), tuple(cells.max(axis=0) + 1) )
+    _, inverse = numpy.unique( cell_index, return_inverse=True )
+    counts = numpy.bincount(inverse).astype(numpy.float64)
+    merged = numpy.zeros( (len(counts), vertices.shape[1]), dtype=vertices.dtype )
+    for axis in range(vertices.shape[1]):
+        merged[:, axis] = numpy.bincount(inverse, vertices[:, axis]) / counts
+
+    faces = inverse[faces]
+    faces = faces[ (faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 0] != faces[:, 2]) ]
+
+    # Remove duplicate faces (keeping the orientation of the first)
+    sorted_faces = numpy.sort(faces, axis=1)
+    order = numpy.lexsort( sorted_faces.T[::-1] )
+    sorted_faces = sorted_faces[order]
+    duplicate = numpy.zeros(len(faces), dtype=bool)
+    duplicate[order[1:]] = (sorted_faces[1:] == sorted_faces[:-1]).all(axis=1)
+    faces = faces[~duplicate]
+
+    # Remove the vertices that are no longer used
+    used = numpy.zeros(len(merged), dtype=bool)
+    used[faces] = True
+    new_index = numpy.cumsum(used) - 1
+    return merged[used], new_index[faces]
+
+def mesh_surface_area(vertices, faces):
+    """
+    The total area of the triangles of a mesh.
+    """
+    triangles = vertices[faces].astype(numpy.float64)
+    normals = numpy.cross( triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0] )
+    return numpy.sqrt( (normals**2).sum(axis=1) ).sum() / 2
+
+def write_obj(filepath, vertices, faces):
+    """
+    Write a mesh to a Wavefront .obj file.
+    """
+    with open(filepath, 'w') as f:
+        numpy.savetxt(f, vertices, fmt='v %.5f %.5f %.5f')
+        numpy.savetxt(f, faces + 1, fmt='f %d %d %d')
+
+def write_ply(filepath, vertices, faces):
+    """
+    Write a mesh to a (ascii) Stanford .ply file.
+    """
+    with open(filepath, 'w') as f:
+        f.write( "ply\n"
+                 "format ascii 1.0\n"
+                 "element vertex {}\n"
+                 "property float x\n"
+                 "property float y\n"
+                 "property float z\n"
+                 "element face {}\n"
+                 "property list uchar int vertex_indices\n"
+                 "end_header\n".format( len(vertices), len(faces) ) )
+        numpy.savetxt(f, vertices, fmt='%.5f %.5f %.5f')
+        numpy.savetxt(f, faces, fmt='3 %d %d %d')
+
+MESH_WRITERS = { 'obj' : write_obj, 'ply' : write_ply }
@@ -0,0 +1,196 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2016, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+"""
+Simple statistics of all objects in a label volume: voxel count, bounding box, centroid
+and (optionally) the sum and mean of the intensities of a raw image.
+
+The volume is read in blocks (aligned with the hdf5 chunks), which are processed in parallel.
+The statistics of each block are merged afterwards, so the volume doesn't have to fit into memory.
+The same blockwise core (blockwise_label_statistics) builds the index of LabelBoundingBoxes.
+"""
+import csv
+import json
+from functools import partial
+
+import numpy
+
+from ilastik.utility.blocking import default_block_shape, map_blocks
+
+import logging
+logger = logging.getLogger(__name__)
+
+DEFAULT_BLOCK_SIZE = 128
+
+def label_statistics(label_volume, raw_volume=None, block_shape=None, axiskeys=None, include_background=False):
+    """
+    Compute the statistics of all labels, block by block.
+
+    label_volume: A numpy array or h5py dataset.
+    raw_volume: A numpy array or h5py dataset of the same shape, for the intensity statistics (optional).
+    block_shape: The blocks to read at a time.
+                 By default, blocks of DEFAULT_BLOCK_SIZE, rounded up to the chunks of an hdf5 dataset.
+    axiskeys: The names of the axes, for the field names of the table, e.g. 'zyx'.
+              By default: from the 'axistags' of an hdf5 dataset, or the axis indexes.
+    include_background: Whether to include label 0.
+
+    Returns: A structured array, one row per label, sorted by label. The fields are:
+             label, count, bbox_start_<axis>, bbox_stop_<axis> (exclusive), centroid_<axis>,
+             and intensity_sum, intensity_mean if a raw volume was given.
+    """
+    shape = label_volume.shape
+    if raw_volume is not None:
+        assert raw_volume.shape == shape, \
+            "Raw volume must have the same shape as the labels: {} != {}".format( raw_volume.shape, shape )
+    if axiskeys is None:
+        axiskeys = _axiskeys(label_volume)
+
+    if block_shape is None:
+        block_shape = default_block_shape(label_volume, DEFAULT_BLOCK_SIZE)
+
+    read_raw = None
+    if raw_volume is not None:
+        read_raw = partial(_read_block, raw_volume)
+    labels, counts, starts, stops, coord_sums, intensity_sums = \
+        blockwise_label_statistics( shape, partial(_read_block, label_volume), block_shape, read_raw )
+
+    table = numpy.zeros( len(labels), dtype=table_dtype(axiskeys, raw_volume is not None) )
+    table['label'] = labels
+    table['count'] = counts
+    for axis, key in enumerate(axiskeys):
+        table['bbox_start_' + key] = starts[:, axis]
+        table['bbox_stop_' + key] = stops[:, axis]
+        table['centroid_' + key] = coord_sums[:, axis] / counts
+    if raw_volume is not None:
+        table['intensity_sum'] = intensity_sums
+        table['intensity_mean'] = intensity_sums / counts
+
+    if not include_background:
+        table = table[table['label'] != 0]
+    return table
+
+def blockwise_label_statistics(shape, read_block, block_shape, read_raw=None):
+    """
+    The statistics of all labels (including 0) of a volume, computed block by block in parallel.
+
+    shape: The shape of the volume
+    read_block: Returns the labels of a block, given its (start, stop)
+    block_shape: The blocks to read at a time (clipped to the shape)
+    read_raw: Returns the raw intensities of a block, given its (start, stop) (optional).
+
+    Returns: (labels, counts, starts, stops, coordinate sums, intensity sums or None), sorted by label.
+             starts, stops and coordinate sums have the shape (N, ndim), stops are exclusive.
+    """
+    block_shape = numpy.minimum(block_shape, shape)
+
+    def process_block(start, stop):
+        raw_block = None
+        if read_raw is not None:
+            raw_block = read_raw(start, stop)
+        return _block_statistics( read_block(start, stop), raw_block, start )
+
+    return _merge( map_blocks(process_block, shape, block_shape) )
+
+def table_dtype(axiskeys, with_intensities):
+    dtype = [('label', numpy.uint64), ('count', numpy.uint64)]
+    dtype += [('bbox_start_' + key, numpy.int64) for key in axiskeys]
+    dtype += [('bbox_stop_' + key, numpy.int64) for key in axiskeys]
+    dtype += [('centroid_' + key, numpy.float64) for key in axiskeys]
+    if with_intensities:
+        dtype += [('intensity_sum', numpy.float64), ('intensity_mean', numpy.float64)]
+    return dtype
+
+def _axiskeys(volume):
+    attrs = getattr(volume, 'attrs', {})
+    if 'axistags' in attrs:
+        return [axis['key'] for axis in json.loads(attrs['axistags'])['axes']]
+    return [str(i) for i in range(len(volume.shape))]
+
+def _read_block(volume, start, stop):
+    return volume[tuple( slice(a, b) for a, b in zip(start, stop) )]
+
+def _block_statistics(block, raw, offset):
+    """
+    The statistics of the labels in one block:
+    (labels, counts, starts, stops, coordinate sums, intensity sums or None), sorted by label.
+    """
+    labels = block.reshape(-1)
+    order = numpy.argsort( labels )
+    sorted_labels = labels[order]
+    first = numpy.flatnonzero( numpy.concatenate( ([True], sorted_labels[1:] != sorted_labels[:-1]) ) )
+    counts = numpy.diff( numpy.append(first, len(labels)) )
+
+    # The coordinates of the sorted voxels, one axis at a time
+    starts = numpy.zeros( (len(first), block.ndim), dtype=numpy.int64 )
+    stops = numpy.zeros( (len(first), block.ndim), dtype=numpy.int64 )
+    coord_sums = numpy.zeros( (len(first), block.ndim), dtype=numpy.float64 )
+    stride = 1
+    for axis in reversed(range(block.ndim)):
+        coords = (order // stride) % block.shape[axis]
+        starts[:, axis] = numpy.minimum.reduceat( coords, first ) + offset[axis]
+        stops[:, axis] = numpy.maximum.reduceat( coords, first ) + offset[axis] + 1
+        coord_sums[:, axis] = numpy.add.reduceat( coords, first ) + counts * float(offset[axis])
+        stride *= block.shape[axis]
+
+    intensity_sums = None
+    if raw is not None:
+        intensity_sums = numpy.add.reduceat( raw.reshape(-1)[order].astype(numpy.float64), first )
+    return sorted_labels[first], counts, starts, stops, coord_sums, intensity_sums
+
+def _merge(block_results):
+    """
+    Merge the statistics of all blocks into one row per label.
+    """
+    labels, counts, starts, stops, coord_sums, intensity_sums = zip(*block_results)
+    labels = numpy.concatenate(labels)
+    order = numpy.argsort( labels )
+    labels = labels[order]
+    first = numpy.flatnonzero( numpy.concatenate( ([True], labels[1:] != labels[:-1]) ) )
+
+    def reduce_partials(ufunc, partials):
+        return ufunc.reduceat( numpy.concatenate(partials)[order], first, axis=0 )
+
+    merged_intensities = None
+    if intensity_sums[0] is not None:
+        merged_intensities = reduce_partials(numpy.add, intensity_sums)
+    return ( labels[first],
+             reduce_partials(numpy.add, counts),
+             reduce_partials(numpy.minimum, starts),
+             reduce_partials(numpy.maximum, stops),
+             reduce_partials(numpy.add, coord_sums),
+             merged_intensities )
+
+def write_csv(table, filepath):
+    """
+    Write a statistics table to a csv file, with a header row.
+    """
+    with open(filepath, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(table.dtype.names)
+        writer.writerows(table.tolist())
+
+def write_hdf5(table, h5group, dataset_name):
+    """
+    Write a statistics table to an hdf5 dataset (with a compound dtype).
+    An existing dataset of the same name is replaced.
+    """
+    if dataset_name in h5group:
+        del h5group[dataset_name]
+    return h5group.create_dataset(dataset_name, data=table)
@@ -0,0 +1,127 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2016, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import bisect
+import functools
+
+from lazyflow.request import Request, SimpleRequestCondition
+from lazyflow.utility import Memory
+
+import logging
+logger = logging.getLogger(__name__)
+
+class MemoryBoundedScheduler(object):
+    """
+    Runs jobs in parallel (as lazyflow Requests), but only as many at a time
+    as fit into the given memory budget, according to each job's estimated memory usage.
+
+    The largest jobs are started first, the remaining budget is filled up with the
+    largest jobs that still fit. (Starting the big jobs last would leave them running
+    alone at the end.) A job that is larger than the whole budget is run on its own,
+    before all others.
+    """
+    def __init__(self, budget_bytes=None):
+        """
+        budget_bytes: The memory that the jobs may use together.
+                      By default: the RAM that lazyflow may use (see LAZYFLOW_TOTAL_RAM_MB),
+                      minus what the process uses already.
+        """
+        if budget_bytes is None:
+            budget_bytes = self.available_memory()
+        self.budget_bytes = budget_bytes
+        self.peak_bytes = 0
+
+    @classmethod
+    def available_memory(cls):
+        return max(Memory.getAvailableRam() - Memory.getMemoryUsage(), 0)
+
+    def run(self, jobs):
+        """
+        jobs: A list of (estimated_bytes, callable).
+              The callables are run without arguments, their results are discarded.
+
+        Blocks until all jobs are done. If a job fails, the exception is raised
+        (after the jobs that are already running have finished).
+        If a job is cancelled, no more jobs are started and Request.CancellationException is raised.
+        """
+        pending = sorted(jobs, key=lambda job: job[0])
+        pending_bytes = [job[0] for job in pending]
+
+        condition = SimpleRequestCondition()
+        state = { 'used' : 0, 'running' : 0 }
+        def release(nbytes, *args):
+            with condition:
+                state['used'] -= nbytes
+                state['running'] -= 1
+                condition.notify()
+
+        requests = []
+        failed = []
+        cancelled = []
+        while pending and not failed and not cancelled:
+            with condition:
+                while True:
+                    if pending_bytes[-1] > self.budget_bytes:
+                        # Too large for the budget: wait until it can run alone.
+                        index = len(pending) - 1
+                        if state['running'] == 0:
+                            logger.debug("Job of {} bytes exceeds the memory budget ({} bytes), running it alone."
+                                         .format(pending_bytes[index], self.budget_bytes))
+                            break
+                    else:
+                        # The largest job that still fits
+                        index = bisect.bisect_right(pending_bytes, self.budget_bytes - state['used']) - 1
+                        if index >= 0:
+                            break
+                    condition.wait()
+                    if failed or cancelled:
+                        break
+                if failed or cancelled:
+                    break
+
+                nbytes, fn = pending.pop(index)
+                del pending_bytes[index]
+                state['used'] += nbytes
+                state['running'] += 1
+                self.peak_bytes = max(self.peak_bytes, state['used'])
+
+            req = Request(fn)
+            req.notify_finished(functools.partial(release, nbytes))
+            req.notify_failed(functools.partial(self._failed, failed, release, nbytes))
+            req.notify_cancelled(functools.partial(self._cancelled, cancelled, release, nbytes, req))
+            requests.append(req)
+            # Not holding the condition here: the request might finish (and notify) synchronously.
+            req.submit()
+
+        for req in requests:
+            if req not in cancelled:
+                req.wait()
+        if cancelled:
+            raise Request.CancellationException()
+
+    @classmethod
+    def _failed(cls, failed, release, nbytes, exc, exc_info):
+        failed.append(exc)
+        release(nbytes)
+
+    @classmethod
+    def _cancelled(cls, cancelled, release, nbytes, req):
+        cancelled.append(req)
+        release(nbytes)
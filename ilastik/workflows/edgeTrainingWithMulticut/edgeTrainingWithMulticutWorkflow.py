@@ -118,6 +118,8 @@ class EdgeTrainingWithMulticutWorkflow(Workflow):
         # Parse workflow-specific command-line args
         parser = argparse.ArgumentParser()
         parser.add_argument('--retrain', help="Re-train the classifier based on labels stored in the project file, and re-save.", action="store_true")
+        parser.add_argument('--wsdt_block_shape', help="Compute the watershed in blocks of this shape (spatial axes only), for volumes that don't fit into RAM.", type=int, nargs='+')
+        parser.add_argument('--multicut_block_shape', help="Solve the multicut hierarchically, in blocks of this shape (spatial axes only).", type=int, nargs='+')
         self.parsed_workflow_args, unused_args = parser.parse_known_args(workflow_cmdline_args)
         if unused_args:
             # Parse batch export/input args.
@@ -248,6 +250,14 @@ class EdgeTrainingWithMulticutWorkflow(Workflow):
         if self.parsed_workflow_args.retrain:
             self._force_retrain_classifier(projectManager)
 
+        if self.parsed_workflow_args.wsdt_block_shape:
+            opWsdt = self.wsdtApplet.topLevelOperator
+            opWsdt.BlockShape.setValue( tuple(self.parsed_workflow_args.wsdt_block_shape) )
+
+        if self.parsed_workflow_args.multicut_block_shape:
+            opEdgeTrainingWithMulticut = self.edgeTrainingWithMulticutApplet.topLevelOperator
+            opEdgeTrainingWithMulticut.MulticutBlockShape.setValue( tuple(self.parsed_workflow_args.multicut_block_shape) )
+
         if self._headless and self._batch_input_args and self._data_export_args:
             # Make sure the watershed can be computed if necessary.
             opWsdt = self.wsdtApplet.topLevelOperator
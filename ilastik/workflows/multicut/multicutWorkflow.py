@@ -19,6 +19,7 @@
 #           http://ilastik.org/license.html
 ###############################################################################
 import sys
+import argparse
 from functools import partial
 import numpy as np
 
@@ -119,8 +120,12 @@ class MulticutWorkflow(Workflow):
 
         # -- Parse command-line arguments
         #    (Command-line args are applied in onProjectLoaded(), below.)
-        if workflow_cmdline_args:
-            self._data_export_args, unused_args = self.dataExportApplet.parse_known_cmdline_args( workflow_cmdline_args )
+        # Parse workflow-specific command-line args
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--wsdt_block_shape', help="Compute the watershed in blocks of this shape (spatial axes only), for volumes that don't fit into RAM.", type=int, nargs='+')
+        self.parsed_workflow_args, unused_args = parser.parse_known_args(workflow_cmdline_args)
+        if unused_args:
+            self._data_export_args, unused_args = self.dataExportApplet.parse_known_cmdline_args( unused_args )
             self._batch_input_args, unused_args = self.batchProcessingApplet.parse_known_cmdline_args( unused_args )
         else:
             unused_args = None
@@ -222,6 +227,10 @@ class MulticutWorkflow(Workflow):
         if self._data_export_args:
             self.dataExportApplet.configure_operator_with_parsed_args( self._data_export_args )
 
+        if self.parsed_workflow_args.wsdt_block_shape:
+            opWsdt = self.wsdtApplet.topLevelOperator
+            opWsdt.BlockShape.setValue( tuple(self.parsed_workflow_args.wsdt_block_shape) )
+
         if self._headless and self._batch_input_args and self._data_export_args:
             # Make sure the watershed can be computed if necessary.
             opWsdt = self.wsdtApplet.topLevelOperator
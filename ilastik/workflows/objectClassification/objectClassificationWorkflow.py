@@ -87,6 +87,7 @@ class ObjectClassificationWorkflow(Workflow):
         parser.add_argument('--fillmissing', help="use 'fill missing' applet with chosen detection method", choices=['classic', 'svm', 'none'], default='none')
         parser.add_argument('--filter', help="pixel feature filter implementation.", choices=['Original', 'Refactored', 'Interpolated'], default='Original')
         parser.add_argument('--nobatch', help="do not append batch applets", action='store_true', default=False)
+        parser.add_argument('--fused_thresholding', help="compute the two-level threshold in a single pass (headless only)", action='store_true', default=False)
         
         parsed_creation_args, unused_args = parser.parse_known_args(project_creation_args)
 
@@ -102,6 +103,10 @@ class ObjectClassificationWorkflow(Workflow):
 
         self.batch = not parsed_args.nobatch
 
+        self.fused_thresholding = parsed_args.fused_thresholding and headless
+        if parsed_args.fused_thresholding and not headless:
+            logger.error( "Ignoring --fused_thresholding cmdline arg.  Fused thresholding is only available in headless mode." )
+
         self._applets = []
 
         self.pcApplet = None
@@ -621,6 +626,7 @@ class ObjectClassificationWorkflowPixel(ObjectClassificationWorkflow):
         opThreshold.RawInput.connect(op5raw.Output)
         opThreshold.InputImage.connect(op5pred.Output)
         opThreshold.InputChannelColors.connect( opClassify.PmapColors )
+        opThreshold.FusedTwoLevels.setValue( self.fused_thresholding )
 
         op5threshold.Input.connect(opThreshold.CachedOutput)
 
@@ -746,6 +752,7 @@ class ObjectClassificationWorkflowPrediction(ObjectClassificationWorkflow):
 
         opTwoLevelThreshold.RawInput.connect(op5raw.Output)
         opTwoLevelThreshold.InputImage.connect(op5predictions.Output)
+        opTwoLevelThreshold.FusedTwoLevels.setValue(self.fused_thresholding)
 
         op5Binary = OpReorderAxes(parent=self)
         op5Binary.AxisOrder.setValue("txyzc")
@@ -1,4 +1,5 @@
 import os
+import argparse
 from lazyflow.graph import Graph
 from lazyflow.utility import PathComponents, make_absolute, format_known_keys
 from ilastik.workflow import Workflow
@@ -150,10 +151,12 @@ class ConservationTrackingWorkflowBase( Workflow ):
         if workflow_cmdline_args:
             self._data_export_args, unused_args = self.dataExportApplet.parse_known_cmdline_args( workflow_cmdline_args )
             self._batch_input_args, unused_args = self.batchProcessingApplet.parse_known_cmdline_args( workflow_cmdline_args )
+            self._tracking_window_args, unused_args = self._parse_tracking_window_args( unused_args )
         else:
             unused_args = None
             self._data_export_args = None
             self._batch_input_args = None
+            self._tracking_window_args = None
 
         if unused_args:
             logger.warn("Unused command-line args: {}".format( unused_args ))
@@ -162,6 +165,22 @@ class ConservationTrackingWorkflowBase( Workflow ):
     def applets(self):
         return self._applets
 
+    @staticmethod
+    def _parse_tracking_window_args(cmdline_args):
+        """
+        Headless overrides of the sliding-window settings stored in the tracking parameters.
+        """
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--tracking_window_size', help='Track in windows of this many frames (0: track all frames at once).', type=int)
+        parser.add_argument('--tracking_window_overlap', help='The number of frames shared by consecutive tracking windows.', type=int)
+        parser.add_argument('--max_parallel_windows', help='The number of tracking windows that are solved at the same time.', type=int)
+        return parser.parse_known_args(cmdline_args)
+
+    def _tracking_window_setting(self, parameters, name, key, default):
+        if self._tracking_window_args is not None and getattr(self._tracking_window_args, name) is not None:
+            return getattr(self._tracking_window_args, name)
+        return parameters.get(key, default)
+
     def _createDivisionDetectionApplet(self,selectedFeatures=dict()):
         return ObjectClassificationApplet(workflow=self,
                                           name="Division Detection (optional)",
@@ -349,7 +368,10 @@ class ConservationTrackingWorkflowBase( Workflow ):
             appearance_cost = parameters['appearanceCost'],
             disappearance_cost = parameters['disappearanceCost'],
             force_build_hypotheses_graph = False,
-            withBatchProcessing = True
+            withBatchProcessing = True,
+            windowSize = self._tracking_window_setting(parameters, 'tracking_window_size', 'windowSize', 0),
+            windowOverlap = self._tracking_window_setting(parameters, 'tracking_window_overlap', 'windowOverlap', 10),
+            maxParallelWindows = self._tracking_window_setting(parameters, 'max_parallel_windows', 'maxParallelWindows', 2)
         )
 
     def post_process_lane_export(self, lane_index):
@@ -18,6 +18,7 @@
 # on the ilastik web site at:
 #           http://ilastik.org/license.html
 ###############################################################################
+import argparse
 import numpy as np
 
 from ilastik.workflow import Workflow
@@ -90,8 +91,12 @@ class WsdtWorkflow(Workflow):
 
         # -- Parse command-line arguments
         #    (Command-line args are applied in onProjectLoaded(), below.)
-        if workflow_cmdline_args:
-            self._data_export_args, unused_args = self.dataExportApplet.parse_known_cmdline_args( workflow_cmdline_args )
+        # Parse workflow-specific command-line args
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--wsdt_block_shape', help="Compute the watershed in blocks of this shape (spatial axes only), for volumes that don't fit into RAM.", type=int, nargs='+')
+        self.parsed_workflow_args, unused_args = parser.parse_known_args(workflow_cmdline_args)
+        if unused_args:
+            self._data_export_args, unused_args = self.dataExportApplet.parse_known_cmdline_args( unused_args )
             self._batch_input_args, unused_args = self.dataSelectionApplet.parse_known_cmdline_args( unused_args, role_names )
         else:
             unused_args = None
@@ -132,6 +137,10 @@ class WsdtWorkflow(Workflow):
         if self._data_export_args:
             self.dataExportApplet.configure_operator_with_parsed_args( self._data_export_args )
 
+        if self.parsed_workflow_args.wsdt_block_shape:
+            opWsdt = self.wsdtApplet.topLevelOperator
+            opWsdt.BlockShape.setValue( tuple(self.parsed_workflow_args.wsdt_block_shape) )
+
         if self._headless and self._batch_input_args and self._data_export_args:
             logger.info("Beginning Batch Processing")
             self.batchProcessingApplet.run_export_from_parsed_args(self._batch_input_args)
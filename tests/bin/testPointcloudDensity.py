@@ -0,0 +1,197 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2016, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import os
+import imp
+import time
+import shutil
+import resource
+import tempfile
+
+import numpy
+import h5py
+import nose
+
+import logging
+logger = logging.getLogger(__name__)
+
+bin_dir = os.path.join( os.path.split(__file__)[0], '../../bin' )
+downsample_pointcloud = imp.load_source( 'downsample_pointcloud', os.path.join(bin_dir, 'downsample_pointcloud.py') )
+pointcloud_density = imp.load_source( 'pointcloud_density', os.path.join(bin_dir, 'pointcloud_density.py') )
+
+POINTCLOUD_COLUMNS = ["x_px", "y_px", "z_px",
+                      "size_px",
+                      "min_x_px", "min_y_px", "min_z_px",
+                      "max_x_px", "max_y_px", "max_z_px"]
+
+def write_pointcloud(csv_filepath, num_points, extent=200, seed=0, columns=POINTCLOUD_COLUMNS, chunk_size=10**6):
+    """
+    Write random points (clustered around a few centers within roughly extent^3, with many duplicates)
+    to a tab-separated csv file.
+    """
+    rng = numpy.random.RandomState(seed)
+    centers = rng.randint(1000, 1000 + extent, (10, 3))
+    with open(csv_filepath, 'w') as f:
+        f.write( '\t'.join(columns) + '\n' )
+        for start in range(0, num_points, chunk_size):
+            count = min(chunk_size, num_points - start)
+            xyz = centers[rng.randint(0, len(centers), count)] + rng.normal(0, extent / 20.0, (count, 3)).astype(int)
+            size = rng.randint(1, 100, (count, 1))
+            rows = numpy.concatenate( (xyz, size, xyz - 5, xyz + 5), axis=1 )
+            numpy.savetxt( f, rows[:, :len(columns)], fmt='%d', delimiter='\t' )
+
+class RecordingDataset(object):
+    """
+    Stands in for an hdf5 dataset, remembering which blocks were written.
+    """
+    def __init__(self, shape, dtype):
+        self.data = numpy.zeros(shape, dtype=dtype)
+        self.shape = shape
+        self.dtype = self.data.dtype
+        self.written = []
+
+    def __setitem__(self, slicing, value):
+        self.written.append( tuple(s.start for s in slicing) )
+        self.data[slicing] = value
+
+class TestPointcloudDensity(object):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.csv_filepath = os.path.join(self.tmpDir, 'points.csv')
+        write_pointcloud( self.csv_filepath, 20000, extent=100 )
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def _density(self, **kwargs):
+        output_filepath = os.path.join(self.tmpDir, 'density.h5')
+        pointcloud_density.pointcloud_density_hdf5( self.csv_filepath, output_filepath,
+                                                    block_shape_zyx=(30, 40, 50),
+                                                    csv_chunk_bytes=100000,
+                                                    **kwargs )
+        with h5py.File(output_filepath, 'r') as f:
+            return f['downsampled_density'][:]
+
+    def testAgainstInMemory(self):
+        for method in ('binary', 'by_count', 'by_size'):
+            for offset, shape in ( (None, None), ((950, 900, 850), (200, 250, 300)) ):
+                expected = downsample_pointcloud.density_volume_from_pointcloud( self.csv_filepath, None, offset, shape, method )
+                result = self._density( offset_xyz=offset, volume_shape_xyz=shape, method=method )
+                assert result.dtype == expected.dtype
+                assert result.shape == expected.shape
+                assert (result == expected).all(), "Densities differ for method {}".format( method )
+
+    def testScale(self):
+        # (density_volume_from_pointcloud() can't be used with a scale.)
+        # Downsampling is the same as summing up (or, for binary, taking the max of) blocks of the full-scale volume.
+        scale_xyz = (3, 4, 5)
+        scale_zyx = scale_xyz[::-1]
+        for method in ('binary', 'by_count', 'by_size'):
+            full_scale = self._density( method=method )
+            result = self._density( method=method, scale_xyz=scale_xyz )
+            padded_shape = [ -(-s // f) * f for s, f in zip(full_scale.shape, scale_zyx) ]
+            padded = numpy.zeros( padded_shape, dtype=full_scale.dtype )
+            padded[tuple( slice(0, s) for s in full_scale.shape )] = full_scale
+            blocks = padded.reshape( (padded_shape[0] // scale_zyx[0], scale_zyx[0],
+                                      padded_shape[1] // scale_zyx[1], scale_zyx[1],
+                                      padded_shape[2] // scale_zyx[2], scale_zyx[2]) )
+            if method == 'binary':
+                expected = blocks.max(axis=5).max(axis=3).max(axis=1)
+            else:
+                expected = blocks.sum(axis=5).sum(axis=3).sum(axis=1)
+            assert result.shape == expected.shape
+            assert (result == expected).all()
+
+    def testSmoothing(self):
+        for sigma in ((1.0, 1.0, 1.0), (2.0, 1.5, 3.0)):
+            expected_filepath = os.path.join(self.tmpDir, 'expected.h5')
+            downsample_pointcloud.downsample_pointcloud( self.csv_filepath, expected_filepath,
+                                                         smoothing_sigma_xyz=sigma, normalize_with_max=100.0 )
+            with h5py.File(expected_filepath, 'r') as f:
+                expected = f['downsampled_density'][:]
+            result = self._density( smoothing_sigma_xyz=sigma, normalize_with_max=100.0 )
+            assert result.shape == expected.shape
+            assert numpy.allclose( result, expected, atol=1e-4 )
+
+    def testOutputDtype(self):
+        result = self._density( scale_xyz=(4, 4, 4), normalize_with_max=255, output_dtype=numpy.uint8 )
+        assert result.dtype == numpy.uint8
+        assert result.max() == 255
+
+    def testBlocksWrittenOnce(self):
+        # The points of all csv chunks are gathered by block before the block is written
+        spill_dir = os.path.join(self.tmpDir, 'blocks')
+        os.mkdir(spill_dir)
+        shape = (20, 30, 45)
+        rng = numpy.random.RandomState(0)
+        chunks = [ (rng.randint(0, 1000, (500, 3)) % shape, rng.randint(1, 100, 500).astype(numpy.float64))
+                   for _ in range(4) ]
+        for coordinates_zyx, weights in chunks:
+            pointcloud_density.spill_points( spill_dir, shape, coordinates_zyx, weights, (10, 10, 10) )
+
+        dset = RecordingDataset(shape, numpy.float32)
+        pointcloud_density.accumulate_spilled_points( spill_dir, dset, 'by_size', (10, 10, 10) )
+        assert len(dset.written) == len(set(dset.written)) == 2 * 3 * 5
+
+        expected = numpy.zeros(shape, dtype=numpy.float32)
+        for coordinates_zyx, weights in chunks:
+            numpy.add.at( expected, tuple(coordinates_zyx.T), weights )
+        assert (dset.data == expected).all()
+
+    def testCommaSeparated(self):
+        csv_filepath = os.path.join(self.tmpDir, 'points_comma.csv')
+        with open(self.csv_filepath) as f_in, open(csv_filepath, 'w') as f_out:
+            f_out.write( f_in.read().replace('\t', ',') )
+        chunks = list( pointcloud_density.iter_csv_chunks( csv_filepath, ['z_px', 'x_px'], {'delimiter' : ','}, 1000 ) )
+        assert len(chunks) > 1
+        expected = downsample_pointcloud.array_from_csv( self.csv_filepath, use_cache=False, column_dtypes=numpy.uint32 )
+        rows = numpy.concatenate(chunks)
+        assert (rows[:, 0] == expected['z_px']).all()
+        assert (rows[:, 1] == expected['x_px']).all()
+
+class TestPointcloudDensityBenchmarking(object):
+
+    @classmethod
+    def setupClass(cls):
+        # This test is useful for performance evaluation,
+        #  but it takes too long to be useful as part of the normal test suite.
+        raise nose.SkipTest
+
+    def testManyPoints(self):
+        tmpDir = tempfile.mkdtemp()
+        try:
+            csv_filepath = os.path.join(tmpDir, 'points.csv')
+            write_pointcloud( csv_filepath, 10**8, extent=4000, columns=POINTCLOUD_COLUMNS[:3] )
+
+            start = time.time()
+            pointcloud_density.pointcloud_density_hdf5( csv_filepath, os.path.join(tmpDir, 'density.h5'),
+                                                        scale_xyz=(4, 4, 4), smoothing_sigma_xyz=2.0 )
+            logger.info( "10^8 points: {:.1f}s, peak memory {:.0f} MB".format(
+                         time.time() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0 ) )
+        finally:
+            shutil.rmtree(tmpDir)
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
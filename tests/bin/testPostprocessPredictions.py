@@ -0,0 +1,217 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2016, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import os
+import imp
+import time
+import shutil
+import argparse
+import tempfile
+
+import numpy
+import h5py
+import vigra
+import nose
+
+from ilastik.applets.dataExport.dataExportApplet import DataExportApplet
+
+import logging
+logger = logging.getLogger(__name__)
+
+bin_dir = os.path.join(os.path.dirname(__file__), '..', '..', 'bin')
+convert_predictions_to_segmentation = imp.load_source( 'convert_predictions_to_segmentation',
+                                                       os.path.join(bin_dir, 'convert_predictions_to_segmentation.py') )
+convert_predictions_to_uncertainties = imp.load_source( 'convert_predictions_to_uncertainties',
+                                                        os.path.join(bin_dir, 'convert_predictions_to_uncertainties.py') )
+postprocess_predictions = imp.load_source( 'postprocess_predictions',
+                                           os.path.join(bin_dir, 'postprocess_predictions.py') )
+
+def write_predictions(filepath, shape, axes='zyxc', chunks=True, seed=0):
+    """
+    Write random (normalized) predictions, with a few ties between the highest channels.
+    """
+    rng = numpy.random.RandomState(seed)
+    pmap = rng.random_sample(shape).astype(numpy.float32)
+    if shape[-1] > 1:
+        pmap[::7, ..., 1] = pmap[::7, ..., 0]
+    pmap /= pmap.sum(axis=-1)[..., None]
+    with h5py.File(filepath, 'w') as f:
+        dataset = f.create_dataset('exported_data', data=pmap, chunks=chunks)
+        dataset.attrs['axistags'] = vigra.defaultAxistags(axes).toJSON()
+    return pmap
+
+def read_output(filepath, internal_path, axes='zyxc'):
+    with h5py.File(filepath, 'r') as f:
+        dataset = f[internal_path]
+        axistags = vigra.AxisTags.fromJSON(dataset.attrs['axistags'])
+        return vigra.taggedView(dataset[:], axistags).withAxes(*axes).view(numpy.ndarray)
+
+def export_args(*args):
+    parser = DataExportApplet.make_cmdline_parser( argparse.ArgumentParser() )
+    return parser.parse_args(list(args))
+
+class TestPostprocessPredictions(object):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def _postprocess(self, shape, output_names, **kwargs):
+        input_path = os.path.join(self.tmpDir, 'predictions.h5')
+        output_path = os.path.join(self.tmpDir, 'postprocessed.h5')
+        pmap = write_predictions(input_path, shape, chunks=(5, 16, 16, shape[-1]))
+        postprocess_predictions.postprocess_predictions( input_path + '/exported_data', output_path, output_names,
+                                                         block_bytes=20000, prefetch=2, **kwargs )
+        return pmap, input_path, output_path
+
+    def testSegmentation(self):
+        _, input_path, output_path = self._postprocess((23, 50, 41, 3), ['segmentation'])
+        convert_predictions_to_segmentation.convert_predictions_to_segmentation(
+            [input_path + '/exported_data'], export_args('--output_format=hdf5', '--output_internal_path=segmentation') )
+
+        expected = read_output(os.path.join(self.tmpDir, 'predictions_Segmentation.h5'), 'segmentation')
+        result = read_output(output_path, 'segmentation')
+        assert result.dtype == expected.dtype == numpy.uint8
+        assert (result == expected).all()
+
+    def testUncertainties(self):
+        _, input_path, output_path = self._postprocess((23, 50, 41, 4), ['uncertainties'])
+        expected_path = os.path.join(self.tmpDir, 'uncertainties.h5')
+        convert_predictions_to_uncertainties.convert_predictions_to_uncertainties(
+            input_path + '/exported_data', export_args('--output_format=hdf5',
+                                                       '--output_filename_format=' + expected_path,
+                                                       '--output_internal_path=uncertainties') )
+
+        expected = read_output(expected_path, 'uncertainties')
+        result = read_output(output_path, 'uncertainties')
+        assert result.dtype == expected.dtype
+        assert (result == expected).all()
+
+    def testAllOutputs(self):
+        outputs = ['segmentation', 'uncertainties', 'entropy', 'thresholded']
+        pmap, _, output_path = self._postprocess((10, 33, 40, 3), outputs, threshold=0.4)
+
+        with h5py.File(output_path, 'r') as f:
+            assert sorted(f.keys()) == sorted(outputs)
+            for name in outputs:
+                assert f[name].shape == (10, 33, 40, 1)
+                assert 'axistags' in f[name].attrs
+            entropy = f['entropy'][..., 0]
+            thresholded = f['thresholded'][..., 0]
+            segmentation = f['segmentation'][..., 0]
+
+        expected_entropy = -(pmap * numpy.log(pmap)).sum(axis=-1) / numpy.log(3)
+        assert numpy.allclose(entropy, expected_entropy, atol=1e-5)
+        assert 0 <= entropy.min() and entropy.max() <= 1 + 1e-6
+
+        certain = pmap.max(axis=-1) >= 0.4
+        assert (thresholded[certain] == segmentation[certain]).all()
+        assert (thresholded[~certain] == 0).all()
+        assert 0 < certain.sum() < certain.size
+
+    def testSingleChannel(self):
+        _, _, output_path = self._postprocess((5, 20, 20, 1), ['segmentation', 'uncertainties', 'entropy'])
+        with h5py.File(output_path, 'r') as f:
+            assert (f['segmentation'][:] == 1).all()
+            assert (f['uncertainties'][:] == 0).all()
+            assert (f['entropy'][:] == 0).all()
+
+    def testBlockShape(self):
+        block_shape = postprocess_predictions.block_shape_for
+        # small datasets are processed in one block
+        assert block_shape((10, 20, 30, 3), (5, 10, 10, 3), 4) == (10, 20, 30, 3)
+
+        # blocks are multiples of the chunks, and keep all channels
+        block = block_shape((100, 1000, 1000, 5), (10, 64, 64, 5), 4, 2**20)
+        assert block[-1] == 5
+        assert all(b % c == 0 for b, c in zip(block[:-1], (10, 64, 64)))
+        assert numpy.prod(block) * 4 <= 2**20
+
+        # unchunked datasets
+        block = block_shape((100, 1000, 1000, 5), None, 4, 2**20)
+        assert numpy.prod(block) * 4 <= 2**20
+
+    def testSeveralFiles(self):
+        input_paths = []
+        output_paths = []
+        expected = []
+        for i in range(5):
+            input_path = os.path.join(self.tmpDir, 'predictions{}.h5'.format(i))
+            pmap = write_predictions(input_path, (8 + i, 30, 20, 3), seed=i)
+            expected.append( numpy.argmax(pmap, axis=-1) + 1 )
+            input_paths.append( input_path + '/exported_data' )
+            output_paths.append( os.path.join(self.tmpDir, 'postprocessed{}.h5'.format(i)) )
+
+        postprocess_predictions.postprocess_all_predictions( input_paths, output_paths, ['segmentation'],
+                                                             block_bytes=10000, memory_budget=200000 )
+        for output_path, segmentation in zip(output_paths, expected):
+            with h5py.File(output_path, 'r') as f:
+                assert (f['segmentation'][..., 0] == segmentation).all()
+
+class TestPostprocessPredictionsBenchmarking(object):
+    """
+    Throughput of postprocess_predictions (segmentation and uncertainties in one pass)
+    vs. convert_predictions_to_segmentation.py and convert_predictions_to_uncertainties.py.
+    """
+
+    @classmethod
+    def setupClass(cls):
+        # This test is useful for performance evaluation,
+        #  but it takes too long to be useful as part of the normal test suite.
+        raise nose.SkipTest
+
+    def testThroughput(self):
+        tmpDir = tempfile.mkdtemp()
+        try:
+            input_paths = []
+            for i in range(4):
+                input_path = os.path.join(tmpDir, 'predictions{}.h5'.format(i))
+                write_predictions(input_path, (100, 512, 512, 3), seed=i)
+                input_paths.append(input_path + '/exported_data')
+            nbytes = 4 * 100 * 512 * 512 * 3 * 4
+
+            start = time.time()
+            for i, input_path in enumerate(input_paths):
+                convert_predictions_to_segmentation.convert_predictions_to_segmentation(
+                    [input_path], export_args('--output_format=hdf5', '--output_internal_path=segmentation') )
+                convert_predictions_to_uncertainties.convert_predictions_to_uncertainties(
+                    input_path, export_args('--output_format=hdf5',
+                                            '--output_filename_format=' + os.path.join(tmpDir, 'uncertainties{}.h5'.format(i)),
+                                            '--output_internal_path=uncertainties') )
+            elapsed = time.time() - start
+            logger.info("convert_predictions_to_*: {:.1f}s, {:.1f} MB/s".format(elapsed, nbytes / 1e6 / elapsed))
+
+            start = time.time()
+            output_paths = [os.path.join(tmpDir, 'postprocessed{}.h5'.format(i)) for i in range(len(input_paths))]
+            postprocess_predictions.postprocess_all_predictions( input_paths, output_paths,
+                                                                 ['segmentation', 'uncertainties'] )
+            elapsed = time.time() - start
+            logger.info("postprocess_predictions: {:.1f}s, {:.1f} MB/s".format(elapsed, nbytes / 1e6 / elapsed))
+        finally:
+            shutil.rmtree(tmpDir)
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
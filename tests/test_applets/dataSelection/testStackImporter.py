@@ -0,0 +1,206 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2016, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import os
+import time
+import shutil
+import tempfile
+
+import h5py
+import numpy
+import vigra
+import nose
+
+from lazyflow.graph import Graph, Operator, InputSlot, OutputSlot
+from lazyflow.operators.ioOperators import OpStackLoader, OpH5WriterBigDataset
+from lazyflow.operators.ioOperators.opTiffSequenceReader import OpTiffSequenceReader
+from ilastik.applets.dataSelection.stackImporter import StackImporter, stack_chunk_shape
+
+import logging
+logger = logging.getLogger(__name__)
+
+def write_slices(directory, shape, extension, seed=0):
+    """
+    Write a stack of smooth random slices (with some noise), return the data in zyx order.
+    """
+    rng = numpy.random.RandomState(seed)
+    data = numpy.zeros(shape, dtype=numpy.uint8)
+    for z in range(shape[0]):
+        noise = rng.randint(0, 20, size=shape[1:])
+        data[z] = (numpy.indices(shape[1:]).sum(0) + 3 * z) % 200 + noise
+        vigra.impex.writeImage( vigra.taggedView(data[z], 'yx'),
+                                os.path.join(directory, "slice{:04d}{}".format(z, extension)) )
+    return data
+
+class OpFailingSlice(Operator):
+    """
+    Passes the input through, but fails for one slice along the first axis.
+    """
+    Input = InputSlot()
+    FailingSlice = InputSlot()
+    Output = OutputSlot()
+
+    def setupOutputs(self):
+        self.Output.meta.assignFrom(self.Input.meta)
+
+    def execute(self, slot, subindex, roi, result):
+        if roi.start[0] <= self.FailingSlice.value < roi.stop[0]:
+            raise RuntimeError("Can't read slice {}".format(self.FailingSlice.value))
+        self.Input(roi.start, roi.stop).writeInto(result).wait()
+
+    def propagateDirty(self, slot, subindex, roi):
+        self.Output.setDirty()
+
+class TestStackImporter(object):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.h5File = h5py.File(os.path.join(self.tmpDir, 'project.h5'), 'w')
+
+    def tearDown(self):
+        self.h5File.close()
+        shutil.rmtree(self.tmpDir)
+
+    def _import(self, data_slot, sequence_axis, **kwargs):
+        group = self.h5File.require_group('local_data')
+        progress = []
+        dataset = StackImporter(**kwargs).run( data_slot, group, 'stack', sequence_axis, progress.append )
+        assert progress[-1] == 100
+        assert progress == sorted(progress)
+        return dataset
+
+    def testPng(self):
+        expected = write_slices(self.tmpDir, (20, 60, 50), '.png')
+        opLoader = OpStackLoader(graph=Graph())
+        opLoader.SequenceAxis.setValue('z')
+        opLoader.globstring.setValue(os.path.join(self.tmpDir, '*.png'))
+
+        dataset = self._import(opLoader.stack, 'z', compression='gzip', compression_opts=4, prefetch_bytes=3 * 60 * 50)
+        assert dataset.compression == 'gzip'
+        assert dataset.chunks is not None
+
+        assert (dataset[:] == opLoader.stack[:].wait()).all()
+        axistags = vigra.AxisTags.fromJSON(dataset.attrs['axistags'])
+        assert axistags == opLoader.stack.meta.axistags
+        result = vigra.taggedView(dataset[:], axistags).withAxes(*'zyx')
+        assert (result == expected).all()
+
+    def testTiff(self):
+        expected = write_slices(self.tmpDir, (15, 40, 70), '.tiff')
+        opLoader = OpTiffSequenceReader(graph=Graph())
+        opLoader.SequenceAxis.setValue('z')
+        opLoader.GlobString.setValue(os.path.join(self.tmpDir, '*.tiff'))
+
+        dataset = self._import(opLoader.Output, 'z')
+        assert dataset.compression == 'lzf'
+        axistags = vigra.AxisTags.fromJSON(dataset.attrs['axistags'])
+        result = vigra.taggedView(dataset[:], axistags).withAxes(*'zyx')
+        assert (result == expected).all()
+
+    def testTimeSeries(self):
+        expected = write_slices(self.tmpDir, (7, 30, 30), '.png')
+        opLoader = OpStackLoader(graph=Graph())
+        opLoader.SequenceAxis.setValue('t')
+        opLoader.globstring.setValue(os.path.join(self.tmpDir, '*.png'))
+
+        dataset = self._import(opLoader.stack, 't', compression=None)
+        assert dataset.compression is None
+        assert dataset.chunks[opLoader.stack.meta.getAxisKeys().index('t')] == 1
+        axistags = vigra.AxisTags.fromJSON(dataset.attrs['axistags'])
+        result = vigra.taggedView(dataset[:], axistags).withAxes(*'tyx')
+        assert (result == expected).all()
+
+    def testFailure(self):
+        data = vigra.taggedView( numpy.zeros((40, 30, 20), dtype=numpy.uint8), 'zyx' )
+        opFailing = OpFailingSlice(graph=Graph())
+        opFailing.Input.setValue(data)
+        opFailing.FailingSlice.setValue(25)
+
+        group = self.h5File.require_group('local_data')
+        try:
+            StackImporter(prefetch_bytes=1).run( opFailing.Output, group, 'stack', 'z' )
+        except RuntimeError:
+            pass
+        else:
+            assert False, "The import should have failed."
+        # No incomplete dataset is left behind
+        assert 'stack' not in group
+
+    def testChunkShape(self):
+        # small stacks fit into one chunk
+        assert stack_chunk_shape((1, 10, 20, 30, 1), 'tzyxc', 1) == (1, 10, 20, 30, 1)
+
+        # time steps and channels are not split, the longest spatial axes first
+        chunks = stack_chunk_shape((5, 300, 2000, 2000, 3), 'tzyxc', 2)
+        assert chunks[0] == 1 and chunks[4] == 3
+        assert numpy.prod(chunks) * 2 <= 2**20
+        assert max(chunks[1:4]) <= 2 * min(chunks[1:4])
+
+        # 2D time series get tiles
+        chunks = stack_chunk_shape((100, 1, 4000, 4000, 1), 'tzyxc', 1)
+        assert chunks[:2] == (1, 1)
+        assert numpy.prod(chunks) <= 2**20
+
+class TestStackImporterBenchmarking(object):
+    """
+    Import time and project size: StackImporter vs. OpH5WriterBigDataset
+    (uncompressed, one slice at a time, as the stack import used to be).
+    """
+
+    @classmethod
+    def setupClass(cls):
+        # This test is useful for performance evaluation,
+        #  but it takes too long to be useful as part of the normal test suite.
+        raise nose.SkipTest
+
+    def testImport(self):
+        tmpDir = tempfile.mkdtemp()
+        try:
+            write_slices(tmpDir, (200, 1024, 1024), '.png')
+            for name in ('OpH5WriterBigDataset', 'lzf', 'gzip'):
+                opLoader = OpStackLoader(graph=Graph())
+                opLoader.SequenceAxis.setValue('z')
+                opLoader.globstring.setValue(os.path.join(tmpDir, '*.png'))
+
+                filename = os.path.join(tmpDir, name + '.h5')
+                start = time.time()
+                with h5py.File(filename, 'w') as f:
+                    if name == 'OpH5WriterBigDataset':
+                        opWriter = OpH5WriterBigDataset(graph=Graph())
+                        opWriter.hdf5File.setValue(f)
+                        opWriter.hdf5Path.setValue('stack')
+                        opWriter.CompressionEnabled.setValue(False)
+                        opWriter.BatchSize.setValue(1)
+                        opWriter.Image.connect(opLoader.stack)
+                        opWriter.WriteImage.value
+                        opWriter.cleanUp()
+                    else:
+                        StackImporter(name).run(opLoader.stack, f, 'stack', 'z')
+                logger.info("{}: {:.1f}s, {:.1f} MB".format(name, time.time() - start,
+                                                            os.path.getsize(filename) / 1e6))
+        finally:
+            shutil.rmtree(tmpDir)
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,107 @@
+import time
+import numpy as np
+import pandas as pd
+import nose
+
+from ilastik.applets.edgeTraining.edgeTable import EdgeTable, edge_keys
+
+import logging
+logger = logging.getLogger("tests.test_applets.edgeTraining")
+
+def random_edges(num_edges, num_sp, seed=0):
+    """
+    Sorted, unique edge ids (sp1 < sp2), like Rag.edge_ids.
+    """
+    rng = np.random.RandomState(seed)
+    pairs = np.sort(rng.randint(1, num_sp, size=(2 * num_edges, 2)), axis=1).astype(np.uint32)
+    pairs = pairs[pairs[:,0] != pairs[:,1]]
+    keys = np.unique(edge_keys(pairs))[:num_edges]
+    edge_ids = np.empty((len(keys), 2), dtype=np.uint32)
+    edge_ids[:,0] = keys >> np.uint64(32)
+    edge_ids[:,1] = keys & np.uint64(0xFFFFFFFF)
+    return edge_ids
+
+def random_features_and_labels(num_edges, num_labels, seed=0):
+    rng = np.random.RandomState(seed)
+    edge_ids = random_edges(num_edges, num_edges // 3, seed)
+    features_df = pd.DataFrame( edge_ids, columns=['sp1', 'sp2'] )
+    for name in ['Grayscale standard_edge_mean', 'Grayscale standard_edge_count']:
+        features_df[name] = rng.rand(len(edge_ids)).astype(np.float32)
+
+    labeled = rng.choice(len(edge_ids), num_labels, replace=False)
+    labels_dict = dict( zip( map(tuple, edge_ids[labeled]), rng.randint(0, 3, size=num_labels) ) )
+    # labels for edges that don't exist are ignored
+    labels_dict[(edge_ids[-1,1] + 1, edge_ids[-1,1] + 2)] = 1
+    return features_df, labels_dict
+
+def merged_training_data(features_df, labels_dict):
+    """
+    How OpTrainEdgeClassifier used to find the features of the labeled edges.
+    """
+    labels_df = pd.DataFrame(np.array(labels_dict.keys()), columns=['sp1', 'sp2'])
+    labels_df['label'] = labels_dict.values()
+    labels_df = labels_df[labels_df['label'] != 0]
+    merged = pd.merge(features_df, labels_df, how='inner', on=['sp1', 'sp2'])
+    return merged[['sp1', 'sp2']].values, merged.iloc[:, 2:-1].values, merged.iloc[:, -1].values
+
+class TestEdgeTable(object):
+
+    def testLookup(self):
+        edge_ids = random_edges(1000, 300)
+        table = EdgeTable(edge_ids)
+        assert (table.lookup(edge_ids) == np.arange(len(edge_ids))).all()
+        assert (table.lookup(edge_ids[::-7]) == np.arange(len(edge_ids))[::-7]).all()
+        assert (table.lookup([[0, 1], [edge_ids[-1,1], edge_ids[-1,1] + 1]]) == -1).all()
+
+    def testUnsortedLookup(self):
+        edge_ids = random_edges(1000, 300)
+        order = np.random.RandomState(1).permutation(len(edge_ids))
+        table = EdgeTable(edge_ids[order])
+        assert (table.lookup(edge_ids[order]) == np.arange(len(edge_ids))).all()
+
+    def testEmpty(self):
+        table = EdgeTable(np.zeros((0,2), dtype=np.uint32))
+        assert (table.lookup([[1, 2]]) == -1).all()
+        rows, labels = table.labeled_rows({})
+        assert len(rows) == len(labels) == 0
+
+    def testTrainingDataEquivalence(self):
+        features_df, labels_dict = random_features_and_labels(5000, 500)
+        expected_ids, expected_features, expected_labels = merged_training_data(features_df, labels_dict)
+
+        rows, labels = EdgeTable(features_df[['sp1', 'sp2']].values).labeled_rows(labels_dict)
+        edge_ids = features_df[['sp1', 'sp2']].values[rows]
+        features = features_df.iloc[rows, 2:].values
+
+        # The rows may come in a different order
+        order = np.lexsort(expected_ids.T[::-1])
+        assert (edge_ids == expected_ids[order]).all()
+        assert (features == expected_features[order]).all()
+        assert (labels == expected_labels[order]).all()
+
+class TestEdgeTableBenchmarking(object):
+
+    @classmethod
+    def setupClass(cls):
+        # This test is useful for performance evaluation,
+        #  but it takes too long to be useful as part of the normal test suite.
+        raise nose.SkipTest
+
+    def testMillionEdges(self):
+        features_df, labels_dict = random_features_and_labels(10**6, 10**5)
+
+        start = time.time()
+        merged_training_data(features_df, labels_dict)
+        logger.info("pandas merge: {:.3f}s".format(time.time() - start))
+
+        start = time.time()
+        rows, _ = EdgeTable(features_df[['sp1', 'sp2']].values).labeled_rows(labels_dict)
+        features_df.iloc[rows, 2:].values
+        logger.info("EdgeTable: {:.3f}s".format(time.time() - start))
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
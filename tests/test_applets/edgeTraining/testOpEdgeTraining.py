@@ -1,10 +1,15 @@
+import time
 import numpy as np
 import pandas as pd
+import vigra
+import nose
 
 from ilastikrag.util import generate_random_voronoi
 
 from lazyflow.graph import Graph
+from lazyflow.request import Request
 from ilastik.applets.edgeTraining import OpEdgeTraining
+from ilastik.applets.edgeTraining.opEdgeTraining import OpCreateRag, OpComputeEdgeFeatures
 
 import logging
 logger = logging.getLogger("tests.test_applets.edgeTraining")
@@ -56,7 +61,76 @@ class TestOpEdgeTraining(object):
         # ON
         assert edge_prob_dict[edge_C] > 0.5
         assert edge_prob_dict[edge_D] > 0.5    
-    
+
+def multichannel_edge_features(superpixels, num_channels, feature_names):
+    """
+    Set up OpComputeEdgeFeatures for random voxel data with the given number of channels.
+    """
+    channel_names = ['channel {}'.format(c) for c in range(num_channels)]
+    voxel_data = np.random.RandomState(0).rand( *(superpixels.shape[:-1] + (num_channels,)) ).astype(np.float32)
+    voxel_data = vigra.taggedView(voxel_data, superpixels.axistags)
+
+    graph = Graph()
+    op_rag = OpCreateRag(graph=graph)
+    op_rag.Superpixels.setValue( superpixels )
+
+    op = OpComputeEdgeFeatures(graph=graph)
+    op.Rag.setValue( op_rag.Rag.value )
+    op.VoxelData.setValue( voxel_data, extra_meta={'channel_names': channel_names} )
+    op.FeatureNames.setValue( dict( (name, feature_names) for name in channel_names ) )
+    return op, voxel_data
+
+class TestOpComputeEdgeFeatures(object):
+
+    def testChannelOrder(self):
+        superpixels = generate_random_voronoi( (50,50,50), 50 ).insertChannelAxis()
+        feature_names = ['standard_edge_mean', 'standard_edge_maximum']
+        op, voxel_data = multichannel_edge_features( superpixels, 5, feature_names )
+
+        # Process one channel at a time, and all at once
+        op.CHANNEL_MEMORY_FACTOR = np.inf
+        df_serial = op.EdgeFeaturesDataFrame.value
+        op.CHANNEL_MEMORY_FACTOR = 1e-12
+        op.EdgeFeaturesDataFrame.setDirty()
+        df_parallel = op.EdgeFeaturesDataFrame.value
+
+        rag = op.Rag.value
+        expected_columns = ['sp1', 'sp2']
+        for c in range(5):
+            channel_df = rag.compute_features( voxel_data[...,c], feature_names )
+            expected_columns += ['channel {} {}'.format(c, name) for name in channel_df.columns[2:]]
+            for name in channel_df.columns[2:]:
+                column = 'channel {} {}'.format(c, name)
+                assert (df_parallel[column].values == channel_df[name].values).all()
+
+        assert list(df_serial.columns) == expected_columns
+        assert list(df_parallel.columns) == expected_columns
+        assert (df_serial.values == df_parallel.values).all()
+
+class TestOpComputeEdgeFeaturesBenchmarking(object):
+
+    @classmethod
+    def setupClass(cls):
+        # This test is useful for performance evaluation,
+        #  but it takes too long to be useful as part of the normal test suite.
+        raise nose.SkipTest
+
+    def testChannelScaling(self):
+        superpixels = generate_random_voronoi( (200,200,200), 2000 ).insertChannelAxis()
+        feature_names = ['standard_edge_mean', 'standard_edge_quantiles']
+        previous_num_threads = Request.global_thread_pool.num_workers
+        try:
+            for num_channels in (1, 3, 8):
+                op, _ = multichannel_edge_features( superpixels, num_channels, feature_names )
+                for num_threads in (1, 8):
+                    Request.reset_thread_pool(num_threads)
+                    op.EdgeFeaturesDataFrame.setDirty()
+                    start = time.time()
+                    op.EdgeFeaturesDataFrame.value
+                    logger.info( "{} channels, {} threads: {:.2f}s".format( num_channels, num_threads, time.time() - start ) )
+        finally:
+            Request.reset_thread_pool(previous_num_threads)
+
 if __name__ == "__main__":
     import sys
     handler = logging.StreamHandler(sys.stdout)
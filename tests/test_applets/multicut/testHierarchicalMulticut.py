@@ -0,0 +1,238 @@
+import time
+import heapq
+
+import numpy as np
+import nose
+
+from ilastik.applets.multicut.hierarchicalMulticut import HierarchicalMulticut, superpixel_blocks, \
+                                                          connected_components, contract_graph, multicut_energy, \
+                                                          consecutive_labels
+
+import logging
+logger = logging.getLogger(__name__)
+
+def greedy_additive(edge_ids, edge_weights, node_count, initial_labels=None):
+    """
+    Greedy additive edge contraction, used as a stand-in for the solver libraries.
+    Repeatedly merges the pair of segments with the largest positive summed weight.
+    """
+    parents = np.arange(node_count)
+    def find(n):
+        while parents[n] != n:
+            parents[n] = parents[parents[n]]
+            n = parents[n]
+        return n
+
+    adjacency = [dict() for _ in range(node_count)]
+    for (u, v), w in zip(edge_ids, edge_weights):
+        adjacency[u][v] = adjacency[u].get(v, 0.0) + w
+        adjacency[v][u] = adjacency[v].get(u, 0.0) + w
+
+    heap = [(-w, u, v) for u in range(node_count) for v, w in adjacency[u].items() if u < v and w > 0]
+    heapq.heapify(heap)
+    while heap:
+        w, u, v = heapq.heappop(heap)
+        if find(u) != u or find(v) != v or adjacency[u].get(v) != -w:
+            # stale entry
+            continue
+        # merge v into u
+        parents[v] = u
+        del adjacency[u][v]
+        del adjacency[v][u]
+        for n, wn in adjacency[v].items():
+            del adjacency[n][v]
+            adjacency[u][n] = adjacency[u].get(n, 0.0) + wn
+            adjacency[n][u] = adjacency[u][n]
+            if adjacency[u][n] > 0:
+                heapq.heappush(heap, (-adjacency[u][n], min(u, n), max(u, n)))
+        adjacency[v] = {}
+
+    return np.array([find(n) for n in range(node_count)], dtype=np.uint32)
+
+def grid_problem(shape, num_segments, noise, seed=0):
+    """
+    A grid of single-pixel superpixels (ids 1..N, 0 is unused) over a random
+    ground-truth segmentation, with noisy edge weights.
+
+    Returns (label_img, edge_ids, edge_weights, ground_truth)
+    """
+    rng = np.random.RandomState(seed)
+    label_img = np.arange(1, np.prod(shape) + 1, dtype=np.uint32).reshape(shape)
+
+    seeds = rng.uniform(0, 1, size=(num_segments, len(shape))) * shape
+    coords = np.indices(shape).reshape(len(shape), -1).T
+    dists = ((coords[:, None, :] - seeds[None, :, :]) ** 2).sum(axis=-1)
+    ground_truth = np.zeros((label_img.size + 1,), dtype=np.uint32)
+    ground_truth[1:] = dists.argmin(axis=1) + 1
+
+    edge_ids = []
+    for axis in range(len(shape)):
+        lower = label_img.take(range(0, shape[axis] - 1), axis=axis).reshape(-1)
+        upper = label_img.take(range(1, shape[axis]), axis=axis).reshape(-1)
+        edge_ids.append( np.array([lower, upper]).T )
+    edge_ids = np.concatenate(edge_ids)
+    edge_ids = edge_ids[np.lexsort((edge_ids[:,1], edge_ids[:,0]))]
+
+    same = (ground_truth[edge_ids[:,0]] == ground_truth[edge_ids[:,1]])
+    edge_weights = np.where(same, 1.0, -1.0) + rng.normal(0, noise, size=len(edge_ids))
+    return label_img, edge_ids, edge_weights, ground_truth
+
+def variation_of_information(seg_a, seg_b):
+    _, a = np.unique(seg_a, return_inverse=True)
+    _, b = np.unique(seg_b, return_inverse=True)
+    n = float(len(a))
+    joint = np.bincount(a * (b.max() + 1) + b) / n
+    joint = joint[joint > 0]
+    pa = np.bincount(a) / n
+    pb = np.bincount(b) / n
+    entropy = lambda p: -(p[p > 0] * np.log(p[p > 0])).sum()
+    return 2 * entropy(joint) - entropy(pa) - entropy(pb)
+
+class CountingSolver(object):
+    def __init__(self):
+        self.node_counts = []
+        self.initial_labels = []
+
+    def __call__(self, edge_ids, edge_weights, node_count, initial_labels):
+        self.node_counts.append(node_count)
+        self.initial_labels.append(initial_labels)
+        return greedy_additive(edge_ids, edge_weights, node_count, initial_labels)
+
+class TestHierarchicalMulticut(object):
+
+    def testConnectedComponents(self):
+        edge_ids = np.array([[0, 4], [4, 2], [1, 3], [5, 6], [6, 5]], dtype=np.uint32)
+        components, num_components = connected_components(edge_ids, 8)
+        assert num_components == 4
+        assert list(components) == [0, 1, 0, 1, 0, 2, 2, 3]
+
+        components, num_components = connected_components(np.zeros((0,2), dtype=np.uint32), 3)
+        assert num_components == 3
+        assert list(components) == [0, 1, 2]
+
+    def testContractGraph(self):
+        edge_ids = np.array([[0, 1], [0, 2], [1, 2], [1, 3], [2, 3]], dtype=np.uint32)
+        edge_weights = np.array([1.0, 2.0, 3.0, 4.0, 5.0])
+        components = np.array([0, 0, 1, 1])
+        reduced_edge_ids, reduced_weights = contract_graph(edge_ids, edge_weights, components)
+        assert reduced_edge_ids.tolist() == [[0, 1]]
+        assert reduced_weights.tolist() == [2.0 + 3.0 + 4.0]
+
+    def testSuperpixelBlocks(self):
+        label_img = np.array([[1, 1, 2, 2],
+                              [1, 1, 2, 2],
+                              [3, 3, 3, 3],
+                              [3, 3, 3, 3]], dtype=np.uint32)
+        node_blocks = superpixel_blocks(label_img, (2, 2), 5)
+        # superpixel 3 has its center at (2.5, 1.5)
+        assert list(node_blocks) == [-1, 0, 1, 2, -1]
+
+    def testCompareToGlobal(self):
+        label_img, edge_ids, edge_weights, ground_truth = grid_problem((60, 60), 30, noise=0.8)
+        node_count = label_img.max() + 1
+
+        global_labels = greedy_additive(edge_ids, edge_weights, node_count)
+        node_blocks = superpixel_blocks(label_img, (15, 15), node_count)
+        labels = HierarchicalMulticut(edge_ids, node_blocks, greedy_additive).solve(edge_weights)
+        assert labels.shape == (node_count,)
+
+        global_energy = multicut_energy(edge_ids, edge_weights, global_labels)
+        energy = multicut_energy(edge_ids, edge_weights, labels)
+        logger.debug("energy: global {}, hierarchical {}".format(global_energy, energy))
+        assert abs(energy - global_energy) < 0.05 * abs(edge_weights).sum()
+
+        global_vi = variation_of_information(global_labels[1:], ground_truth[1:])
+        vi = variation_of_information(labels[1:], ground_truth[1:])
+        logger.debug("VI: global {}, hierarchical {}".format(global_vi, vi))
+        assert vi < global_vi + 0.1
+
+    def testSingleBlock(self):
+        # With a single block, the whole problem is solved by the block solver.
+        label_img, edge_ids, edge_weights, _ = grid_problem((20, 20), 5, noise=0.3)
+        node_count = label_img.max() + 1
+        global_labels = greedy_additive(edge_ids, edge_weights, node_count)
+        node_blocks = superpixel_blocks(label_img, (20, 20), node_count)
+        labels = HierarchicalMulticut(edge_ids, node_blocks, greedy_additive).solve(edge_weights)
+        assert multicut_energy(edge_ids, edge_weights, labels) == multicut_energy(edge_ids, edge_weights, global_labels)
+
+    def testWarmStart(self):
+        label_img, edge_ids, edge_weights, _ = grid_problem((40, 40), 10, noise=0.5)
+        node_count = label_img.max() + 1
+        node_blocks = superpixel_blocks(label_img, (10, 10), node_count)
+
+        solver = CountingSolver()
+        multicut = HierarchicalMulticut(edge_ids, node_blocks, solver)
+        first_labels = multicut.solve(edge_weights)
+        num_blocks = len(solver.node_counts) - 1
+        assert num_blocks == 16
+
+        # Nothing changed: only the contracted problem is solved again
+        del solver.node_counts[:]
+        labels = multicut.solve(edge_weights)
+        assert len(solver.node_counts) == 1
+        assert (labels == first_labels).all()
+        # The starting point is labeled consecutively, like a solver result
+        initial_labels = solver.initial_labels[-1]
+        assert (np.unique(initial_labels) == np.arange(initial_labels.max() + 1)).all()
+
+        # Change the weights of an edge within the first block: one block and the contracted problem
+        inner = np.flatnonzero( (node_blocks[edge_ids[:,0]] == 0) & (node_blocks[edge_ids[:,1]] == 0) )
+        edge_weights = edge_weights.copy()
+        edge_weights[inner[0]] = -10.0
+        del solver.node_counts[:]
+        labels = multicut.solve(edge_weights)
+        assert len(solver.node_counts) == 2
+        u, v = edge_ids[inner[0]]
+        assert labels[u] != labels[v]
+        for node_count, initial_labels in zip(solver.node_counts, solver.initial_labels[-2:]):
+            assert (np.unique(initial_labels) == np.arange(initial_labels.max() + 1)).all()
+            assert initial_labels.max() < node_count
+
+    def testConsecutiveLabels(self):
+        labels = consecutive_labels(np.array([7, 3, 7, 1000, 3], dtype=np.uint32))
+        assert labels.dtype == np.uint32
+        assert list(labels) == [1, 0, 1, 2, 0]
+
+class TestHierarchicalMulticutBenchmarking(object):
+    """
+    Hierarchical vs. global solve on large grid graphs.
+    """
+
+    @classmethod
+    def setupClass(cls):
+        # This test is useful for performance evaluation,
+        #  but it takes too long to be useful as part of the normal test suite.
+        raise nose.SkipTest
+
+    def testScaling(self):
+        for side in (224, 708):  # ~1e5 and ~1e6 edges
+            label_img, edge_ids, edge_weights, ground_truth = grid_problem((side, side), side // 4, noise=0.8)
+            node_count = label_img.max() + 1
+
+            start = time.time()
+            global_labels = greedy_additive(edge_ids, edge_weights, node_count)
+            global_time = time.time() - start
+
+            start = time.time()
+            node_blocks = superpixel_blocks(label_img, (64, 64), node_count)
+            multicut = HierarchicalMulticut(edge_ids, node_blocks, greedy_additive)
+            labels = multicut.solve(edge_weights)
+            hierarchical_time = time.time() - start
+
+            energies = (multicut_energy(edge_ids, edge_weights, global_labels),
+                        multicut_energy(edge_ids, edge_weights, labels))
+
+            edge_weights[:len(edge_weights) // 100] *= 2
+            start = time.time()
+            multicut.solve(edge_weights)
+            warm_time = time.time() - start
+
+            logger.info("{} edges: global {:.2f}s (energy {:.1f}), hierarchical {:.2f}s (energy {:.1f}), warm start {:.2f}s"
+                        .format(len(edge_ids), global_time, energies[0], hierarchical_time, energies[1], warm_time))
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,162 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2016, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import copy
+import time
+
+import numpy
+import vigra
+import nose
+
+from lazyflow.graph import Graph
+from lazyflow.operators import OpArrayPiper
+from lazyflow.roi import roiFromShape, roiToSlice, getIntersectingBlocks, getBlockBounds
+
+from ilastik.applets.splitBodyCarving.opSplitBodyCarving import OpSplitBodyCarving
+from ilastik.utility.labelBoundingBoxes import LabelBoundingBoxes
+
+import logging
+logger = logging.getLogger(__name__)
+
+class FakeLaneView(object):
+    """
+    Just the parts of an OpSplitBodyCarving lane that autoSeedBackground() uses.
+    """
+    def __init__(self, labels):
+        self._opLabels = OpArrayPiper( graph=Graph() )
+        self._opLabels.Input.setValue( labels )
+        self.RavelerLabels = self._opLabels.Output
+        self.WriteSeeds = numpy.zeros( labels.shape, dtype=numpy.uint8 )
+        self._boundingBoxes = None
+
+    def getRavelerBoundingBoxes(self):
+        if self._boundingBoxes is None:
+            self._boundingBoxes = LabelBoundingBoxes.from_slot( self.RavelerLabels )
+        return self._boundingBoxes
+
+def serial_auto_seed(laneView, foreground_label):
+    """
+    Background seeding as it used to be done: every block of the volume, one after another.
+    """
+    volume_shape = laneView.RavelerLabels.meta.shape
+    block_shape = numpy.minimum( (OpSplitBodyCarving.BLOCK_SIZE,) * len( volume_shape ), volume_shape )
+    for block_start in getIntersectingBlocks( block_shape, roiFromShape( volume_shape ) ):
+        block_roi = getBlockBounds( volume_shape, block_shape, block_start )
+        label_block = laneView.RavelerLabels(*block_roi).wait()
+        background_block = numpy.asarray( numpy.where( label_block == foreground_label, 0, 1 ), numpy.float32 )
+        if (background_block == 0.0).any():
+            background_block_view = background_block.view( vigra.VigraArray )
+            background_block_view.axistags = copy.copy( laneView.RavelerLabels.meta.axistags )
+            background_block_view_3d = background_block_view.bindAxis('t', 0).bindAxis('c', 0)
+            distance_transformed_block = vigra.filters.distanceTransform(background_block_view_3d, background=False)
+            background_seed_block = (distance_transformed_block.astype( numpy.uint8 ) == OpSplitBodyCarving.SEED_MARGIN)
+            background_seed_block = background_seed_block.astype(numpy.uint8)
+            axisorder = laneView.RavelerLabels.meta.getTaggedShape().keys()
+            laneView.WriteSeeds[ roiToSlice( *block_roi ) ] = background_seed_block.withAxes(*axisorder)
+
+def random_bodies(shape, num_bodies, seed=0):
+    """
+    A tzyxc label volume of a few blob-shaped bodies (label 0 is the space between them).
+    """
+    rng = numpy.random.RandomState(seed)
+    labels = numpy.zeros( shape[1:4], dtype=numpy.uint32 )
+    coords = numpy.ogrid[ tuple(slice(0, s) for s in shape[1:4]) ]
+    for label in range(1, num_bodies+1):
+        center = [ rng.randint(0, s) for s in shape[1:4] ]
+        radius = rng.randint(5, 20)
+        distance = sum( (c - m)**2 for c, m in zip(coords, center) )
+        labels[distance < radius**2] = label
+    labels = labels[None, ..., None]
+    return vigra.taggedView( labels, 'tzyxc' )
+
+class TestLabelBoundingBoxes(object):
+
+    def testAgainstWhere(self):
+        labels = random_bodies( (1, 90, 100, 110, 1), 20 )
+        op = OpArrayPiper( graph=Graph() )
+        op.Input.setValue( labels )
+        boxes = LabelBoundingBoxes.from_slot( op.Output, block_shape=(1, 32, 40, 50, 1) )
+
+        for label in range(0, 25):
+            coords = numpy.where( labels == label )
+            if len(coords[0]) == 0:
+                assert boxes.bounding_box( label ) is None
+                continue
+            start = tuple( c.min() for c in coords )
+            stop = tuple( c.max() + 1 for c in coords )
+            assert boxes.bounding_box( label ) == (start, stop), \
+                "Wrong bounding box for label {}: {} != {}".format( label, boxes.bounding_box( label ), (start, stop) )
+
+class TestAutoSeedBackground(object):
+
+    def setUp(self):
+        self._blockSize = OpSplitBodyCarving.BLOCK_SIZE
+        self._batchSize = OpSplitBodyCarving.SEED_BATCH_SIZE
+        # Small blocks and batches, to get many of them
+        OpSplitBodyCarving.BLOCK_SIZE = 30
+        OpSplitBodyCarving.SEED_BATCH_SIZE = 3
+
+    def tearDown(self):
+        OpSplitBodyCarving.BLOCK_SIZE = self._blockSize
+        OpSplitBodyCarving.SEED_BATCH_SIZE = self._batchSize
+
+    def testAgainstSerial(self):
+        labels = random_bodies( (1, 100, 100, 100, 1), 10 )
+        for label in range(1, 11):
+            expected = FakeLaneView( labels )
+            serial_auto_seed( expected, label )
+
+            laneView = FakeLaneView( labels )
+            OpSplitBodyCarving.autoSeedBackground( laneView, label )
+            assert (laneView.WriteSeeds == expected.WriteSeeds).all(), \
+                "Seeds for label {} differ".format( label )
+
+    def testMissingLabel(self):
+        laneView = FakeLaneView( random_bodies( (1, 50, 50, 50, 1), 3 ) )
+        OpSplitBodyCarving.autoSeedBackground( laneView, 99 )
+        assert (laneView.WriteSeeds == 0).all()
+
+class TestAutoSeedBackgroundBenchmarking(object):
+
+    @classmethod
+    def setupClass(cls):
+        # This test is useful for performance evaluation,
+        #  but it takes too long to be useful as part of the normal test suite.
+        raise nose.SkipTest
+
+    def testSeedingTime(self):
+        labels = random_bodies( (1, 1000, 1000, 1000, 1), 50 )
+        for name, seed_fn in ( ('serial', serial_auto_seed),
+                               ('bounding box', OpSplitBodyCarving.autoSeedBackground) ):
+            laneView = FakeLaneView( labels )
+            start = time.time()
+            laneView.getRavelerBoundingBoxes()
+            logger.info("{}: bounding box index took {:.1f}s".format( name, time.time() - start ))
+            start = time.time()
+            for label in range(1, 11):
+                seed_fn( laneView, label )
+            logger.info("{}: {:.2f}s per body".format( name, (time.time() - start) / 10 ))
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
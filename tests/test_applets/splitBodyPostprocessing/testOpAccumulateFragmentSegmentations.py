@@ -0,0 +1,136 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2016, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import time
+import resource
+
+import numpy
+import vigra
+import nose
+
+from lazyflow.graph import Graph
+from lazyflow.operators.valueProviders import OpMetadataInjector
+
+from ilastik.applets.splitBodyPostprocessing.opSplitBodyPostprocessing import \
+    OpAccumulateFragmentSegmentations, OpBlockwiseAccumulateFragmentSegmentations
+
+import logging
+logger = logging.getLogger(__name__)
+
+def synthetic_bodies(shape, num_bodies, seed=0):
+    """
+    Raveler labels (blocks of constant label) and, for some of the bodies,
+    a fragment segmentation within the body (in 'txyzc' order).
+    """
+    rng = numpy.random.RandomState(seed)
+    raveler = numpy.zeros( (1,) + shape + (1,), dtype=numpy.uint32 )
+    body_ids = rng.choice( numpy.arange(1, 1000), size=num_bodies, replace=False )
+    edges = [ numpy.sort( rng.randint(0, s, size=num_bodies) ) for s in shape ]
+    for i, body_id in enumerate(body_ids):
+        start = [e[i] // 2 for e in edges]
+        stop = [e[i] + (s - e[i]) // 2 + 1 for e, s in zip(edges, shape)]
+        raveler[0, start[0]:stop[0], start[1]:stop[1], start[2]:stop[2], 0] = body_id
+
+    fragments = []
+    for body_id in body_ids:
+        mask = (raveler == body_id)
+        fragment_labels = rng.randint(1, rng.randint(2, 10), size=raveler.shape).astype(numpy.uint32)
+        fragments.append( (body_id, numpy.where(mask, fragment_labels, 0).astype(numpy.uint32)) )
+    # One body without any fragments
+    fragments.append( (body_ids[0], numpy.zeros_like(raveler)) )
+    return vigra.taggedView(raveler, 'txyzc'), fragments
+
+class TestOpBlockwiseAccumulateFragmentSegmentations(object):
+
+    def _connect(self, op, raveler, fragments):
+        op.RavelerLabels.setValue( raveler )
+        op.FragmentSegmentations.resize( len(fragments) )
+        for i, (body_id, fragment_image) in enumerate(fragments):
+            opMeta = OpMetadataInjector( graph=op.graph )
+            opMeta.Input.setValue( vigra.taggedView(fragment_image, 'txyzc') )
+            opMeta.Metadata.setValue( { 'selected_label' : body_id } )
+            op.FragmentSegmentations[i].connect( opMeta.Output )
+
+    def testAgainstWholeImage(self):
+        raveler, fragments = synthetic_bodies( (30, 40, 20), 6 )
+        graph = Graph()
+        opExpected = OpAccumulateFragmentSegmentations( graph=graph )
+        self._connect( opExpected, raveler, fragments )
+        expected = opExpected.Output[:].wait()
+        expected_mapping = opExpected.Mapping.value
+
+        op = OpBlockwiseAccumulateFragmentSegmentations( graph=graph )
+        self._connect( op, raveler, fragments )
+        op.BlockShape.setValue( (1, 7, 9, 11, 1) )
+
+        # The mapping is available before the output is computed
+        assert op.Mapping.value == expected_mapping
+        assert (op.Output[:].wait() == expected).all()
+        assert (op.Output[:, 5:23, 3:31, 2:19, :].wait() == expected[:, 5:23, 3:31, 2:19, :]).all()
+
+        # default block shape
+        op.BlockShape.disconnect()
+        assert (op.Output[:].wait() == expected).all()
+
+    def testNoBodies(self):
+        raveler, _ = synthetic_bodies( (10, 10, 10), 3 )
+        op = OpBlockwiseAccumulateFragmentSegmentations( graph=Graph() )
+        self._connect( op, raveler, [] )
+        assert (op.Output[:].wait() == raveler).all()
+        assert op.Mapping.value.items() == [((0, raveler.max()+1), -1)]
+
+class TestOpBlockwiseAccumulateFragmentSegmentationsBenchmarking(object):
+    """
+    Time and peak memory of the whole-image vs. the blockwise accumulation, for 50 bodies on a 1 GB volume.
+    Run the two cases in separate processes to compare their peak memory.
+    """
+
+    @classmethod
+    def setupClass(cls):
+        # This test is useful for performance evaluation,
+        #  but it takes too long to be useful as part of the normal test suite.
+        raise nose.SkipTest
+
+    def _run(self, opClass):
+        # (All bodies share one fragment image, 50 different ones wouldn't fit into memory.)
+        raveler, fragments = synthetic_bodies( (640, 640, 610), 1 )
+        fragment_image = numpy.where( raveler, fragments[0][1] + 1, 0 ).astype(numpy.uint32)
+        fragments = [ (body_id, fragment_image) for body_id in range(1, 51) ]
+        op = opClass( graph=Graph() )
+        TestOpBlockwiseAccumulateFragmentSegmentations()._connect( op, raveler, fragments )
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        op.Output[:].wait()
+        logger.info("{}: {:.1f}s, peak memory grew by {} MB"
+                    .format(opClass.__name__, time.time() - start,
+                            (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) // 1024))
+
+    def testWholeImage(self):
+        self._run( OpAccumulateFragmentSegmentations )
+
+    def testBlockwise(self):
+        self._run( OpBlockwiseAccumulateFragmentSegmentations )
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,96 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2016, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import time
+import collections
+
+import numpy
+import nose
+
+from ilastik.applets.splitBodySupervoxelExport.opSplitBodySupervoxelExport import supervoxel_transform_table
+
+import logging
+logger = logging.getLogger(__name__)
+
+def synthetic_mapping(num_raveler_labels, fragment_counts, seed=0):
+    """
+    A mapping like the one of OpAccumulateFragmentSegmentations:
+    the raveler labels, then a range of fragment labels for each edited body.
+    """
+    rng = numpy.random.RandomState(seed)
+    mapping = collections.OrderedDict()
+    mapping[(0, num_raveler_labels)] = -1
+    start = num_raveler_labels
+    for count in fragment_counts:
+        mapping[(start, start+count)] = int(rng.randint(1, num_raveler_labels))
+        start += count
+    return mapping
+
+def loop_transform_table(mapping):
+    """
+    The table as it used to be built: one supervoxel at a time.
+    """
+    num_labels = mapping.keys()[-1][1]
+    transform = numpy.zeros( shape=(num_labels, 2), dtype=numpy.uint32 )
+    for (start, stop), body_id in mapping.items():
+        for supervoxel_label in range(start, stop):
+            transform[supervoxel_label][0] = supervoxel_label
+            if body_id == -1:
+                transform[supervoxel_label][1] = supervoxel_label
+            else:
+                transform[supervoxel_label][1] = body_id
+    return transform
+
+class TestSupervoxelTransformTable(object):
+
+    def testAgainstLoop(self):
+        # (including a body without fragments)
+        mapping = synthetic_mapping( 1000, [5, 17, 0, 300, 1] )
+        transform = supervoxel_transform_table( mapping )
+        assert transform.dtype == numpy.uint32
+        assert (transform == loop_transform_table(mapping)).all()
+
+    def testOnlyRavelerLabels(self):
+        mapping = synthetic_mapping( 10, [] )
+        transform = supervoxel_transform_table( mapping )
+        assert (transform == numpy.array( [numpy.arange(10)]*2 ).T).all()
+
+class TestSupervoxelTransformTableBenchmarking(object):
+
+    @classmethod
+    def setupClass(cls):
+        # This test is useful for performance evaluation,
+        #  but it takes too long to be useful as part of the normal test suite.
+        raise nose.SkipTest
+
+    def testTiming(self):
+        # 10^7 labels
+        mapping = synthetic_mapping( 5*10**6, [10**5] * 50 )
+        for fn in (loop_transform_table, supervoxel_transform_table):
+            start = time.time()
+            fn( mapping )
+            logger.info("{}: {:.2f}s".format( fn.__name__, time.time() - start ))
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,126 @@
+import time
+import resource
+
+import numpy
+import vigra
+import nose
+from nose.tools import raises
+
+from ilastik.applets.thresholdTwoLevels.ipht import identity_preserving_hysteresis_thresholding, \
+                                                    blockwise_identity_preserving_hysteresis_thresholding
+
+import logging
+logger = logging.getLogger(__name__)
+
+def blobs(shape, num_blobs, sigma=3.0, seed=0):
+    """
+    Smooth random blobs (many of them crossing tile boundaries), normalized to [0, 1].
+    """
+    rng = numpy.random.RandomState(seed)
+    img = numpy.zeros(shape, dtype=numpy.float32)
+    points = tuple( rng.randint(0, s, size=num_blobs) for s in shape )
+    img[points] = rng.uniform(0.5, 1.0, size=num_blobs)
+    axes = 'xyz'[:len(shape)]
+    img = vigra.filters.gaussianSmoothing(vigra.taggedView(img, axes), sigma)
+    img /= img.max()
+    return img
+
+def same_partition(labels_a, labels_b):
+    labels_a = numpy.asarray(labels_a).reshape(-1).astype(numpy.uint64)
+    labels_b = numpy.asarray(labels_b).reshape(-1).astype(numpy.uint64)
+    if ((labels_a == 0) != (labels_b == 0)).any():
+        return False
+    pairs = numpy.unique( (labels_a << numpy.uint64(32)) | labels_b )
+    return len(pairs) == len(numpy.unique(labels_a)) == len(numpy.unique(labels_b))
+
+class TestBlockwiseIpht(object):
+
+    def _check(self, img, block_shape, high=0.5, low=0.2, min_size=0, max_size=None):
+        expected = identity_preserving_hysteresis_thresholding(img, high, low, min_size, max_size)
+        result = blockwise_identity_preserving_hysteresis_thresholding(img, high, low, min_size, max_size,
+                                                                       block_shape=block_shape, halo=16)
+        assert result.shape == img.shape
+        assert same_partition(result, expected)
+        return result
+
+    def test3d(self):
+        img = blobs((100, 90, 80), 60)
+        result = self._check(img, (32, 32, 32))
+        assert len(numpy.unique(result)) > 10
+
+    def test2d(self):
+        img = blobs((300, 200), 50)
+        self._check(img, (64, 50))
+        self._check(img, (300, 200))
+
+    def testSizeFilter(self):
+        img = blobs((100, 90, 80), 60)
+        labels = identity_preserving_hysteresis_thresholding(img, 0.5, 0.2, 0)
+        sizes = numpy.bincount(labels.view(numpy.ndarray).reshape(-1))[1:]
+        sizes = numpy.sort(sizes[sizes > 0])
+        median = sizes[len(sizes) // 2]
+
+        self._check(img, (32, 32, 32), min_size=median)
+        self._check(img, (32, 32, 32), max_size=median)
+        self._check(img, (32, 32, 32), min_size=sizes[-1] + 1)
+
+    def testTouchingObjects(self):
+        # Two seeds in a shared low-threshold region, on both sides of a tile boundary
+        img = numpy.zeros((64, 64), dtype=numpy.float32)
+        img[10:50, 10:54] = 0.3
+        img[20:40, 20:28] = 0.9
+        img[20:40, 36:44] = 0.8
+        img = vigra.filters.gaussianSmoothing(vigra.taggedView(img, 'xy'), 1.0)
+        result = self._check(img, (32, 32))
+        assert len(numpy.unique(result)) == 3
+
+    def testOut(self):
+        img = blobs((60, 60, 60), 20)
+        out = vigra.VigraArray(img.shape, dtype=numpy.uint32, axistags=img.axistags)
+        result = blockwise_identity_preserving_hysteresis_thresholding(img, 0.5, 0.2, 0, out=out, block_shape=(32, 32, 32))
+        assert result is out
+
+    def testHaloLargerThanTiles(self):
+        # The tiles are enlarged to the halo, the halo is not clipped to the tiles
+        img = blobs((300, 200), 50)
+        expected = identity_preserving_hysteresis_thresholding(img, 0.5, 0.2, 0)
+        result = blockwise_identity_preserving_hysteresis_thresholding(img, 0.5, 0.2, 0, block_shape=(8, 64), halo=16)
+        assert same_partition(result, expected)
+
+    @raises(ValueError)
+    def testNoHalo(self):
+        img = blobs((64, 64), 5)
+        blockwise_identity_preserving_hysteresis_thresholding(img, 0.5, 0.2, 0, block_shape=(32, 32), halo=0)
+
+class TestBlockwiseIphtBenchmarking(object):
+    """
+    Peak memory and runtime of the blockwise vs. the whole-image thresholding.
+    Run the two implementations in separate processes to compare their peak memory.
+    """
+
+    @classmethod
+    def setupClass(cls):
+        # This test is useful for performance evaluation,
+        #  but it takes too long to be useful as part of the normal test suite.
+        raise nose.SkipTest
+
+    def testPeakMemory(self):
+        for side in (1024, 1448, 2048, 2896):  # 1, 2, 4 and 8 GB
+            img = vigra.VigraArray((side, side, 256), dtype=numpy.float32, axistags=vigra.defaultAxistags('xyz'))
+            for z in range(0, 256, 64):
+                img[..., z:z+64] = blobs((side, side, 64), side, seed=z)
+            out = vigra.VigraArray(img.shape, dtype=numpy.uint32, axistags=img.axistags)
+
+            before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            start = time.time()
+            blockwise_identity_preserving_hysteresis_thresholding(img, 0.5, 0.2, 10, out=out)
+            logger.info("{:.1f} GB: {:.1f}s, peak memory grew by {} MB"
+                        .format(img.nbytes / 1e9, time.time() - start,
+                                (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) // 1024))
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
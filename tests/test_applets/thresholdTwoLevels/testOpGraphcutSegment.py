@@ -37,6 +37,8 @@ from lazyflow.operators.opArrayPiper import OpArrayPiper
 if have_opengm:
     from ilastik.applets.thresholdTwoLevels.opGraphcutSegment\
         import OpObjectsSegment, OpGraphCut
+    from ilastik.applets.thresholdTwoLevels import _OpObjectsSegment
+    from ilastik.applets.thresholdTwoLevels._OpObjectsSegment import splitBox
 
 def getTestVolume():
     t, c = 3, 2
@@ -163,6 +165,47 @@ class TestOpObjectsSegment(unittest.TestCase):
         assert_array_equal(out[45:75, 55:85, 3] > 0, vol[45:75, 55:85, 3] > .5)
         assert np.all(out[:40, ...] == 0)
 
+    def testSplitBox(self):
+        shape = (50, 40, 30)
+        boxes = splitBox(shape, 20000, (5, 5, 5))
+        assert len(boxes) > 1
+        covered = np.zeros(shape, dtype=np.uint8)
+        for core, subbox in boxes:
+            covered[core] += 1
+            assert np.prod([s.stop - s.start for s in subbox]) <= 20000
+            for c, s, n in zip(core, subbox, shape):
+                assert s.start == max(c.start - 5, 0)
+                assert s.stop == min(c.stop + 5, n)
+        # the cores partition the box
+        assert np.all(covered == 1)
+
+        # small boxes are not split
+        assert len(splitBox(shape, 50*40*30, (5, 5, 5))) == 1
+        # neither are boxes where the overlap dominates
+        assert len(splitBox((40, 40, 40), 10000, (20, 20, 20))) == 1
+
+    def testSplitObjects(self):
+        # objects that are too large for a single graph cut are split up
+        maxBoxSize = _OpObjectsSegment.MAXBOXSIZE
+        _OpObjectsSegment.MAXBOXSIZE = 10000
+        try:
+            graph = Graph()
+            op = OpObjectsSegment(graph=graph)
+            piper = OpArrayPiper(graph=graph)
+            piper.Input.setValue(self.vol)
+            op.Prediction.connect(piper.Output)
+            op.LabelImage.setValue(self.labels)
+            op.Margin.setValue(np.asarray((5, 5, 5)))
+
+            out = op.Output[0, ..., 0].wait()
+            out = vigra.taggedView(out, axistags=op.Output.meta.axistags)
+            out = out.withAxes(*'xyz')
+            assert np.all(out[22:38, 22:38, 22:38] > 0)
+            assert np.all(out[62:78, 62:78, 62:78] > 0)
+            assert np.all(out[:15, ...] == 0)
+        finally:
+            _OpObjectsSegment.MAXBOXSIZE = maxBoxSize
+
     def testFaulty(self):
         vec = vigra.taggedView(np.zeros((500,), dtype=np.float32),
                                axistags=vigra.defaultAxistags('x'))
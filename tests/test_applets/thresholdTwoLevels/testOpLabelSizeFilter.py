@@ -0,0 +1,154 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2016, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import time
+
+import numpy
+from numpy.testing import assert_array_equal
+import vigra
+np = numpy
+
+from lazyflow.graph import Graph
+from lazyflow.operators import OpArrayPiper, OpFilterLabels
+
+from ilastik.applets.thresholdTwoLevels.thresholdingTools import OpLabelSizeFilter
+
+import ilastik.ilastik_logging
+ilastik.ilastik_logging.default_config.init()
+import unittest
+
+
+def random_labels(shape, seed=0):
+    """
+    Connected components of thresholded noise, in 'txyzc' order.
+    """
+    rng = numpy.random.RandomState(seed)
+    labels = numpy.zeros(shape, dtype=numpy.uint32)
+    for t in range(shape[0]):
+        for c in range(shape[4]):
+            mask = rng.uniform(size=shape[1:4]) > 0.6
+            labels[t, ..., c] = vigra.analysis.labelVolumeWithBackground(mask.astype(numpy.uint8))
+    return vigra.taggedView(labels, axistags='txyzc')
+
+
+def filter_sizes(labels, minSize, maxSize):
+    """
+    The expected result, for each t/c volume.
+    """
+    result = numpy.zeros_like(labels)
+    for t in range(labels.shape[0]):
+        for c in range(labels.shape[4]):
+            volume = labels[t, ..., c].view(numpy.ndarray)
+            sizes = numpy.bincount(volume.reshape(-1))
+            good = (sizes >= minSize) & (sizes <= maxSize)
+            result[t, ..., c] = numpy.where(good[volume], volume, 0)
+    return result
+
+
+class TestOpLabelSizeFilter(unittest.TestCase):
+
+    def setUp(self):
+        self.labels = random_labels((2, 30, 40, 20, 2))
+
+        g = Graph()
+        self.piper = OpArrayPiper(graph=g)
+        self.piper.Input.setValue(self.labels)
+        self.op = OpLabelSizeFilter(graph=g)
+        self.op.Input.connect(self.piper.Output)
+
+    def testFilter(self):
+        for minSize, maxSize in [(0, 100000), (3, 10), (5, 5), (20, 100000)]:
+            self.op.MinLabelSize.setValue(minSize)
+            self.op.MaxLabelSize.setValue(maxSize)
+            out = self.op.Output[:].wait()
+            assert_array_equal(out, filter_sizes(self.labels, minSize, maxSize))
+
+    def testBinary(self):
+        self.op.MinLabelSize.setValue(3)
+        self.op.MaxLabelSize.setValue(10)
+        self.op.BinaryOut.setValue(True)
+        out = self.op.Output[:].wait()
+        assert_array_equal(out, filter_sizes(self.labels, 3, 10) != 0)
+
+    def testRoi(self):
+        # sizes are counted over the whole volume, not just the roi
+        self.op.MinLabelSize.setValue(3)
+        self.op.MaxLabelSize.setValue(10)
+        out = self.op.Output[1:2, 5:17, 10:30, 3:11, 0:1].wait()
+        expected = filter_sizes(self.labels, 3, 10)
+        assert_array_equal(out, expected[1:2, 5:17, 10:30, 3:11, 0:1])
+
+    def testSizesAreKept(self):
+        self.op.MinLabelSize.setValue(3)
+        self.op.MaxLabelSize.setValue(10)
+        self.op.Output[:].wait()
+        sizes = dict(self.op._sizes)
+        assert len(sizes) == 4
+
+        # changing the size range doesn't count again
+        self.op.MinLabelSize.setValue(5)
+        self.op.MaxLabelSize.setValue(50)
+        out = self.op.Output[:].wait()
+        assert all(self.op._sizes[key] is sizes[key] for key in sizes)
+        assert_array_equal(out, filter_sizes(self.labels, 5, 50))
+
+        # changing the labels does
+        self.labels[0, ..., 0] = random_labels((1, 30, 40, 20, 1), seed=1)[0, ..., 0]
+        self.piper.Input.setDirty((0, 0, 0, 0, 0), (1, 30, 40, 20, 1))
+        assert (0, 0) not in self.op._sizes
+        assert self.op._sizes[(1, 1)] is sizes[(1, 1)]
+        out = self.op.Output[:].wait()
+        assert_array_equal(out, filter_sizes(self.labels, 5, 50))
+
+
+class TestOpLabelSizeFilterBenchmarking(unittest.TestCase):
+    """
+    Time per change of the size range, for OpFilterLabels (counting the sizes each time)
+    and OpLabelSizeFilter (counting them once).
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        # This test is useful for performance evaluation,
+        #  but it takes too long to be useful as part of the normal test suite.
+        raise unittest.SkipTest("Benchmark")
+
+    def testParameterChanges(self):
+        labels = random_labels((1, 512, 512, 128, 1))
+        for opClass in (OpFilterLabels, OpLabelSizeFilter):
+            op = opClass(graph=Graph())
+            op.Input.setValue(labels)
+            op.MaxLabelSize.setValue(1000000)
+            op.MinLabelSize.setValue(0)
+            op.Output[:].wait()
+
+            start = time.time()
+            for minSize in range(1, 11):
+                op.MinLabelSize.setValue(minSize)
+                op.Output[:].wait()
+            print("{}: {:.2f}s per change".format(opClass.__name__, (time.time() - start) / 10))
+
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -31,11 +31,15 @@ from ilastik.applets.thresholdTwoLevels.opThresholdTwoLevels\
     import _OpThresholdOneLevel as OpThresholdOneLevel
 from ilastik.applets.thresholdTwoLevels.opThresholdTwoLevels\
     import _OpThresholdTwoLevels as OpThresholdTwoLevels5d
+from ilastik.applets.thresholdTwoLevels.opThresholdTwoLevels\
+    import _OpThresholdTwoLevelsFused as OpThresholdTwoLevelsFused5d
 from ilastik.applets.thresholdTwoLevels.opGraphcutSegment import haveGraphCut
 
 import ilastik.ilastik_logging
 ilastik.ilastik_logging.default_config.init()
 import unittest
+import time
+import resource
 
 from testOpGraphcutSegment import have_opengm
 
@@ -644,6 +648,95 @@ class TestThresholdTwoLevels(Generator2):
             oper.CurOperator.setValue(0)
 
 
+class TestThresholdTwoLevelsFused(Generator2):
+
+    def testAgainstChained(self):
+        g = Graph()
+        smoothed = vigra.filters.gaussianSmoothing(
+            self.data5d[0, ..., 0].astype(numpy.float32), 0.3, window_size=2.0)
+        smoothed = vigra.taggedView(smoothed, axistags='xyz').withAxes(*'txyzc')
+
+        chained = OpThresholdTwoLevels5d(graph=g)
+        chained.InputImage.setValue(smoothed)
+        fused = OpThresholdTwoLevelsFused5d(graph=g)
+        fused.InputImage.setValue(self.data5d[0:1, ...])
+        fused.Sigmas.setValue(self.sigma)
+
+        for op in (chained, fused):
+            op.MinSize.setValue(self.minSize)
+            op.MaxSize.setValue(self.maxSize)
+            op.HighThreshold.setValue(self.highThreshold)
+            op.LowThreshold.setValue(self.lowThreshold)
+
+        expected = chained.Output[:].wait()
+        output = fused.Output[:].wait()
+        numpy.testing.assert_array_equal(output, expected)
+
+        # a roi gets the same labels as the whole volume
+        numpy.testing.assert_array_equal(fused.Output[:, 10:30, 5:40, 20:30, :].wait(),
+                                         expected[:, 10:30, 5:40, 20:30, :])
+
+        output = vigra.taggedView(output, axistags=fused.Output.meta.axistags)
+        self.checkResult(output)
+
+    def testTopLevel(self):
+        oper5d = OpThresholdTwoLevels(graph=Graph())
+        oper5d.InputImage.setValue(self.data5d)
+        oper5d.MinSize.setValue(self.minSize)
+        oper5d.MaxSize.setValue(self.maxSize)
+        oper5d.HighThreshold.setValue(self.highThreshold)
+        oper5d.LowThreshold.setValue(self.lowThreshold)
+        oper5d.SmootherSigma.setValue(self.sigma)
+        oper5d.Channel.setValue(0)
+        oper5d.CurOperator.setValue(1)
+
+        expected = oper5d.CachedOutput[:].wait()
+        oper5d.FusedTwoLevels.setValue(True)
+        assert not oper5d.BigRegions.ready()
+        numpy.testing.assert_array_equal(oper5d.CachedOutput[:].wait(), expected)
+        numpy.testing.assert_array_equal(oper5d.Output[:].wait(), expected)
+
+
+class TestThresholdTwoLevelsFusedBenchmarking(unittest.TestCase):
+    """
+    Runtime and peak memory of the chained vs. the fused two-level thresholding.
+    Run the two in separate processes (-m ...:testChained / testFused) to compare their peak memory.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        # This test is useful for performance evaluation,
+        #  but it takes too long to be useful as part of the normal test suite.
+        raise unittest.SkipTest("Benchmark")
+
+    def _run(self, fused):
+        rng = numpy.random.RandomState(0)
+        data = rng.uniform(0, 1, size=(512, 512, 256)).astype(numpy.float32)
+        data = vigra.taggedView(data, axistags='xyz')
+
+        oper5d = OpThresholdTwoLevels(graph=Graph())
+        oper5d.InputImage.setValue(data)
+        oper5d.MinSize.setValue(10)
+        oper5d.MaxSize.setValue(100000)
+        oper5d.HighThreshold.setValue(0.7)
+        oper5d.LowThreshold.setValue(0.4)
+        oper5d.SmootherSigma.setValue({'x': 2.0, 'y': 2.0, 'z': 2.0})
+        oper5d.CurOperator.setValue(1)
+        oper5d.FusedTwoLevels.setValue(fused)
+
+        start = time.time()
+        oper5d.CachedOutput[:].wait()
+        print("{}: {:.1f}s, peak memory {} MB".format(
+            "fused" if fused else "chained", time.time() - start,
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024))
+
+    def testChained(self):
+        self._run(False)
+
+    def testFused(self):
+        self._run(True)
+
+
 class TestThresholdGC(Generator2):
 
     @unittest.skipIf(not have_opengm, "OpenGM not available")
@@ -0,0 +1,139 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2016, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import numpy as np
+
+from ilastik.applets.tracking.base.lineageGraph import LineageGraph
+
+
+def make_lineage(num_frames=12, num_roots=5, division_rate=0.3, seed=0):
+    """
+    Simulate a lineage the way _setLabel2Color(export_mode=True) numbers it:
+    every appearance and every daughter cell gets the next free track id.
+    Returns the division list and the per-frame {label: track} dicts.
+    """
+    rng = np.random.RandomState(seed)
+    max_id = 2
+    alive = []
+    for _ in range(num_roots):
+        alive.append(max_id)
+        max_id += 1
+
+    track_ids = [dict((label + 1, track) for label, track in enumerate(alive))]
+    divisions = []
+    for t in range(1, num_frames):
+        next_alive = []
+        for label, track in enumerate(alive):
+            if rng.rand() < division_rate:
+                divisions.append((t, label + 1, track,
+                                  len(next_alive) + 1, max_id,
+                                  len(next_alive) + 2, max_id + 1))
+                next_alive += [max_id, max_id + 1]
+                max_id += 2
+            else:
+                next_alive.append(track)
+        alive = next_alive
+        track_ids.append(dict((label + 1, track) for label, track in enumerate(alive)))
+    return divisions, track_ids
+
+
+def reference_children(divisions, track_id):
+    for _, _, track, _, child1, _, child2 in divisions:
+        if track == track_id:
+            return [child1, child2] + reference_children(divisions, child1) + reference_children(divisions, child2)
+    return []
+
+
+def reference_parents(divisions, track_id):
+    for _, _, track, _, child1, _, child2 in divisions:
+        if track_id in (child1, child2):
+            return [track] + reference_parents(divisions, track)
+    return []
+
+
+class TestLineageGraph(object):
+    def setUp(self):
+        self.divisions, self.track_ids = make_lineage()
+        self.graph = LineageGraph(self.divisions, self.track_ids)
+        self.all_tracks = sorted(set(v for d in self.track_ids for v in d.values()))
+
+    def testDescendants(self):
+        assert len(self.divisions) > 0
+        for track in self.all_tracks:
+            assert self.graph.descendants(track) == reference_children(self.divisions, track)
+
+    def testAncestors(self):
+        for track in self.all_tracks:
+            assert self.graph.ancestors(track) == reference_parents(self.divisions, track)
+
+    def testRoots(self):
+        roots = self.graph.roots()
+        for track in self.all_tracks:
+            chain = reference_parents(self.divisions, track)
+            expected = chain[-1] if chain else track
+            assert roots[track] == expected
+
+    def testTrackIds(self):
+        times = []
+        labels = []
+        expected = []
+        for t, mapping in enumerate(self.track_ids):
+            for label, track in mapping.items():
+                times.append(t)
+                labels.append(label)
+                expected.append(track)
+        assert (self.graph.track_ids_at(times, labels) == expected).all()
+        # unknown objects are not part of any track
+        assert self.graph.track_id(len(self.track_ids), 1) == LineageGraph.NO_TRACK
+        assert self.graph.track_id(0, 10000) == LineageGraph.NO_TRACK
+
+    def testLastDivision(self):
+        # (t, oid, track, child_oid1, child_track1, child_oid2, child_track2), in the order of the events
+        divisions = [(1, 1, 2, 1, 4, 2, 5),
+                     (2, 2, 5, 2, 6, 3, 7),
+                     (3, 1, 4, 1, 8, 2, 9)]
+        track_ids = [{1: 2, 2: 3},
+                     {1: 4, 2: 5, 3: 3},
+                     {1: 4, 2: 6, 3: 7, 4: 3},
+                     {1: 8, 2: 9, 3: 6, 4: 7, 5: 3}]
+        graph = LineageGraph(divisions, track_ids)
+
+        # The daughters of the last division have parents, too
+        # (OpTrackingBase.track_parent used to skip the last division).
+        assert graph.ancestors(8) == [4, 2]
+        assert graph.ancestors(9) == [4, 2]
+        assert graph.ancestors(6) == [5, 2]
+        assert graph.ancestors(3) == []
+        assert graph.descendants(2) == [4, 5, 8, 9, 6, 7]
+        assert graph.descendants(4) == [8, 9]
+        assert graph.family(9) == ([], [4, 2])
+
+    def testEmpty(self):
+        graph = LineageGraph([])
+        assert graph.family(5) == ([], [])
+        assert graph.track_id(0, 1) == LineageGraph.NO_TRACK
+
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
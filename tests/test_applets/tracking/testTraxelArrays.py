@@ -0,0 +1,188 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2016, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import time
+
+import numpy as np
+import nose
+
+from ilastik.applets.objectExtraction.opObjectExtraction import default_features_key
+from ilastik.applets.objectExtraction import config
+from ilastik.applets.tracking.base.traxelArrays import frame_traxel_arrays
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def make_frame(num_objects, ndim, seed=0):
+    rng = np.random.RandomState(seed)
+    # row 0 is the background
+    centers = rng.uniform(0, 100, size=(num_objects + 1, ndim)).astype(np.float32)
+    feats = {default_features_key: {'RegionCenter': centers,
+                                    'Coord<Minimum>': np.floor(centers - 3),
+                                    'Coord<Maximum>': np.ceil(centers + 3),
+                                    'Count': rng.randint(1, 200, size=(num_objects + 1, 1)).astype(np.float32)},
+             config.features_vigra_name: {'RegionCenter_corr': centers + 0.5}}
+    div_probs = rng.rand(num_objects + 1, 2).astype(np.float32)
+    det_probs = rng.rand(num_objects + 1, 3).astype(np.float32)
+    # values that need clipping
+    det_probs[1:, 0] = 0.0
+    det_probs[2:, 1] = 1.0
+    local_centers = [rng.rand(rng.randint(1, 4), 3) for _ in range(num_objects + 1)]
+    return feats, div_probs, det_probs, local_centers
+
+
+def reference_traxels(feats, x_range, y_range, z_range, size_range, div_probs, det_probs, local_centers):
+    """
+    The per-object feature filling _generate_traxelstore() used to do,
+    recording the values instead of writing them to pgmlink.
+    """
+    rc = feats[default_features_key]['RegionCenter'][1:]
+    lower = feats[default_features_key]['Coord<Minimum>'][1:]
+    upper = feats[default_features_key]['Coord<Maximum>'][1:]
+    rc_corr = feats[config.features_vigra_name]['RegionCenter_corr'][1:]
+    ct = feats[default_features_key]['Count'][1:]
+
+    traxels = []
+    filtered = []
+    for idx in range(rc.shape[0]):
+        if len(rc[idx]) == 2:
+            x, y = rc[idx]
+            z = 0
+        else:
+            x, y, z = rc[idx]
+        size = ct[idx]
+        if (x < x_range[0] or x >= x_range[1] or
+                y < y_range[0] or y >= y_range[1] or
+                z < z_range[0] or z >= z_range[1] or
+                size < size_range[0] or size >= size_range[1]):
+            filtered.append(idx + 1)
+            continue
+
+        values = {}
+        def set_values(name, length, items):
+            values[name] = [0.0] * length
+            for i, v in enumerate(items):
+                values[name][i] = float(v)
+
+        set_values('com', 3, [x, y, z])
+        set_values('CoordMinimum', 3, lower[idx])
+        set_values('CoordMaximum', 3, upper[idx])
+        set_values('com_corrected', 3, rc_corr[idx])
+        set_values('divProb', 1, [div_probs[idx + 1][1]])
+        set_values('detProb', len(det_probs[idx + 1]),
+                   [min(max(float(v), 0.0000001), 0.99999999) for v in det_probs[idx + 1]])
+        centers = local_centers[idx + 1]
+        set_values('localCentersX', len(centers), [v[0] for v in centers])
+        set_values('localCentersY', len(centers), [v[1] for v in centers])
+        set_values('localCentersZ', len(centers), [v[2] for v in centers])
+        set_values('count', 1, [size])
+        traxels.append((idx + 1, values))
+    return traxels, filtered
+
+
+class TestFrameTraxelArrays(object):
+    def _check(self, ndim):
+        feats, div_probs, det_probs, local_centers = make_frame(500, ndim)
+        ranges = ((10, 90), (0, 80), (0, 1000) if ndim == 3 else (0, 1), (20, 150))
+
+        expected, expected_filtered = reference_traxels(feats, *ranges, div_probs=div_probs,
+                                                        det_probs=det_probs, local_centers=local_centers)
+        object_ids, features, filtered = frame_traxel_arrays(feats, *ranges, with_opt_correction=True,
+                                                             div_probs=div_probs, det_probs=det_probs,
+                                                             local_centers=local_centers)
+
+        assert filtered == expected_filtered
+        assert list(object_ids) == [oid for oid, _ in expected]
+        for row, (_, values) in enumerate(expected):
+            assert sorted(features.keys()) == sorted(values.keys())
+            for name, column in features.items():
+                assert column[row] == values[name], (name, column[row], values[name])
+
+    def test2d(self):
+        self._check(2)
+
+    def test3d(self):
+        self._check(3)
+
+    def testFeatureOrder(self):
+        feats, _, _, _ = make_frame(10, 3)
+        _, features, _ = frame_traxel_arrays(feats, (0, 100), (0, 100), (0, 100), (0, 1000))
+        assert features.keys() == ['com', 'CoordMinimum', 'CoordMaximum', 'count']
+
+    def testEmptyFrame(self):
+        feats, _, _, _ = make_frame(0, 3)
+        object_ids, features, filtered = frame_traxel_arrays(feats, (0, 100), (0, 100), (0, 100), (0, 1000))
+        assert len(object_ids) == 0
+        assert filtered == []
+
+
+class TestTraxelStoreBenchmarking(object):
+    """
+    Filling a pgmlink TraxelStore end to end (feature preparation and the pgmlink calls):
+    the previous per-object logic vs. frame_traxel_arrays() + add_frame_traxels().
+    """
+
+    @classmethod
+    def setupClass(cls):
+        # This test is useful for performance evaluation,
+        #  but it takes too long to be useful as part of the normal test suite.
+        raise nose.SkipTest
+
+    def testFillTraxelStore(self):
+        from ilastik.applets.tracking.base.opTrackingBase import pgmlink, add_frame_traxels
+        frames = [make_frame(5000, 3, seed=t) for t in range(20)]
+        ranges = ((0, 100), (0, 100), (0, 100), (0, 1000))
+
+        start = time.time()
+        ts = pgmlink.TraxelStore()
+        fs = pgmlink.FeatureStore()
+        for t, (feats, div_probs, det_probs, local_centers) in enumerate(frames):
+            traxels, _ = reference_traxels(feats, *ranges, div_probs=div_probs,
+                                           det_probs=det_probs, local_centers=local_centers)
+            for oid, values in traxels:
+                tr = pgmlink.Traxel()
+                tr.set_feature_store(fs)
+                tr.Id = oid
+                tr.Timestep = t
+                for name, column in values.items():
+                    tr.add_feature_array(name, len(column))
+                    for i, v in enumerate(column):
+                        tr.set_feature_value(name, i, v)
+                ts.add(fs, tr)
+        logger.info("per-object: {:.2f}s".format(time.time() - start))
+
+        start = time.time()
+        ts = pgmlink.TraxelStore()
+        fs = pgmlink.FeatureStore()
+        for t, (feats, div_probs, det_probs, local_centers) in enumerate(frames):
+            object_ids, features, _ = frame_traxel_arrays(feats, *ranges, with_opt_correction=True,
+                                                          div_probs=div_probs, det_probs=det_probs,
+                                                          local_centers=local_centers)
+            add_frame_traxels(ts, fs, t, object_ids, features, (1.0, 1.0, 1.0))
+        logger.info("per-frame arrays: {:.2f}s".format(time.time() - start))
+
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
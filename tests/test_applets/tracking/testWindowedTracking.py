@@ -0,0 +1,231 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2016, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import pickle
+
+import numpy as np
+from nose.tools import raises
+
+from ilastik.applets.tracking.base.windowedTracking import tracking_windows, window_cuts, owned_frames, \
+    stitch_window_events, stitch_window_filtered_labels, WindowedCoordinateMap
+
+
+def make_detections(num_frames, num_objects, transients, seed=0):
+    """
+    Well separated objects moving slowly, plus transient objects given as
+    (first frame, number of frames). Labels are shuffled in every frame.
+    """
+    rng = np.random.RandomState(seed)
+    start = np.arange(num_objects, dtype=np.float64)[:, None] * 100.0 + rng.rand(num_objects, 2)
+    centers = []
+    for t in range(num_frames):
+        frame = list(start + t * 2.0 + rng.rand(num_objects, 2))
+        for k, (transient_first, transient_length) in enumerate(transients):
+            if transient_first <= t < transient_first + transient_length:
+                frame.append(np.array([-1000.0 * (k + 1), t * 2.0]))
+        frame = np.asarray(frame)
+        centers.append(frame[rng.permutation(len(frame))])
+    return centers
+
+
+def solve(centers, first, last, min_length=4):
+    """
+    A deterministic stand-in for the tracking solver, returning events in the
+    format of trackingUtilities.get_events(). Objects are linked to their nearest
+    neighbor in the next frame, and tracks shorter than min_length frames are
+    discarded as false detections. As in conservation tracking, whether an object
+    is tracked depends on the whole time range that is solved, so the solutions
+    of overlapping windows disagree close to the window boundaries.
+    """
+    links = {}
+    for t in range(first, last):
+        previous, current = centers[t], centers[t + 1]
+        distances = ((previous[:, None, :] - current[None, :, :]) ** 2).sum(axis=-1)
+        for source, target in enumerate(distances.argmin(axis=1)):
+            if distances[source, target] < 100.0:
+                links[(t, source)] = target
+
+    linked = set((t + 1, target) for (t, _), target in links.items())
+    tracked = set()
+    for t in range(first, last + 1):
+        for i in range(len(centers[t])):
+            if (t, i) in linked:
+                continue
+            track = [(t, i)]
+            while track[-1] in links:
+                track.append((track[-1][0] + 1, links[track[-1]]))
+            if len(track) >= min_length:
+                tracked.update(track)
+
+    sources = dict(((t + 1, target), source) for (t, source), target in links.items())
+    events = {}
+    for t in range(first, last + 1):
+        app, mov = [], []
+        for i in range(len(centers[t])):
+            if (t, i) not in tracked:
+                continue
+            if t > first and (t, i) in sources:
+                mov.append((sources[(t, i)] + 1, i + 1, 0.0))
+            else:
+                app.append((i + 1, 0.0))
+        events_at = {}
+        if app:
+            events_at['app'] = np.asarray(app)
+        if mov:
+            events_at['mov'] = np.asarray(mov)
+        events[str(t - first)] = events_at
+    return events
+
+
+def event_rows(events_at, key):
+    return sorted(tuple(int(x) for x in row[:-1]) for row in events_at.get(key, []))
+
+
+def assert_consistent(events):
+    """
+    Every move starts at an object that is tracked in the previous frame, and no object moves twice.
+    """
+    for t in range(1, len(events)):
+        previous = events[str(t - 1)]
+        tracked = set(i for i, in event_rows(previous, 'app')) | set(target for _, target in event_rows(previous, 'mov'))
+        sources = [source for source, _ in event_rows(events[str(t)], 'mov')]
+        assert set(sources) <= tracked, "frame {}: moves from untracked objects {}".format(t, set(sources) - tracked)
+        assert len(set(sources)) == len(sources)
+
+
+class TestTrackingWindows(object):
+    def testCoverage(self):
+        for first, last, size, overlap in [(0, 99, 20, 4), (3, 50, 10, 2), (0, 30, 31, 5), (0, 41, 10, 9)]:
+            windows = tracking_windows(first, last, size, overlap)
+            assert windows[0][0] == first
+            assert windows[-1][1] == last
+            for (start, stop), (next_start, _) in zip(windows[:-1], windows[1:]):
+                assert stop - start + 1 == size
+                assert stop - next_start + 1 == overlap
+
+            owned = owned_frames(windows)
+            frames = [t for own_first, own_last in owned for t in range(own_first, own_last + 1)]
+            assert frames == range(first, last + 1)
+            for (start, stop), (own_first, own_last) in zip(windows, owned):
+                assert start <= own_first <= own_last <= stop
+                # every transition into an owned frame was solved within the window
+                assert own_first == first or own_first > start
+
+    def testSingleWindow(self):
+        assert tracking_windows(0, 9, 20, 4) == [(0, 9)]
+
+    @raises(ValueError)
+    def testTooSmallOverlap(self):
+        tracking_windows(0, 99, 10, 1)
+
+    @raises(ValueError)
+    def testTooSmallWindow(self):
+        tracking_windows(0, 99, 4, 4)
+
+
+class TestStitching(object):
+    def setUp(self):
+        self.windows = tracking_windows(0, 39, 10, 4)
+        assert [start for start, _ in self.windows] == [0, 6, 12, 18, 24, 30]
+
+    def testStitchedEventsEqualFullRange(self):
+        # the second window only sees part of frames 5-8 and 14-17, frames 21-22 are too short everywhere
+        centers = make_detections(40, 6, [(5, 4), (14, 4), (21, 2), (35, 4)])
+        full = solve(centers, 0, 39)
+
+        window_events = [solve(centers, start, stop) for start, stop in self.windows]
+        cuts = window_cuts(self.windows, window_events)
+        # not in the middle of the overlap where the windows disagree
+        assert cuts[:2] == [10, 14]
+        stitched = stitch_window_events(self.windows, window_events, cuts)
+
+        assert sorted(stitched.keys()) == sorted(full.keys())
+        for key in full:
+            for event in ('app', 'mov'):
+                assert event_rows(stitched[key], event) == event_rows(full[key], event), (key, event)
+        assert_consistent(stitched)
+
+    def testWindowsDisagree(self):
+        # frames 7-10 are truncated in the first window, and tracked in the whole overlap of the second one
+        centers = make_detections(40, 6, [(7, 4)])
+        window_events = [solve(centers, start, stop) for start, stop in self.windows]
+        cuts = window_cuts(self.windows, window_events)
+        assert cuts[0] == 8
+        stitched = stitch_window_events(self.windows, window_events, cuts)
+        assert_consistent(stitched)
+
+        # the transient object enters the stitched result as an appearance at the cut
+        full = solve(centers, 0, 39)
+        assert len(event_rows(stitched['8'], 'app')) == 1
+        assert len(event_rows(stitched['8'], 'mov')) == 6
+        assert set(event_rows(stitched['8'], 'mov')) < set(event_rows(full['8'], 'mov'))
+
+    def testNoCutAtMergers(self):
+        centers = make_detections(40, 6, [])
+        window_events = [solve(centers, start, stop) for start, stop in self.windows]
+        assert window_cuts(self.windows, window_events)[0] == 8
+
+        # the second window resolves a merger in frame 7, its resolved ids mean nothing in the first window
+        window_events[1]['1'] = dict(window_events[1]['1'], merger=np.asarray([(3, 2, 0.0)]),
+                                     res={3: np.asarray([7, 8, 0.0])})
+        cuts = window_cuts(self.windows, window_events)
+        assert cuts[0] == 9
+        assert_consistent(stitch_window_events(self.windows, window_events, cuts))
+
+    def testFilteredLabels(self):
+        windows = tracking_windows(10, 29, 8, 2)
+        cuts = [16, 22]
+        # every window filters label t in frame t (keys relative to the window start)
+        window_filtered = [dict((str(t - start), [t]) for t in range(start, stop + 1)) for start, stop in windows]
+        filtered = stitch_window_filtered_labels(windows, window_filtered, cuts)
+        assert filtered == dict((str(t - 10), [t]) for t in range(10, 30))
+
+    def testCoordinateMaps(self):
+        windows = tracking_windows(10, 29, 8, 2)
+        cuts = [16, 22]
+        window_maps = [FakeCoordinateMap(size) for size in range(len(windows))]
+        coordinate_map = WindowedCoordinateMap(windows, window_maps, cuts)
+        assert coordinate_map.size() == sum(range(len(windows)))
+        assert coordinate_map.at(9) is None
+        assert coordinate_map.at(30) is None
+        for (own_first, own_last), window_map in zip(owned_frames(windows, cuts), window_maps):
+            for t in range(own_first, own_last + 1):
+                assert coordinate_map.at(t) is window_map
+
+        # stored in the project file by the TrackingSerializer
+        loaded = pickle.loads(pickle.dumps(coordinate_map))
+        assert loaded.size() == coordinate_map.size()
+        assert loaded.at(16).size() == window_maps[1].size()
+
+
+class FakeCoordinateMap(object):
+    def __init__(self, size):
+        self._size = size
+
+    def size(self):
+        return self._size
+
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
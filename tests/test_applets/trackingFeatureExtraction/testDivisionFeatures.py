@@ -0,0 +1,174 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2016, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import numpy as np
+
+from ilastik.applets.trackingFeatureExtraction.trackingFeatures import FeatureManager
+
+FEAT_NAMES = ['ParentChildrenRatio_Count', 'ParentChildrenRatio_Mean', 'ChildrenRatio_Count', 'ChildrenRatio_Mean',
+              'ParentChildrenAngle_RegionCenter', 'SquaredDistances_0', 'SquaredDistances_1', 'SquaredDistances_2']
+
+
+def region_features(labels, raw):
+    """
+    Count, Mean and RegionCenter as the object extraction computes them (row 0 is the background).
+    """
+    n = labels.max() + 1
+    flat = labels.ravel()
+    count = np.bincount(flat, minlength=n).astype(np.float32)
+    mean = (np.bincount(flat, weights=raw.ravel(), minlength=n) / np.maximum(count, 1)).astype(np.float32)
+    coords = np.indices(labels.shape).reshape(labels.ndim, -1)
+    center = np.stack([np.bincount(flat, weights=c, minlength=n) for c in coords], axis=1) / np.maximum(count, 1)[:, None]
+    return {'Count': count[:, None], 'Mean': mean[:, None], 'RegionCenter': center.astype(np.float32)}
+
+
+def make_frames(shape, num_cells, seed=0):
+    """
+    Two frames of discs (or balls), where some of the cells divide into two daughters.
+    """
+    rng = np.random.RandomState(seed)
+    grid = np.indices(shape)
+    frames = [np.zeros(shape, dtype=np.uint32), np.zeros(shape, dtype=np.uint32)]
+    next_label = 1
+    for label in range(1, num_cells + 1):
+        center = rng.uniform(5, np.array(shape) - 5)
+        radius = rng.uniform(1, 4)
+        disc = ((grid - center.reshape((-1,) + (1,) * len(shape))) ** 2).sum(axis=0) <= radius ** 2
+        frames[0][disc] = label
+        if rng.rand() < 0.3:
+            offsets = [rng.uniform(-3, 3, size=len(shape)), None]
+            offsets[1] = -offsets[0]
+        else:
+            offsets = [rng.uniform(-3, 3, size=len(shape))]
+        for offset in offsets:
+            c = center + offset
+            disc = ((grid - c.reshape((-1,) + (1,) * len(shape))) ** 2).sum(axis=0) <= (radius * 0.8) ** 2
+            frames[1][disc] = next_label
+            next_label += 1
+
+    raw = rng.rand(*shape)
+    feats = []
+    for frame in frames:
+        # relabel consecutively, objects may be fully covered by others
+        frame[...] = np.unique(frame, return_inverse=True)[1].reshape(shape)
+        feats.append(region_features(frame, raw))
+    return frames, feats
+
+
+def reference_features(fm, feats_cur, feats_next, img_next, feat_names):
+    """
+    The per-object search for successor candidates that FeatureManager.computeFeatures_at() used to do.
+    """
+    result = {}
+    vigra_feat_names = set([fm.com_name_cur, fm.com_name_next, fm.size_name])
+    feat_classes = {}
+    for name in feat_names:
+        name_split = name.split(fm.delim)
+        if "SquaredDistances" in name_split:
+            continue
+        feat_dim = len(feats_cur[name_split[1]][0])
+        feat_classes[name] = fm.feature_mappings[name_split[0]](name_split[1], delim=fm.delim, ndim=fm.ndim, feat_dim=feat_dim)
+        result[name] = np.ones((feats_cur.values()[0].shape[0], feat_classes[name].dim())) * feat_classes[name].default_value
+        vigra_feat_names.add(name_split[1])
+
+    for idx in range(fm.n_best):
+        result['SquaredDistances_' + str(idx)] = np.ones((feats_cur.values()[0].shape[0], 1)) * fm.squared_distance_default
+
+    for label_cur, com_cur in enumerate(feats_cur[fm.com_name_cur]):
+        if label_cur == 0:
+            continue
+        subset = dict((k, {}) for k in vigra_feat_names)
+        if feats_next is not None and img_next is not None:
+            roi = []
+            for idx, coord in enumerate([round(x) for x in com_cur]):
+                roi.append(slice(int(max(coord - fm.template_size // 2, 0)),
+                                 int(min(coord + fm.template_size // 2, img_next.shape[idx]))))
+            for l in np.unique(img_next[tuple(roi)]).tolist():
+                if l != 0:
+                    for n in vigra_feat_names:
+                        subset[n][l] = np.array([feats_next[n][l]]).flatten()
+
+        sq_dist_label = best_squared_distances(fm, com_cur, subset[fm.com_name_next], subset[fm.size_name])
+        best = {}
+        for n in vigra_feat_names:
+            best[n] = [subset[n][row[0]] for row in sq_dist_label if row[0] != -1]
+
+        for idx in range(fm.n_best):
+            result['SquaredDistances_' + str(idx)][label_cur] = sq_dist_label[idx][1]
+        for name, feat_class in feat_classes.items():
+            f_cur = np.array([feats_cur[feat_class.feats_name][label_cur]]).flatten()
+            f_next = np.array([best[feat_class.feats_name]]).reshape((-1, f_cur.shape[0]))
+            result[name][label_cur] = feat_class.compute(f_cur, f_next)
+    return result
+
+
+def best_squared_distances(fm, com_cur, coms_next, sizes_next):
+    squaredDistances = []
+    for label_next in sorted(coms_next.keys()):
+        if fm.size_filter != None and sizes_next[label_next] >= fm.size_filter:
+            squaredDistances.append([label_next, np.linalg.norm(coms_next[label_next] - com_cur * fm.scales)])
+    squaredDistances = np.array(sorted(squaredDistances, key=lambda a_entry: a_entry[1]))
+    result = np.array([[-1, fm.squared_distance_default] for x in range(fm.n_best)], dtype=np.float32)
+    if squaredDistances.shape[0] != 0:
+        n = min(squaredDistances.shape[0], result.shape[0])
+        result[0:n, :] = squaredDistances[0:n, :]
+    return result
+
+
+class TestDivisionFeatures(object):
+    def _check(self, shape, num_cells, template_size, scales=[1.0, 1.0, 1.0]):
+        frames, feats = make_frames(shape, num_cells)
+        fm = FeatureManager(ndim=len(shape), template_size=template_size, scales=scales)
+
+        expected = reference_features(fm, feats[0], feats[1], frames[1], FEAT_NAMES)
+        result = fm.computeFeatures_at(feats[0], feats[1], frames[1], FEAT_NAMES)
+
+        assert sorted(result.keys()) == sorted(expected.keys())
+        for name in expected:
+            assert result[name].shape == expected[name].shape, name
+            assert np.allclose(result[name], expected[name], rtol=1e-5, atol=1e-4), name
+
+    def test2d(self):
+        self._check((120, 100), 60, template_size=10)
+
+    def test2dLargeTemplate(self):
+        self._check((120, 100), 60, template_size=50)
+
+    def test3d(self):
+        self._check((40, 30, 20), 20, template_size=8)
+
+    def testAnisotropic(self):
+        self._check((120, 100), 60, template_size=12, scales=[1.0, 2.0, 1.0])
+
+    def testLastFrame(self):
+        frames, feats = make_frames((50, 50), 10)
+        fm = FeatureManager(ndim=2)
+        result = fm.computeFeatures_at(feats[0], None, None, FEAT_NAMES)
+        for idx in range(fm.n_best):
+            assert (result['SquaredDistances_' + str(idx)] == fm.squared_distance_default).all()
+        assert (result['ParentChildrenAngle_RegionCenter'] == 0).all()
+
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,194 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2016, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import sys
+import time
+import numpy as np
+import vigra
+import nose
+from lazyflow.graph import Graph
+from lazyflow.request import Request
+from lazyflow.operators import OpArrayPiper
+from ilastik.applets.objectExtraction.opObjectExtraction import OpRegionFeatures
+from ilastik.applets.trackingFeatureExtraction.opTrackingFeatureExtraction import OpCachedDivisionFeatures
+from ilastik.applets.trackingFeatureExtraction import config
+
+import logging
+logger = logging.getLogger(__name__)
+logger.addHandler( logging.StreamHandler(sys.stdout) )
+logger.setLevel(logging.INFO)
+
+FEATURES = {
+    config.features_vigra_name : {
+        "Count" : {},
+        "RegionCenter" : {},
+        "Mean" : {},
+    }
+}
+
+DIVISION_FEATURES = {
+    config.features_division_name : ['ParentChildrenRatio_Count', 'ChildrenRatio_Count', 'ParentChildrenAngle_RegionCenter',
+                                     'SquaredDistances_0', 'SquaredDistances_1', 'SquaredDistances_2']
+}
+
+
+def labelImage(num_frames, shape=(100, 100), spacing=20):
+    """
+    A grid of squares moving by one pixel per frame, in txyzc order.
+    """
+    img = np.zeros((num_frames,) + shape + (1, 1), dtype=np.uint32)
+    corners = [(x, y) for x in range(0, shape[0] - spacing, spacing) for y in range(0, shape[1] - spacing, spacing)]
+    for t in range(num_frames):
+        for label, (x, y) in enumerate(corners, start=1):
+            img[t, x+t:x+t+4, y:y+4, 0, 0] = label
+    img = img.view(vigra.VigraArray)
+    img.axistags = vigra.defaultAxistags('txyzc')
+    return img
+
+
+class TestOpDivisionFeatures(object):
+    def setUp(self):
+        g = Graph()
+        self.labels = labelImage(5)
+        self.opLabels = OpArrayPiper(graph=g)
+        self.opLabels.Input.setValue(self.labels)
+
+        self.opFeats = OpRegionFeatures(graph=g)
+        self.opFeats.LabelVolume.connect(self.opLabels.Output)
+        self.opFeats.RawVolume.connect(self.opLabels.Output)
+        self.opFeats.Features.setValue(FEATURES)
+
+        self.op = OpCachedDivisionFeatures(graph=g)
+        self.op.LabelImage.connect(self.opLabels.Output)
+        self.op.RegionFeaturesVigra.connect(self.opFeats.Output)
+        self.op.DivisionFeatureNames.setValue(DIVISION_FEATURES)
+
+    def _countComputations(self):
+        """
+        Record the number of frame pairs that are computed from now on.
+        """
+        featureManager = self.op._opDivisionFeatures.featureManager
+        computeFeatures_at = featureManager.computeFeatures_at
+        calls = []
+        def counting(*args, **kwargs):
+            calls.append(args[1] is None)
+            return computeFeatures_at(*args, **kwargs)
+        featureManager.computeFeatures_at = counting
+        return calls
+
+    def testFeatures(self):
+        feats = self.op.Output[:].wait()
+        assert len(feats) == self.labels.shape[0]
+        for t in range(len(feats) - 1):
+            res = feats[t][config.features_division_name]
+            # every object has a successor in the next frame, one pixel apart
+            assert np.allclose(res['SquaredDistances_0'][1:], 1.0)
+        res = feats[-1][config.features_division_name]
+        assert (res['SquaredDistances_0'] == config.squared_distance_default).all()
+
+    def testSingleFrameDirty(self):
+        self.op.Output[:].wait()
+        calls = self._countComputations()
+
+        dirty = []
+        self.op.Output.notifyDirty(lambda slot, roi: dirty.append((roi.start[0], roi.stop[0])))
+
+        # only the pairs (1, 2) and (2, 3) use frame 2
+        self.opLabels.Input.setDirty(slice(2, 3))
+        assert dirty and min(start for start, _ in dirty) == 1 and max(stop for _, stop in dirty) == 3
+
+        self.op.Output[:].wait()
+        assert len(calls) == 2
+
+    def testLastFrameDirty(self):
+        self.op.Output[:].wait()
+        calls = self._countComputations()
+
+        self.opLabels.Input.setDirty(slice(4, 5))
+        self.op.Output[:].wait()
+        assert len(calls) == 2
+        # the last frame has no successors
+        assert sorted(calls) == [False, True]
+
+    def testLastFramePair(self):
+        # Request single frames from the uncached operator, as the cache does:
+        # the second-to-last frame still needs the objects of the last frame.
+        opDivisionFeatures = self.op._opDivisionFeatures
+        num_frames = self.labels.shape[0]
+
+        res = opDivisionFeatures.BlockwiseDivisionFeatures[num_frames-2:num_frames-1].wait()[0]
+        assert np.allclose(res[config.features_division_name]['SquaredDistances_0'][1:], 1.0)
+
+        res = opDivisionFeatures.BlockwiseDivisionFeatures[num_frames-1:num_frames].wait()[0]
+        assert (res[config.features_division_name]['SquaredDistances_0'] == config.squared_distance_default).all()
+
+    def testFeatureNamesDirty(self):
+        feats = self.op.Output[:].wait()
+        assert 'ChildrenRatio_Count' in feats[0][config.features_division_name]
+
+        self.op.DivisionFeatureNames.setValue({config.features_division_name: ['SquaredDistances_0']})
+        feats = self.op.Output[:].wait()
+        for t in range(self.labels.shape[0]):
+            assert 'ChildrenRatio_Count' not in feats[t][config.features_division_name]
+
+
+class TestOpDivisionFeaturesBenchmarking(object):
+    """
+    Thread scaling of the division feature computation.
+    """
+
+    @classmethod
+    def setupClass(cls):
+        # This test is useful for performance evaluation,
+        #  but it takes too long to be useful as part of the normal test suite.
+        raise nose.SkipTest
+
+    def testThreadScaling(self):
+        labels = labelImage(20, shape=(1000, 1000), spacing=10)
+        previous_num_threads = Request.global_thread_pool.num_workers
+        try:
+            for num_threads in (1, 2, 4, 8):
+                Request.reset_thread_pool(num_threads)
+                g = Graph()
+                opLabels = OpArrayPiper(graph=g)
+                opLabels.Input.setValue(labels)
+                opFeats = OpRegionFeatures(graph=g)
+                opFeats.LabelVolume.connect(opLabels.Output)
+                opFeats.RawVolume.connect(opLabels.Output)
+                opFeats.Features.setValue(FEATURES)
+
+                op = OpCachedDivisionFeatures(graph=g)
+                op.LabelImage.connect(opLabels.Output)
+                op.RegionFeaturesVigra.connect(opFeats.Output)
+                op.DivisionFeatureNames.setValue(DIVISION_FEATURES)
+
+                start = time.time()
+                op.Output[:].wait()
+                logger.info("{} threads: {:.3f}s".format(num_threads, time.time() - start))
+
+        finally:
+            Request.reset_thread_pool(previous_num_threads)
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,151 @@
+import time
+
+import numpy as np
+import scipy.ndimage
+import nose
+from nose.tools import raises
+
+from lazyflow.request import Request
+from ilastik.applets.wsdt.blockwiseWsdt import BlockwiseWsdt, wsdt_halo
+
+import logging
+logger = logging.getLogger(__name__)
+
+def threshold_watershed(pmap, pmin=0.5):
+    """
+    Stand-in for wsDtSegmentation: the connected components below pmin,
+    with every membrane pixel assigned to the nearest component.
+    """
+    labels, _ = scipy.ndimage.label(pmap < pmin)
+    if labels.max() == 0:
+        return labels.astype(np.uint32)
+    _, indices = scipy.ndimage.distance_transform_edt(labels == 0, return_indices=True)
+    return labels[tuple(indices)].astype(np.uint32)
+
+def voronoi_membranes(shape, num_cells, seed=0):
+    """
+    A probability map with thin membranes between random (convex) cells.
+    """
+    rng = np.random.RandomState(seed)
+    seeds = rng.uniform(0, 1, size=(num_cells, len(shape))) * shape
+    coords = np.indices(shape).reshape(len(shape), -1).T
+    cells = np.empty((len(coords),), dtype=np.uint32)
+    for i in range(0, len(coords), 10000):
+        chunk = coords[i:i+10000]
+        cells[i:i+10000] = ((chunk[:, None, :] - seeds[None, :, :]) ** 2).sum(axis=-1).argmin(axis=1)
+    cells = cells.reshape(shape)
+
+    membranes = np.zeros(shape, dtype=bool)
+    for axis in range(len(shape)):
+        boundary = (np.diff(cells, axis=axis) != 0)
+        pad = [(0, 0)] * len(shape)
+        pad[axis] = (0, 1)
+        membranes |= np.pad(boundary, pad, mode='constant')
+    pmap = rng.uniform(0, 0.3, size=shape).astype(np.float32)
+    pmap[membranes] = rng.uniform(0.7, 1.0, size=membranes.sum())
+    return pmap
+
+def same_partition(labels_a, labels_b):
+    pairs = np.unique(labels_a.astype(np.uint64) << np.uint64(32) | labels_b.astype(np.uint64))
+    return len(pairs) == len(np.unique(labels_a)) == len(np.unique(labels_b))
+
+class TestBlockwiseWsdt(object):
+
+    def _check(self, pmap, block_shape, halo=4):
+        expected = threshold_watershed(pmap)
+
+        out = np.zeros(pmap.shape, dtype=np.uint32)
+        def read_block(start, stop):
+            return pmap[tuple(slice(a, b) for a, b in zip(start, stop))]
+        num_segments = BlockwiseWsdt(pmap.shape, block_shape, halo, threshold_watershed).run(read_block, out)
+
+        assert same_partition(out, expected)
+        assert num_segments == expected.max()
+        assert (np.unique(out) == np.arange(1, num_segments + 1)).all()
+
+    def test2d(self):
+        pmap = voronoi_membranes((200, 150), 40)
+        self._check(pmap, (64, 64))
+        self._check(pmap, (50, 30), halo=2)
+        self._check(pmap, (200, 150))
+
+    def test3d(self):
+        pmap = voronoi_membranes((60, 70, 50), 30)
+        self._check(pmap, (32, 32, 32))
+        self._check(pmap, (20, 25, 50))
+
+    def testConnectedOutsideBlock(self):
+        # A wall that splits the first block, but not the whole image:
+        # both halves must still end up in the same segment if they are connected within the halo.
+        pmap = np.zeros((64, 64), dtype=np.float32)
+        pmap[0:34, 16] = 1.0
+        self._check(pmap, (32, 32))
+
+    def testMergeMutualBestMatches(self):
+        # on the face, 1 overlaps mostly with 5, 2 overlaps with 5 as well, 3 only with 6
+        labels =          np.array([1, 1, 1, 2, 2, 3, 3, 0])
+        neighbor_labels = np.array([5, 5, 5, 5, 6, 6, 6, 6])
+        merges = BlockwiseWsdt._overlap_merges(labels, 10, neighbor_labels, 100)
+        assert sorted(map(tuple, merges)) == [(11, 105), (13, 106)]
+
+        # ties go to the smaller label
+        merges = BlockwiseWsdt._overlap_merges(np.array([1, 2]), 0, np.array([3, 3]), 0)
+        assert map(tuple, merges) == [(1, 3)]
+
+    def testHalo(self):
+        assert wsdt_halo(3.0, 0.0, margin=0) == 9
+        assert wsdt_halo(1.0, 2.5, margin=5) == 13
+
+    def testHaloLargerThanBlocks(self):
+        # The blocks are enlarged, the halo is kept
+        blockwise = BlockwiseWsdt((200, 150), (8, 64), 16, threshold_watershed)
+        assert blockwise.block_shape == (16, 64)
+        assert blockwise.halo == 16
+        blockwise = BlockwiseWsdt((10, 150), (8, 8), 16, threshold_watershed)
+        assert blockwise.block_shape == (10, 16)
+
+        pmap = voronoi_membranes((200, 150), 40)
+        self._check(pmap, (8, 64), halo=16)
+
+    @raises(ValueError)
+    def testNoHalo(self):
+        BlockwiseWsdt((200, 150), (64, 64), 0, threshold_watershed)
+
+class TestBlockwiseWsdtBenchmarking(object):
+    """
+    Speedup of the blockwise watershed.
+    """
+
+    @classmethod
+    def setupClass(cls):
+        # This test is useful for performance evaluation,
+        #  but it takes too long to be useful as part of the normal test suite.
+        raise nose.SkipTest
+
+    def testThreadScaling(self):
+        pmap = voronoi_membranes((256, 256, 256), 2000)
+        def read_block(start, stop):
+            return pmap[tuple(slice(a, b) for a, b in zip(start, stop))]
+
+        start_time = time.time()
+        expected = threshold_watershed(pmap)
+        logger.info("Whole volume: {:.2f}s".format(time.time() - start_time))
+
+        previous_num_threads = Request.global_thread_pool.num_workers
+        try:
+            for num_threads in (1, 2, 4, 8):
+                Request.reset_thread_pool(num_threads)
+                out = np.zeros(pmap.shape, dtype=np.uint32)
+                start_time = time.time()
+                BlockwiseWsdt(pmap.shape, (64, 64, 64), 8, threshold_watershed).run(read_block, out)
+                logger.info("{} threads: {:.2f}s".format(num_threads, time.time() - start_time))
+                assert same_partition(out, expected)
+        finally:
+            Request.reset_thread_pool(previous_num_threads)
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
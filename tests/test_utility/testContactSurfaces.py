@@ -0,0 +1,138 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2016, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import os
+import imp
+import time
+import tempfile
+import shutil
+
+import numpy
+import h5py
+import vigra
+import nose
+
+from ilastik.utility.contactSurfaces import contact_area_table
+
+import logging
+logger = logging.getLogger(__name__)
+
+# The pairwise measurements of the bin script
+measure_surface_contact = imp.load_source( 'measure_surface_contact',
+                                           os.path.join( os.path.split(__file__)[0],
+                                                         '../../bin/measure_surface_contact.py' ) )
+
+def random_objects(shape, num_labels, seed=0):
+    """
+    A volume of randomly shaped, touching objects (and some background).
+    """
+    rng = numpy.random.RandomState(seed)
+    noise = vigra.filters.gaussianSmoothing( rng.rand(*shape).astype(numpy.float32), 2.0 )
+    noise = (noise - noise.min()) / (noise.max() - noise.min())
+    return (noise * num_labels * 3).astype(numpy.uint32) % (num_labels + 1)
+
+def as_dict(table):
+    return { (label_1, label_2) : area for label_1, label_2, area in table }
+
+class TestContactAreaTable(object):
+
+    def testAgainstPairwise(self):
+        volume = random_objects( (40, 35, 30), 6 )
+        labels = [label for label in numpy.unique(volume) if label != 0]
+        for contact_distance in (1, 2, 3):
+            areas = as_dict( contact_area_table( volume, contact_distance, block_shape=(16, 16, 16) ) )
+            for label_1 in labels:
+                for label_2 in labels:
+                    if label_1 == label_2:
+                        continue
+                    expected = measure_surface_contact.measure_surface_contact_B( volume, label_1, label_2, contact_distance )
+                    assert areas.get( (label_1, label_2), 0 ) == expected, \
+                        "Contact area of {} on {} at distance {}: {} != {}"\
+                        .format( label_1, label_2, contact_distance, areas.get( (label_1, label_2), 0 ), expected )
+
+    def testAgainstPairwiseRounded(self):
+        # measure_surface_contact_A counts the voxels at a distance that rounds to the contact distance
+        volume = random_objects( (30, 35, 40), 5, seed=1 )
+        labels = [label for label in numpy.unique(volume) if label != 0]
+        for contact_distance in (1, 2):
+            table = contact_area_table( volume, distance_range=(contact_distance-0.5, contact_distance+0.5),
+                                        block_shape=(20, 20, 20) )
+            areas = as_dict( table )
+            for label_1 in labels:
+                for label_2 in labels:
+                    if label_1 == label_2:
+                        continue
+                    expected = measure_surface_contact.measure_surface_contact_A( volume, label_1, label_2, contact_distance )
+                    assert areas.get( (label_1, label_2), 0 ) == expected
+
+    def testHdf5(self):
+        volume = random_objects( (50, 60, 45), 20 ).reshape( (1, 50, 60, 45, 1) )
+        tmpDir = tempfile.mkdtemp()
+        try:
+            with h5py.File( os.path.join(tmpDir, 'labels.h5'), 'w' ) as f:
+                dataset = f.create_dataset( 'labels', data=volume, chunks=(1, 16, 16, 16, 1) )
+                table = contact_area_table( dataset )
+        finally:
+            shutil.rmtree(tmpDir)
+
+        # Same as one block with everything in memory
+        expected = contact_area_table( volume.squeeze(), block_shape=(50, 60, 45) )
+        assert (table == expected).all()
+
+    def test2D(self):
+        volume = numpy.zeros( (10, 10), dtype=numpy.uint8 )
+        volume[:, :5] = 1
+        volume[:5, 5:] = 2
+        volume[5:, 5:] = 3
+        areas = as_dict( contact_area_table( volume ) )
+        assert areas == { (1, 2) : 5, (2, 1) : 5, (1, 3) : 5, (3, 1) : 5, (2, 3) : 5, (3, 2) : 5 }
+
+class TestContactAreaTableBenchmarking(object):
+
+    @classmethod
+    def setupClass(cls):
+        # This test is useful for performance evaluation,
+        #  but it takes too long to be useful as part of the normal test suite.
+        raise nose.SkipTest
+
+    def testManyLabels(self):
+        # About 10^4 objects
+        volume = numpy.zeros( (300, 300, 300), dtype=numpy.uint32 )
+        cells = numpy.random.RandomState(0).permutation(22**3).reshape( (22, 22, 22) ) + 1
+        volume[:] = cells.repeat(14, 0).repeat(14, 1).repeat(14, 2)[:300, :300, :300]
+
+        start = time.time()
+        table = contact_area_table( volume )
+        duration = time.time() - start
+        logger.info( "All {} object pairs: {:.1f}s".format( len(table), duration ) )
+
+        # (measure_surface_contact_B only supports 255 labels)
+        start = time.time()
+        for label_1, label_2, _ in table[:10]:
+            measure_surface_contact.measure_surface_contact_A( volume, label_1, label_2 )
+        logger.info( "Pairwise: {:.1f}s per pair, {:.0f}s for all pairs".format(
+                     (time.time() - start) / 10, (time.time() - start) / 10 * len(table) ) )
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,395 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2016, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import os
+import time
+import shutil
+import resource
+import tempfile
+
+import numpy as np
+import h5py
+import vigra
+import nose
+
+from lazyflow.graph import Graph, Operator, InputSlot, OutputSlot
+from lazyflow.stype import Opaque
+from lazyflow.rtype import List
+from lazyflow.operators import OpArrayPiper
+from ilastik.utility.exportFile import ExportFile, Mode, Default, create_slicing, actual_axistags, ilastik_ids
+
+import logging
+logger = logging.getLogger(__name__)
+
+def synthetic_objects(shape, num_objects, max_size=10, seed=0):
+    """
+    A txyzc label image of random boxes and a feature table with their coordinates.
+    The objects are numbered 1..N in each time step.
+    """
+    rng = np.random.RandomState(seed)
+    labels = np.zeros(shape, dtype=np.uint32)
+    times = np.sort(rng.randint(0, shape[0], num_objects))
+    mins = np.array([rng.randint(0, s - max_size, num_objects) for s in shape[1:4]]).T
+    maxs = mins + rng.randint(1, max_size, (num_objects, 3))
+
+    table = np.zeros((num_objects,), dtype=[(Default.TimeColumnName, "i")] +
+                     [("Coord<Minimum>_{}".format(i), "f") for i in range(3)] +
+                     [("Coord<Maximum>_{}".format(i), "f") for i in range(3)])
+    oid = 0
+    for i in range(num_objects):
+        oid = oid + 1 if i > 0 and times[i] == times[i - 1] else 1
+        labels[times[i], mins[i, 0]:maxs[i, 0], mins[i, 1]:maxs[i, 1], mins[i, 2]:maxs[i, 2]] = oid
+        table[i] = (times[i],) + tuple(mins[i]) + tuple(maxs[i] - 1)
+    return vigra.taggedView(labels, "txyzc"), table
+
+def add_rois_in_memory(export_file, table_path, image_slot, feature_table_name, margin, type_="image"):
+    """
+    ExportFile.add_rois as it used to be: one request per object, the rois are kept in the table_dict.
+    """
+    slicings = create_slicing(image_slot.meta.axistags, image_slot.meta.shape,
+                              margin, export_file.table_dict[feature_table_name])
+    for i, (slicing, oid) in enumerate(slicings):
+        roi = image_slot(slicing).wait()
+        if type_ == "labeling":
+            roi = np.vectorize(lambda pixel_value: 1 if pixel_value == oid else 0)(roi)
+        roi_path = table_path.format(i)
+        export_file.meta_dict[roi_path] = {
+            "type": type_,
+            "axistags": actual_axistags(image_slot.meta.axistags, roi.shape).toJSON()
+        }
+        export_file.table_dict[roi_path] = roi.squeeze()
+
+class OpSyntheticFeatures(Operator):
+    """
+    Random object features, like the RegionFeatures of OpObjectExtraction:
+    a dict of (time, featuredict) pairs for the requested list of time steps.
+    """
+    ObjectCounts = InputSlot()
+    Output = OutputSlot(stype=Opaque, rtype=List)
+
+    def setupOutputs(self):
+        self.Output.meta.shape = (len(self.ObjectCounts.value),)
+        self.Output.meta.dtype = object
+
+    def execute(self, slot, subindex, roi, destination):
+        if len(roi) == 0:
+            roi = range(self.Output.meta.shape[0])
+        result = {}
+        for t in roi:
+            rng = np.random.RandomState(t)
+            count = self.ObjectCounts.value[t] + 1 # with background
+            result[t] = {
+                "Default features": {
+                    "Count": rng.randint(1, 1000, (count, 1)).astype(np.float32),
+                    "Coord<Minimum>": rng.randint(0, 50, (count, 3)).astype(np.float32),
+                    "Coord<Maximum>": rng.randint(50, 100, (count, 3)).astype(np.float32),
+                    "RegionCenter": rng.rand(count, 3).astype(np.float32)
+                },
+                "Standard Object Features": {
+                    "Mean": rng.rand(count, 1).astype(np.float32),
+                    "Variance": rng.rand(count, 1),
+                    "Histogram": rng.rand(count, 8).astype(np.float32)
+                }
+            }
+        return result
+
+    def propagateDirty(self, slot, subindex, roi):
+        self.Output.setDirty()
+
+def flatten_in_memory(table, selection):
+    """
+    The feature table as it used to be flattened: all frames are computed first (one after another).
+    """
+    frames = table.meta.shape[0]
+    if frames > 1:
+        computed_feature = {}
+        for t in xrange(frames):
+            computed_feature.update(table([t]).wait())
+    else:
+        computed_feature = table([]).wait()
+
+    names, types, keys, feature_names = [], [], [], []
+    for cat_name, category in computed_feature[0].iteritems():
+        for feat_name, feat_array in category.iteritems():
+            if (cat_name == "Default features" or feat_name in selection) and feat_name not in feature_names:
+                feature_names.append(feat_name)
+                for c in xrange(feat_array.shape[1]):
+                    names.append("%s_%i" % (feat_name, c) if feat_array.shape[1] > 1 else feat_name)
+                    types.append(feat_array.dtype.name)
+                    keys.append((cat_name, feat_name, c))
+
+    parts = []
+    for t in sorted(computed_feature.keys()):
+        cf = computed_feature[t]
+        part = np.zeros((cf["Default features"]["Count"].shape[0] - 1,), dtype=zip(names, types))
+        for name, (cat, feat_name, index) in zip(names, keys):
+            part[name] = cf[cat][feat_name][1:, index]
+        parts.append(part)
+    return np.concatenate(parts)
+
+class TestExportFileFeatureTable(object):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def _export(self, obj_counts, file_name, mode, streamed, selection=("Mean", "Histogram")):
+        opFeatures = OpSyntheticFeatures(graph=Graph())
+        opFeatures.ObjectCounts.setValue(obj_counts)
+
+        export_file = ExportFile(os.path.join(self.tmpDir, file_name))
+        export_file.add_columns("table", range(sum(obj_counts)), Mode.List, Default.KnimeId)
+        export_file.add_columns("table", list(ilastik_ids(obj_counts)), Mode.List, Default.IlastikId)
+        if streamed:
+            export_file.add_columns("table", opFeatures.Output, Mode.IlastikFeatureTable, {"selection": selection})
+        else:
+            export_file.add_columns("table", flatten_in_memory(opFeatures.Output, selection), Mode.NumpyStructArray)
+        export_file.add_columns("divisions", [(1, 2), (3, 4)], Mode.List, {"names": ("a", "b")})
+        export_file.update_meta("table", {"note": "synthetic"})
+        export_file.write_all(mode, {"compression": "gzip"})
+        return export_file
+
+    def testH5(self):
+        for obj_counts in ([5, 0, 17, 3, 1000, 2], [12]):
+            expected = self._export(obj_counts, "expected.h5", "h5", False)
+            result = self._export(obj_counts, "result.h5", "h5", True)
+            with h5py.File(expected.file_name, "r") as fexpected, h5py.File(result.file_name, "r") as fresult:
+                assert set(fexpected.keys()) == set(fresult.keys())
+                for name in fexpected.keys():
+                    assert fexpected[name].dtype == fresult[name].dtype
+                    assert (fexpected[name][:] == fresult[name][:]).all()
+                    assert dict(fexpected[name].attrs) == dict(fresult[name].attrs)
+                assert fresult["table"].compression == "gzip"
+
+    def testCsv(self):
+        obj_counts = [5, 0, 17, 3, 100]
+        self._export(obj_counts, "expected.csv", "csv", False)
+        self._export(obj_counts, "result.csv", "csv", True)
+        for table_name in ("table", "divisions"):
+            with open(os.path.join(self.tmpDir, "expected_{}.csv".format(table_name))) as fexpected, \
+                 open(os.path.join(self.tmpDir, "result_{}.csv".format(table_name))) as fresult:
+                assert fexpected.read() == fresult.read()
+
+    def testColumnsAfterFeatures(self):
+        opFeatures = OpSyntheticFeatures(graph=Graph())
+        opFeatures.ObjectCounts.setValue([3, 4])
+        export_file = ExportFile(os.path.join(self.tmpDir, "result.h5"))
+        export_file.add_columns("table", opFeatures.Output, Mode.IlastikFeatureTable, {"selection": []})
+        try:
+            export_file.add_columns("table", range(7), Mode.List, Default.KnimeId)
+        except AttributeError:
+            pass
+        else:
+            assert False, "Expected an AttributeError"
+
+    def testCoordinateTable(self):
+        obj_counts = [5, 0, 17]
+        opFeatures = OpSyntheticFeatures(graph=Graph())
+        opFeatures.ObjectCounts.setValue(obj_counts)
+        export_file = ExportFile(os.path.join(self.tmpDir, "result.h5"))
+        export_file.add_columns("table", list(ilastik_ids(obj_counts)), Mode.List, Default.IlastikId)
+        export_file.add_columns("table", opFeatures.Output, Mode.IlastikFeatureTable, {"selection": ["Mean"]})
+
+        coordinates = export_file._coordinate_table("table")
+        expected = flatten_in_memory(opFeatures.Output, ["Mean"])
+        assert coordinates.shape == expected.shape
+        assert (coordinates[Default.TimeColumnName] == [0] * 5 + [2] * 17).all()
+        for name in ("Coord<Minimum>_0", "Coord<Maximum>_2"):
+            assert (coordinates[name] == expected[name]).all()
+        assert "Mean" not in coordinates.dtype.names
+
+        # The frames are requested only once, for all add_rois calls
+        assert export_file._coordinate_table("table") is coordinates
+
+class ExpectedError(Exception):
+    pass
+
+class OpFailing(Operator):
+    """
+    Fails on every request.
+    """
+    Input = InputSlot()
+    Output = OutputSlot()
+
+    def setupOutputs(self):
+        self.Output.meta.assignFrom(self.Input.meta)
+
+    def execute(self, slot, subindex, roi, result):
+        raise ExpectedError()
+
+    def propagateDirty(self, slot, subindex, roi):
+        self.Output.setDirty()
+
+class TestExportFileRois(object):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        # Small blocks, to get many groups (and objects that are larger than a block)
+        self._blockSize = ExportFile.ROI_BLOCK_SIZE
+        ExportFile.ROI_BLOCK_SIZE = 16
+
+    def tearDown(self):
+        ExportFile.ROI_BLOCK_SIZE = self._blockSize
+        shutil.rmtree(self.tmpDir)
+
+    def _export(self, labels, raw, table, add_rois_fn, file_name, compression=None):
+        opLabels = OpArrayPiper(graph=Graph())
+        opLabels.Input.setValue(labels)
+        opRaw = OpArrayPiper(graph=Graph())
+        opRaw.Input.setValue(raw)
+
+        export_file = ExportFile(os.path.join(self.tmpDir, file_name))
+        export_file.add_columns("table", table, Mode.NumpyStructArray)
+        add_rois_fn(export_file, Default.LabelRoiPath, opLabels.Output, "table", 2, "labeling")
+        add_rois_fn(export_file, Default.RawRoiPath, opRaw.Output, "table", 2)
+        export_file.write_all("h5", compression)
+        return export_file.file_name
+
+    def _assert_equal_files(self, expected_name, result_name):
+        with h5py.File(expected_name, "r") as expected, h5py.File(result_name, "r") as result:
+            assert set(expected["images"].keys()) == set(result["images"].keys())
+            for i in expected["images"].keys():
+                for name in ("labeling", "raw"):
+                    expected_dset = expected["images"][i][name]
+                    result_dset = result["images"][i][name]
+                    assert expected_dset.dtype == result_dset.dtype
+                    assert (expected_dset[()] == result_dset[()]).all(), \
+                        "Roi {}/{} differs".format(i, name)
+                    assert dict(expected_dset.attrs) == dict(result_dset.attrs)
+            assert (expected["table"][:] == result["table"][:]).all()
+
+    def testAgainstInMemory(self):
+        labels, table = synthetic_objects((2, 100, 80, 30, 1), 300, max_size=25)
+        raw = vigra.taggedView(np.random.RandomState(1).randint(0, 255, labels.shape).astype(np.uint8), "txyzc")
+
+        def add_rois(export_file, *args):
+            export_file.add_rois(*args, compression={"compression": "gzip"})
+        expected_name = self._export(labels, raw, table, add_rois_in_memory, "expected.h5")
+        result_name = self._export(labels, raw, table, add_rois, "result.h5", {"compression": "gzip"})
+        self._assert_equal_files(expected_name, result_name)
+
+        with h5py.File(result_name, "r") as result:
+            assert result["images/0/labeling"].compression == "gzip"
+
+    def testFileClosedOnError(self):
+        labels, table = synthetic_objects((1, 40, 40, 10, 1), 10)
+        opLabels = OpArrayPiper(graph=Graph())
+        opLabels.Input.setValue(labels)
+        opFailing = OpFailing(graph=Graph())
+        opFailing.Input.setValue(labels)
+
+        export_file = ExportFile(os.path.join(self.tmpDir, "result.h5"))
+        export_file.add_columns("table", table, Mode.NumpyStructArray)
+        export_file.add_rois(Default.LabelRoiPath, opLabels.Output, "table", 2, "labeling")
+        try:
+            export_file.add_rois(Default.RawRoiPath, opFailing.Output, "table", 2)
+        except ExpectedError:
+            pass
+        else:
+            assert False, "Expected an ExpectedError"
+
+        # The file has been closed (hdf5 can't truncate a file that is still open)
+        with h5py.File(export_file.file_name, "w"):
+            pass
+
+    def testGrouping(self):
+        shape = (2, 64, 64, 1, 1)
+        axistags = vigra.defaultAxistags("txyzc")
+        slicings = [([slice(0, 1), slice(1, 5), slice(2, 6), slice(0, 1), slice(None)], 1),
+                    ([slice(0, 1), slice(3, 9), slice(0, 4), slice(0, 1), slice(None)], 2),
+                    ([slice(0, 1), slice(20, 30), slice(0, 4), slice(0, 1), slice(None)], 3),
+                    ([slice(0, 1), slice(0, 60), slice(0, 4), slice(0, 1), slice(None)], 4),
+                    ([slice(1, 2), slice(1, 5), slice(2, 6), slice(0, 1), slice(None)], 1)]
+        groups = ExportFile._group_rois(axistags, shape, slicings)
+        assert [[roi[0] for roi in rois] for _, _, rois in groups] == [[0, 1], [2], [3], [4]]
+        start, stop, _ = groups[0]
+        assert tuple(start) == (0, 1, 0, 0, 0)
+        assert tuple(stop) == (1, 9, 6, 1, 1)
+
+class TestExportFileRoisBenchmarking(object):
+
+    @classmethod
+    def setupClass(cls):
+        # This test is useful for performance evaluation,
+        #  but it takes too long to be useful as part of the normal test suite.
+        raise nose.SkipTest
+
+    def testExportRois(self):
+        labels, table = synthetic_objects((5, 1000, 1000, 100, 1), 10000, max_size=30)
+        tmpDir = tempfile.mkdtemp()
+        try:
+            # (The grouped export runs first, since the peak memory of the process can only grow.)
+            for name in ("grouped", "in memory"):
+                opLabels = OpArrayPiper(graph=Graph())
+                opLabels.Input.setValue(labels)
+                export_file = ExportFile(os.path.join(tmpDir, name + ".h5"))
+                export_file.add_columns("table", table, Mode.NumpyStructArray)
+
+                start = time.time()
+                if name == "grouped":
+                    export_file.add_rois(Default.LabelRoiPath, opLabels.Output, "table", 2, "labeling")
+                else:
+                    add_rois_in_memory(export_file, Default.LabelRoiPath, opLabels.Output, "table", 2, "labeling")
+                export_file.write_all("h5")
+                logger.info("{}: {:.1f}s, peak memory {:.0f} MB".format(
+                    name, time.time() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+        finally:
+            shutil.rmtree(tmpDir)
+
+class TestExportFileFeatureTableBenchmarking(object):
+
+    @classmethod
+    def setupClass(cls):
+        # This test is useful for performance evaluation,
+        #  but it takes too long to be useful as part of the normal test suite.
+        raise nose.SkipTest
+
+    def testExportFrames(self):
+        obj_counts = [2000] * 1000
+        tmpDir = tempfile.mkdtemp()
+        try:
+            # (The streamed export runs first, since the peak memory of the process can only grow.)
+            for name in ("streamed", "in memory"):
+                opFeatures = OpSyntheticFeatures(graph=Graph())
+                opFeatures.ObjectCounts.setValue(obj_counts)
+                export_file = ExportFile(os.path.join(tmpDir, name + ".h5"))
+                export_file.add_columns("table", range(sum(obj_counts)), Mode.List, Default.KnimeId)
+
+                start = time.time()
+                if name == "streamed":
+                    export_file.add_columns("table", opFeatures.Output, Mode.IlastikFeatureTable,
+                                            {"selection": ["Mean", "Histogram"]})
+                else:
+                    export_file.add_columns("table", flatten_in_memory(opFeatures.Output, ["Mean", "Histogram"]),
+                                            Mode.NumpyStructArray)
+                export_file.write_all("h5")
+                logger.info("{}: {:.1f}s, peak memory {:.0f} MB".format(
+                    name, time.time() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+        finally:
+            shutil.rmtree(tmpDir)
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,221 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2016, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import os
+import time
+import tempfile
+import shutil
+
+import numpy
+import h5py
+import nose
+
+from ilastik.utility.labelMeshes import label_meshes, decimate_mesh, mesh_surface_area, write_obj, write_ply, \
+                                        _marching_cubes
+
+import logging
+logger = logging.getLogger(__name__)
+
+def box_area(shape):
+    """
+    The area of the marching cubes mesh of a box of the given shape (in voxels):
+    The faces lie half a voxel outside the voxel centers, and are connected by
+    chamfers along the edges and triangles at the corners.
+    """
+    a, b, c = numpy.array(shape) - 1
+    return 2 * (a*b + b*c + a*c) + 4 * (a + b + c) * numpy.sqrt(2) / 2 + numpy.sqrt(3)
+
+def random_balls(shape, num_labels, radius_range=(2, 10), seed=0):
+    """
+    A volume of (possibly overlapping) balls, labeled 1..num_labels.
+    """
+    rng = numpy.random.RandomState(seed)
+    volume = numpy.zeros(shape, dtype=numpy.uint32)
+    for label in range(1, num_labels + 1):
+        radius = rng.randint(*radius_range)
+        center = [rng.randint(0, s) for s in shape]
+        start = [max(c - radius, 0) for c in center]
+        stop = [min(c + radius + 1, s) for c, s in zip(center, shape)]
+        grid = numpy.ogrid[ tuple( slice(a, b) for a, b in zip(start, stop) ) ]
+        ball = sum( (g - c)**2 for g, c in zip(grid, center) ) <= radius**2
+        volume[ tuple( slice(a, b) for a, b in zip(start, stop) ) ][ball] = label
+    return volume
+
+def check_closed(vertices, faces, euler_characteristic):
+    """
+    Every edge of a closed (oriented) mesh is shared by exactly 2 faces, in opposite directions.
+    """
+    assert faces.min() >= 0 and faces.max() < len(vertices)
+    edges = numpy.concatenate( [faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [2, 0]]] )
+    forward = set(map(tuple, edges))
+    assert len(forward) == len(edges)
+    assert forward == set(map(tuple, edges[:, ::-1]))
+    assert len(vertices) - len(edges) // 2 + len(faces) == euler_characteristic
+
+class TestLabelMeshes(object):
+
+    def testBoxes(self):
+        volume = numpy.zeros((30, 40, 50), dtype=numpy.uint8)
+        volume[5:10, 10:25, 20:27] = 1
+        volume[0:10, 0:5, 40:50] = 2   # touches the volume border
+        volume[20, 20, 20] = 3
+
+        meshes = { label : (vertices, faces) for label, vertices, faces in label_meshes(volume, block_shape=(8, 16, 16)) }
+        assert sorted(meshes.keys()) == [1, 2, 3]
+        for label, start, stop in [ (1, (5, 10, 20), (10, 25, 27)),
+                                    (2, (0, 0, 40), (10, 5, 50)),
+                                    (3, (20, 20, 20), (21, 21, 21)) ]:
+            vertices, faces = meshes[label]
+            assert vertices.dtype == numpy.float32
+            check_closed(vertices, faces, 2)
+            assert numpy.allclose( vertices.min(axis=0), numpy.array(start) - 0.5 )
+            assert numpy.allclose( vertices.max(axis=0), numpy.array(stop) - 0.5 )
+            area = mesh_surface_area(vertices, faces)
+            assert numpy.isclose( area, box_area(numpy.array(stop) - start), rtol=1e-5 ), \
+                "label {}: {} != {}".format( label, area, box_area(numpy.array(stop) - start) )
+
+    def testSphere(self):
+        for radius in (5, 12):
+            grid = numpy.indices((40, 40, 40)) - 20
+            volume = ((grid**2).sum(axis=0) <= radius**2).astype(numpy.uint32) * 7
+            (label, vertices, faces), = list(label_meshes(volume))
+            assert label == 7
+            check_closed(vertices, faces, 2)
+            # The voxelized sphere is a bit bumpy
+            ratio = mesh_surface_area(vertices, faces) / (4 * numpy.pi * radius**2)
+            assert 1.0 < ratio < 1.12, ratio
+
+    def testTorus(self):
+        z, y, x = numpy.indices((20, 50, 50)) - numpy.array([10, 25, 25])[:, None, None, None]
+        volume = ( (numpy.sqrt(x**2 + y**2) - 15)**2 + z**2 <= 5**2 ).astype(numpy.uint8)
+        (_, vertices, faces), = list(label_meshes(volume))
+        check_closed(vertices, faces, 0)
+
+    def testSpacing(self):
+        volume = random_balls( (30, 30, 30), 5 )
+        spacing = (4.0, 1.0, 0.5)
+        plain = list(label_meshes(volume))
+        spaced = list(label_meshes(volume, spacing=spacing))
+        for (label, vertices, faces), (spaced_label, spaced_vertices, spaced_faces) in zip(plain, spaced):
+            assert label == spaced_label
+            assert (faces == spaced_faces).all()
+            assert numpy.allclose( vertices * spacing, spaced_vertices, atol=1e-4 )
+
+    def testHdf5(self):
+        volume = random_balls( (40, 30, 20), 10 )
+        tmpDir = tempfile.mkdtemp()
+        try:
+            with h5py.File(os.path.join(tmpDir, 'labels.h5'), 'w') as f:
+                dataset = f.create_dataset( 'labels', data=volume[None, ..., None], chunks=(1, 10, 10, 10, 1) )
+                meshes = list( label_meshes(dataset, labels=[3, 1, 1000, 5]) )
+        finally:
+            shutil.rmtree(tmpDir)
+
+        # Missing labels are skipped, the others are meshed in the given order
+        assert [label for label, _, _ in meshes] == [3, 1, 5]
+        for label, vertices, faces in meshes:
+            mask = (volume == label).astype(numpy.float32)
+            expected_vertices, expected_faces = _marching_cubes( numpy.pad(mask, 1, 'constant'), 0.5 )[:2]
+            assert numpy.isclose( mesh_surface_area(vertices, faces),
+                                  mesh_surface_area(expected_vertices, expected_faces), rtol=1e-5 )
+            assert numpy.allclose( vertices.min(axis=0), expected_vertices.min(axis=0) - 1, atol=1e-4 )
+
+    def testDecimation(self):
+        volume = numpy.zeros((50, 50, 50), dtype=numpy.uint8)
+        grid = numpy.indices(volume.shape) - 25
+        volume[(grid**2).sum(axis=0) <= 20**2] = 1
+        (_, vertices, faces), = list(label_meshes(volume))
+        (_, decimated_vertices, decimated_faces), = list(label_meshes(volume, decimation=3.0))
+
+        assert len(decimated_faces) < len(faces) / 5
+        assert decimated_faces.max() < len(decimated_vertices)
+        assert len(numpy.unique(decimated_faces)) == len(decimated_vertices)
+        assert numpy.isclose( mesh_surface_area(decimated_vertices, decimated_faces),
+                              mesh_surface_area(vertices, faces), rtol=0.1 )
+
+        # Cells smaller than the vertex spacing change nothing
+        same_vertices, same_faces = decimate_mesh(vertices, faces, 0.1)
+        assert len(same_vertices) == len(vertices)
+        assert len(same_faces) == len(faces)
+
+    def testWriters(self):
+        volume = numpy.zeros((5, 6, 7), dtype=numpy.uint8)
+        volume[1:4, 2:4, 3:6] = 1
+        (_, vertices, faces), = list(label_meshes(volume))
+
+        tmpDir = tempfile.mkdtemp()
+        try:
+            obj_path = os.path.join(tmpDir, 'mesh.obj')
+            write_obj(obj_path, vertices, faces)
+            with open(obj_path) as f:
+                lines = [line.split() for line in f]
+            assert numpy.allclose( [map(float, line[1:]) for line in lines if line[0] == 'v'], vertices, atol=1e-4 )
+            assert ( numpy.array([map(int, line[1:]) for line in lines if line[0] == 'f']) == faces + 1 ).all()
+
+            ply_path = os.path.join(tmpDir, 'mesh.ply')
+            write_ply(ply_path, vertices, faces)
+            with open(ply_path) as f:
+                lines = f.read().splitlines()
+            header_end = lines.index('end_header') + 1
+            assert "element vertex {}".format(len(vertices)) in lines[:header_end]
+            assert "element face {}".format(len(faces)) in lines[:header_end]
+            ply_faces = numpy.array( [map(int, line.split()) for line in lines[header_end + len(vertices):]] )
+            assert (ply_faces[:, 0] == 3).all()
+            assert (ply_faces[:, 1:] == faces).all()
+        finally:
+            shutil.rmtree(tmpDir)
+
+class TestLabelMeshesBenchmarking(object):
+    """
+    Meshing each object within its bounding box vs. meshing the object's mask in the whole volume
+    (as hdf5-to-mesh.py does for a single label).
+    """
+
+    @classmethod
+    def setupClass(cls):
+        # This test is useful for performance evaluation,
+        #  but it takes too long to be useful as part of the normal test suite.
+        raise nose.SkipTest
+
+    def testManyLabels(self):
+        volume = random_balls( (256, 256, 256), 1000, radius_range=(3, 15) )
+        num_labels = len(numpy.unique(volume)) - 1
+
+        start = time.time()
+        mesh_count = 0
+        face_count = 0
+        for label, vertices, faces in label_meshes(volume):
+            mesh_count += 1
+            face_count += len(faces)
+        logger.info( "label_meshes: {} meshes, {} faces in {:.1f}s".format( mesh_count, face_count, time.time() - start ) )
+
+        # Whole-volume masks take too long for all labels, extrapolate
+        start = time.time()
+        for label in range(1, 11):
+            _marching_cubes( (volume == label).astype(numpy.float32), 0.5 )
+        logger.info( "Whole-volume masks: {:.1f}s (extrapolated to {} labels)"
+                     .format( (time.time() - start) * num_labels / 10.0, num_labels ) )
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
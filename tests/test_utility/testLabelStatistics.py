@@ -0,0 +1,167 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2016, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import os
+import csv
+import time
+import tempfile
+import shutil
+
+import numpy
+import h5py
+import vigra
+import nose
+
+from lazyflow.request import Request
+from ilastik.utility.labelStatistics import label_statistics, write_csv, write_hdf5
+
+import logging
+logger = logging.getLogger(__name__)
+
+def random_labels(shape, num_labels, seed=0):
+    """
+    A volume of random labels in 1..num_labels (and some background), in small cubes.
+    """
+    rng = numpy.random.RandomState(seed)
+    coarse = rng.randint(0, num_labels + 1, size=[-(-s // 4) for s in shape])
+    volume = coarse
+    for axis in range(len(shape)):
+        volume = volume.repeat(4, axis=axis)
+    return volume[tuple(slice(0, s) for s in shape)].astype(numpy.uint32)
+
+def reference_statistics(volume, raw=None):
+    """
+    The statistics of each label, computed from the whole volume.
+    """
+    result = {}
+    for label in numpy.unique(volume):
+        coords = numpy.array(numpy.nonzero(volume == label))
+        stats = { 'count' : coords.shape[1],
+                  'start' : coords.min(axis=1),
+                  'stop' : coords.max(axis=1) + 1,
+                  'centroid' : coords.mean(axis=1) }
+        if raw is not None:
+            stats['intensity_sum'] = raw[volume == label].astype(numpy.float64).sum()
+        result[label] = stats
+    return result
+
+class TestLabelStatistics(object):
+
+    def _check(self, table, volume, axiskeys, raw=None, include_background=False):
+        expected = reference_statistics(volume, raw)
+        if not include_background:
+            expected.pop(0, None)
+        assert list(table['label']) == sorted(expected.keys())
+        for row in table:
+            stats = expected[row['label']]
+            assert row['count'] == stats['count']
+            for axis, key in enumerate(axiskeys):
+                assert row['bbox_start_' + key] == stats['start'][axis]
+                assert row['bbox_stop_' + key] == stats['stop'][axis]
+                assert numpy.isclose( row['centroid_' + key], stats['centroid'][axis] )
+            if raw is not None:
+                assert numpy.isclose( row['intensity_sum'], stats['intensity_sum'] )
+                assert numpy.isclose( row['intensity_mean'], stats['intensity_sum'] / stats['count'] )
+
+    def testAgainstNumpy(self):
+        volume = random_labels( (37, 45, 23), 30 )
+        for block_shape in [(10, 16, 7), (37, 45, 23), (64, 64, 64)]:
+            table = label_statistics( volume, block_shape=block_shape )
+            assert table.dtype.names[:2] == ('label', 'count')
+            self._check(table, volume, '012')
+
+    def testRaw(self):
+        volume = random_labels( (40, 30, 20), 50 )
+        raw = numpy.random.RandomState(1).randint(0, 256, size=volume.shape).astype(numpy.uint8)
+        table = label_statistics( volume, raw, block_shape=(16, 16, 16), axiskeys='zyx', include_background=True )
+        assert table['label'][0] == 0
+        self._check(table, volume, 'zyx', raw, include_background=True)
+
+    def test2D(self):
+        volume = random_labels( (100, 70), 20 )
+        table = label_statistics( volume, block_shape=(32, 32), axiskeys='yx' )
+        self._check(table, volume, 'yx')
+
+    def testHdf5(self):
+        volume = random_labels( (1, 30, 40, 25, 1), 40 )
+        raw = numpy.random.RandomState(1).random_sample(volume.shape).astype(numpy.float32)
+        tmpDir = tempfile.mkdtemp()
+        try:
+            with h5py.File(os.path.join(tmpDir, 'volumes.h5'), 'w') as f:
+                labels_dataset = f.create_dataset( 'labels', data=volume, chunks=(1, 10, 10, 10, 1) )
+                labels_dataset.attrs['axistags'] = vigra.defaultAxistags('tzyxc').toJSON()
+                raw_dataset = f.create_dataset( 'raw', data=raw, chunks=(1, 16, 16, 16, 1) )
+                table = label_statistics( labels_dataset, raw_dataset )
+                self._check(table, volume, 'tzyxc', raw)
+
+                # Write the results
+                write_hdf5(table, f, 'statistics')
+                write_hdf5(table, f, 'statistics')
+                assert (f['statistics'][:] == table).all()
+
+                csv_path = os.path.join(tmpDir, 'statistics.csv')
+                write_csv(table, csv_path)
+                with open(csv_path) as csv_file:
+                    rows = list(csv.reader(csv_file))
+                assert tuple(rows[0]) == table.dtype.names
+                assert len(rows) == len(table) + 1
+                assert [int(row[0]) for row in rows[1:]] == list(table['label'])
+                assert numpy.allclose( [float(row[-1]) for row in rows[1:]], table['intensity_mean'] )
+        finally:
+            shutil.rmtree(tmpDir)
+
+class TestLabelStatisticsBenchmarking(object):
+    """
+    Thread scaling of label_statistics.
+    """
+
+    @classmethod
+    def setupClass(cls):
+        # This test is useful for performance evaluation,
+        #  but it takes too long to be useful as part of the normal test suite.
+        raise nose.SkipTest
+
+    def testThreadScaling(self):
+        volume = random_labels( (512, 512, 512), 100000 )
+        raw = numpy.random.RandomState(1).randint(0, 256, size=volume.shape).astype(numpy.uint8)
+        tmpDir = tempfile.mkdtemp()
+        try:
+            with h5py.File(os.path.join(tmpDir, 'volumes.h5'), 'w') as f:
+                labels_dataset = f.create_dataset( 'labels', data=volume, chunks=(64, 64, 64) )
+                raw_dataset = f.create_dataset( 'raw', data=raw, chunks=(64, 64, 64) )
+                del volume, raw
+                previous_num_threads = Request.global_thread_pool.num_workers
+                try:
+                    for num_threads in (1, 2, 4, 8):
+                        Request.reset_thread_pool(num_threads)
+                        start = time.time()
+                        label_statistics( labels_dataset, raw_dataset )
+                        logger.info("{} threads: {:.2f}s".format(num_threads, time.time() - start))
+                finally:
+                    Request.reset_thread_pool(previous_num_threads)
+        finally:
+            shutil.rmtree(tmpDir)
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
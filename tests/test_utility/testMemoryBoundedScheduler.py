@@ -0,0 +1,112 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2016, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import time
+import random
+import functools
+import threading
+
+from lazyflow.request import Request
+from ilastik.utility import MemoryBoundedScheduler
+
+class UsageRecorder(object):
+    """
+    Jobs that record how much (estimated) memory is in use while they run.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.used = 0
+        self.peak = 0
+        self.started = []
+
+    def job(self, nbytes):
+        with self.lock:
+            self.used += nbytes
+            self.peak = max(self.peak, self.used)
+            self.started.append(nbytes)
+        time.sleep(0.001 * random.random())
+        with self.lock:
+            self.used -= nbytes
+
+    def jobs(self, sizes):
+        return [(nbytes, functools.partial(self.job, nbytes)) for nbytes in sizes]
+
+class TestMemoryBoundedScheduler(object):
+
+    def testBudget(self):
+        random.seed(0)
+        sizes = [random.choice([1, 2, 5, 10, 50]) for _ in range(200)]
+        recorder = UsageRecorder()
+        scheduler = MemoryBoundedScheduler(budget_bytes=60)
+        scheduler.run(recorder.jobs(sizes))
+
+        assert sorted(recorder.started) == sorted(sizes)
+        assert recorder.peak <= 60
+        assert scheduler.peak_bytes <= 60
+        # the largest jobs are started first
+        assert recorder.started[0] == 50
+
+    def testOversizedJob(self):
+        recorder = UsageRecorder()
+        scheduler = MemoryBoundedScheduler(budget_bytes=10)
+        scheduler.run(recorder.jobs([3, 100, 4, 5, 20]))
+
+        assert sorted(recorder.started) == [3, 4, 5, 20, 100]
+        # jobs that don't fit into the budget run alone
+        assert recorder.peak == 100
+        assert recorder.started[:2] == [100, 20]
+
+    def testNoJobs(self):
+        MemoryBoundedScheduler(budget_bytes=10).run([])
+
+    def testFailure(self):
+        def fail():
+            raise ValueError("job failed")
+        recorder = UsageRecorder()
+        jobs = recorder.jobs([1, 2, 3]) + [(2, fail)]
+        try:
+            MemoryBoundedScheduler(budget_bytes=3).run(jobs)
+        except ValueError:
+            pass
+        else:
+            assert False, "Expected the job's exception"
+
+    def testCancelledJob(self):
+        # The budget of a cancelled job must be released, or run() would wait for it forever.
+        def cancel():
+            Request._current_request().cancel()
+            Request.raise_if_cancelled()
+        recorder = UsageRecorder()
+        scheduler = MemoryBoundedScheduler(budget_bytes=3)
+        try:
+            scheduler.run( [(3, cancel)] + recorder.jobs([1, 2]) )
+        except Request.CancellationException:
+            pass
+        else:
+            assert False, "Expected a CancellationException"
+        # No more jobs are started after the cancellation
+        assert recorder.started == []
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)